@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+camcops_server/alembic/versions/0048_blob_store.py
+
+===============================================================================
+
+    Copyright (C) 2012-2020 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CamCOPS.
+
+    CamCOPS is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CamCOPS is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CamCOPS. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+DATABASE REVISION SCRIPT
+
+blob_store
+
+Adds ``_blob_sha256`` and ``_blob_size`` to the ``blobs`` table, referring to
+content held in the optional content-addressed BLOB store, and the
+``_blob_contents`` table used by the ``table`` BLOB store. Existing BLOBs are
+not moved; see ``camcops_server migrate_blobs``.
+
+Revision ID: 0048
+Revises: 0047
+Creation date: 2026-10-17 14:05:12.310944
+
+"""
+
+# =============================================================================
+# Imports
+# =============================================================================
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# =============================================================================
+# Revision identifiers, used by Alembic.
+# =============================================================================
+
+revision = '0048'
+down_revision = '0047'
+branch_labels = None
+depends_on = None
+
+
+# =============================================================================
+# The upgrade/downgrade steps
+# =============================================================================
+
+# noinspection PyPep8,PyTypeChecker
+def upgrade():
+    with op.batch_alter_table('blobs', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('_blob_sha256', sa.String(length=64), nullable=True, comment="(SERVER) SHA-256 digest of the BLOB, if its content is held in the BLOB store rather than in theblob"))
+        batch_op.add_column(sa.Column('_blob_size', sa.BigInteger(), nullable=True, comment="(SERVER) Size of the BLOB (bytes), if its content is held in the BLOB store rather than in theblob"))
+        batch_op.create_index(batch_op.f('ix_blobs__blob_sha256'), ['_blob_sha256'], unique=False)
+
+    op.create_table(
+        '_blob_contents',
+        sa.Column('sha256', sa.String(length=64), nullable=False, comment='SHA-256 digest of the content (lower-case hex)'),
+        sa.Column('size', sa.BigInteger(), nullable=False, comment='Size of the content (bytes)'),
+        sa.Column('content', sa.LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'), nullable=True, comment='The content itself'),
+        sa.Column('when_stored_utc', sa.DateTime(), nullable=False, comment='Date/time this content was last stored (UTC)'),
+        sa.PrimaryKeyConstraint('sha256', name=op.f('pk__blob_contents')),
+        mysql_charset='utf8mb4 COLLATE utf8mb4_unicode_ci',
+        mysql_engine='InnoDB',
+        mysql_row_format='DYNAMIC'
+    )
+    with op.batch_alter_table('_blob_contents', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix__blob_contents_when_stored_utc'), ['when_stored_utc'], unique=False)
+
+
+# noinspection PyPep8,PyTypeChecker
+def downgrade():
+    with op.batch_alter_table('_blob_contents', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix__blob_contents_when_stored_utc'))
+
+    op.drop_table('_blob_contents')
+
+    with op.batch_alter_table('blobs', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_blobs__blob_sha256'))
+        batch_op.drop_column('_blob_size')
+        batch_op.drop_column('_blob_sha256')
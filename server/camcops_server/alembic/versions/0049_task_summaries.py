@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+camcops_server/alembic/versions/0049_task_summaries.py
+
+===============================================================================
+
+    Copyright (C) 2012-2020 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CamCOPS.
+
+    CamCOPS is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CamCOPS is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CamCOPS. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+DATABASE REVISION SCRIPT
+
+task_summaries
+
+Adds the ``_task_summaries`` table, which stores task summary values
+calculated at upload. Existing tasks are not summarized; see
+``camcops_server rebuild_summaries``.
+
+Revision ID: 0049
+Revises: 0048
+Creation date: 2026-10-17 16:42:08.517203
+
+"""
+
+# =============================================================================
+# Imports
+# =============================================================================
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# =============================================================================
+# Revision identifiers, used by Alembic.
+# =============================================================================
+
+revision = '0049'
+down_revision = '0048'
+branch_labels = None
+depends_on = None
+
+
+# =============================================================================
+# The upgrade/downgrade steps
+# =============================================================================
+
+# noinspection PyPep8,PyTypeChecker
+def upgrade():
+    op.create_table(
+        '_task_summaries',
+        sa.Column('task_table_name', sa.String(length=128), nullable=False, comment="Table name of the task's base table"),
+        sa.Column('task_pk', sa.Integer(), autoincrement=False, nullable=False, comment='Server primary key of the task'),
+        sa.Column('summarized_at_utc', sa.DateTime(), nullable=False, comment='When these summaries were calculated'),
+        sa.Column('summaries', sa.UnicodeText(), nullable=False, comment='Summary values, as a JSON object mapping summary names to values'),
+        sa.Column('has_all_values', sa.Boolean(), nullable=False, comment="Are all the task's summary values stored? (Text values, which may be language-dependent, are not.)"),
+        sa.PrimaryKeyConstraint('task_table_name', 'task_pk', name=op.f('pk__task_summaries')),
+        mysql_charset='utf8mb4 COLLATE utf8mb4_unicode_ci',
+        mysql_engine='InnoDB',
+        mysql_row_format='DYNAMIC'
+    )
+
+
+# noinspection PyPep8,PyTypeChecker
+def downgrade():
+    op.drop_table('_task_summaries')
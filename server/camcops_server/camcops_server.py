@@ -232,7 +232,9 @@ def _merge_camcops_db(src: str,
                       default_group_id: Optional[int],
                       default_group_name: Optional[str],
                       groupnum_map: Dict[int, int],
-                      whichidnum_map: Dict[int, int]) -> None:
+                      whichidnum_map: Dict[int, int],
+                      batched: bool,
+                      chunk_size: int) -> None:
     # noinspection PyUnresolvedReferences
     import camcops_server.camcops_server_core  # delayed import; import side effects  # noqa
     from camcops_server.cc_modules.merge_db import merge_camcops_db  # delayed import  # noqa
@@ -246,7 +248,9 @@ def _merge_camcops_db(src: str,
                      default_group_id=default_group_id,
                      default_group_name=default_group_name,
                      groupnum_map=groupnum_map,
-                     whichidnum_map=whichidnum_map)
+                     whichidnum_map=whichidnum_map,
+                     batched=batched,
+                     chunk_size=chunk_size)
 
 
 def _get_all_ddl(dialect_name: str = SqlaDialectName.MYSQL) -> str:
@@ -256,9 +260,21 @@ def _get_all_ddl(dialect_name: str = SqlaDialectName.MYSQL) -> str:
     return get_all_ddl(dialect_name=dialect_name)
 
 
-def _reindex(cfg: CamcopsConfig) -> None:
+def _reindex(cfg: CamcopsConfig, nprocesses: int = 1) -> None:
     import camcops_server.camcops_server_core as core  # delayed import; import side effects  # noqa
-    core.reindex(cfg=cfg)
+    core.reindex(cfg=cfg, nprocesses=nprocesses)
+
+
+def _rebuild_summaries() -> None:
+    import camcops_server.camcops_server_core as core  # delayed import; import side effects  # noqa
+    core.cmd_rebuild_summaries()
+
+
+def _migrate_blobs(cfg: CamcopsConfig,
+                   reverse: bool = False,
+                   chunk_size: int = 100) -> bool:
+    import camcops_server.camcops_server_core as core  # delayed import; import side effects  # noqa
+    return core.migrate_blobs(cfg=cfg, reverse=reverse, chunk_size=chunk_size)
 
 
 def _check_index(cfg: CamcopsConfig,
@@ -799,6 +815,15 @@ def camcops_main() -> int:
         '--default_group_name', type=str, default=None,
         help="If default_group_id is not specified, use this group name. The "
              "group will be looked up if it exists, and created if not.")
+    mergedb_parser.add_argument(
+        '--batched', action="store_true",
+        help="Merge in batches via SQLAlchemy Core, rather than record by "
+             "record via the ORM (much faster for large databases). Nothing "
+             "else should write to the destination database meanwhile.")
+    mergedb_parser.add_argument(
+        '--chunk_size', type=int, default=1000,
+        help="For batched merges: number of records to read and write at "
+             "once")
     add_req_named(
         mergedb_parser,
         "--src",
@@ -831,6 +856,8 @@ def camcops_main() -> int:
         default_group_name=args.default_group_name,
         whichidnum_map=args.whichidnum_map,
         groupnum_map=args.groupnum_map,
+        batched=args.batched,
+        chunk_size=args.chunk_size,
     ))
     # WATCH OUT. There appears to be a bug somewhere in the way that the
     # Pyramid debug toolbar registers itself with SQLAlchemy (see
@@ -884,9 +911,48 @@ def camcops_main() -> int:
         subparsers, "reindex",
         help="Recreate task index"
     )
+    reindex_parser.add_argument(
+        "--processes", type=int, default=1,
+        help="Number of parallel processes to use for the task index"
+    )
     reindex_parser.set_defaults(
         func=lambda args: _reindex(
-            cfg=get_default_config_from_os_env()
+            cfg=get_default_config_from_os_env(),
+            nprocesses=args.processes
+        )
+    )
+
+    # Recalculate stored task summaries
+    rebuild_summaries_parser = add_sub(
+        subparsers, "rebuild_summaries",
+        help="Recalculate the stored summary values (e.g. scores) of all "
+             "tasks, as used by dumps and reports (run this after changing "
+             "a task's scoring code)"
+    )
+    rebuild_summaries_parser.set_defaults(
+        func=lambda args: _rebuild_summaries()
+    )
+
+    # Move BLOBs to/from the BLOB store
+    migrate_blobs_parser = add_sub(
+        subparsers, "migrate_blobs",
+        help="Move existing BLOB content into the BLOB store configured by "
+             "BLOB_STORE_BACKEND (or back into the database table)"
+    )
+    migrate_blobs_parser.add_argument(
+        "--reverse", action="store_true",
+        help="Move BLOB content out of the BLOB store, back into the 'blobs' "
+             "table (e.g. before switching the BLOB store off)"
+    )
+    migrate_blobs_parser.add_argument(
+        "--chunk_size", type=int, default=100,
+        help="Number of BLOBs to move per database transaction"
+    )
+    migrate_blobs_parser.set_defaults(
+        func=lambda args: _migrate_blobs(
+            cfg=get_default_config_from_os_env(),
+            reverse=args.reverse,
+            chunk_size=args.chunk_size
         )
     )
 
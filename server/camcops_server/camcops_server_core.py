@@ -82,6 +82,11 @@ from camcops_server.cc_modules.cc_anon import (  # noqa: E402
 )
 # noinspection PyUnresolvedReferences
 import camcops_server.cc_modules.client_api  # import side effects (register unit test)  # noqa: E402,E501,F401
+from camcops_server.cc_modules.cc_blob import (  # noqa: E402
+    DEFAULT_BLOB_MIGRATION_CHUNK_SIZE,
+    migrate_blobs as migrate_blobs_to_or_from_store,
+)
+from camcops_server.cc_modules.cc_blobstore import get_blob_store  # noqa: E402,E501
 from camcops_server.cc_modules.cc_config import (  # noqa: E402
     CamcopsConfig,
     get_config_filename_from_os_env,
@@ -111,6 +116,7 @@ from camcops_server.cc_modules.cc_taskindex import (  # noqa: E402
     check_indexes,
     reindex_everything,
 )
+from camcops_server.cc_modules.cc_tasksummary import rebuild_summaries  # noqa: E402,E501
 # noinspection PyUnresolvedReferences
 from camcops_server.cc_modules.cc_tracker import TrackerCtvTests  # import side effects (register unit test)  # noqa: E402,F401,E501
 from camcops_server.cc_modules.cc_unittest import (  # noqa: E402
@@ -169,6 +175,8 @@ def ensure_database_is_ok() -> None:
 def ensure_directories_exist() -> None:
     config = get_default_config_from_os_env()
     mkdir_p(config.export_lockdir)
+    if config.export_staging_dir:
+        mkdir_p(config.export_staging_dir)
     if config.user_download_dir:
         mkdir_p(config.user_download_dir)
 
@@ -763,16 +771,27 @@ def show_database_schema(schemastem: str,
         subprocess.check_call(cmd)
 
 
-def reindex(cfg: CamcopsConfig) -> None:
+def reindex(cfg: CamcopsConfig, nprocesses: int = 1) -> None:
     """
     Drops and regenerates the server task index.
 
     Args:
         cfg: a :class:`camcops_server.cc_modules.cc_config.CamcopsConfig`
+        nprocesses: number of processes to use for the task index
     """
     ensure_database_is_ok()
     with cfg.get_dbsession_context() as dbsession:
-        reindex_everything(dbsession)
+        reindex_everything(dbsession, nprocesses=nprocesses)
+
+
+def cmd_rebuild_summaries() -> None:
+    """
+    Recalculates all stored task summaries (e.g. after a change to a task's
+    scoring code).
+    """
+    ensure_database_is_ok()
+    with command_line_request_context() as req:
+        rebuild_summaries(req)
 
 
 def check_index(cfg: CamcopsConfig, show_all_bad: bool = False) -> bool:
@@ -797,6 +816,33 @@ def check_index(cfg: CamcopsConfig, show_all_bad: bool = False) -> bool:
     return ok
 
 
+def migrate_blobs(cfg: CamcopsConfig,
+                  reverse: bool = False,
+                  chunk_size: int = DEFAULT_BLOB_MIGRATION_CHUNK_SIZE) -> bool:
+    """
+    Moves existing BLOB content into the configured BLOB store (or, with
+    ``reverse``, back into the ``blobs`` table).
+
+    Args:
+        cfg: a :class:`camcops_server.cc_modules.cc_config.CamcopsConfig`
+        reverse: move content out of the store, not into it?
+        chunk_size: number of BLOBs to move per transaction
+
+    Returns:
+        success?
+    """
+    store = get_blob_store()
+    if store is None:
+        log.critical("No BLOB store is configured; see the "
+                     "BLOB_STORE_BACKEND config parameter.")
+        return False
+    ensure_database_is_ok()
+    with cfg.get_dbsession_context() as dbsession:
+        migrate_blobs_to_or_from_store(dbsession, store, reverse=reverse,
+                                       chunk_size=chunk_size)
+    return True
+
+
 def add_dummy_data(cfg: CamcopsConfig,
                    confirm_add_dummy_data: bool = False) -> None:
     if not confirm_add_dummy_data:
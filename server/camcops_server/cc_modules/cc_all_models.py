@@ -85,6 +85,7 @@ from camcops_server.cc_modules.cc_taskindex import (
     PatientIdNumIndexEntry,
     TaskIndexEntry,
 )
+from camcops_server.cc_modules.cc_tasksummary import TaskSummaryEntry
 from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
 from camcops_server.cc_modules.cc_user import (
     SecurityAccountLockout,
@@ -155,6 +156,7 @@ RESERVED_TABLE_NAMES = [
     SpecialNote.__tablename__,
     TaskFilter.__tablename__,
     TaskIndexEntry.__tablename__,
+    TaskSummaryEntry.__tablename__,
     User.__tablename__,
     UserGroupMembership.__tablename__,
 ]
@@ -28,11 +28,22 @@ camcops_server/cc_modules/cc_audit.py
 
 The Big Brother part.
 
+Audit entries are not added to the ORM session one by one. Instead, they are
+collected by an :class:`AuditBuffer` attached to the database session, and
+written with a single multi-row INSERT just before that session commits (or
+discarded if it rolls back).
+
 """
 
-from typing import TYPE_CHECKING
+from collections import OrderedDict
+import logging
+from typing import Any, Dict, Iterable, List, Tuple, TYPE_CHECKING
+from unittest import mock
 
+from cardinal_pythonlib.logs import BraceStyleAdapter
+from sqlalchemy import event
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.session import Session as SqlASession
 from sqlalchemy.sql.schema import Column, ForeignKey
 from sqlalchemy.sql.sqltypes import DateTime, Integer, UnicodeText
 
@@ -42,12 +53,17 @@ from camcops_server.cc_modules.cc_sqla_coltypes import (
     TableNameColType,
 )
 from camcops_server.cc_modules.cc_sqlalchemy import Base
+from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
 
 if TYPE_CHECKING:
     from camcops_server.cc_modules.cc_request import CamcopsRequest
+    from camcops_server.cc_modules.cc_task import Task
+
+log = BraceStyleAdapter(logging.getLogger(__name__))
 
 
 MAX_AUDIT_STRING_LENGTH = 65000
+AUDIT_BUFFER_SESSION_INFO_KEY = "camcops_audit_buffer"
 
 
 # =============================================================================
@@ -109,6 +125,143 @@ class AuditEntry(Base):
     # See MAX_AUDIT_STRING_LENGTH above.
 
 
+# =============================================================================
+# Writing audit entries
+# =============================================================================
+
+def write_audit_rows(dbsession: SqlASession,
+                     rows: List[Dict[str, Any]]) -> None:
+    """
+    Writes audit entries (as dictionaries mapping column names to values)
+    directly, with a single multi-row INSERT. Used by the backend for entries
+    deferred by an :class:`AuditBuffer`.
+    """
+    if rows:
+        dbsession.execute(AuditEntry.__table__.insert(), rows)
+
+
+# =============================================================================
+# AuditBuffer
+# =============================================================================
+
+class AuditBuffer(object):
+    """
+    Collects audit entries for one SQLAlchemy session, and writes them all
+    with a single multi-row (Core) INSERT just before the session commits.
+    Entries are discarded if the session rolls back, just as they would be if
+    they had been added to the session as ORM objects.
+
+    Rows marked as ``deferrable`` (see :meth:`add`) are instead handed to the
+    Celery backend once the COMMIT has succeeded (see :meth:`send_deferred`),
+    so that the request doesn't wait for them to be written.
+
+    Use :func:`get_audit_buffer` to fetch the buffer for a session.
+    """
+    def __init__(self, dbsession: SqlASession) -> None:
+        """
+        Args:
+            dbsession: the SQLAlchemy session to buffer for
+        """
+        self.dbsession = dbsession
+        self.rows = []  # type: List[Dict[str, Any]]
+        self.deferred_rows = []  # type: List[Dict[str, Any]]
+        self.committed_deferred_rows = []  # type: List[Dict[str, Any]]
+        event.listen(dbsession, "before_commit", self._before_commit)
+        event.listen(dbsession, "after_commit", self._after_commit)
+        event.listen(dbsession, "after_rollback", self._after_rollback)
+
+    def add(self, row: Dict[str, Any], deferrable: bool = False) -> None:
+        """
+        Adds an entry.
+
+        Args:
+            row: dictionary mapping :class:`AuditEntry` column names to values
+            deferrable: may this entry be written asynchronously, after the
+                COMMIT, by the Celery backend?
+        """
+        if deferrable:
+            self.deferred_rows.append(row)
+        else:
+            self.rows.append(row)
+
+    def flush(self) -> None:
+        """
+        Writes all non-deferred entries to the database (within the session's
+        current transaction).
+        """
+        if not self.rows:
+            return
+        rows = self.rows
+        self.rows = []
+        write_audit_rows(self.dbsession, rows)
+
+    def send_deferred(self) -> None:
+        """
+        Sends deferred entries whose request work has been committed to the
+        Celery backend. If that fails (e.g. the broker is down), writes them
+        directly instead, and COMMITs.
+
+        Called after the COMMIT (when SQLAlchemy won't let us emit SQL from
+        within its own session events).
+        """
+        if not self.committed_deferred_rows:
+            return
+        rows = self.committed_deferred_rows
+        self.committed_deferred_rows = []
+        from camcops_server.cc_modules.celery import write_audit_entries  # delayed import  # noqa
+        try:
+            write_audit_entries.delay(rows)
+        except Exception as exc:
+            log.warning("Unable to send {} audit entries to backend; writing "
+                        "them directly: {!r}", len(rows), exc)
+            write_audit_rows(self.dbsession, rows)
+            self.dbsession.commit()
+
+    def _before_commit(self, session: SqlASession) -> None:
+        """
+        SQLAlchemy session event: about to COMMIT.
+        """
+        self.flush()
+
+    def _after_commit(self, session: SqlASession) -> None:
+        """
+        SQLAlchemy session event: COMMIT succeeded. Deferred entries may now
+        be sent.
+        """
+        self.committed_deferred_rows.extend(self.deferred_rows)
+        self.deferred_rows = []
+
+    def _after_rollback(self, session: SqlASession) -> None:
+        """
+        SQLAlchemy session event: ROLLBACK. Discards all uncommitted entries.
+        """
+        self.rows = []
+        self.deferred_rows = []
+
+
+def get_audit_buffer(dbsession: SqlASession) -> AuditBuffer:
+    """
+    Returns the :class:`AuditBuffer` for the specified session, creating it if
+    necessary.
+    """
+    buffer = dbsession.info.get(AUDIT_BUFFER_SESSION_INFO_KEY)
+    if buffer is None:
+        buffer = AuditBuffer(dbsession)
+        dbsession.info[AUDIT_BUFFER_SESSION_INFO_KEY] = buffer
+    return buffer
+
+
+def send_deferred_audit_entries(dbsession: SqlASession) -> None:
+    """
+    Sends any deferred (committed) audit entries for this session to the
+    backend; see :meth:`AuditBuffer.send_deferred`. Call this after the
+    COMMIT.
+    """
+    buffer = dbsession.info.get(AUDIT_BUFFER_SESSION_INFO_KEY)
+    if buffer is not None:
+        buffer.send_deferred()
+
+
 # =============================================================================
 # Audit function
 # =============================================================================
@@ -125,8 +278,13 @@ def audit(req: "CamcopsRequest",
           from_dbclient: bool = False) -> None:
     """
     Write an entry to the audit log.
+
+    The entry is buffered, and written when the request's database session
+    commits; see :class:`AuditBuffer`. If the config file's
+    ``AUDIT_ASYNC_CLIENT_API`` setting is on, entries from the client API
+    (``from_dbclient``) are written asynchronously by the backend after the
+    COMMIT.
     """
-    dbsession = req.dbsession
     if not remote_addr:
         remote_addr = req.remote_addr if req else None
     if user_id is None:
@@ -140,8 +298,7 @@ def audit(req: "CamcopsRequest",
     now = req.now_utc
     if details and len(details) > MAX_AUDIT_STRING_LENGTH:
         details = details[:MAX_AUDIT_STRING_LENGTH]
-    # noinspection PyTypeChecker
-    entry = AuditEntry(
+    row = dict(
         when_access_utc=now,
         source=source,
         remote_addr=remote_addr,
@@ -152,4 +309,188 @@ def audit(req: "CamcopsRequest",
         patient_server_pk=patient_server_pk,
         details=details
     )
-    dbsession.add(entry)
+    deferrable = from_dbclient and req.config.audit_async_client_api
+    get_audit_buffer(req.dbsession).add(row, deferrable=deferrable)
+
+
+def aggregate_task_access(
+        tasks: Iterable["Task"]) -> List[Tuple[str, int, List[int]]]:
+    """
+    Groups tasks for an aggregated audit entry.
+
+    Args:
+        tasks: the tasks
+
+    Returns:
+        a list of ``tablename, patient_server_pk, task_pks`` tuples, in order
+        of first appearance
+    """
+    groups = OrderedDict()  # type: Dict[Tuple[str, int], List[int]]
+    for task in tasks:
+        key = (task.tablename, task.get_patient_server_pk())
+        groups.setdefault(key, []).append(task.get_pk())
+    return [(tablename, patient_server_pk, pks)
+            for (tablename, patient_server_pk), pks in groups.items()]
+
+
+def audit_task_access(req: "CamcopsRequest",
+                      details: str,
+                      tasks: Iterable["Task"]) -> None:
+    """
+    Audits access to several tasks (e.g. for a tracker or clinical text view).
+
+    Normally, this writes one audit entry per task. If the config file's
+    ``AUDIT_AGGREGATE_TASK_ACCESS`` setting is on, it writes a single entry
+    per task table and patient, like "Tracker data accessed: 3 tasks
+    accessed: phq9 server PKs 7, 9, 12".
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        details: details of the access
+        tasks: the tasks accessed
+    """
+    if not req.config.audit_aggregate_task_access:
+        for task in tasks:
+            audit(req,
+                  details,
+                  table=task.tablename,
+                  server_pk=task.get_pk(),
+                  patient_server_pk=task.get_patient_server_pk())
+        return
+    for tablename, patient_server_pk, pks in aggregate_task_access(tasks):
+        if len(pks) == 1:
+            audit(req,
+                  details,
+                  table=tablename,
+                  server_pk=pks[0],
+                  patient_server_pk=patient_server_pk)
+        else:
+            pk_str = ", ".join(str(pk) for pk in pks)
+            audit(req,
+                  f"{details}: {len(pks)} tasks accessed: "
+                  f"{tablename} server PKs {pk_str}",
+                  table=tablename,
+                  patient_server_pk=patient_server_pk)
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class AuditTests(DemoDatabaseTestCase):
+    """
+    Unit tests.
+    """
+    def _entries(self, details_prefix: str) -> List[AuditEntry]:
+        return (
+            self.dbsession.query(AuditEntry)
+            .filter(AuditEntry.details.startswith(details_prefix))
+            .order_by(AuditEntry.id)
+            .all()
+        )
+
+    def test_audit_written_at_commit(self) -> None:
+        audit(self.req, "Buffered entry 1")
+        audit(self.req, "Buffered entry 2", table="phq9", server_pk=1)
+        self.assertEqual(len(self._entries("Buffered entry")), 0)
+        self.dbsession.commit()
+        entries = self._entries("Buffered entry")
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[1].table_name, "phq9")
+        self.assertEqual(entries[1].server_pk, 1)
+
+    def test_audit_task_access(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        patient = self.create_patient_with_one_idnum()
+        tasks = []
+        for i in range(3):
+            task = Phq9()
+            task.id = i + 1
+            self.apply_standard_task_fields(task)
+            task.patient_id = patient.id
+            self.dbsession.add(task)
+            tasks.append(task)
+        self.dbsession.flush()
+
+        self.req.config.audit_aggregate_task_access = False
+        audit_task_access(self.req, "Individual access", tasks)
+        self.req.config.audit_aggregate_task_access = True
+        try:
+            audit_task_access(self.req, "Aggregated access", tasks)
+        finally:
+            self.req.config.audit_aggregate_task_access = False
+        self.dbsession.commit()
+
+        self.assertEqual(len(self._entries("Individual access")), 3)
+        aggregated = self._entries("Aggregated access")
+        self.assertEqual(len(aggregated), 1)
+        entry = aggregated[0]
+        self.assertEqual(entry.table_name, "phq9")
+        self.assertIsNone(entry.server_pk)
+        self.assertEqual(entry.patient_server_pk,
+                         tasks[0].get_patient_server_pk())
+        pk_str = ", ".join(str(t.get_pk()) for t in tasks)
+        self.assertEqual(
+            entry.details,
+            f"Aggregated access: 3 tasks accessed: phq9 server PKs {pk_str}")
+
+    def test_rollback_discards_entries(self) -> None:
+        self.req.config.audit_async_client_api = True
+        try:
+            audit(self.req, "Rolled back entry")
+            audit(self.req, "Rolled back entry (client)", from_dbclient=True)
+        finally:
+            self.req.config.audit_async_client_api = False
+        buffer = get_audit_buffer(self.dbsession)
+        self.assertEqual(len(buffer.rows), 1)
+        self.assertEqual(len(buffer.deferred_rows), 1)
+        self.dbsession.rollback()
+        self.assertEqual(buffer.rows, [])
+        self.assertEqual(buffer.deferred_rows, [])
+        self.dbsession.commit()
+        self.assertEqual(buffer.committed_deferred_rows, [])
+        self.assertEqual(len(self._entries("Rolled back entry")), 0)
+
+    def test_async_client_api_entries_deferred(self) -> None:
+        from camcops_server.cc_modules.celery import write_audit_entries
+        self.req.config.audit_async_client_api = True
+        try:
+            audit(self.req, "Deferred entry", from_dbclient=True)
+            audit(self.req, "Immediate entry")
+        finally:
+            self.req.config.audit_async_client_api = False
+        self.dbsession.commit()
+        self.assertEqual(len(self._entries("Immediate entry")), 1)
+        self.assertEqual(len(self._entries("Deferred entry")), 0)
+
+        with mock.patch.object(write_audit_entries, "delay") as mock_delay:
+            send_deferred_audit_entries(self.dbsession)
+        mock_delay.assert_called_once()
+        rows = mock_delay.call_args[0][0]
+        self.assertEqual([r["details"] for r in rows], ["Deferred entry"])
+        self.assertEqual(rows[0]["source"], "tablet")
+        self.assertEqual(
+            get_audit_buffer(self.dbsession).committed_deferred_rows, [])
+
+        # What the backend then does:
+        write_audit_rows(self.dbsession, rows)
+        self.dbsession.commit()
+        self.assertEqual(len(self._entries("Deferred entry")), 1)
+
+    def test_send_deferred_falls_back_to_direct_write(self) -> None:
+        from camcops_server.cc_modules.celery import write_audit_entries
+        self.req.config.audit_async_client_api = True
+        try:
+            audit(self.req, "Undeliverable entry", from_dbclient=True)
+        finally:
+            self.req.config.audit_async_client_api = False
+        self.dbsession.commit()
+        self.assertEqual(len(self._entries("Undeliverable entry")), 0)
+
+        with mock.patch.object(write_audit_entries, "delay",
+                               side_effect=OSError("Broker down")):
+            send_deferred_audit_entries(self.dbsession)
+        self.dbsession.rollback()  # entries were committed, so survive this
+        entries = self._entries("Undeliverable entry")
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].source, "tablet")
@@ -60,6 +60,8 @@ DEFAULT_EXTRA_STRINGS_DIR = join(CAMCOPS_SERVER_DIRECTORY, "extra_strings")
 
 LINUX_DEFAULT_CAMCOPS_CONFIG_DIR = "/etc/camcops"
 LINUX_DEFAULT_CAMCOPS_DIR = "/usr/share/camcops"
+LINUX_DEFAULT_EXPORT_STAGING_DIR = "/var/tmp/camcops_export_staging"
+# ... not within LINUX_DEFAULT_USER_DOWNLOAD_DIR, whose old files are deleted
 # Lintian dislikes files/subdirectories in: /usr/bin/X, /usr/local/X, /opt/X
 # It dislikes images in /usr/lib
 LINUX_DEFAULT_LOCK_DIR = "/var/lock/camcops"
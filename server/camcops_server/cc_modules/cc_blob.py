@@ -28,20 +28,39 @@ camcops_server/cc_modules/cc_blob.py
 
 """
 
+import datetime
+import io
 import logging
-from typing import Optional, Type, TYPE_CHECKING
+import os
+import tempfile
+import time
+from typing import (
+    Any, BinaryIO, Dict, Generator, List, Optional, Type, TYPE_CHECKING,
+)
+from unittest import mock
 
 from cardinal_pythonlib.httpconst import MimeType
 from cardinal_pythonlib.logs import BraceStyleAdapter
 from pendulum import DateTime as Pendulum
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship, undefer
 from sqlalchemy.orm import Session as SqlASession
 from sqlalchemy.orm.relationships import RelationshipProperty
 from sqlalchemy.sql.schema import Column
-from sqlalchemy.sql.sqltypes import Integer, Text
+from sqlalchemy.sql.sqltypes import BigInteger, Integer, Text
 import wand.image
 
+from camcops_server.cc_modules.cc_blobstore import (
+    BLOB_STORE_PURGE_GRACE_PERIOD_S,
+    blob_sha256,
+    BlobStore,
+    DirectoryBlobStore,
+    get_blob_store,
+    temporary_blob_store,
+    unreferenced_sha256s,
+)
 from camcops_server.cc_modules.cc_db import (
+    BFN_BLOB_SHA256,
+    BFN_BLOB_SIZE,
     GenericTabletRecordMixin,
     TaskDescendant,
 )
@@ -49,10 +68,17 @@ from camcops_server.cc_modules.cc_html import (
     get_data_url,
     get_embedded_img_tag,
 )
+from camcops_server.cc_modules.cc_imagecache import (
+    DerivedImageKey,
+    get_derived_image_cache,
+    THUMBNAIL_SIZE_PX,
+)
+from camcops_server.cc_modules.cc_pyramid import Routes, ViewParam
 from camcops_server.cc_modules.cc_simpleobjects import TaskExportOptions
 from camcops_server.cc_modules.cc_sqla_coltypes import (
     CamcopsColumn,
     MimeTypeColType,
+    Sha256HexColType,
     TableNameColType,
 )
 from camcops_server.cc_modules.cc_sqla_coltypes import (
@@ -72,6 +98,9 @@ if TYPE_CHECKING:
 
 log = BraceStyleAdapter(logging.getLogger(__name__))
 
+DEFAULT_BLOB_MIGRATION_CHUNK_SIZE = 100
+BLOB_STORE_PURGE_CHUNK_SIZE = 1000
+
 # ExactImage API documentation is a little hard to find. See:
 #   http://www.exactcode.com/site/open_source/exactimage
 #   man econvert # after sudo apt-get install exactimage
@@ -131,10 +160,24 @@ class Blob(GenericTabletRecordMixin, TaskDescendant, Base):
         "image_rotation_deg_cw", Integer,
         comment="For images: rotation to be applied, clockwise, in degrees"
     )
-    theblob = Column(
+    theblob = deferred(Column(
         "theblob", LongBlob,
         comment="The BLOB itself, a binary object containing arbitrary "
                 "information (such as a picture)"
+    ))
+    # ... deferred: loaded only when accessed, not whenever a Blob is loaded
+    # (e.g. to list it, index it, or walk past it in a dump); use
+    # undefer(Blob.theblob) in queries that will need it for every row.
+    _blob_sha256 = Column(
+        BFN_BLOB_SHA256, Sha256HexColType,
+        index=True,
+        comment="(SERVER) SHA-256 digest of the BLOB, if its content is held "
+                "in the BLOB store rather than in theblob"
+    )
+    _blob_size = Column(
+        BFN_BLOB_SIZE, BigInteger,
+        comment="(SERVER) Size of the BLOB (bytes), if its content is held "
+                "in the BLOB store rather than in theblob"
     )
 
     @classmethod
@@ -187,25 +230,133 @@ class Blob(GenericTabletRecordMixin, TaskDescendant, Base):
         # https://stackoverflow.com/questions/37445041/sqlalchemy-how-to-filter-column-which-contains-both-null-and-integer-values  # noqa
         return blob
 
+    @property
+    def is_in_blob_store(self) -> bool:
+        """
+        Is this BLOB's content held in the BLOB store (see
+        :mod:`camcops_server.cc_modules.cc_blobstore`), rather than in
+        ``theblob``?
+        """
+        return bool(self._blob_sha256)
+
+    def _get_blob_store_or_none(self) -> Optional[BlobStore]:
+        """
+        Returns the BLOB store, or ``None`` (with an error logged) if this
+        BLOB's content is in a store but none is configured.
+        """
+        store = get_blob_store()
+        if store is None:
+            log.error("BLOB with _pk={} is in the BLOB store, but no BLOB "
+                      "store is configured", self._pk)
+        return store
+
+    def get_blob_bytes(self) -> Optional[bytes]:
+        """
+        Returns the content of the BLOB, from wherever it is held, or None.
+        """
+        if self.is_in_blob_store:
+            store = self._get_blob_store_or_none()
+            if store is None:
+                return None
+            return store.get(SqlASession.object_session(self),
+                             self._blob_sha256)
+        return self.theblob
+
+    def open_blob(self) -> Optional[BinaryIO]:
+        """
+        Returns a binary file-like object for reading the content of the BLOB
+        (streaming it from the BLOB store if it's there), or None. The caller
+        must close it.
+        """
+        if self.is_in_blob_store:
+            store = self._get_blob_store_or_none()
+            if store is None:
+                return None
+            return store.open(SqlASession.object_session(self),
+                              self._blob_sha256)
+        if self.theblob is None:
+            return None
+        return io.BytesIO(self.theblob)
+
     def get_rotated_image(self) -> Optional[bytes]:
         """
         Returns a binary image, having rotated if necessary, or None.
         """
-        if not self.theblob:
+        return self.get_derived_image()
+
+    def get_thumbnail(self) -> Optional[bytes]:
+        """
+        Returns a thumbnail of the image (rotated if necessary), or None.
+        """
+        return self.get_derived_image(max_size_px=THUMBNAIL_SIZE_PX)
+
+    def get_derived_image(self, max_size_px: int = None) -> Optional[bytes]:
+        """
+        Returns a binary image, rotated if necessary and (if ``max_size_px``
+        is given) shrunk to fit within that width and height, or None.
+
+        If a derived image cache is configured (see
+        :mod:`camcops_server.cc_modules.cc_imagecache`), ImageMagick is only
+        used the first time a given rendition is requested.
+        """
+        rotation = (self.image_rotation_deg_cw or 0) % 360
+        if rotation == 0 and max_size_px is None:
+            return self.get_blob_bytes()
+        if self._manually_erased:
             return None
-        rotation = self.image_rotation_deg_cw
-        if rotation is None or rotation % 360 == 0:
-            return self.theblob
-        with wand.image.Image(blob=self.theblob) as img:
-            img.rotate(rotation)
-            return img.make_blob()
+        cache = get_derived_image_cache()
+        key = None  # type: Optional[DerivedImageKey]
+        if cache is not None and self._pk is not None:
+            key = DerivedImageKey(blob_pk=self._pk,
+                                  rotation=rotation,
+                                  max_size_px=max_size_px,
+                                  fmt=self.mimetype or MimeType.PNG)
+            image = cache.get(key)
+            if image is not None:
+                return image
+        blob_bytes = self.get_blob_bytes()
+        if not blob_bytes:
+            return None
+        with wand.image.Image(blob=blob_bytes) as img:
+            if rotation:
+                img.rotate(rotation)
+            if max_size_px is not None:
+                # ">": only shrink, never enlarge; aspect ratio is preserved
+                img.transform(resize=f"{max_size_px}x{max_size_px}>")
+            image = img.make_blob()
             # ... no parameter => return in same format as supplied
+        if key is not None:
+            cache.put(key, image)
+        return image
 
-    def get_img_html(self) -> str:
+    def get_img_html(self, req: "CamcopsRequest" = None,
+                     thumbnail: bool = False) -> str:
         """
         Returns an HTML IMG tag encoding the BLOB, or ''.
+
+        If ``req`` is given and its ``use_blob_urls`` flag is set (as for our
+        web view of a task), the tag refers to the BLOB by URL (see
+        :meth:`get_url`), so the content isn't read here or inlined into the
+        page. Otherwise (e.g. for PDFs and exported HTML, which must be
+        self-contained), the image is embedded as a data URL.
+
+        If ``thumbnail`` is set, the image is a thumbnail (see
+        :meth:`get_thumbnail`); by URL, it is also a link to the full image.
         """
-        image_bits = self.get_rotated_image()
+        if req is not None and req.use_blob_urls and self._pk is not None:
+            if self._manually_erased:
+                return ""
+            if thumbnail:
+                return (
+                    f'<a href="{self.get_url(req)}">'
+                    f'<img src="{self.get_url(req, thumbnail=True)}">'
+                    f'</a>'
+                )
+            return f'<img src="{self.get_url(req)}">'
+        if thumbnail:
+            image_bits = self.get_thumbnail()
+        else:
+            image_bits = self.get_rotated_image()
         if not image_bits:
             return ""
         return get_embedded_img_tag(self.mimetype or MimeType.PNG, image_bits)
@@ -235,13 +386,94 @@ class Blob(GenericTabletRecordMixin, TaskDescendant, Base):
         image_bits = self.get_rotated_image()
         return image_bits
 
+    def get_url(self, req: "CamcopsRequest", thumbnail: bool = False) -> str:
+        """
+        Returns the URL from which our web front end serves this BLOB (as an
+        image, rotated if necessary, or as a thumbnail).
+        """
+        query = {ViewParam.SERVER_PK: self._pk}
+        if thumbnail:
+            query[ViewParam.THUMBNAIL] = 1
+        return req.route_url(Routes.BLOB, _query=query)
+
+    def get_etag(self, thumbnail: bool = False) -> str:
+        """
+        Returns an HTTP entity tag for the image served by :meth:`get_url`.
+        The content of a given BLOB row never changes (a modified BLOB is a
+        new row), so its PK and the rotation suffice.
+        """
+        rotation = (self.image_rotation_deg_cw or 0) % 360
+        suffix = "-thumb" if thumbnail else ""
+        return f"blob-{self._pk}-{rotation}{suffix}"
+
+    def get_last_modified(self) -> Optional[Pendulum]:
+        """
+        Returns when this BLOB arrived on the server (for HTTP
+        ``Last-Modified``), if known.
+        """
+        return self._when_added_exact
+
     def get_data_url(self) -> str:
         """
         Returns a data URL encapsulating the BLOB, or ''.
         """
-        if not self.theblob:
+        blob_bytes = self.get_blob_bytes()
+        if not blob_bytes:
             return ""
-        return get_data_url(self.mimetype or MimeType.PNG, self.theblob)
+        return get_data_url(self.mimetype or MimeType.PNG, blob_bytes)
+
+    def manually_erase_with_dependants(self, req: "CamcopsRequest") -> None:
+        """
+        As for
+        :meth:`camcops_server.cc_modules.cc_db.GenericTabletRecordMixin.manually_erase_with_dependants`,
+        but also clears any reference to content in the BLOB store. (The
+        content itself is deleted by :func:`purge_blob_store` once nothing
+        refers to it.)
+        """  # noqa
+        super().manually_erase_with_dependants(req)
+        if self._manually_erased:
+            self._blob_sha256 = None
+            self._blob_size = None
+            cache = get_derived_image_cache()
+            if cache is not None:
+                cache.discard_blob(self._pk)
+
+    # -------------------------------------------------------------------------
+    # BLOB store
+    # -------------------------------------------------------------------------
+
+    def move_to_blob_store(self, store: BlobStore) -> bool:
+        """
+        Moves the content of ``theblob`` into the BLOB store. Returns whether
+        anything was moved.
+        """
+        if self.is_in_blob_store or self.theblob is None:
+            return False
+        dbsession = SqlASession.object_session(self)
+        self._blob_size = len(self.theblob)
+        self._blob_sha256 = store.put(dbsession, self.theblob)
+        self.theblob = None
+        return True
+
+    def move_from_blob_store(self, store: BlobStore) -> bool:
+        """
+        Moves the content of the BLOB back from the BLOB store into
+        ``theblob``. Returns whether anything was moved. (The store's copy is
+        deleted later, by :func:`purge_blob_store`, if nothing else refers
+        to it.)
+        """
+        if not self.is_in_blob_store:
+            return False
+        blob_bytes = store.get(SqlASession.object_session(self),
+                               self._blob_sha256)
+        if blob_bytes is None:
+            log.error("Can't move BLOB with _pk={} out of the BLOB store; "
+                      "content is missing", self._pk)
+            return False
+        self.theblob = blob_bytes
+        self._blob_sha256 = None
+        self._blob_size = None
+        return True
 
     # -------------------------------------------------------------------------
     # TaskDescendant overrides
@@ -320,18 +552,144 @@ def blob_relationship(classname: str,
 
 
 # =============================================================================
-# Unit tests
+# HTML
 # =============================================================================
 
 def get_blob_img_html(blob: Optional[Blob],
-                      html_if_missing: str = "<i>(No picture)</i>") -> str:
+                      html_if_missing: str = "<i>(No picture)</i>",
+                      req: "CamcopsRequest" = None) -> str:
     """
-    For the specified BLOB, get an HTML IMG tag with embedded data, or an HTML
+    For the specified BLOB, get an HTML IMG tag (with embedded data, or
+    referring to the BLOB by URL; see :meth:`Blob.get_img_html`), or an HTML
     error message.
     """
     if blob is None:
         return html_if_missing
-    return blob.get_img_html() or html_if_missing
+    return blob.get_img_html(req) or html_if_missing
+
+
+# =============================================================================
+# BLOB store: uploads, migration, and housekeeping
+# =============================================================================
+
+def move_uploaded_blob_to_store(dbsession: SqlASession,
+                                valuedict: Dict[str, Any]) -> None:
+    """
+    If a BLOB store is configured, moves the content of a ``blobs`` record
+    that is about to be inserted (as a dictionary of {colname: value} pairs)
+    into the store, replacing it with a reference. Modifies ``valuedict`` in
+    place.
+    """
+    store = get_blob_store()
+    if store is None:
+        return
+    blob_bytes = valuedict.get(Blob.theblob.name)
+    if blob_bytes is None:
+        return
+    valuedict[BFN_BLOB_SIZE] = len(blob_bytes)
+    valuedict[BFN_BLOB_SHA256] = store.put(dbsession, blob_bytes)
+    valuedict[Blob.theblob.name] = None
+
+
+def migrate_blobs(dbsession: SqlASession,
+                  store: BlobStore,
+                  reverse: bool = False,
+                  chunk_size: int = DEFAULT_BLOB_MIGRATION_CHUNK_SIZE) -> int:
+    """
+    Moves the content of existing BLOBs into the BLOB store, or (with
+    ``reverse``) back into the ``blobs`` table. Works in chunks of
+    ``chunk_size`` BLOBs (by server PK), committing after each, so that it can
+    be interrupted and re-run, and so that memory use stays bounded.
+
+    Args:
+        dbsession: an SQLAlchemy Session
+        store: the BLOB store
+        reverse: move content out of the store, not into it?
+        chunk_size: number of BLOBs to move per transaction
+
+    Returns:
+        the number of BLOBs moved
+    """
+    n_moved = 0
+    last_pk = None  # type: Optional[int]
+    while True:
+        # Find PKs first, so we don't read the content of rows we won't touch.
+        # noinspection PyProtectedMember
+        q = dbsession.query(Blob._pk)
+        if reverse:
+            # noinspection PyProtectedMember
+            q = q.filter(Blob._blob_sha256.isnot(None))
+        else:
+            # noinspection PyProtectedMember
+            q = q.filter(Blob.theblob.isnot(None))
+        if last_pk is not None:
+            # noinspection PyProtectedMember
+            q = q.filter(Blob._pk > last_pk)
+        # noinspection PyProtectedMember
+        pks = [row[0] for row in q.order_by(Blob._pk).limit(chunk_size)]
+        if not pks:
+            break
+        # noinspection PyProtectedMember
+        blobs = (
+            dbsession.query(Blob)
+            .options(undefer(Blob.theblob))
+            .filter(Blob._pk.in_(pks))
+            .all()
+        )  # type: List[Blob]
+        for blob in blobs:
+            if reverse:
+                moved = blob.move_from_blob_store(store)
+            else:
+                moved = blob.move_to_blob_store(store)
+            if moved:
+                n_moved += 1
+        dbsession.commit()
+        dbsession.expunge_all()  # keep memory use bounded
+        last_pk = pks[-1]
+        log.info("... {} BLOB(s) moved so far", n_moved)
+        if len(pks) < chunk_size:
+            break
+    log.info("Moved {} BLOB(s) {} the BLOB store", n_moved,
+             "out of" if reverse else "into")
+    return n_moved
+
+
+def purge_blob_store(
+        dbsession: SqlASession,
+        store: BlobStore,
+        grace_period_s: float = BLOB_STORE_PURGE_GRACE_PERIOD_S) -> int:
+    """
+    Deletes content from the BLOB store that no ``blobs`` row refers to,
+    except content stored within the last ``grace_period_s`` seconds (which
+    may belong to an upload that hasn't yet committed), including content
+    stored again while we are purging.
+
+    Returns:
+        the number of items deleted
+    """
+    cutoff_utc = (datetime.datetime.utcnow() -
+                  datetime.timedelta(seconds=grace_period_s))
+    candidates = list(store.gen_sha256s_stored_before(dbsession, cutoff_utc))
+    n_deleted = 0
+    for i in range(0, len(candidates), BLOB_STORE_PURGE_CHUNK_SIZE):
+        chunk = candidates[i:i + BLOB_STORE_PURGE_CHUNK_SIZE]
+        # noinspection PyProtectedMember
+        referenced = [
+            row[0] for row in
+            dbsession.query(Blob._blob_sha256)
+            .filter(Blob._blob_sha256.in_(chunk))
+            .distinct()
+        ]
+        for sha256 in unreferenced_sha256s(chunk, referenced):
+            # An upload may have stored the same content again since we
+            # looked; if so, it's no longer before the cutoff, and stays.
+            if store.delete(dbsession, sha256, cutoff_utc=cutoff_utc):
+                n_deleted += 1
+        dbsession.commit()
+    if n_deleted:
+        log.info("Deleted {} unreferenced item(s) from the BLOB store",
+                 n_deleted)
+    return n_deleted
 
 
 # =============================================================================
@@ -351,3 +709,81 @@ class BlobTests(DemoDatabaseTestCase):
         self.assertIsInstance(b.get_img_html(), str)
         self.assertIsInstance(b.get_xml_element(self.req), XmlElement)
         self.assertIsInstance(b.get_data_url(), str)
+        self.req.use_blob_urls = True
+        try:
+            html = b.get_img_html(self.req)
+        finally:
+            self.req.use_blob_urls = False
+        self.assertIn(f"{ViewParam.SERVER_PK}={b.get_pk()}", html)
+        self.assertNotIn("data:", html)
+
+    def test_blob_store(self) -> None:
+        self.announce("test_blob_store")
+        original = {
+            b.get_pk(): b.theblob for b in self.dbsession.query(Blob)
+        }
+        distinct = set(v for v in original.values() if v is not None)
+        assert distinct, "Missing BLOB content in demo database!"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DirectoryBlobStore(tmpdir)
+            with temporary_blob_store(store):
+                n_moved = migrate_blobs(self.dbsession, store, chunk_size=2)
+                self.assertEqual(
+                    n_moved,
+                    sum(1 for v in original.values() if v is not None))
+                for b in self.dbsession.query(Blob):
+                    self.assertIsNone(b.theblob)
+                    self.assertEqual(b.get_blob_bytes(), original[b.get_pk()])
+                # Identical content is stored once, and not purged while
+                # referenced:
+                self.assertEqual(
+                    len(list(store.gen_sha256s_stored_before(
+                        self.dbsession, datetime.datetime.utcnow() +
+                        datetime.timedelta(minutes=1)))),
+                    len(distinct))
+                self.assertEqual(
+                    purge_blob_store(self.dbsession, store,
+                                     grace_period_s=-60), 0)
+                # Move back:
+                migrate_blobs(self.dbsession, store, reverse=True)
+                for b in self.dbsession.query(Blob):
+                    self.assertFalse(b.is_in_blob_store)
+                    self.assertEqual(b.theblob, original[b.get_pk()])
+                self.assertEqual(
+                    purge_blob_store(self.dbsession, store,
+                                     grace_period_s=-60), len(distinct))
+
+    def test_purge_spares_content_stored_again(self) -> None:
+        self.announce("test_purge_spares_content_stored_again")
+        distinct = sorted(set(
+            b.theblob for b in self.dbsession.query(Blob)
+            if b.theblob is not None
+        ))
+        assert distinct, "Missing BLOB content in demo database!"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DirectoryBlobStore(tmpdir)
+            # Unreferenced content, stored long ago:
+            two_days_ago = time.time() - 2 * 24 * 60 * 60
+            for data in distinct:
+                filename = store.path(store.put(self.dbsession, data))
+                os.utime(filename, (two_days_ago, two_days_ago))
+            reuploaded = distinct[0]
+            scan = store.gen_sha256s_stored_before
+
+            def scan_then_upload(
+                    dbsession: SqlASession,
+                    cutoff_utc: datetime.datetime) \
+                    -> Generator[str, None, None]:
+                yield from scan(dbsession, cutoff_utc)
+                # An upload stores identical content, and hasn't yet
+                # committed the row referring to it:
+                store.put(dbsession, reuploaded)
+
+            with mock.patch.object(store, "gen_sha256s_stored_before",
+                                   side_effect=scan_then_upload):
+                n_deleted = purge_blob_store(self.dbsession, store)
+            self.assertEqual(n_deleted, len(distinct) - 1)
+            self.assertEqual(
+                [store.contains(self.dbsession, blob_sha256(data))
+                 for data in distinct],
+                [data is reuploaded for data in distinct])
@@ -0,0 +1,729 @@
+#!/usr/bin/env python
+
+"""
+camcops_server/cc_modules/cc_blobstore.py
+
+===============================================================================
+
+    Copyright (C) 2012-2020 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CamCOPS.
+
+    CamCOPS is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CamCOPS is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CamCOPS. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Content-addressed store for BLOB (binary large object) content.**
+
+BLOB NOTES
+
+- By default, the bytes of each uploaded BLOB live in the ``theblob`` column of
+  the ``blobs`` table. Every modified re-upload creates a new row with a full
+  copy, old versions are kept, and identical pictures attached to several
+  records are stored several times.
+
+- Optionally (see the ``BLOB_STORE_BACKEND`` config parameter), the bytes can
+  instead be held in a BLOB store, keyed by the SHA-256 digest of their
+  content. The ``blobs`` row then has ``theblob`` set to NULL and records the
+  digest (and size) in its ``_blob_sha256`` and ``_blob_size`` columns.
+  Identical content is stored once, however many rows refer to it.
+
+- Two stores are provided:
+
+  - ``directory``: one file per digest in a sharded directory tree, e.g.
+    ``<root>/ab/cd/abcd...``. Files are written to a temporary file and
+    renamed into place, so readers never see a partial file. Reads use a
+    plain file object (for streaming) or a single ``read()``; ``mmap`` is
+    available for callers that can work on the mapped file directly.
+
+  - ``table``: a dedicated ``_blob_contents`` table with the digest as its
+    primary key. This keeps everything in the database (so nothing extra to
+    back up), but still gives deduplication and makes row scans of ``blobs``
+    cheap.
+
+- Rows with content in ``theblob`` remain valid when a store is configured;
+  see ``camcops_server migrate_blobs`` to move existing content across (or
+  back).
+
+- When a row is manually erased, its reference is cleared at once. Content
+  that no row refers to any more is deleted from the store by the regular
+  housekeeping task. Storing content (even content that is already present)
+  refreshes its "last stored" time, and housekeeping leaves alone anything
+  stored within the last :data:`BLOB_STORE_PURGE_GRACE_PERIOD_S`; that
+  covers an upload that has stored content but not yet committed the row
+  referring to it. The "last stored" time is checked again as the content is
+  deleted, so an upload that stores identical content after housekeeping
+  has decided the content is unreferenced still keeps it.
+
+"""
+
+from contextlib import contextmanager
+import datetime
+import hashlib
+import io
+import logging
+import mmap
+import os
+import tempfile
+from typing import BinaryIO, Generator, Iterable, List, Optional, Union
+import unittest
+
+from cardinal_pythonlib.logs import BraceStyleAdapter
+from cardinal_pythonlib.sqlalchemy.dialect import SqlaDialectName
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm import Session as SqlASession, sessionmaker
+from sqlalchemy.sql.expression import exists
+from sqlalchemy.sql.schema import Column
+from sqlalchemy.sql.sqltypes import BigInteger, DateTime
+
+from camcops_server.cc_modules.cc_sqla_coltypes import (
+    LongBlob,
+    Sha256HexColType,
+)
+from camcops_server.cc_modules.cc_sqlalchemy import Base
+
+log = BraceStyleAdapter(logging.getLogger(__name__))
+
+
+# =============================================================================
+# Constants
+# =============================================================================
+
+class BlobStoreBackend(object):
+    """
+    Permitted values of the ``BLOB_STORE_BACKEND`` config parameter.
+    """
+    NONE = "none"  # BLOBs stay in the "blobs" table
+    DIRECTORY = "directory"  # sharded directory tree
+    TABLE = "table"  # deduplicated "_blob_contents" table
+
+
+BLOB_STORE_BACKENDS = [
+    BlobStoreBackend.NONE,
+    BlobStoreBackend.DIRECTORY,
+    BlobStoreBackend.TABLE,
+]
+
+STREAM_CHUNK_SIZE = 1024 * 1024  # bytes
+BLOB_STORE_PURGE_GRACE_PERIOD_S = 24 * 60 * 60  # 1 day
+
+
+def blob_sha256(data: Union[bytes, bytearray, memoryview]) -> str:
+    """
+    Returns the SHA-256 digest of some content, as lower-case hex.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_valid_sha256(sha256: str) -> bool:
+    """
+    Is this a plausible lower-case hex SHA-256 digest? (Digests are used to
+    build filenames, so we check them.)
+    """
+    return (
+        isinstance(sha256, str) and
+        len(sha256) == 64 and
+        all(c in "0123456789abcdef" for c in sha256)
+    )
+
+
+def _check_sha256(sha256: str) -> None:
+    """
+    Raises :exc:`ValueError` if ``sha256`` isn't a valid digest.
+    """
+    if not is_valid_sha256(sha256):
+        raise ValueError(f"Bad BLOB store digest: {sha256!r}")
+
+
+def _epoch_s(when_utc: datetime.datetime) -> float:
+    """
+    Converts a timezone-naive UTC ``datetime`` to seconds since the epoch, to
+    compare with file modification times.
+    """
+    return when_utc.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+# =============================================================================
+# BlobStore
+# =============================================================================
+
+class BlobStore(object):
+    """
+    Abstract base class for a content-addressed BLOB store.
+
+    All methods take the database session, which only some stores use.
+    """
+    backend = ""
+
+    def put(self, dbsession: SqlASession, data: bytes) -> str:
+        """
+        Stores the content (if it's not already present) and returns its
+        SHA-256 digest.
+        """
+        raise NotImplementedError
+
+    def contains(self, dbsession: SqlASession, sha256: str) -> bool:
+        """
+        Is content with this digest present?
+        """
+        raise NotImplementedError
+
+    def get(self, dbsession: SqlASession, sha256: str) -> Optional[bytes]:
+        """
+        Returns the content with this digest, or ``None`` if it's missing.
+        """
+        raise NotImplementedError
+
+    def open(self, dbsession: SqlASession, sha256: str) -> Optional[BinaryIO]:
+        """
+        Returns a binary file-like object, open for reading, for the content
+        with this digest, or ``None`` if it's missing. The caller must close
+        it.
+        """
+        data = self.get(dbsession, sha256)
+        if data is None:
+            return None
+        return io.BytesIO(data)
+
+    def delete(self, dbsession: SqlASession, sha256: str,
+               cutoff_utc: datetime.datetime = None) -> bool:
+        """
+        Deletes the content with this digest, if present.
+
+        Args:
+            dbsession: the database session
+            sha256: the digest
+            cutoff_utc: if specified (as a timezone-naive UTC ``datetime``),
+                only delete the content if it was last stored before this
+                time, checking that atomically with respect to :meth:`put`
+
+        Returns:
+            was anything deleted?
+        """
+        raise NotImplementedError
+
+    def gen_sha256s_stored_before(
+            self,
+            dbsession: SqlASession,
+            cutoff_utc: datetime.datetime) -> Generator[str, None, None]:
+        """
+        Generates the digests of content last stored before the cutoff (a
+        timezone-naive UTC ``datetime``).
+        """
+        raise NotImplementedError
+
+
+class DirectoryBlobStore(BlobStore):
+    """
+    Stores BLOB content as files in a sharded directory tree.
+    """
+    backend = BlobStoreBackend.DIRECTORY
+
+    def __init__(self, root_directory: str) -> None:
+        """
+        Args:
+            root_directory: top-level directory of the store; created if it
+                doesn't exist
+        """
+        if not root_directory:
+            raise ValueError("No directory specified for BLOB store")
+        self.root_directory = os.path.abspath(root_directory)
+        os.makedirs(self.root_directory, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.root_directory!r})"
+
+    def path(self, sha256: str) -> str:
+        """
+        Returns the filename used for content with this digest.
+        """
+        _check_sha256(sha256)
+        return os.path.join(self.root_directory,
+                            sha256[0:2], sha256[2:4], sha256)
+
+    def put(self, dbsession: SqlASession, data: bytes) -> str:
+        sha256 = blob_sha256(data)
+        filename = self.path(sha256)
+        try:
+            os.utime(filename)  # already stored; refresh "last stored" time
+            return sha256
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file in the same directory (hence on the same
+        # filesystem), then rename it into place, which is atomic. If two
+        # processes store the same content simultaneously, both renames
+        # succeed and the result is the same.
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpname, filename)
+        except BaseException:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+        return sha256
+
+    def contains(self, dbsession: SqlASession, sha256: str) -> bool:
+        return os.path.isfile(self.path(sha256))
+
+    def get(self, dbsession: SqlASession, sha256: str) -> Optional[bytes]:
+        # We need a bytes copy anyway, so a plain read does; callers that can
+        # work on the mapped file directly should use mmap().
+        try:
+            with open(self.path(sha256), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            log.error("BLOB missing from store: {}", sha256)
+            return None
+
+    def open(self, dbsession: SqlASession, sha256: str) -> Optional[BinaryIO]:
+        try:
+            return open(self.path(sha256), "rb")
+        except FileNotFoundError:
+            log.error("BLOB missing from store: {}", sha256)
+            return None
+
+    @contextmanager
+    def mmap(self, sha256: str) \
+            -> Generator[Union[mmap.mmap, bytes], None, None]:
+        """
+        Context manager yielding a read-only memory map of the content with
+        this digest (or ``b""`` for empty content, which can't be mapped).
+        Slicing it gives ``bytes``; ``memoryview()`` gives zero-copy access.
+
+        Raises:
+            :exc:`FileNotFoundError` if the content is missing
+        """
+        with open(self.path(sha256), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield m
+
+    def delete(self, dbsession: SqlASession, sha256: str,
+               cutoff_utc: datetime.datetime = None) -> bool:
+        filename = self.path(sha256)
+        if cutoff_utc is None:
+            try:
+                os.remove(filename)
+                return True
+            except FileNotFoundError:
+                return False
+        # Move the file out of the way first (atomically), so that put()
+        # either refreshes it before the move, which we then see, or finds it
+        # missing and stores it afresh.
+        tombstone = f"{filename}.{os.getpid()}.deleting"
+        try:
+            os.rename(filename, tombstone)
+        except FileNotFoundError:
+            return False
+        if os.stat(tombstone).st_mtime < _epoch_s(cutoff_utc):
+            os.remove(tombstone)
+            return True
+        # Stored again since we looked; put it back (unless it has been
+        # stored afresh meanwhile, which gives the same result).
+        os.replace(tombstone, filename)
+        return False
+
+    def gen_sha256s_stored_before(
+            self,
+            dbsession: SqlASession,
+            cutoff_utc: datetime.datetime) -> Generator[str, None, None]:
+        cutoff_epoch_s = _epoch_s(cutoff_utc)
+        for dirpath, _, filenames in os.walk(self.root_directory):
+            for filename in filenames:
+                if not is_valid_sha256(filename):
+                    continue
+                try:
+                    mtime = os.stat(os.path.join(dirpath, filename)).st_mtime
+                except FileNotFoundError:
+                    continue
+                if mtime < cutoff_epoch_s:
+                    yield filename
+
+
+class BlobContent(Base):
+    """
+    Deduplicated BLOB content, for :class:`TableBlobStore`.
+    """
+    __tablename__ = "_blob_contents"
+
+    sha256 = Column(
+        "sha256", Sha256HexColType,
+        primary_key=True,
+        comment="SHA-256 digest of the content (lower-case hex)"
+    )
+    size = Column(
+        "size", BigInteger,
+        nullable=False,
+        comment="Size of the content (bytes)"
+    )
+    content = Column(
+        "content", LongBlob,
+        comment="The content itself"
+    )
+    when_stored_utc = Column(
+        "when_stored_utc", DateTime,
+        nullable=False, index=True,
+        comment="Date/time this content was last stored (UTC)"
+    )
+
+
+class TableBlobStore(BlobStore):
+    """
+    Stores BLOB content in the ``_blob_contents`` table, one row per distinct
+    content.
+    """
+    backend = BlobStoreBackend.TABLE
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}()"
+
+    def put(self, dbsession: SqlASession, data: bytes) -> str:
+        sha256 = blob_sha256(data)
+        table = BlobContent.__table__
+        now_utc = datetime.datetime.utcnow()
+        values = dict(sha256=sha256, size=len(data), content=data,
+                      when_stored_utc=now_utc)
+        dialect_name = dbsession.get_bind().dialect.name
+        # Another process may insert the same content at the same time, so
+        # let the database deal with the duplicate where it can.
+        if dialect_name == SqlaDialectName.MYSQL:
+            dbsession.execute(
+                mysql_insert(table).values(values)
+                .on_duplicate_key_update(when_stored_utc=now_utc)
+            )
+            return sha256
+        if dialect_name == SqlaDialectName.SQLITE:
+            dbsession.execute(table.insert().prefix_with("OR IGNORE"), values)
+        elif not self.contains(dbsession, sha256):
+            dbsession.execute(table.insert(), values)
+            return sha256
+        dbsession.execute(
+            table.update()
+            .where(table.c.sha256 == sha256)
+            .values(when_stored_utc=now_utc)
+        )
+        return sha256
+
+    def contains(self, dbsession: SqlASession, sha256: str) -> bool:
+        _check_sha256(sha256)
+        return dbsession.query(
+            exists().where(BlobContent.sha256 == sha256)
+        ).scalar()
+
+    def get(self, dbsession: SqlASession, sha256: str) -> Optional[bytes]:
+        _check_sha256(sha256)
+        row = (
+            dbsession.query(BlobContent.content)
+            .filter(BlobContent.sha256 == sha256)
+            .first()
+        )
+        if row is None:
+            log.error("BLOB missing from store: {}", sha256)
+            return None
+        return row[0]
+
+    def delete(self, dbsession: SqlASession, sha256: str,
+               cutoff_utc: datetime.datetime = None) -> bool:
+        _check_sha256(sha256)
+        table = BlobContent.__table__
+        statement = table.delete().where(table.c.sha256 == sha256)
+        if cutoff_utc is not None:
+            statement = statement.where(table.c.when_stored_utc < cutoff_utc)
+        return dbsession.execute(statement).rowcount > 0
+
+    def gen_sha256s_stored_before(
+            self,
+            dbsession: SqlASession,
+            cutoff_utc: datetime.datetime) -> Generator[str, None, None]:
+        q = (
+            dbsession.query(BlobContent.sha256)
+            .filter(BlobContent.when_stored_utc < cutoff_utc)
+        )
+        for row in q:
+            yield row[0]
+
+
+def make_blob_store(backend: str,
+                    directory: str = "") -> Optional[BlobStore]:
+    """
+    Creates a BLOB store, or returns ``None`` if BLOBs should stay in the
+    ``blobs`` table.
+
+    Args:
+        backend: one of :data:`BLOB_STORE_BACKENDS`
+        directory: root directory, for the ``directory`` backend
+
+    Raises:
+        :exc:`ValueError` for bad parameters
+    """
+    backend = (backend or BlobStoreBackend.NONE).lower()
+    if backend == BlobStoreBackend.NONE:
+        return None
+    if backend == BlobStoreBackend.DIRECTORY:
+        return DirectoryBlobStore(directory)
+    if backend == BlobStoreBackend.TABLE:
+        return TableBlobStore()
+    raise ValueError(f"Bad BLOB store backend: {backend!r}; "
+                     f"must be one of {BLOB_STORE_BACKENDS!r}")
+
+
+# =============================================================================
+# The process-wide store
+# =============================================================================
+
+_blob_store = None  # type: Optional[BlobStore]
+_blob_store_configured = False
+
+
+def configure_blob_store(backend: str, directory: str = "") -> None:
+    """
+    Sets up the process-wide BLOB store. Only the first call has any effect
+    (the config is not re-read within a process).
+    """
+    global _blob_store, _blob_store_configured
+    if _blob_store_configured:
+        return
+    _blob_store = make_blob_store(backend, directory)
+    _blob_store_configured = True
+    log.debug("BLOB store: {!r}", _blob_store)
+
+
+def get_blob_store() -> Optional[BlobStore]:
+    """
+    Returns the process-wide BLOB store, or ``None`` if BLOBs are kept in the
+    ``blobs`` table.
+    """
+    return _blob_store
+
+
+@contextmanager
+def temporary_blob_store(store: Optional[BlobStore]) \
+        -> Generator[Optional[BlobStore], None, None]:
+    """
+    Context manager to use a different process-wide BLOB store temporarily
+    (for testing and for migration between stores).
+    """
+    global _blob_store
+    previous = _blob_store
+    _blob_store = store
+    try:
+        yield store
+    finally:
+        _blob_store = previous
+
+
+def gen_chunks(f: BinaryIO,
+               chunk_size: int = STREAM_CHUNK_SIZE) \
+        -> Generator[bytes, None, None]:
+    """
+    Reads a binary file in chunks, then closes it. Suitable for streaming
+    BLOB content as a response body.
+    """
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+def unreferenced_sha256s(candidates: Iterable[str],
+                         referenced: Iterable[str]) -> List[str]:
+    """
+    Returns the distinct digests in ``candidates`` that are not in
+    ``referenced``, in their original order.
+    """
+    seen = set(referenced)
+    result = []  # type: List[str]
+    for sha256 in candidates:
+        if sha256 and sha256 not in seen:
+            result.append(sha256)
+            seen.add(sha256)
+    return result
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class DirectoryBlobStoreTests(unittest.TestCase):
+    """
+    Unit tests.
+    """
+    # don't inherit from ExtendedTestCase; circular import
+
+    def test_roundtrip_and_dedupe(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DirectoryBlobStore(tmpdir)
+            data = bytes(range(256)) * 100
+            sha256 = store.put(None, data)
+            self.assertEqual(sha256, hashlib.sha256(data).hexdigest())
+            self.assertEqual(store.put(None, data), sha256)
+            now = datetime.datetime.utcnow()
+            self.assertEqual(
+                list(store.gen_sha256s_stored_before(
+                    None, now + datetime.timedelta(minutes=1))),
+                [sha256]
+            )
+            self.assertEqual(
+                list(store.gen_sha256s_stored_before(
+                    None, now - datetime.timedelta(minutes=1))),
+                []
+            )
+            self.assertTrue(store.path(sha256).startswith(
+                os.path.join(tmpdir, sha256[0:2], sha256[2:4])))
+            self.assertTrue(store.contains(None, sha256))
+            self.assertEqual(store.get(None, sha256), data)
+            self.assertEqual(b"".join(gen_chunks(store.open(None, sha256),
+                                                 chunk_size=1000)),
+                             data)
+            with store.mmap(sha256) as m:
+                self.assertEqual(bytes(memoryview(m)[0:3]), b"\x00\x01\x02")
+            store.delete(None, sha256)
+            self.assertFalse(store.contains(None, sha256))
+            self.assertIsNone(store.get(None, sha256))
+            self.assertIsNone(store.open(None, sha256))
+
+    def test_delete_before_cutoff(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DirectoryBlobStore(tmpdir)
+            data = b"some content"
+            sha256 = store.put(None, data)
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+            two_hours_ago = _epoch_s(cutoff) - 3600
+            os.utime(store.path(sha256), (two_hours_ago, two_hours_ago))
+            self.assertEqual(
+                list(store.gen_sha256s_stored_before(None, cutoff)),
+                [sha256])
+            # An upload stores the same content again before we delete it:
+            store.put(None, data)
+            self.assertFalse(store.delete(None, sha256, cutoff_utc=cutoff))
+            self.assertEqual(store.get(None, sha256), data)
+            self.assertEqual(os.listdir(os.path.dirname(store.path(sha256))),
+                             [sha256])  # no tombstone left behind
+            # ... otherwise it goes:
+            os.utime(store.path(sha256), (two_hours_ago, two_hours_ago))
+            self.assertTrue(store.delete(None, sha256, cutoff_utc=cutoff))
+            self.assertFalse(store.contains(None, sha256))
+            self.assertFalse(store.delete(None, sha256, cutoff_utc=cutoff))
+
+    def test_empty_content(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DirectoryBlobStore(tmpdir)
+            sha256 = store.put(None, b"")
+            self.assertEqual(store.get(None, sha256), b"")
+
+    def test_bad_digest(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DirectoryBlobStore(tmpdir)
+            self.assertRaises(ValueError, store.path, "../../etc/passwd")
+            self.assertRaises(ValueError, store.path, "A" * 64)
+            self.assertRaises(ValueError, make_blob_store, "nonsense")
+
+    def test_unreferenced(self) -> None:
+        self.assertEqual(
+            unreferenced_sha256s(["a", "b", "a", None, "c"], ["b"]),
+            ["a", "c"]
+        )
+
+
+class TableBlobStoreTests(unittest.TestCase):
+    """
+    Unit tests.
+    """
+    def setUp(self) -> None:
+        super().setUp()
+        engine = create_engine("sqlite://")
+        BlobContent.__table__.create(engine)
+        self.dbsession = sessionmaker(bind=engine)()  # type: SqlASession
+
+    def tearDown(self) -> None:
+        self.dbsession.close()
+        super().tearDown()
+
+    def test_roundtrip_and_dedupe(self) -> None:
+        store = TableBlobStore()
+        data = bytes(range(256)) * 100
+        sha256 = store.put(self.dbsession, data)
+        self.assertEqual(sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(store.put(self.dbsession, data), sha256)
+        self.assertEqual(self.dbsession.query(BlobContent).count(), 1)
+        now = datetime.datetime.utcnow()
+        self.assertEqual(
+            list(store.gen_sha256s_stored_before(
+                self.dbsession, now + datetime.timedelta(minutes=1))),
+            [sha256]
+        )
+        self.assertEqual(
+            list(store.gen_sha256s_stored_before(
+                self.dbsession, now - datetime.timedelta(minutes=1))),
+            []
+        )
+        self.assertTrue(store.contains(self.dbsession, sha256))
+        self.assertEqual(store.get(self.dbsession, sha256), data)
+        self.assertEqual(
+            b"".join(gen_chunks(store.open(self.dbsession, sha256),
+                                chunk_size=1000)),
+            data)
+        store.delete(self.dbsession, sha256)
+        self.assertFalse(store.contains(self.dbsession, sha256))
+        self.assertIsNone(store.get(self.dbsession, sha256))
+        self.assertIsNone(store.open(self.dbsession, sha256))
+
+    def test_delete_before_cutoff(self) -> None:
+        store = TableBlobStore()
+        data = b"some content"
+        sha256 = store.put(self.dbsession, data)
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        table = BlobContent.__table__
+        backdate = table.update().values(
+            when_stored_utc=cutoff - datetime.timedelta(hours=1))
+        self.dbsession.execute(backdate)
+        self.assertEqual(
+            list(store.gen_sha256s_stored_before(self.dbsession, cutoff)),
+            [sha256])
+        # An upload stores the same content again before we delete it:
+        store.put(self.dbsession, data)
+        self.assertFalse(
+            store.delete(self.dbsession, sha256, cutoff_utc=cutoff))
+        self.assertEqual(store.get(self.dbsession, sha256), data)
+        # ... otherwise it goes:
+        self.dbsession.execute(backdate)
+        self.assertTrue(
+            store.delete(self.dbsession, sha256, cutoff_utc=cutoff))
+        self.assertFalse(store.contains(self.dbsession, sha256))
+
+    def test_empty_content(self) -> None:
+        store = TableBlobStore()
+        sha256 = store.put(self.dbsession, b"")
+        self.assertEqual(store.get(self.dbsession, sha256), b"")
+
+    def test_bad_digest(self) -> None:
+        store = TableBlobStore()
+        self.assertRaises(ValueError, store.get, self.dbsession, "x")
+        self.assertRaises(ValueError, store.contains, self.dbsession,
+                          "A" * 64)
@@ -95,17 +95,36 @@ Crash using type-hinted functions under Python 3.5 with dogpile.cache==0.6.4:
   The actual price is of the order of 0.6-1 ms per query, for the queries
   "find me all the ID number definitions" and "fetch the server settings".
 
-- The answer is probably:
+- What we do:
 
   - continue to use dogpile.cache.memory for simple "fixed" stuff read from
-    disk;
+    disk (``cache_region_static``);
   - continue to use Pyramid's per-request caching mechanism (@reify);
-  - forget about database caching for now;
-  - if it becomes a problem later, move to Redis
-
-- Therefore:
-
-  - there should be no calls to cache_region_static.delete
+  - cache a small amount of database-derived, rarely-changing information
+    (ID number definitions, server settings, group visibility) in
+    ``cache_region_db``, whose backend is chosen by the site config
+    (``DB_CACHE_BACKEND``). The default is "none", i.e. no caching, which is
+    always correct. For a single host running several processes, "file" uses
+    a DBM file (``dogpile.cache.dbm``) shared between processes via file
+    locks; for several hosts, use "memcached" or "redis".
+
+- Invalidation of ``cache_region_db`` is by a version key. All cached values
+  are stored under keys that include the current version; bumping the
+  version (``invalidate_cache_region_db``) makes every other process miss on
+  its next read, so stale entries simply age out. Web views that change the
+  relevant data call :meth:`CamcopsRequest.invalidate_db_cache`, which bumps
+  the version once the database transaction has been committed.
+
+- There should still be no calls to cache_region_static.delete.
+
+- One exception: row counts used for pagination (e.g. "how many tasks match
+  this filter?") are expensive on large databases and tolerant of being a
+  little out of date, so they live in a separate, briefly cached region,
+  ``cache_region_counts``, keyed by the full SQL statement and parameters.
+
+- Hit/miss counts for each region are kept per process (see
+  :func:`get_cache_stats`). They are counted at the backend, so a value that
+  is present but expired counts as a hit (and is then regenerated).
 
 """  # noqa
 
@@ -114,8 +133,119 @@ Crash using type-hinted functions under Python 3.5 with dogpile.cache==0.6.4:
 # Imports; logging
 # =============================================================================
 
+import logging
+import os
+import tempfile
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import unittest
+import uuid
+
 from cardinal_pythonlib.dogpile_cache import kw_fkg_allowing_type_hints as fkg
+from cardinal_pythonlib.logs import BraceStyleAdapter
 from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+from dogpile.cache.region import CacheRegion
+
+log = BraceStyleAdapter(logging.getLogger(__name__))
+
+
+# =============================================================================
+# Hit/miss statistics
+# =============================================================================
+
+class CacheRegionStats(object):
+    """
+    Per-process hit/miss counters for a cache region.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def record(self, hits: int = 0, misses: int = 0) -> None:
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def reset(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_ratio(self) -> Optional[float]:
+        """
+        Fraction of reads that were hits, or ``None`` if there have been no
+        reads.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns a copy of the counters, as a dictionary.
+        """
+        with self._lock:
+            return dict(name=self.name,
+                        hits=self.hits,
+                        misses=self.misses,
+                        hit_ratio=self.hit_ratio)
+
+
+class CacheStatsProxy(ProxyBackend):
+    """
+    dogpile.cache proxy backend that counts hits and misses.
+    """
+    def __init__(self, stats: CacheRegionStats,
+                 ignore_keys: Sequence[str] = ()) -> None:
+        super().__init__()
+        self.stats = stats
+        self.ignore_keys = set(ignore_keys)
+
+    def get(self, key: str) -> Any:
+        value = self.proxied.get(key)
+        if key not in self.ignore_keys:
+            if value is NO_VALUE:
+                self.stats.record(misses=1)
+            else:
+                self.stats.record(hits=1)
+        return value
+
+    def get_multi(self, keys: Sequence[str]) -> List[Any]:
+        values = self.proxied.get_multi(keys)
+        hits = misses = 0
+        for key, value in zip(keys, values):
+            if key in self.ignore_keys:
+                continue
+            if value is NO_VALUE:
+                misses += 1
+            else:
+                hits += 1
+        self.stats.record(hits=hits, misses=misses)
+        return values
+
+
+_CACHE_STATS = []  # type: List[CacheRegionStats]
+
+
+def make_cache_stats(name: str) -> CacheRegionStats:
+    """
+    Creates hit/miss counters, reported by :func:`get_cache_stats`.
+    """
+    stats = CacheRegionStats(name)
+    _CACHE_STATS.append(stats)
+    return stats
+
+
+def get_cache_stats() -> List[Dict[str, Any]]:
+    """
+    Returns hit/miss counters for all our cache regions, for this process.
+    """
+    return [stats.snapshot() for stats in _CACHE_STATS]
+
 
 # =============================================================================
 # The main cache: static for the lifetime of this process.
@@ -123,12 +253,271 @@ from dogpile.cache import make_region
 
 cache_region_static = make_region()
 cache_region_static.configure(
-    backend='dogpile.cache.memory'
-    # Consider later: memcached via dogpile.cache.pylibmc
+    backend='dogpile.cache.memory',
+    wrap=[CacheStatsProxy(make_cache_stats("static"))]
 )
 
 # Can now use:
 # @cache_region_static.cache_on_arguments(function_key_generator=fkg)
 
+# =============================================================================
+# Short-lived cache for COUNT queries (e.g. for pagination)
+# =============================================================================
+
+COUNT_CACHE_EXPIRY_S = 60
+
+cache_region_counts = make_region()
+cache_region_counts.configure(
+    backend='dogpile.cache.memory',
+    expiration_time=COUNT_CACHE_EXPIRY_S,
+    wrap=[CacheStatsProxy(make_cache_stats("counts"))]
+)
+
+# =============================================================================
+# Shared (potentially multi-process) cache for database-derived information
+# =============================================================================
+
+
+class DbCacheBackend(object):
+    """
+    Options for the ``DB_CACHE_BACKEND`` config parameter.
+    """
+    NONE = "none"
+    MEMORY = "memory"
+    FILE = "file"
+    MEMCACHED = "memcached"
+    REDIS = "redis"
+
+
+DB_CACHE_BACKENDS = [
+    DbCacheBackend.NONE,
+    DbCacheBackend.MEMORY,
+    DbCacheBackend.FILE,
+    DbCacheBackend.MEMCACHED,
+    DbCacheBackend.REDIS,
+]
+
+DB_CACHE_VERSION_KEY = "camcops:db_cache_version"
+
+_db_cache_stats = make_cache_stats("db")
+
+
+def make_db_cache_region(backend: str,
+                         url: str = "",
+                         expiration_time_s: int = None,
+                         stats: CacheRegionStats = None) -> CacheRegion:
+    """
+    Creates a configured dogpile.cache region for database-derived
+    information.
+
+    Args:
+        backend: one of the :class:`DbCacheBackend` values
+        url: for "file", the DBM filename; for "memcached", a comma-separated
+            list of servers; for "redis", the server URL (e.g.
+            ``redis://localhost:6379/0``)
+        expiration_time_s: expiry time, in seconds (``None`` or 0 for no
+            expiry)
+        stats: optional :class:`CacheRegionStats` to count hits/misses
+
+    Raises:
+        :exc:`ValueError` for bad parameters
+    """
+    backend = (backend or DbCacheBackend.NONE).lower()
+    arguments = {}  # type: Dict[str, Any]
+    if backend == DbCacheBackend.NONE:
+        dogpile_backend = "dogpile.cache.null"
+    elif backend == DbCacheBackend.MEMORY:
+        dogpile_backend = "dogpile.cache.memory_pickle"
+    elif backend == DbCacheBackend.FILE:
+        dogpile_backend = "dogpile.cache.dbm"
+        arguments["filename"] = url
+    elif backend == DbCacheBackend.MEMCACHED:
+        dogpile_backend = "dogpile.cache.pylibmc"
+        arguments["url"] = [x.strip() for x in url.split(",") if x.strip()]
+    elif backend == DbCacheBackend.REDIS:
+        dogpile_backend = "dogpile.cache.redis"
+        arguments["url"] = url
+        arguments["distributed_lock"] = True
+    else:
+        raise ValueError(f"Unknown database cache backend: {backend!r}; "
+                         f"options are {DB_CACHE_BACKENDS!r}")
+    if backend in (DbCacheBackend.FILE,
+                   DbCacheBackend.MEMCACHED,
+                   DbCacheBackend.REDIS) and not url:
+        raise ValueError(f"Database cache backend {backend!r} needs a URL "
+                         f"or filename")
+    region = make_region()
+    wrap = []  # type: List[ProxyBackend]
+    if stats:
+        wrap.append(CacheStatsProxy(stats,
+                                    ignore_keys=[DB_CACHE_VERSION_KEY]))
+    region.configure(
+        backend=dogpile_backend,
+        expiration_time=expiration_time_s or None,
+        arguments=arguments,
+        wrap=wrap
+    )
+    region.camcops_backend = backend  # for is_null_db_cache_region()
+    return region
+
+
+def is_null_db_cache_region(region: Optional[CacheRegion]) -> bool:
+    """
+    Is this region absent, or one that caches nothing?
+    """
+    return (region is None or
+            getattr(region, "camcops_backend",
+                    DbCacheBackend.NONE) == DbCacheBackend.NONE)
+
+
+cache_region_db = None  # type: Optional[CacheRegion]
+# ... set by configure_cache_region_db(), called when the config is read.
+
+
+def configure_cache_region_db(backend: str,
+                              url: str = "",
+                              expiration_time_s: int = None) -> None:
+    """
+    Sets up the process-wide :data:`cache_region_db`. Only the first call has
+    any effect (the config is not re-read within a process).
+    """
+    global cache_region_db
+    if cache_region_db is not None:
+        return
+    cache_region_db = make_db_cache_region(
+        backend=backend,
+        url=url,
+        expiration_time_s=expiration_time_s,
+        stats=_db_cache_stats
+    )
+    log.debug("Database cache backend: {!r}", backend)
+
+
+def get_db_cache_version(region: CacheRegion) -> str:
+    """
+    Returns the current version string for the database cache, creating one
+    if none exists.
+    """
+    version = region.get(DB_CACHE_VERSION_KEY, ignore_expiration=True)
+    if version is NO_VALUE:
+        version = uuid.uuid4().hex
+        region.set(DB_CACHE_VERSION_KEY, version)
+    return version
+
+
+def invalidate_db_cache_region(region: Optional[CacheRegion]) -> None:
+    """
+    Invalidates everything in the database cache (for all processes sharing
+    the backend) by bumping its version.
+    """
+    if is_null_db_cache_region(region):
+        return
+    region.set(DB_CACHE_VERSION_KEY, uuid.uuid4().hex)
+
+
+def invalidate_cache_region_db() -> None:
+    """
+    Invalidates the process-wide :data:`cache_region_db`. Call this after
+    committing changes to ID number definitions, server settings, or groups.
+    """
+    invalidate_db_cache_region(cache_region_db)
+
+
+def db_cache_get_or_create(
+        key: str,
+        creator: Callable[[], Any],
+        should_cache_fn: Callable[[Any], bool] = None,
+        region: CacheRegion = None) -> Any:
+    """
+    Fetches a value from the database cache, or creates it using
+    ``creator()`` (and stores it, if ``should_cache_fn`` allows).
+
+    Values must be picklable. SQLAlchemy ORM objects are fine, but they come
+    back detached; use ``Session.merge(obj, load=False)`` to reattach them.
+
+    Args:
+        key: cache key (without version)
+        creator: function to create the value
+        should_cache_fn: optional function taking the value and returning
+            whether it should be cached
+        region: region to use; default :data:`cache_region_db`
+    """
+    if region is None:
+        region = cache_region_db
+    if is_null_db_cache_region(region):
+        return creator()
+    version = get_db_cache_version(region)
+    return region.get_or_create(f"{key}:{version}", creator,
+                                should_cache_fn=should_cache_fn)
+
+
 # https://stackoverflow.com/questions/44834/can-someone-explain-all-in-python
-__all__ = ['cache_region_static', 'fkg']  # prevents "Unused import statement"
+__all__ = [  # prevents "Unused import statement"
+    'cache_region_counts',
+    'cache_region_db',
+    'cache_region_static',
+    'configure_cache_region_db',
+    'db_cache_get_or_create',
+    'fkg',
+    'get_cache_stats',
+    'invalidate_cache_region_db',
+]
+
+
+# =============================================================================
+# Unit testing
+# =============================================================================
+
+class DbCacheTests(unittest.TestCase):
+    """
+    Unit tests, using the (local) file backend.
+    """
+    # don't inherit from ExtendedTestCase; circular import
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, "cache.dbm")
+        self.stats = CacheRegionStats("test")
+        self.region = make_db_cache_region(DbCacheBackend.FILE,
+                                           url=self.filename,
+                                           stats=self.stats)
+        self.ncalls = 0
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def _creator(self) -> int:
+        self.ncalls += 1
+        return self.ncalls
+
+    def _get(self, region: CacheRegion = None) -> int:
+        return db_cache_get_or_create("thing", self._creator,
+                                      region=region or self.region)
+
+    def test_cached_and_counted(self) -> None:
+        self.assertEqual(self._get(), 1)
+        self.assertEqual(self._get(), 1)
+        self.assertEqual(self.ncalls, 1)
+        self.assertEqual(self.stats.hits, 1)
+        # ... the first get_or_create() reads twice: once before and once
+        # after acquiring the dogpile lock.
+        self.assertGreaterEqual(self.stats.misses, 1)
+
+    def test_shared_between_regions(self) -> None:
+        # A second region on the same file, e.g. in another process.
+        other = make_db_cache_region(DbCacheBackend.FILE, url=self.filename)
+        self.assertEqual(self._get(), 1)
+        self.assertEqual(self._get(other), 1)
+        invalidate_db_cache_region(other)
+        self.assertEqual(self._get(), 2)
+        self.assertEqual(self._get(other), 2)
+
+    def test_null_backend(self) -> None:
+        region = make_db_cache_region(DbCacheBackend.NONE)
+        self.assertEqual(self._get(region), 1)
+        self.assertEqual(self._get(region), 2)
+
+    def test_bad_config(self) -> None:
+        with self.assertRaises(ValueError):
+            make_db_cache_region("nonsense")
+        with self.assertRaises(ValueError):
+            make_db_cache_region(DbCacheBackend.REDIS)
@@ -28,7 +28,13 @@ camcops_server/cc_modules/cc_client_api_core.py
 
 """
 
-from typing import Any, Dict, Iterable, List, Optional, Set, TYPE_CHECKING
+from functools import partial
+import json
+import re
+from typing import (
+    Any, Callable, Dict, Generator, Iterable, List, Optional, Set, Tuple,
+    TYPE_CHECKING,
+)
 
 from cardinal_pythonlib.datetimefunc import format_datetime
 from cardinal_pythonlib.reprfunc import simple_repr
@@ -73,6 +79,7 @@ class TabletParam(object):
     bidirectional).
     """
     ADDRESS = "address"  # C->S, in JSON, v2.3.0
+    BINARY_PREFIX = "binary"  # C->S, multipart, v2.3.8
     CAMCOPS_VERSION = "camcops_version"  # C->S
     DATABASE_TITLE = "databaseTitle"  # S->C
     DATEVALUES = "datevalues"  # C->S
@@ -804,6 +811,233 @@ class UploadTableChanges(object):
         return f"{self.tablename} ({'; '.join(parts)})"
 
 
+# =============================================================================
+# Incremental decoding of the one-step upload's database JSON
+# =============================================================================
+
+REGEX_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_JSON_WS = r"[ \t\n\r]*"
+_JSON_STRING = r'"(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"'
+_JSON_SCALAR = (
+    r"(?:" + _JSON_STRING +
+    r"|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?"
+    r"|true|false|null)"
+)
+_JSON_MEMBER = _JSON_STRING + _JSON_WS + ":" + _JSON_WS + _JSON_SCALAR
+REGEX_JSON_FLAT_OBJECT = re.compile(
+    r"\{" + _JSON_WS +
+    r"(?:" + _JSON_MEMBER +
+    r"(?:" + _JSON_WS + "," + _JSON_WS + _JSON_MEMBER + r")*" +
+    _JSON_WS + r")?\}"
+)
+# ... a JSON object whose values are all strings, numbers, booleans or nulls
+
+
+class DbDataJsonStreamer(object):
+    """
+    Incremental decoder for the JSON sent as :attr:`TabletParam.DBDATA` by the
+    one-step upload. That is of the form
+
+    .. code-block:: none
+
+        {
+            "tablename1": [
+                {"colname1": "value1", "colname2": "value2", ...},
+                ...
+            ],
+            ...
+        }
+
+    Rather than decoding the whole structure at once, we make a single pass
+    to index where each table's row list starts (checking the syntax of each
+    row, but not decoding it), and then decode the rows of one table at a
+    time, on demand, via :meth:`gen_rows`. Tables can therefore be processed in any
+    order (as the upload requires; see
+    :func:`camcops_server.cc_modules.cc_client_api_helpers.upload_commit_order_sorter`),
+    and the memory required beyond the raw text depends on the largest
+    table, not the whole database.
+
+    Badly formed JSON, or JSON not of the structure above, raises
+    :exc:`UserErrorException`.
+    """  # noqa
+    _END = object()  # sentinel for the end of a JSON list
+
+    def __init__(self, text: str,
+                 decoder: json.JSONDecoder = None,
+                 description: str = TabletParam.DBDATA) -> None:
+        """
+        Args:
+            text: the raw JSON text
+            decoder: the JSON decoder object to use (for individual rows); if
+                ``None``, a default is created
+            description: what to call the JSON in error messages
+        """
+        self.text = text
+        self.decoder = decoder or json.JSONDecoder()
+        self.description = description
+        self._table_info = {}  # type: Dict[str, Tuple[int, int]]
+        # ... maps tablename to (offset of row list, number of rows)
+        self._index_tables()
+
+    def __repr__(self) -> str:
+        return simple_repr(self, ["description", "tablenames"])
+
+    # -------------------------------------------------------------------------
+    # Low-level scanning
+    # -------------------------------------------------------------------------
+
+    def _fail(self, pos: int, msg: str) -> None:
+        """
+        Raises :exc:`UserErrorException` about bad JSON at a given position.
+        """
+        fail_user_error(f"Bad JSON for key {self.description!r} at character "
+                        f"{pos}: {msg}")
+
+    def _skip_whitespace(self, pos: int) -> int:
+        """
+        Returns the position of the next non-whitespace character.
+        """
+        return REGEX_JSON_WHITESPACE.match(self.text, pos).end()
+
+    def _expect(self, pos: int, char: str) -> int:
+        """
+        Ensures that the next non-whitespace character is ``char``, and returns
+        the position just after it.
+        """
+        pos = self._skip_whitespace(pos)
+        if not self.text.startswith(char, pos):
+            self._fail(pos, f"expected {char!r}")
+        return pos + 1
+
+    def _decode_value(self, pos: int) -> Tuple[Any, int]:
+        """
+        Decodes a single JSON value starting at (or after whitespace from)
+        ``pos``. Returns ``value, position_after_value``.
+        """
+        pos = self._skip_whitespace(pos)
+        try:
+            return self.decoder.raw_decode(self.text, pos)
+        except json.JSONDecodeError as e:
+            self._fail(e.pos, e.msg)
+
+    def _skip_row(self, pos: int, tablename: str) -> Tuple[None, int]:
+        """
+        Skips over a row (a JSON object) starting at (or after whitespace
+        from) ``pos``, without decoding it if we can avoid that. Returns
+        ``None, position_after_row``.
+        """
+        pos = self._skip_whitespace(pos)
+        m = REGEX_JSON_FLAT_OBJECT.match(self.text, pos)
+        if m:
+            return None, m.end()
+        # Not a simple row; decode it, which also reports any error properly.
+        row, pos = self._decode_value(pos)
+        if not isinstance(row, dict):
+            self._fail(pos, f"row in table {tablename!r} is not a JSON object")
+        return None, pos
+
+    def _gen_list_items(
+            self, pos: int,
+            read_item: Callable[[int], Tuple[Any, int]] = None) \
+            -> Generator[Tuple[Any, int], None, None]:
+        """
+        Generates ``item, position_after_item`` for each item of the JSON list
+        starting at ``pos``. The last thing generated is ``_END,
+        position_after_closing_bracket``.
+
+        Items are read by ``read_item(pos)``, which returns ``item,
+        position_after_item``; by default, they are decoded.
+        """
+        text = self.text
+        read_item = read_item or self._decode_value
+        pos = self._expect(pos, "[")
+        pos = self._skip_whitespace(pos)
+        if text.startswith("]", pos):
+            yield self._END, pos + 1
+            return
+        while True:
+            item, pos = read_item(pos)
+            yield item, pos
+            pos = self._skip_whitespace(pos)
+            if text.startswith(",", pos):
+                pos += 1
+            elif text.startswith("]", pos):
+                yield self._END, pos + 1
+                return
+            else:
+                self._fail(pos, "expected ',' or ']'")
+
+    def _index_tables(self) -> None:
+        """
+        Scans the whole JSON structure, recording where each table's rows
+        start, and checking the structure as we go.
+        """
+        text = self.text
+        pos = self._expect(0, "{")
+        pos = self._skip_whitespace(pos)
+        if text.startswith("}", pos):
+            pos += 1
+        else:
+            while True:
+                tablename, pos = self._decode_value(pos)
+                if not isinstance(tablename, str):
+                    self._fail(pos, "table name is not a string")
+                pos = self._expect(pos, ":")
+                pos = self._skip_whitespace(pos)
+                start = pos
+                nrows = 0
+                skip_row = partial(self._skip_row, tablename=tablename)
+                for row, pos in self._gen_list_items(start,
+                                                     read_item=skip_row):
+                    if row is self._END:
+                        break
+                    nrows += 1
+                self._table_info[tablename] = (start, nrows)
+                pos = self._skip_whitespace(pos)
+                if text.startswith(",", pos):
+                    pos += 1
+                elif text.startswith("}", pos):
+                    pos += 1
+                    break
+                else:
+                    self._fail(pos, "expected ',' or '}'")
+        pos = self._skip_whitespace(pos)
+        if pos != len(text):
+            self._fail(pos, "extra data")
+
+    # -------------------------------------------------------------------------
+    # Public interface
+    # -------------------------------------------------------------------------
+
+    @property
+    def tablenames(self) -> List[str]:
+        """
+        The table names present, in the order they were sent.
+        """
+        return list(self._table_info.keys())
+
+    def n_rows(self, tablename: str) -> int:
+        """
+        The number of rows sent for a table (zero for an absent table).
+        """
+        return self._table_info.get(tablename, (None, 0))[1]
+
+    def gen_rows(self, tablename: str) \
+            -> Generator[Dict[str, Any], None, None]:
+        """
+        Generates the rows for a table, decoding them one at a time. Each is
+        a dictionary mapping column names to values. Generates nothing for an
+        absent table.
+        """
+        if tablename not in self._table_info:
+            return
+        start, _ = self._table_info[tablename]
+        for row, _ in self._gen_list_items(start):
+            if row is self._END:
+                return
+            yield row
+
+
 # =============================================================================
 # Value dictionaries for updating records, to reduce repetition
 # =============================================================================
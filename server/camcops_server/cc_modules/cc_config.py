@@ -113,13 +113,19 @@ from camcops_server.cc_modules.cc_baseconstants import (
     ALEMBIC_VERSION_TABLE,
     DEFAULT_EXTRA_STRINGS_DIR,
     ENVVAR_CONFIG_FILE,
+    LINUX_DEFAULT_EXPORT_STAGING_DIR,
     LINUX_DEFAULT_LOCK_DIR,
     LINUX_DEFAULT_MATPLOTLIB_CACHE_DIR,
     LINUX_DEFAULT_USER_DOWNLOAD_DIR,
     ON_READTHEDOCS,
     STATIC_ROOT_DIR,
 )
-from camcops_server.cc_modules.cc_cache import cache_region_static, fkg
+from camcops_server.cc_modules.cc_blobstore import configure_blob_store
+from camcops_server.cc_modules.cc_cache import (
+    cache_region_static,
+    configure_cache_region_db,
+    fkg,
+)
 from camcops_server.cc_modules.cc_constants import (
     CONFIG_FILE_EXPORT_SECTION,
     CONFIG_FILE_SERVER_SECTION,
@@ -138,7 +144,11 @@ from camcops_server.cc_modules.cc_filename import (
     PatientSpecElementForFilename,
 )
 from camcops_server.cc_modules.cc_group import is_group_name_valid
+from camcops_server.cc_modules.cc_imagecache import (
+    configure_derived_image_cache,
+)
 from camcops_server.cc_modules.cc_language import POSSIBLE_LOCALES
+from camcops_server.cc_modules.cc_pdf import configure_pdf_render_pool
 from camcops_server.cc_modules.cc_pyramid import MASTER_ROUTE_CLIENT_API
 from camcops_server.cc_modules.cc_snomed import (
     get_all_task_snomed_concepts,
@@ -146,6 +156,7 @@ from camcops_server.cc_modules.cc_snomed import (
     get_icd10_snomed_concepts_from_xml,
     SnomedConcept,
 )
+from camcops_server.cc_modules.cc_trackerplot import configure_tracker_plots
 from camcops_server.cc_modules.cc_version_string import (
     CAMCOPS_SERVER_VERSION_STRING,
 )
@@ -233,6 +244,16 @@ def get_demo_config(extra_strings_dir: str = None,
 {ConfigParamSite.DB_URL} = {db_url}
 {ConfigParamSite.DB_ECHO} = {cd.DB_ECHO}
 
+{ConfigParamSite.DB_CACHE_BACKEND} = {cd.DB_CACHE_BACKEND}
+{ConfigParamSite.DB_CACHE_URL} =
+{ConfigParamSite.DB_CACHE_EXPIRY_S} = {cd.DB_CACHE_EXPIRY_S}
+
+{ConfigParamSite.BLOB_STORE_BACKEND} = {cd.BLOB_STORE_BACKEND}
+{ConfigParamSite.BLOB_STORE_DIRECTORY} =
+
+{ConfigParamSite.DERIVED_IMAGE_CACHE_DIRECTORY} =
+{ConfigParamSite.DERIVED_IMAGE_CACHE_MAX_SIZE_MB} = {cd.DERIVED_IMAGE_CACHE_MAX_SIZE_MB}
+
 # -----------------------------------------------------------------------------
 # URLs and paths
 # -----------------------------------------------------------------------------
@@ -250,6 +271,11 @@ def get_demo_config(extra_strings_dir: str = None,
 {ConfigParamSite.SNOMED_ICD10_XML_FILENAME} =
 
 {ConfigParamSite.WKHTMLTOPDF_FILENAME} =
+{ConfigParamSite.PDF_WORKER_PROCESSES} = {cd.PDF_WORKER_PROCESSES}
+{ConfigParamSite.PDF_WORKER_TIMEOUT_S} = {cd.PDF_WORKER_TIMEOUT_S}
+{ConfigParamSite.PDF_WORKER_MEMORY_MB} = {cd.PDF_WORKER_MEMORY_MB}
+{ConfigParamSite.TRACKER_PLOT_PROCESSES} = {cd.TRACKER_PLOT_PROCESSES}
+{ConfigParamSite.TRACKER_PLOT_CACHE_MAX_SIZE_MB} = {cd.TRACKER_PLOT_CACHE_MAX_SIZE_MB}
 
 # -----------------------------------------------------------------------------
 # Login and session configuration
@@ -261,6 +287,8 @@ def get_demo_config(extra_strings_dir: str = None,
 {ConfigParamSite.LOCKOUT_THRESHOLD} = {cd.LOCKOUT_THRESHOLD}
 {ConfigParamSite.LOCKOUT_DURATION_INCREMENT_MINUTES} = {cd.LOCKOUT_DURATION_INCREMENT_MINUTES}
 {ConfigParamSite.DISABLE_PASSWORD_AUTOCOMPLETE} = {cd.DISABLE_PASSWORD_AUTOCOMPLETE}
+{ConfigParamSite.AUDIT_AGGREGATE_TASK_ACCESS} = {cd.AUDIT_AGGREGATE_TASK_ACCESS}
+{ConfigParamSite.AUDIT_ASYNC_CLIENT_API} = {cd.AUDIT_ASYNC_CLIENT_API}
 
 # -----------------------------------------------------------------------------
 # Suggested filenames for saving PDFs from the web view
@@ -376,6 +404,7 @@ def get_demo_config(extra_strings_dir: str = None,
 {ConfigParamExportGeneral.CELERY_WORKER_EXTRA_ARGS} =
 {ConfigParamExportGeneral.CELERY_EXPORT_TASK_RATE_LIMIT} = 100/m
 {ConfigParamExportGeneral.EXPORT_LOCKDIR} = {lock_dir}
+{ConfigParamExportGeneral.EXPORT_STAGING_DIR} = {LINUX_DEFAULT_EXPORT_STAGING_DIR}
 
 {ConfigParamExportGeneral.RECIPIENTS} =
 
@@ -471,6 +500,8 @@ def get_demo_config(extra_strings_dir: str = None,
 {ConfigParamExportRecipient.HL7_PORT} = {cd.HL7_PORT}
 {ConfigParamExportRecipient.HL7_PING_FIRST} = {cd.HL7_PING_FIRST}
 {ConfigParamExportRecipient.HL7_NETWORK_TIMEOUT_MS} = {cd.HL7_NETWORK_TIMEOUT_MS}
+{ConfigParamExportRecipient.HL7_PERSISTENT_CONNECTION} = {cd.HL7_PERSISTENT_CONNECTION}
+{ConfigParamExportRecipient.HL7_PIPELINE_WINDOW} = {cd.HL7_PIPELINE_WINDOW}
 {ConfigParamExportRecipient.HL7_KEEP_MESSAGE} = {cd.HL7_KEEP_MESSAGE}
 {ConfigParamExportRecipient.HL7_KEEP_REPLY} = {cd.HL7_KEEP_REPLY}
 {ConfigParamExportRecipient.HL7_DEBUG_DIVERT_TO_FILE} = {cd.HL7_DEBUG_DIVERT_TO_FILE}
@@ -1052,6 +1083,18 @@ class CamcopsConfig(object):
         self.allow_insecure_cookies = _get_bool(
             s, cs.ALLOW_INSECURE_COOKIES, cd.ALLOW_INSECURE_COOKIES)
 
+        self.audit_aggregate_task_access = _get_bool(
+            s, cs.AUDIT_AGGREGATE_TASK_ACCESS, cd.AUDIT_AGGREGATE_TASK_ACCESS)
+        self.audit_async_client_api = _get_bool(
+            s, cs.AUDIT_ASYNC_CLIENT_API, cd.AUDIT_ASYNC_CLIENT_API)
+
+        self.blob_store_backend = _get_str(
+            s, cs.BLOB_STORE_BACKEND, cd.BLOB_STORE_BACKEND).lower()
+        self.blob_store_directory = _get_str(s, cs.BLOB_STORE_DIRECTORY, "")
+        configure_blob_store(backend=self.blob_store_backend,
+                             directory=self.blob_store_directory)
+        # ... MUTABLE GLOBAL STATE (but only the first config read counts)
+
         self.camcops_logo_file_absolute = _get_str(
             s, cs.CAMCOPS_LOGO_FILE_ABSOLUTE, cd.CAMCOPS_LOGO_FILE_ABSOLUTE)
         self.ctv_filename_spec = _get_str(s, cs.CTV_FILENAME_SPEC)
@@ -1059,6 +1102,24 @@ class CamcopsConfig(object):
         self.db_url = parser.get(s, cs.DB_URL)
         # ... no default: will fail if not provided
         self.db_echo = _get_bool(s, cs.DB_ECHO, cd.DB_ECHO)
+        self.db_cache_backend = _get_str(
+            s, cs.DB_CACHE_BACKEND, cd.DB_CACHE_BACKEND).lower()
+        self.db_cache_expiry_s = _get_int(
+            s, cs.DB_CACHE_EXPIRY_S, cd.DB_CACHE_EXPIRY_S)
+        self.db_cache_url = _get_str(s, cs.DB_CACHE_URL, "")
+        configure_cache_region_db(backend=self.db_cache_backend,
+                                  url=self.db_cache_url,
+                                  expiration_time_s=self.db_cache_expiry_s)
+        # ... MUTABLE GLOBAL STATE (but only the first config read counts)
+        self.derived_image_cache_directory = _get_str(
+            s, cs.DERIVED_IMAGE_CACHE_DIRECTORY, "")
+        self.derived_image_cache_max_size_mb = _get_int(
+            s, cs.DERIVED_IMAGE_CACHE_MAX_SIZE_MB,
+            cd.DERIVED_IMAGE_CACHE_MAX_SIZE_MB)
+        configure_derived_image_cache(
+            directory=self.derived_image_cache_directory,
+            max_size_mb=self.derived_image_cache_max_size_mb)
+        # ... MUTABLE GLOBAL STATE (but only the first config read counts)
         self.client_api_loglevel = get_config_parameter_loglevel(
             parser, s, cs.CLIENT_API_LOGLEVEL, cd.CLIENT_API_LOGLEVEL)
         logging.getLogger("camcops_server.cc_modules.client_api")\
@@ -1148,6 +1209,15 @@ class CamcopsConfig(object):
 
         self.task_filename_spec = _get_str(s, cs.TASK_FILENAME_SPEC)
         self.tracker_filename_spec = _get_str(s, cs.TRACKER_FILENAME_SPEC)
+        self.tracker_plot_processes = _get_int(
+            s, cs.TRACKER_PLOT_PROCESSES, cd.TRACKER_PLOT_PROCESSES)
+        self.tracker_plot_cache_max_size_mb = _get_int(
+            s, cs.TRACKER_PLOT_CACHE_MAX_SIZE_MB,
+            cd.TRACKER_PLOT_CACHE_MAX_SIZE_MB)
+        configure_tracker_plots(
+            processes=self.tracker_plot_processes,
+            cache_max_size_mb=self.tracker_plot_cache_max_size_mb)
+        # ... MUTABLE GLOBAL STATE (but only the first config read counts)
 
         self.user_download_dir = _get_str(s, cs.USER_DOWNLOAD_DIR, "")
         self.user_download_file_lifetime_min = _get_int(
@@ -1162,6 +1232,16 @@ class CamcopsConfig(object):
         logging.getLogger().setLevel(self.webview_loglevel)  # root logger
         # ... MUTABLE GLOBAL STATE (if relatively unimportant); todo: fix
         self.wkhtmltopdf_filename = _get_str(s, cs.WKHTMLTOPDF_FILENAME)
+        self.pdf_worker_processes = _get_int(
+            s, cs.PDF_WORKER_PROCESSES, cd.PDF_WORKER_PROCESSES)
+        self.pdf_worker_timeout_s = _get_int(
+            s, cs.PDF_WORKER_TIMEOUT_S, cd.PDF_WORKER_TIMEOUT_S)
+        self.pdf_worker_memory_mb = _get_int(
+            s, cs.PDF_WORKER_MEMORY_MB, cd.PDF_WORKER_MEMORY_MB)
+        configure_pdf_render_pool(processes=self.pdf_worker_processes,
+                                  timeout_s=self.pdf_worker_timeout_s,
+                                  memory_mb=self.pdf_worker_memory_mb)
+        # ... MUTABLE GLOBAL STATE (but only the first config read counts)
 
         # More validity checks for the main section:
         if not self.patient_spec_if_anonymous:
@@ -1261,6 +1341,7 @@ class CamcopsConfig(object):
         self.export_lockdir = _get_str(es, ce.EXPORT_LOCKDIR)
         if not self.export_lockdir:
             raise_missing(es, ConfigParamExportGeneral.EXPORT_LOCKDIR)
+        self.export_staging_dir = _get_str(es, ce.EXPORT_STAGING_DIR, "")
 
         self.export_recipient_names = _get_multiline_ignoring_comments(
             CONFIG_FILE_EXPORT_SECTION, ce.RECIPIENTS)
@@ -1520,6 +1601,21 @@ class CamcopsConfig(object):
         # ".lock" is appended automatically by the lockfile package
         return os.path.join(self.export_lockdir, filename)
 
+    def get_export_db_staging_dir(self, recipient_name: str) -> str:
+        """
+        Returns a full path to a directory used to assemble a whole-database
+        export to a particular export recipient, when that export runs via the
+        back end.
+
+        Args:
+            recipient_name: name of the recipient
+
+        Returns:
+            a directory name
+        """
+        dirname = f"camcops_export_db_{recipient_name}"
+        return os.path.join(self.export_staging_dir, dirname)
+
     def get_export_lockfilename_task(self, recipient_name: str,
                                      basetable: str, pk: int) -> str:
         """
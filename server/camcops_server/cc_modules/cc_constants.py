@@ -323,11 +323,20 @@ class ConfigParamSite(object):
     file.
     """
     ALLOW_INSECURE_COOKIES = "ALLOW_INSECURE_COOKIES"
+    AUDIT_AGGREGATE_TASK_ACCESS = "AUDIT_AGGREGATE_TASK_ACCESS"
+    AUDIT_ASYNC_CLIENT_API = "AUDIT_ASYNC_CLIENT_API"
+    BLOB_STORE_BACKEND = "BLOB_STORE_BACKEND"
+    BLOB_STORE_DIRECTORY = "BLOB_STORE_DIRECTORY"
     CAMCOPS_LOGO_FILE_ABSOLUTE = "CAMCOPS_LOGO_FILE_ABSOLUTE"
     CLIENT_API_LOGLEVEL = "CLIENT_API_LOGLEVEL"
     CTV_FILENAME_SPEC = "CTV_FILENAME_SPEC"
+    DB_CACHE_BACKEND = "DB_CACHE_BACKEND"
+    DB_CACHE_EXPIRY_S = "DB_CACHE_EXPIRY_S"
+    DB_CACHE_URL = "DB_CACHE_URL"
     DB_URL = "DB_URL"
     DB_ECHO = "DB_ECHO"
+    DERIVED_IMAGE_CACHE_DIRECTORY = "DERIVED_IMAGE_CACHE_DIRECTORY"
+    DERIVED_IMAGE_CACHE_MAX_SIZE_MB = "DERIVED_IMAGE_CACHE_MAX_SIZE_MB"
     DISABLE_PASSWORD_AUTOCOMPLETE = "DISABLE_PASSWORD_AUTOCOMPLETE"
     EMAIL_FROM = "EMAIL_FROM"
     EMAIL_HOST = "EMAIL_HOST"
@@ -346,6 +355,9 @@ class ConfigParamSite(object):
     PASSWORD_CHANGE_FREQUENCY_DAYS = "PASSWORD_CHANGE_FREQUENCY_DAYS"
     PATIENT_SPEC = "PATIENT_SPEC"
     PATIENT_SPEC_IF_ANONYMOUS = "PATIENT_SPEC_IF_ANONYMOUS"
+    PDF_WORKER_MEMORY_MB = "PDF_WORKER_MEMORY_MB"
+    PDF_WORKER_PROCESSES = "PDF_WORKER_PROCESSES"
+    PDF_WORKER_TIMEOUT_S = "PDF_WORKER_TIMEOUT_S"
     PERMIT_IMMEDIATE_DOWNLOADS = "PERMIT_IMMEDIATE_DOWNLOADS"
     RESTRICTED_TASKS = "RESTRICTED_TASKS"
     SESSION_COOKIE_SECRET = "SESSION_COOKIE_SECRET"
@@ -355,6 +367,8 @@ class ConfigParamSite(object):
     SNOMED_ICD10_XML_FILENAME = "SNOMED_ICD10_XML_FILENAME"
     TASK_FILENAME_SPEC = "TASK_FILENAME_SPEC"
     TRACKER_FILENAME_SPEC = "TRACKER_FILENAME_SPEC"
+    TRACKER_PLOT_CACHE_MAX_SIZE_MB = "TRACKER_PLOT_CACHE_MAX_SIZE_MB"
+    TRACKER_PLOT_PROCESSES = "TRACKER_PLOT_PROCESSES"
     USER_DOWNLOAD_DIR = "USER_DOWNLOAD_DIR"
     USER_DOWNLOAD_FILE_LIFETIME_MIN = "USER_DOWNLOAD_FILE_LIFETIME_MIN"
     USER_DOWNLOAD_MAX_SPACE_MB = "USER_DOWNLOAD_MAX_SPACE_MB"
@@ -407,6 +421,7 @@ class ConfigParamExportGeneral(object):
     CELERY_WORKER_EXTRA_ARGS = "CELERY_WORKER_EXTRA_ARGS"
     CELERY_EXPORT_TASK_RATE_LIMIT = "CELERY_EXPORT_TASK_RATE_LIMIT"
     EXPORT_LOCKDIR = "EXPORT_LOCKDIR"
+    EXPORT_STAGING_DIR = "EXPORT_STAGING_DIR"
     RECIPIENTS = "RECIPIENTS"
     SCHEDULE = "SCHEDULE"
     SCHEDULE_TIMEZONE = "SCHEDULE_TIMEZONE"
@@ -450,7 +465,9 @@ class ConfigParamExportRecipient(object):
     HL7_KEEP_MESSAGE = "HL7_KEEP_MESSAGE"
     HL7_KEEP_REPLY = "HL7_KEEP_REPLY"
     HL7_NETWORK_TIMEOUT_MS = "HL7_NETWORK_TIMEOUT_MS"
+    HL7_PERSISTENT_CONNECTION = "HL7_PERSISTENT_CONNECTION"
     HL7_PING_FIRST = "HL7_PING_FIRST"
+    HL7_PIPELINE_WINDOW = "HL7_PIPELINE_WINDOW"
     HL7_PORT = "HL7_PORT"
     IDNUM_AA_PREFIX = "IDNUM_AA_"  # unusual; prefix not parameter
     IDNUM_TYPE_PREFIX = "IDNUM_TYPE_"  # unusual; prefix not parameter
@@ -489,13 +506,19 @@ class ConfigDefaults(object):
     """
     # [site] section
     ALLOW_INSECURE_COOKIES = False
+    AUDIT_AGGREGATE_TASK_ACCESS = False
+    AUDIT_ASYNC_CLIENT_API = False
+    BLOB_STORE_BACKEND = "none"
     CAMCOPS_LOGO_FILE_ABSOLUTE = os.path.join(STATIC_ROOT_DIR,
                                               "logo_camcops.png")
     CLIENT_API_LOGLEVEL = logging.INFO
     CLIENT_API_LOGLEVEL_TEXTFORMAT = "info"  # should match CLIENT_API_LOGLEVEL
+    DB_CACHE_BACKEND = "none"
+    DB_CACHE_EXPIRY_S = 300
     DB_ECHO = False
     DB_PORT = 3306
     DB_SERVER = "localhost"
+    DERIVED_IMAGE_CACHE_MAX_SIZE_MB = 256
     DISABLE_PASSWORD_AUTOCOMPLETE = True
     EMAIL_PORT = SMTP_TLS_PORT  # or SMTP_PORT
     EMAIL_USE_TLS = True
@@ -506,8 +529,13 @@ class ConfigDefaults(object):
     LOCKOUT_THRESHOLD = 10
     PASSWORD_CHANGE_FREQUENCY_DAYS = 0  # zero for never
     PATIENT_SPEC_IF_ANONYMOUS = "anonymous"
+    PDF_WORKER_MEMORY_MB = 4096
+    PDF_WORKER_PROCESSES = 0  # render in the calling process
+    PDF_WORKER_TIMEOUT_S = 300
     PERMIT_IMMEDIATE_DOWNLOADS = False
     SESSION_TIMEOUT_MINUTES = 30
+    TRACKER_PLOT_CACHE_MAX_SIZE_MB = 64
+    TRACKER_PLOT_PROCESSES = 0  # draw in the calling thread
     USER_DOWNLOAD_FILE_LIFETIME_MIN = 60
     USER_DOWNLOAD_MAX_SPACE_MB = 100
     WEBVIEW_LOGLEVEL = logging.INFO
@@ -558,7 +586,9 @@ class ConfigDefaults(object):
     HL7_KEEP_MESSAGE = False
     HL7_KEEP_REPLY = False
     HL7_NETWORK_TIMEOUT_MS = 10000
+    HL7_PERSISTENT_CONNECTION = False
     HL7_PING_FIRST = True
+    HL7_PIPELINE_WINDOW = 1
     HL7_PORT = DEFAULT_HL7_MLLP_PORT
     INCLUDE_ANONYMOUS = False
     PUSH = False
@@ -30,13 +30,19 @@ client.**
 """
 
 from collections import OrderedDict
+import datetime
 import logging
 from typing import (Any, Callable, Dict, Generator, Iterable, List, Optional,
                     Set, Tuple, Type, TYPE_CHECKING, TypeVar, Union)
 
+from cardinal_pythonlib.datetimefunc import (
+    coerce_to_pendulum,
+    pendulum_to_utc_datetime_without_tz,
+)
 from cardinal_pythonlib.logs import BraceStyleAdapter
 from cardinal_pythonlib.sqlalchemy.orm_inspect import gen_columns
 from pendulum import DateTime as Pendulum
+from pendulum.parsing.exceptions import ParserError
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.relationships import RelationshipProperty
@@ -236,6 +242,28 @@ TFN_WHEN_FIRSTEXIT = "when_firstexit"
 TFN_FIRSTEXIT_IS_FINISH = "firstexit_is_finish"
 TFN_FIRSTEXIT_IS_ABORT = "firstexit_is_abort"
 TFN_EDITING_TIME_S = "editing_time_s"
+# Server-side copy of when_created, as a UTC DATETIME, for indexed filtering:
+TFN_WHEN_CREATED_UTC = "_when_created_utc"
+
+# Server-side fieldnames of the BLOB table, used when the BLOB's content is
+# held in the BLOB store (see cc_blobstore.py). Do not change.
+BFN_BLOB_SHA256 = "_blob_sha256"
+BFN_BLOB_SIZE = "_blob_size"
+
+
+def when_created_to_utc_datetime(value: Any) -> Optional[datetime.datetime]:
+    """
+    Converts a task creation date/time (as a Pendulum or other datetime, or
+    as our ISO-8601 text) to the timezone-naive UTC ``DATETIME`` value stored
+    in the ``_when_created_utc`` column. Returns ``None`` for missing or
+    unparseable values.
+    """
+    if value is None:
+        return None
+    try:
+        return pendulum_to_utc_datetime_without_tz(coerce_to_pendulum(value))
+    except (ParserError, TypeError, ValueError):
+        return None
 
 
 # =============================================================================
@@ -471,6 +499,9 @@ class GenericTabletRecordMixin(object):
         FN_ADDITION_PENDING,
         FN_REMOVAL_PENDING,
         FN_GROUP_ID,
+        TFN_WHEN_CREATED_UTC,  # tasks only
+        BFN_BLOB_SHA256,  # BLOBs only
+        BFN_BLOB_SIZE,  # BLOBs only
     ]  # but more generally: they start with "_"...
     assert(all(x.startswith("_") for x in RESERVED_FIELDS))
 
@@ -650,8 +681,8 @@ class GenericTabletRecordMixin(object):
         row = OrderedDict()
         for attrname, column in gen_columns(self):
             row[heading_prefix + attrname] = getattr(self, attrname)
-        for s in self.get_summaries(req):
-            row[heading_prefix + s.name] = s.value
+        for name, value in self.get_summary_values(req).items():
+            row[heading_prefix + name] = value
         return TsvPage(name=self.__tablename__, rows=[row])
 
     # -------------------------------------------------------------------------
@@ -926,6 +957,14 @@ class GenericTabletRecordMixin(object):
         """
         return [x.name for x in self.get_summaries(req)]
 
+    def get_summary_values(self, req: "CamcopsRequest") -> Dict[str, Any]:
+        """
+        Returns the values of this object's summaries (see
+        :meth:`get_summaries`), as an ordered mapping from summary name to
+        value.
+        """
+        return OrderedDict((s.name, s.value) for s in self.get_summaries(req))
+
 
 # =============================================================================
 # Relationships
@@ -962,6 +1001,8 @@ def ancillary_relationship(
         viewonly=read_only,
         info={
             RelationshipInfo.IS_ANCILLARY: True,
+            RelationshipInfo.ANCILLARY_FK_TO_PARENT:
+                ancillary_fk_to_parent_attr_name,
         },
         # ... "info" is a user-defined dictionary; see
         # http://docs.sqlalchemy.org/en/latest/orm/relationship_api.html#sqlalchemy.orm.relationship.params.info  # noqa
@@ -28,7 +28,9 @@ camcops_server/cc_modules/cc_dump.py
 
 """
 
+from itertools import islice
 import logging
+import os
 from typing import (
     Any, Dict, Generator, Iterable, List, Optional, Set, Tuple, Type,
     TYPE_CHECKING, Union,
@@ -40,13 +42,21 @@ from cardinal_pythonlib.sqlalchemy.orm_inspect import (
     gen_orm_classes_from_base,
     walk_orm_tree,
 )
+from cardinal_pythonlib.sqlalchemy.schema import (
+    get_column_names,
+    get_table_names,
+)
 from sqlalchemy.exc import CompileError
+from sqlalchemy.engine import create_engine
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import Session as SqlASession
+from sqlalchemy.orm import Session as SqlASession, sessionmaker
+from sqlalchemy.sql.expression import select
 from sqlalchemy.sql.schema import Column, MetaData, Table
 
 from camcops_server.cc_modules.cc_blob import Blob
 from camcops_server.cc_modules.cc_db import (
+    BFN_BLOB_SHA256,
+    BFN_BLOB_SIZE,
     GenericTabletRecordMixin,
     TaskDescendant,
 )
@@ -67,13 +77,19 @@ from camcops_server.cc_modules.cc_patientidnum import (
     PatientIdNum,
 )
 from camcops_server.cc_modules.cc_sqla_coltypes import CamcopsColumn
+from camcops_server.cc_modules.cc_simpleobjects import TaskExportOptions
+from camcops_server.cc_modules.cc_sqlalchemy import Base
 from camcops_server.cc_modules.cc_task import Task
+from camcops_server.cc_modules.cc_tasksummary import (
+    DEFAULT_SUMMARY_CHUNK_SIZE,
+    preload_stored_summaries,
+)
+from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
 from camcops_server.cc_modules.cc_user import User
 
 if TYPE_CHECKING:
     from camcops_server.cc_modules.cc_request import CamcopsRequest
     from camcops_server.cc_modules.cc_summaryelement import ExtraSummaryTable
-    from camcops_server.cc_modules.cc_simpleobjects import TaskExportOptions
 
 log = BraceStyleAdapter(logging.getLogger(__name__))
 
@@ -98,6 +114,12 @@ DUMP_ONLY_COLNAMES = {  # mapping of tablename : list_of_column_names
 }
 # Drop specific columns from certain tables:
 DUMP_DROP_COLNAMES = {  # mapping of tablename : list_of_column_names
+    # Dumps are self-contained; BLOB content is copied into "theblob" even if
+    # it lives in the BLOB store, so references to the store are irrelevant.
+    Blob.__tablename__: [
+        BFN_BLOB_SHA256,
+        BFN_BLOB_SIZE,
+    ],
 }
 # List of columns to be skipped regardless of table:
 DUMP_SKIP_COLNAMES = [
@@ -140,6 +162,8 @@ DUMP_SKIP_ALL_RELS_FOR_TABLES = [
 ]
 FOREIGN_KEY_CONSTRAINTS_IN_DUMP = False
 # ... the keys will be present, but should we try to enforce constraints?
+PARTIAL_DUMP_COPY_BATCH_SIZE = 1000
+# ... rows copied at a time from a partial dump; see copy_partial_dumps()
 
 
 # =============================================================================
@@ -155,18 +179,23 @@ class DumpController(object):
                  dst_engine: Engine,
                  dst_session: SqlASession,
                  export_options: "TaskExportOptions",
-                 req: "CamcopsRequest") -> None:
+                 req: "CamcopsRequest",
+                 existing_tables_ok: bool = False) -> None:
         """
         Args:
             dst_engine: destination SQLAlchemy Engine
             dst_session:  destination SQLAlchemy Session
             export_options: :class:`camcops_server.cc_modules.cc_simpleobjects.TaskExportOptions`
             req: :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            existing_tables_ok: may destination tables exist already (e.g.
+                created by an earlier attempt that failed before copying any
+                rows)? If not, that is an error.
         """  # noqa
         self.dst_engine = dst_engine
         self.dst_session = dst_session
         self.export_options = export_options
         self.req = req
+        self.existing_tables_ok = existing_tables_ok
 
         # We start with blank metadata.
         self.dst_metadata = MetaData()
@@ -181,6 +210,8 @@ class DumpController(object):
         self.tablenames_seen = set()  # type: Set[str]
         # ORM objects we've visited:
         self.instances_seen = set()  # type: Set[object]
+        # Primary keys of rows copied from partial dumps, by table:
+        self.pks_copied = {}  # type: Dict[str, Set[Tuple[Any, ...]]]
 
         if export_options.db_make_all_tables_even_empty:
             self._create_all_dest_tables()
@@ -376,6 +407,75 @@ class DumpController(object):
         self.dst_tables[tablename] = dst_table
         return dst_table
 
+    def get_dest_table_for_src_tablename(self, tablename: str) \
+            -> Optional[Table]:
+        """
+        Produces the destination table for a source table, by name, or
+        ``None`` if there is no ORM class for that table.
+        """
+        if tablename in self.dst_tables:
+            return self.dst_tables[tablename]
+        for cls in gen_orm_classes_from_base(Base):
+            if getattr(cls, "__tablename__", None) == tablename:
+                return self.get_dest_table_for_src_object(cls())
+        return None
+
+    def create_dest_tables_for_partial_dump(self, src_engine: Engine) -> None:
+        """
+        Creates destination tables for all the tables in a partial dump (made
+        by :func:`copy_tasks_and_summaries` for a subset of tasks).
+
+        Args:
+            src_engine: SQLAlchemy Engine for the partial dump
+        """
+        for tablename in get_table_names(src_engine):
+            dst_table = self.get_dest_table_for_src_tablename(tablename)
+            if dst_table is None:
+                log.warning("Skipping table {!r} from partial dump; not known",
+                            tablename)
+                continue
+            self._create_dest_table(dst_table)
+
+    def copy_partial_dump(self, src_engine: Engine) -> None:
+        """
+        Copies the rows of a partial dump into our destination. Call
+        :meth:`create_dest_tables_for_partial_dump` first.
+
+        Rows we have already copied from another partial dump (e.g. a patient
+        or device shared by tasks in different partial dumps) are recognized
+        by their primary key, and copied only once.
+
+        Args:
+            src_engine: SQLAlchemy Engine for the partial dump
+        """
+        for tablename in get_table_names(src_engine):
+            if tablename not in self.tablenames_created:
+                continue
+            dst_table = self.dst_tables[tablename]
+            src_colnames = set(get_column_names(src_engine, tablename))
+            columns = [c for c in dst_table.columns if c.name in src_colnames]
+            colnames = [c.name for c in columns]
+            pk_colnames = [c.name for c in dst_table.primary_key.columns]
+            pks_copied = self.pks_copied.setdefault(tablename, set())
+            # Reading via the destination table's columns means that values
+            # come back with the same Python types that were written.
+            result = src_engine.execute(select(columns))
+            while True:
+                rows = result.fetchmany(PARTIAL_DUMP_COPY_BATCH_SIZE)
+                if not rows:
+                    break
+                batch = []  # type: List[Dict[str, Any]]
+                for row in rows:
+                    values = dict(zip(colnames, row))
+                    if pk_colnames:
+                        pk = tuple(values.get(c) for c in pk_colnames)
+                        if pk in pks_copied:
+                            continue
+                        pks_copied.add(pk)
+                    batch.append(values)
+                if batch:
+                    self.dst_session.execute(dst_table.insert(), batch)
+
     def get_dest_table_for_est(self, est: "ExtraSummaryTable",
                                add_extra_id_cols: bool = False) -> Table:
         """
@@ -449,7 +549,7 @@ class DumpController(object):
         #     "sqlalchemy.exc.OperationalError: (sqlite3.OperationalError)
         #     database is locked", since a session is also being used.
         self.dst_session.commit()
-        dst_table.create(self.dst_engine)
+        dst_table.create(self.dst_engine, checkfirst=self.existing_tables_ok)
         self.tablenames_created.add(tablename)
 
     def _copy_object_to_dump(self, src_obj: object) -> None:
@@ -475,11 +575,18 @@ class DumpController(object):
             if self._dump_skip_column(tablename, column.name):
                 continue
             row[column.name] = getattr(src_obj, attrname)
+        if (isinstance(src_obj, Blob) and src_obj.is_in_blob_store and
+                Blob.theblob.name in row):
+            row[Blob.theblob.name] = src_obj.get_blob_bytes()
         # Any other columns to add for this table?
         if isinstance(src_obj, GenericTabletRecordMixin):
             if self.export_options.db_include_summaries:
-                for summary_element in src_obj.get_summaries(self.req):
-                    row[summary_element.name] = summary_element.value
+                for name, value in src_obj.get_summary_values(
+                        self.req).items():
+                    # Stored summaries from older scoring code may not match
+                    # the columns; ignore any that don't.
+                    if name in dst_table.columns:
+                        row[name] = value
             if adding_extra_ids:
                 if patient:
                     patient.add_extra_idnum_info_to_row(row)
@@ -601,14 +708,175 @@ def copy_tasks_and_summaries(tasks: Iterable[Task],
                                 req=req)
 
     # We walk through all the objects.
+    skip_tables = list(DUMP_SKIP_TABLES)
+    if not export_options.include_blobs:
+        # Don't even walk to BLOBs. (Their content is deferred, so loading
+        # them wouldn't read it, but there's no point.)
+        skip_tables.append(Blob.__tablename__)
     log.debug("Starting to copy tasks...")
-    for startobj in tasks:
-        log.debug("Processing task: {!r}", startobj)
-        for src_obj in walk_orm_tree(
-                startobj,
-                seen=controller.instances_seen,
-                skip_relationships_always=DUMP_SKIP_RELNAMES,
-                skip_all_relationships_for_tablenames=DUMP_SKIP_ALL_RELS_FOR_TABLES,  # noqa
-                skip_all_objects_for_tablenames=DUMP_SKIP_TABLES):
-            controller.consider_object(src_obj)
+    tasks = iter(tasks)
+    while True:
+        task_chunk = list(islice(tasks, DEFAULT_SUMMARY_CHUNK_SIZE))
+        if not task_chunk:
+            break
+        if export_options.db_include_summaries:
+            # Read stored task summaries in bulk, rather than calculating
+            # them task by task.
+            preload_stored_summaries(req, task_chunk)
+        for startobj in task_chunk:
+            log.debug("Processing task: {!r}", startobj)
+            for src_obj in walk_orm_tree(
+                    startobj,
+                    seen=controller.instances_seen,
+                    skip_relationships_always=DUMP_SKIP_RELNAMES,
+                    skip_all_relationships_for_tablenames=DUMP_SKIP_ALL_RELS_FOR_TABLES,  # noqa
+                    skip_all_objects_for_tablenames=skip_tables):
+                controller.consider_object(src_obj)
+    req.stored_task_summaries.clear()  # e.g. tasks whose tables were skipped
     log.debug("... finished copying tasks.")
+
+
+def copy_partial_dumps(src_engines: Iterable[Engine],
+                       dst_engine: Engine,
+                       dst_session: SqlASession,
+                       export_options: "TaskExportOptions",
+                       req: "CamcopsRequest") -> None:
+    """
+    Combine several partial dumps, each made by
+    :func:`copy_tasks_and_summaries` for a different subset of tasks (e.g. in
+    parallel, by different processes), into one dump. The result is the same
+    as calling :func:`copy_tasks_and_summaries` for all the tasks.
+
+    Destination tables that exist already are used, not created; tables are
+    created outside the transaction in which rows are copied, so may survive
+    an attempt that fails.
+
+    Args:
+        src_engines: SQLAlchemy Engines for the partial dumps
+        dst_engine: destination SQLAlchemy Engine
+        dst_session:  destination SQLAlchemy Session
+        export_options: :class:`camcops_server.cc_modules.cc_simpleobjects.TaskExportOptions`
+        req: :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+    """  # noqa
+    controller = DumpController(dst_engine=dst_engine,
+                                dst_session=dst_session,
+                                export_options=export_options,
+                                req=req,
+                                existing_tables_ok=True)
+    src_engines = list(src_engines)
+    # Create all the tables first. (Creating a table commits the destination
+    # session, so the rows can then be written in a single transaction.)
+    for src_engine in src_engines:
+        controller.create_dest_tables_for_partial_dump(src_engine)
+    log.debug("Starting to copy partial dumps...")
+    for src_engine in src_engines:
+        log.debug("Copying partial dump: {}", src_engine.url)
+        controller.copy_partial_dump(src_engine)
+    log.debug("... finished copying partial dumps.")
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class PartialDumpTests(DemoDatabaseTestCase):
+    """
+    Tests that :func:`copy_partial_dumps` gives the same result as
+    :func:`copy_tasks_and_summaries`.
+    """
+    export_options = TaskExportOptions(
+        include_blobs=True,
+        db_patient_id_per_row=True,
+        db_include_summaries=True,
+    )
+
+    def _all_tasks(self) -> List[Task]:
+        tasks = []  # type: List[Task]
+        for cls in Task.all_subclasses_by_tablename():
+            tasks.extend(self.dbsession.query(cls).all())
+        return tasks
+
+    def _make_engine(self, name: str) -> Engine:
+        filename = os.path.join(self.tmpdir_obj.name, name + ".sqlite")
+        return create_engine("sqlite:///" + filename, echo=False)
+
+    def _dump(self, tasks: List[Task], name: str) -> Engine:
+        engine = self._make_engine(name)
+        session = sessionmaker(bind=engine)()  # type: SqlASession
+        copy_tasks_and_summaries(tasks=tasks,
+                                 dst_engine=engine,
+                                 dst_session=session,
+                                 export_options=self.export_options,
+                                 req=self.req)
+        session.commit()
+        session.close()
+        return engine
+
+    @staticmethod
+    def _contents(engine: Engine) -> Dict[str, List[str]]:
+        contents = {}  # type: Dict[str, List[str]]
+        for tablename in get_table_names(engine):
+            table = Table(tablename, MetaData(),
+                          autoload=True, autoload_with=engine)
+            contents[tablename] = sorted(
+                repr(tuple(row)) for row in engine.execute(select([table])))
+        return contents
+
+    def test_partial_dumps_match_whole_dump(self) -> None:
+        tasks = self._all_tasks()
+        self.assertGreater(len(tasks), 2)
+        # Split by table, so both halves refer to both patients, and to the
+        # same device.
+        tasks.sort(key=lambda t: t.tablename)
+        half = len(tasks) // 2
+        if tasks[half - 1].tablename == tasks[half].tablename:
+            half += 1
+        src_engines = [self._dump(tasks[:half], "part_a"),
+                       self._dump(tasks[half:], "part_b")]
+        whole_engine = self._dump(tasks, "whole")
+
+        dst_engine = self._make_engine("combined")
+        dst_session = sessionmaker(bind=dst_engine)()  # type: SqlASession
+        copy_partial_dumps(src_engines=src_engines,
+                           dst_engine=dst_engine,
+                           dst_session=dst_session,
+                           export_options=self.export_options,
+                           req=self.req)
+        dst_session.commit()
+        dst_session.close()
+
+        combined = self._contents(dst_engine)
+        # Shared patient and device rows were copied once only.
+        for tablename in (Patient.__tablename__, Device.__tablename__):
+            self.assertIn(tablename, combined)
+            self.assertEqual(len(combined[tablename]),
+                             len(set(combined[tablename])))
+            for src_engine in src_engines:
+                self.assertEqual(self._contents(src_engine)[tablename],
+                                 combined[tablename])
+        self.assertEqual(combined, self._contents(whole_engine))
+
+        for engine in src_engines + [whole_engine, dst_engine]:
+            engine.dispose()
+
+    def test_existing_tables_ok(self) -> None:
+        # For example, after an attempt that created the tables then failed.
+        tasks = self._all_tasks()
+        src_engines = [self._dump(tasks, "part")]
+        dst_engine = self._make_engine("combined")
+        for attempt in range(2):
+            dst_session = sessionmaker(bind=dst_engine)()  # type: SqlASession  # noqa
+            copy_partial_dumps(src_engines=src_engines,
+                               dst_engine=dst_engine,
+                               dst_session=dst_session,
+                               export_options=self.export_options,
+                               req=self.req)
+            if attempt == 0:
+                dst_session.rollback()
+            else:
+                dst_session.commit()
+            dst_session.close()
+        self.assertEqual(self._contents(dst_engine),
+                         self._contents(src_engines[0]))
+        for engine in src_engines + [dst_engine]:
+            engine.dispose()
@@ -149,11 +149,18 @@ Thoughts as of 2018-12-22.
 
 """  # noqa
 
+import configparser
+from contextlib import ExitStack
+import json
 import logging
 import os
+import shutil
 import sqlite3
 import tempfile
-from typing import (Dict, List, Generator, Optional,
+from itertools import count, islice
+import unittest
+from unittest import mock
+from typing import (Any, Dict, Iterable, List, Generator, Optional,
                     Tuple, Type, TYPE_CHECKING, Union)
 
 from cardinal_pythonlib.classes import gen_all_subclasses
@@ -164,8 +171,9 @@ from cardinal_pythonlib.datetimefunc import (
     get_tz_utc,
 )
 from cardinal_pythonlib.email.sendmail import CONTENT_TYPE_TEXT
-from cardinal_pythonlib.fileops import relative_filename_within_dir
+from cardinal_pythonlib.fileops import mkdir_p, relative_filename_within_dir
 from cardinal_pythonlib.json.serialize import register_for_json
+from cardinal_pythonlib.lists import chunks
 from cardinal_pythonlib.logs import BraceStyleAdapter
 from cardinal_pythonlib.pyramid.responses import (
     OdsResponse,
@@ -175,35 +183,70 @@ from cardinal_pythonlib.pyramid.responses import (
     ZipResponse,
 )
 from cardinal_pythonlib.sizeformatter import bytes2human
+from cardinal_pythonlib.sqlalchemy.core_query import exists_in_table
+from cardinal_pythonlib.sqlalchemy.schema import table_exists
 from cardinal_pythonlib.sqlalchemy.session import get_safe_url_from_engine
 import lockfile
 from pendulum import DateTime as Pendulum, Duration, Period
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.renderers import render_to_response
 from pyramid.response import Response
+from sqlalchemy import event
 from sqlalchemy.engine import create_engine
+from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm import Session as SqlASession, sessionmaker
+from sqlalchemy.sql.expression import column, table
 
 from camcops_server.cc_modules.cc_audit import audit
-from camcops_server.cc_modules.cc_constants import DateFormat
-from camcops_server.cc_modules.cc_dump import copy_tasks_and_summaries
+from camcops_server.cc_modules.cc_constants import (
+    CONFIG_FILE_EXPORT_SECTION,
+    ConfigParamExportGeneral,
+    DateFormat,
+    FileType,
+)
+from camcops_server.cc_modules.cc_db import FN_PK
+from camcops_server.cc_modules.cc_dump import (
+    copy_partial_dumps,
+    copy_tasks_and_summaries,
+)
 from camcops_server.cc_modules.cc_email import Email
 from camcops_server.cc_modules.cc_exportmodels import (
     ExportedTask,
+    ExportedTaskHL7Message,
+    ExportedTaskRedcap,
     ExportRecipient,
     gen_tasks_having_exportedtasks,
     get_collection_for_export,
 )
+from camcops_server.cc_modules.cc_exportrecipientinfo import (
+    ExportTransmissionMethod,
+)
 from camcops_server.cc_modules.cc_forms import UserDownloadDeleteForm
+from camcops_server.cc_modules.cc_pdf import (
+    get_pdf_render_pool,
+    PDF_JOBS_PER_WORKER_CALL,
+    PdfBatch,
+    PdfRenderingError,
+)
 from camcops_server.cc_modules.cc_pyramid import Routes, ViewArg, ViewParam
 from camcops_server.cc_modules.cc_simpleobjects import TaskExportOptions
 from camcops_server.cc_modules.cc_sqlalchemy import sql_from_sqlite_database
-from camcops_server.cc_modules.cc_task import Task
-from camcops_server.cc_modules.cc_tsv import TsvCollection
+from camcops_server.cc_modules.cc_task import (
+    Task,
+    tablename_to_task_class_dict,
+)
+from camcops_server.cc_modules.cc_tasksummary import preload_stored_summaries
+from camcops_server.cc_modules.cc_tsv import (
+    SpooledTsvCollection,
+    TsvCollection,
+)
+from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
 from camcops_server.cc_modules.celery import (
     create_user_download,
     email_basic_dump,
+    export_database_chunk_backend,
     export_task_backend,
+    finalise_database_export_backend,
 )
 
 if TYPE_CHECKING:
@@ -212,6 +255,16 @@ if TYPE_CHECKING:
 
 log = BraceStyleAdapter(logging.getLogger(__name__))
 
+HL7_PIPELINE_WINDOWS_PER_CHUNK = 4
+# ... tasks exported via a pipelined HL7 connection are processed in chunks of
+# this many windows; see export_hl7_tasks_pipelined()
+DB_EXPORT_TASKS_PER_CHUNK = 500
+# ... whole-database exports via the back end are split into chunks of at most
+# this many tasks, all of one type; see export_whole_database_via_backend()
+REDCAP_EXPORT_CHUNK_SIZE = 100
+# ... tasks exported to REDCap are sent in batches of this many; see
+# export_redcap_tasks_batched()
+
 
 # =============================================================================
 # Export tasks from the back end
@@ -286,7 +339,8 @@ def export(req: "CamcopsRequest",
         log.info("Exporting to recipient: {}", recipient)
         if recipient.using_db():
             if schedule_via_backend:
-                raise NotImplementedError()  # todo: implement whole-database export via Celery backend  # noqa
+                export_whole_database_via_backend(req, recipient,
+                                                  via_index=via_index)
             else:
                 export_whole_database(req, recipient, via_index=via_index)
         else:
@@ -322,17 +376,11 @@ def export_whole_database(req: "CamcopsRequest",
                      get_safe_url_from_engine(dst_engine))
             dst_session = sessionmaker(bind=dst_engine)()  # type: SqlASession
             task_generator = gen_tasks_having_exportedtasks(collection)
-            export_options = TaskExportOptions(
-                include_blobs=recipient.db_include_blobs,
-                db_patient_id_per_row=recipient.db_patient_id_per_row,
-                db_make_all_tables_even_empty=True,
-                db_include_summaries=recipient.db_add_summaries,
-            )
             copy_tasks_and_summaries(
                 tasks=task_generator,
                 dst_engine=dst_engine,
                 dst_session=dst_session,
-                export_options=export_options,
+                export_options=get_db_export_options(recipient),
                 req=req,
             )
             dst_session.commit()
@@ -341,6 +389,448 @@ def export_whole_database(req: "CamcopsRequest",
                     "aborting", lockfilename)
 
 
+def get_db_export_options(
+        recipient: ExportRecipient,
+        db_make_all_tables_even_empty: bool = True) -> TaskExportOptions:
+    """
+    Returns the export options for a whole-database export.
+
+    Args:
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+        db_make_all_tables_even_empty: create all tables, even empty ones?
+    """  # noqa
+    return TaskExportOptions(
+        include_blobs=recipient.db_include_blobs,
+        db_patient_id_per_row=recipient.db_patient_id_per_row,
+        db_make_all_tables_even_empty=db_make_all_tables_even_empty,
+        db_include_summaries=recipient.db_add_summaries,
+    )
+
+
+# =============================================================================
+# Whole-database export via the back end
+# =============================================================================
+
+class DatabaseExportStaging(object):
+    """
+    The staging directory for a whole-database export that runs via the back
+    end; see :func:`export_whole_database_via_backend`.
+
+    It holds a manifest listing the chunks of tasks to be exported, and an
+    SQLite file for each chunk that has been written. A chunk's file only
+    appears (by renaming) once it is complete, so if the export fails
+    part-way, the next attempt need only write the chunks that are missing.
+
+    The manifest also records how far :func:`finalise_database_export` got
+    (see :attr:`state`), so that a resumed export doesn't copy its tasks to
+    the destination database twice.
+    """
+    MANIFEST_FILENAME = "manifest.json"
+    STATE_WRITING = "writing"  # chunks being written
+    STATE_COMMITTING = "committing"  # copying to the destination
+    STATE_COMMITTED = "committed"  # destination committed
+
+    def __init__(self, directory: str) -> None:
+        """
+        Args:
+            directory: the staging directory
+        """
+        self.directory = directory
+        self.manifest_filename = os.path.join(directory,
+                                              self.MANIFEST_FILENAME)
+        self._manifest = None  # type: Optional[Dict[str, Any]]
+
+    def exists(self) -> bool:
+        """
+        Is there an unfinished export here?
+        """
+        return os.path.isfile(self.manifest_filename)
+
+    def create(self, chunks_: List[Dict[str, Any]]) -> None:
+        """
+        Starts an export, writing its manifest.
+
+        Args:
+            chunks_: list of chunks, each a dictionary with keys
+                ``basetable`` (task base table name) and ``task_pks`` (list of
+                task server PKs)
+        """
+        mkdir_p(self.directory)
+        self._write_manifest({"chunks": chunks_, "state": self.STATE_WRITING})
+
+    def _write_manifest(self, manifest: Dict[str, Any]) -> None:
+        """
+        Writes the manifest, under another name then renamed, so that it is
+        replaced in one go.
+        """
+        partial_filename = self.manifest_filename + ".partial"
+        with open(partial_filename, "w") as f:
+            json.dump(manifest, f)
+        os.replace(partial_filename, self.manifest_filename)
+        self._manifest = manifest
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        """
+        Returns the manifest, as a dictionary.
+        """
+        if self._manifest is None:
+            with open(self.manifest_filename) as f:
+                self._manifest = json.load(f)
+        return self._manifest
+
+    @property
+    def chunks(self) -> List[Dict[str, Any]]:
+        """
+        Returns the chunks listed in the manifest; see :meth:`create`.
+        """
+        return self.manifest["chunks"]
+
+    @property
+    def state(self) -> str:
+        """
+        Returns the state of the export, one of :data:`STATE_WRITING`,
+        :data:`STATE_COMMITTING`, and :data:`STATE_COMMITTED`.
+        """
+        return self.manifest.get("state", self.STATE_WRITING)
+
+    def set_state(self, state: str) -> None:
+        """
+        Records the state of the export in the manifest; see :attr:`state`.
+        """
+        manifest = dict(self.manifest)
+        manifest["state"] = state
+        self._write_manifest(manifest)
+
+    def chunk_filename(self, index: int) -> str:
+        """
+        Returns the filename of the SQLite file for a completed chunk.
+        """
+        return os.path.join(self.directory, f"chunk_{index:06d}.sqlite")
+
+    def chunk_done(self, index: int) -> bool:
+        """
+        Has a chunk been written?
+        """
+        return os.path.isfile(self.chunk_filename(index))
+
+    def pending_chunk_indexes(self) -> List[int]:
+        """
+        Returns the indexes of chunks that have yet to be written.
+        """
+        return [i for i in range(len(self.chunks)) if not self.chunk_done(i)]
+
+    def remove(self) -> None:
+        """
+        Removes the staging directory. The manifest goes first, so that a
+        half-removed directory isn't mistaken for an unfinished export.
+        """
+        if self.exists():
+            os.remove(self.manifest_filename)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def gen_database_export_chunks(
+        req: "CamcopsRequest",
+        recipient: ExportRecipient,
+        via_index: bool = True) -> Generator[Dict[str, Any], None, None]:
+    """
+    Generates chunks of tasks for a whole-database export (see
+    :meth:`DatabaseExportStaging.create`): ranges of PKs within each task
+    table, of at most :data:`DB_EXPORT_TASKS_PER_CHUNK` tasks.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+        via_index: use the task index (faster)?
+    """  # noqa
+    collection = get_collection_for_export(req, recipient, via_index=via_index)
+    pks_by_basetable = {}  # type: Dict[str, List[int]]
+    for task_or_index in collection.gen_all_tasks_or_indexes():
+        if isinstance(task_or_index, Task):
+            basetable = task_or_index.tablename
+            task_pk = task_or_index.get_pk()
+        else:
+            basetable = task_or_index.task_table_name
+            task_pk = task_or_index.task_pk
+        pks_by_basetable.setdefault(basetable, []).append(task_pk)
+    for basetable in sorted(pks_by_basetable):
+        for task_pks in chunks(sorted(pks_by_basetable[basetable]),
+                               DB_EXPORT_TASKS_PER_CHUNK):
+            yield {"basetable": basetable, "task_pks": task_pks}
+
+
+def export_whole_database_via_backend(req: "CamcopsRequest",
+                                      recipient: ExportRecipient,
+                                      via_index: bool = True) -> None:
+    """
+    Exports to a database via the back end.
+
+    The tasks are split into chunks (see :func:`gen_database_export_chunks`),
+    each written to its own SQLite file in a staging directory by a back-end
+    job (:func:`export_database_chunk`), so chunks are written in parallel.
+    When the last is done, another job (:func:`finalise_database_export`)
+    copies them all to the destination database in a single transaction.
+
+    If a previous export to this recipient didn't finish, it is resumed
+    instead: only the chunks that are missing are written.
+
+    If no :ref:`EXPORT_STAGING_DIR <EXPORT_STAGING_DIR>` is configured, this
+    falls back to :func:`export_whole_database`.
+
+    Holds a recipient-specific file lock while scheduling the jobs.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+        via_index: use the task index (faster)?
+    """  # noqa
+    cfg = req.config
+    if not cfg.export_staging_dir:
+        log.warning("No export staging directory configured; exporting to "
+                    "database in this process")
+        export_whole_database(req, recipient, via_index=via_index)
+        return
+    recipient_name = recipient.recipient_name
+    lockfilename = cfg.get_export_lockfilename_db(
+        recipient_name=recipient_name)
+    try:
+        with lockfile.FileLock(lockfilename, timeout=0):  # doesn't wait
+            staging = DatabaseExportStaging(
+                cfg.get_export_db_staging_dir(recipient_name))
+            if staging.exists():
+                log.info("Resuming unfinished database export to {}",
+                         recipient_name)
+            else:
+                staging.create(list(gen_database_export_chunks(
+                    req, recipient, via_index=via_index)))
+            pending = staging.pending_chunk_indexes()
+            log.info("Submitting {} of {} database export chunk(s) for {}",
+                     len(pending), len(staging.chunks), recipient_name)
+            for chunk_index in pending:
+                export_database_chunk_backend.delay(
+                    recipient_name=recipient_name,
+                    chunk_index=chunk_index
+                )
+            if not pending:
+                finalise_database_export_backend.delay(
+                    recipient_name=recipient_name)
+    except lockfile.AlreadyLocked:
+        log.warning("Export logfile {!r} already locked by another process; "
+                    "aborting", lockfilename)
+
+
+def export_database_chunk(req: "CamcopsRequest",
+                          recipient: ExportRecipient,
+                          chunk_index: int) -> None:
+    """
+    Writes one chunk of a whole-database export (see
+    :func:`export_whole_database_via_backend`) to its SQLite file, unless that
+    has already been done. If that was the last chunk, schedules
+    :func:`finalise_database_export`.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+        chunk_index: index of the chunk in the export's manifest
+    """  # noqa
+    recipient_name = recipient.recipient_name
+    staging = DatabaseExportStaging(
+        req.config.get_export_db_staging_dir(recipient_name))
+    if not staging.exists():
+        log.warning("No database export to {} in progress; ignoring chunk {}",
+                    recipient_name, chunk_index)
+        return
+
+    if not staging.chunk_done(chunk_index):
+        chunk = staging.chunks[chunk_index]
+        basetable = chunk["basetable"]
+        task_class = tablename_to_task_class_dict()[basetable]
+        # noinspection PyProtectedMember
+        tasks = (
+            req.dbsession.query(task_class)
+            .filter(task_class._pk.in_(chunk["task_pks"]))
+            .order_by(task_class._pk)
+            .all()
+        )
+        log.info("Writing database export chunk {} for {}: {} {} task(s)",
+                 chunk_index, recipient_name, len(tasks), basetable)
+        filename = staging.chunk_filename(chunk_index)
+        # Written under another name, then renamed, so that the chunk only
+        # appears once it's complete.
+        partial_filename = f"{filename}.{os.getpid()}.partial"
+        if os.path.exists(partial_filename):
+            os.remove(partial_filename)  # from an earlier failed attempt
+        engine = create_engine("sqlite:///" + partial_filename, echo=False)
+        dst_session = sessionmaker(bind=engine)()  # type: SqlASession
+        try:
+            copy_tasks_and_summaries(
+                tasks=tasks,
+                dst_engine=engine,
+                dst_session=dst_session,
+                export_options=get_db_export_options(
+                    recipient, db_make_all_tables_even_empty=False),
+                req=req,
+            )
+            dst_session.commit()
+        except Exception:
+            dst_session.close()
+            engine.dispose()
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
+            raise
+        dst_session.close()
+        engine.dispose()
+        os.replace(partial_filename, filename)
+
+    if not staging.pending_chunk_indexes():
+        finalise_database_export_backend.delay(recipient_name=recipient_name)
+
+
+def finalise_database_export(req: "CamcopsRequest",
+                             recipient: ExportRecipient) -> None:
+    """
+    Finishes a whole-database export (see
+    :func:`export_whole_database_via_backend`) once all its chunks have been
+    written: copies them to the destination database in a single
+    transaction, records the tasks as exported, and removes the staging
+    directory. Does nothing if there's no export in progress, or it has chunks
+    still to be written.
+
+    Each step is recorded (in the manifest, or the CamCOPS database) before
+    the next starts, so if this fails part-way, running it again finishes the
+    job without copying anything to the destination twice:
+
+    - the manifest is marked :data:`DatabaseExportStaging.STATE_COMMITTING`
+      before the destination commit, and
+      :data:`DatabaseExportStaging.STATE_COMMITTED` after it;
+    - if it was left "committing", we look in the destination database to
+      see whether that commit happened (see
+      :func:`_database_export_committed`);
+    - tasks already recorded as exported aren't recorded again;
+    - the staging directory is removed only once those records are
+      committed.
+
+    Holds the recipient-specific file lock in the process.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+
+    Raises:
+        :exc:`lockfile.AlreadyLocked` if another process holds the lock
+    """  # noqa
+    cfg = req.config
+    recipient_name = recipient.recipient_name
+    lockfilename = cfg.get_export_lockfilename_db(
+        recipient_name=recipient_name)
+    with lockfile.FileLock(lockfilename, timeout=0):  # doesn't wait
+        staging = DatabaseExportStaging(
+            cfg.get_export_db_staging_dir(recipient_name))
+        if not staging.exists():
+            log.info("No database export to {} in progress", recipient_name)
+            return
+        pending = staging.pending_chunk_indexes()
+        if pending:
+            log.info("Database export to {} has {} chunk(s) still to write",
+                     recipient_name, len(pending))
+            return
+
+        if staging.state != DatabaseExportStaging.STATE_COMMITTED:
+            dst_engine = create_engine(recipient.db_url,
+                                       echo=recipient.db_echo)
+            log.info("Exporting to database: {}",
+                     get_safe_url_from_engine(dst_engine))
+            dst_session = sessionmaker(bind=dst_engine)()  # type: SqlASession  # noqa
+            try:
+                if (staging.state == DatabaseExportStaging.STATE_COMMITTING and
+                        _database_export_committed(staging, dst_engine,
+                                                   dst_session)):
+                    log.info("Database export to {} was committed by an "
+                             "earlier attempt", recipient_name)
+                else:
+                    staging.set_state(DatabaseExportStaging.STATE_COMMITTING)
+                    _copy_staged_chunks(req, recipient, staging,
+                                        dst_engine, dst_session)
+                    dst_session.commit()
+            finally:
+                dst_session.close()
+                dst_engine.dispose()
+            staging.set_state(DatabaseExportStaging.STATE_COMMITTED)
+
+        dbsession = req.dbsession
+        for chunk in staging.chunks:
+            basetable = chunk["basetable"]
+            task_pks = chunk["task_pks"]
+            # noinspection PyUnresolvedReferences
+            already_exported = set(
+                pk for pk, in (
+                    dbsession.query(ExportedTask.task_server_pk)
+                    .filter(ExportedTask.recipient_id == recipient.id)
+                    .filter(ExportedTask.basetable == basetable)
+                    .filter(ExportedTask.task_server_pk.in_(task_pks))
+                    .filter(ExportedTask.success == True)  # noqa: E712
+                )
+            )
+            for task_pk in task_pks:
+                if task_pk in already_exported:
+                    continue
+                et = ExportedTask(recipient,
+                                  basetable=basetable,
+                                  task_server_pk=task_pk)
+                dbsession.add(et)
+                et.succeed()
+        dbsession.commit()
+
+        staging.remove()
+
+
+def _copy_staged_chunks(req: "CamcopsRequest",
+                        recipient: ExportRecipient,
+                        staging: DatabaseExportStaging,
+                        dst_engine: Engine,
+                        dst_session: SqlASession) -> None:
+    """
+    Copies all the chunks of a whole-database export to the destination
+    database, without committing. Part of :func:`finalise_database_export`.
+    """
+    src_engines = [
+        create_engine("sqlite:///" + staging.chunk_filename(i), echo=False)
+        for i in range(len(staging.chunks))
+    ]
+    try:
+        copy_partial_dumps(
+            src_engines=src_engines,
+            dst_engine=dst_engine,
+            dst_session=dst_session,
+            export_options=get_db_export_options(recipient),
+            req=req,
+        )
+    finally:
+        for src_engine in src_engines:
+            src_engine.dispose()
+
+
+def _database_export_committed(staging: DatabaseExportStaging,
+                               dst_engine: Engine,
+                               dst_session: SqlASession) -> bool:
+    """
+    For a whole-database export whose finalisation stopped part-way: did the
+    destination commit happen? It did if the destination holds the first task
+    of the export (all the tasks having been committed together).
+    """
+    for chunk in staging.chunks:
+        if not chunk["task_pks"]:
+            continue
+        basetable = chunk["basetable"]
+        if not table_exists(dst_engine, basetable):
+            return False
+        dst_table = table(basetable, column(FN_PK))
+        return exists_in_table(dst_session, dst_table,
+                               dst_table.c[FN_PK] == chunk["task_pks"][0])
+    return False
+
+
 def export_tasks_individually(req: "CamcopsRequest",
                               recipient: ExportRecipient,
                               via_index: bool = True,
@@ -371,8 +861,18 @@ def export_tasks_individually(req: "CamcopsRequest",
                 basetable=basetable,
                 task_pk=task_pk
             )
+    elif (recipient.using_hl7() and
+            recipient.hl7_persistent_connection and
+            recipient.hl7_pipeline_window > 1 and
+            not recipient.hl7_debug_divert_to_file):
+        export_hl7_tasks_pipelined(req, recipient,
+                                   collection.gen_tasks_by_class())
+    elif recipient.using_redcap():
+        export_redcap_tasks_batched(req, recipient,
+                                    collection.gen_tasks_by_class())
     else:
-        for task in collection.gen_tasks_by_class():
+        for task in gen_tasks_with_prerendered_pdfs(
+                req, recipient, collection.gen_tasks_by_class()):
             # Do NOT use this to check the working of export_task_backend():
             # export_task_backend(recipient.recipient_name, task.tablename, task.get_pk())  # noqa
             # ... it will deadlock at the database (because we're already
@@ -380,6 +880,53 @@ def export_tasks_individually(req: "CamcopsRequest",
             export_task(req, recipient, task)
 
 
+def gen_tasks_with_prerendered_pdfs(
+        req: "CamcopsRequest",
+        recipient: ExportRecipient,
+        tasks: Iterable[Task]) -> Generator[Task, None, None]:
+    """
+    Yields tasks to be exported. If the recipient wants PDFs and we have a
+    PDF rendering pool, the PDFs for each group of tasks are rendered in
+    parallel (while the previous group is being exported), and placed in
+    ``req.prerendered_task_pdfs`` for
+    :meth:`camcops_server.cc_modules.cc_task.Task.get_pdf` to use.
+    """
+    pool = get_pdf_render_pool()
+    if (pool is None or
+            recipient.task_format != FileType.PDF or
+            recipient.transmission_method not in (
+                ExportTransmissionMethod.EMAIL,
+                ExportTransmissionMethod.FILE)):
+        yield from tasks
+        return
+    chunk_size = pool.processes * PDF_JOBS_PER_WORKER_CALL
+    tasks = iter(tasks)
+
+    def submit_next() -> Tuple[List[Task], Optional[PdfBatch]]:
+        chunk_ = list(islice(tasks, chunk_size))
+        if not chunk_:
+            return chunk_, None
+        return chunk_, pool.submit([t.get_pdf_job(req) for t in chunk_])
+
+    chunk, batch = submit_next()
+    while chunk:
+        results = batch.get_results()
+        next_chunk, next_batch = submit_next()
+        for task, result in zip(chunk, results):
+            if isinstance(result, PdfRenderingError):
+                # Leave it to export_task() to try (and perhaps fail) for
+                # this task alone.
+                log.warning("Failed to prerender PDF for {!r}: {}",
+                            task, result)
+                continue
+            req.prerendered_task_pdfs[
+                (task.tablename, task.get_pk(), False)] = result
+        for task in chunk:
+            yield task
+        req.prerendered_task_pdfs.clear()  # e.g. tasks not actually exported
+        chunk, batch = next_chunk, next_batch
+
+
 def export_task(req: "CamcopsRequest",
                 recipient: ExportRecipient,
                 task: Task) -> None:
@@ -430,6 +977,127 @@ def export_task(req: "CamcopsRequest",
                     "aborting", lockfilename)
 
 
+def gen_locked_exported_task_chunks(
+        req: "CamcopsRequest",
+        recipient: ExportRecipient,
+        tasks: Iterable[Task],
+        chunk_size: int) -> Generator[List[ExportedTask], None, None]:
+    """
+    Used by the batched export functions. Takes tasks in chunks and, for each
+    chunk, yields new :class:`camcops_server.cc_modules.cc_exportmodels.ExportedTask`
+    objects (already added to the session) for those tasks that are suitable
+    for the recipient, not locked by another process, and not yet exported.
+
+    The per-task locks for a chunk are held until the caller asks for the next
+    chunk, so the caller should export and commit each chunk before then.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+        tasks: the tasks
+        chunk_size: maximum number of tasks per chunk
+
+    Yields:
+        lists of :class:`camcops_server.cc_modules.cc_exportmodels.ExportedTask`
+    """  # noqa
+    cfg = req.config
+    dbsession = req.dbsession
+    tasks = iter(tasks)
+    while True:
+        chunk = list(islice(tasks, chunk_size))
+        if not chunk:
+            return
+        with ExitStack() as locks:
+            exported_tasks = []  # type: List[ExportedTask]
+            for task in chunk:
+                if not recipient.is_task_suitable(task):
+                    continue
+                lockfilename = cfg.get_export_lockfilename_task(
+                    recipient_name=recipient.recipient_name,
+                    basetable=task.tablename,
+                    pk=task.get_pk(),
+                )
+                try:
+                    locks.enter_context(
+                        lockfile.FileLock(lockfilename, timeout=0))
+                except lockfile.AlreadyLocked:
+                    log.warning("Export logfile {!r} already locked by "
+                                "another process; skipping", lockfilename)
+                    continue
+                if ExportedTask.task_already_exported(
+                        dbsession=dbsession,
+                        recipient_name=recipient.recipient_name,
+                        basetable=task.tablename,
+                        task_pk=task.get_pk()):
+                    log.info("Task {!r} already exported to recipient {!r}; "
+                             "ignoring", task, recipient)
+                    continue
+                et = ExportedTask(recipient, task)
+                dbsession.add(et)
+                log.info("Exporting task {!r} to recipient {}",
+                         task, recipient)
+                exported_tasks.append(et)
+            yield exported_tasks
+
+
+def export_hl7_tasks_pipelined(req: "CamcopsRequest",
+                               recipient: ExportRecipient,
+                               tasks: Iterable[Task]) -> None:
+    """
+    Exports tasks to an HL7 recipient, sending several messages at a time over
+    a persistent, pipelined connection (see
+    :meth:`camcops_server.cc_modules.cc_exportmodels.ExportedTaskHL7Message.transmit_hl7_messages`).
+    Otherwise equivalent to calling :func:`export_task` for each task.
+
+    Tasks are processed in chunks. The per-task locks for a chunk are held
+    until its messages have been acknowledged and the results committed.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+        tasks: the tasks
+    """  # noqa
+    chunk_size = recipient.hl7_pipeline_window * HL7_PIPELINE_WINDOWS_PER_CHUNK
+    for exported_tasks in gen_locked_exported_task_chunks(
+            req, recipient, tasks, chunk_size):
+        messages = []  # type: List[ExportedTaskHL7Message]
+        for et in exported_tasks:
+            ehl7 = et.prepare_hl7_message(req)
+            if ehl7:
+                messages.append(ehl7)
+        ExportedTaskHL7Message.transmit_hl7_messages(recipient, messages)
+        req.dbsession.commit()
+
+
+def export_redcap_tasks_batched(req: "CamcopsRequest",
+                                recipient: ExportRecipient,
+                                tasks: Iterable[Task]) -> None:
+    """
+    Exports tasks to a REDCap recipient in batches (see
+    :meth:`camcops_server.cc_modules.cc_exportmodels.ExportedTaskRedcap.export_tasks`),
+    so that REDCap is queried once per batch rather than once per task.
+    Otherwise equivalent to calling :func:`export_task` for each task.
+
+    The per-task locks for a batch are held until it has been exported and
+    the results committed.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        recipient: an :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
+        tasks: the tasks
+    """  # noqa
+    dbsession = req.dbsession
+    for exported_tasks in gen_locked_exported_task_chunks(
+            req, recipient, tasks, REDCAP_EXPORT_CHUNK_SIZE):
+        exported_task_redcaps = []  # type: List[ExportedTaskRedcap]
+        for et in exported_tasks:
+            eredcap = ExportedTaskRedcap(et)
+            dbsession.add(eredcap)
+            exported_task_redcaps.append(eredcap)
+        ExportedTaskRedcap.export_tasks(req, exported_task_redcaps)
+        dbsession.commit()
+
+
 # =============================================================================
 # Helpers for task collection export functions
 # =============================================================================
@@ -460,6 +1128,34 @@ def gen_audited_tasks_for_task_class(
     )
 
 
+def gen_audited_task_chunks_for_task_class(
+        collection: "TaskCollection",
+        cls: Type[Task],
+        audit_descriptions: List[str]) -> Generator[List[Task], None, None]:
+    """
+    As for :func:`gen_audited_tasks_for_task_class`, but generates lists of
+    tasks, via
+    :meth:`camcops_server.cc_modules.cc_taskcollection.TaskCollection.gen_task_chunks_for_task_class`,
+    so the tasks are not all held in memory at once.
+
+    Args:
+        collection: a :class:`camcops_server.cc_modules.cc_taskcollection.TaskCollection`
+        cls: the task class to generate
+        audit_descriptions: list of strings to be modified
+
+    Yields:
+        lists of :class:`camcops_server.cc_modules.cc_task.Task` objects
+    """  # noqa
+    pklist = []  # type: List[int]
+    for tasks in collection.gen_task_chunks_for_task_class(cls):
+        pklist.extend(task.get_pk() for task in tasks)
+        yield tasks
+    audit_descriptions.append(
+        f"{cls.__tablename__}: "
+        f"{','.join(str(pk) for pk in pklist)}"
+    )
+
+
 def gen_audited_tasks_by_task_class(
         collection: "TaskCollection",
         audit_descriptions: List[str]) -> Generator[Task, None, None]:
@@ -659,35 +1355,40 @@ class TaskCollectionExporter(object):
 
         download_dir = self.req.user_download_dir
         space = self.req.user_download_bytes_available
-        filename, contents = self.to_file()
-        size = len(contents)
-
-        if size > space:
-            # Not enough space
-            total_permitted = self.req.user_download_bytes_permitted
-            msg = _(
-                "You do not have enough space to create this download. "
-                "You are allowed %s bytes and you are have %s bytes free. "
-                "This download would need %s bytes."
-            ) % (total_permitted, space, size)
-        else:
-            # Create file
-            fullpath = os.path.join(download_dir, filename)
-            try:
-                with open(fullpath, "wb") as f:
-                    f.write(contents)
-                # Success
-                log.info(f"Created user download: {fullpath}")
-                msg = _(
-                    "The research data dump you requested is ready to be "
-                    "downloaded. You will find it in your download area. "
-                    "It is called %s"
-                ) % filename
-            except Exception as e:
-                # Some other error
+        filename = self.get_filename()
+
+        # Write the file outside the user's download area (so a half-written
+        # file never appears there), then move it in if there's room.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_fullpath = os.path.join(tmpdir, filename)
+            self.write_file(tmp_fullpath)
+            size = os.path.getsize(tmp_fullpath)
+
+            if size > space:
+                # Not enough space
+                total_permitted = self.req.user_download_bytes_permitted
                 msg = _(
-                    "Failed to create file %s. Error was: %s"
-                ) % (filename, e)
+                    "You do not have enough space to create this download. "
+                    "You are allowed %s bytes and you are have %s bytes free. "
+                    "This download would need %s bytes."
+                ) % (total_permitted, space, size)
+            else:
+                # Create file
+                fullpath = os.path.join(download_dir, filename)
+                try:
+                    shutil.move(tmp_fullpath, fullpath)
+                    # Success
+                    log.info(f"Created user download: {fullpath}")
+                    msg = _(
+                        "The research data dump you requested is ready to be "
+                        "downloaded. You will find it in your download area. "
+                        "It is called %s"
+                    ) % filename
+                except Exception as e:
+                    # Some other error
+                    msg = _(
+                        "Failed to create file %s. Error was: %s"
+                    ) % (filename, e)
 
         # E-mail the user, if they have an e-mail address
         email_to = self.req.user.email
@@ -724,6 +1425,22 @@ class TaskCollectionExporter(object):
         """
         raise NotImplementedError("Exporter needs to implement 'get_file_body'")
 
+    def write_file(self, filename: str) -> None:
+        """
+        Writes the data to a file. Exporters that can stream their output to
+        disk override this; by default, we write :meth:`get_file_body`.
+        """
+        with open(filename, "wb") as f:
+            f.write(self.get_file_body())
+
+    def _preload_stored_summaries(self, cls: Type[Task]) -> None:
+        """
+        Reads the stored summaries of all our tasks of one type, in bulk; see
+        :func:`camcops_server.cc_modules.cc_tasksummary.preload_stored_summaries`.
+        """  # noqa
+        preload_stored_summaries(self.req,
+                                 self.collection.tasks_for_task_class(cls))
+
     def get_tsv_collection(self) -> TsvCollection:
         """
         Converts the collection of tasks to a collection of spreadsheet-style
@@ -737,10 +1454,12 @@ class TaskCollectionExporter(object):
         tsvcoll = TsvCollection()
         # Iterate through tasks, creating the TSV collection
         for cls in self.collection.task_classes():
+            self._preload_stored_summaries(cls)
             for task in gen_audited_tasks_for_task_class(self.collection, cls,
                                                          audit_descriptions):
                 tsv_pages = task.get_tsv_pages(self.req)
                 tsvcoll.add_pages(tsv_pages)
+            self.req.stored_task_summaries.clear()
 
         tsvcoll.sort_pages()
         if self.options.spreadsheet_sort_by_heading:
@@ -750,6 +1469,40 @@ class TaskCollectionExporter(object):
 
         return tsvcoll
 
+    def get_spooled_tsv_collection(self) -> SpooledTsvCollection:
+        """
+        As for :meth:`get_tsv_collection`, but returns a disk-backed
+        collection, to which each task's rows are written as the task is
+        generated. The tasks are fetched a chunk at a time (see
+        :func:`gen_audited_task_chunks_for_task_class`), so memory use doesn't
+        grow with the number of tasks (beyond a list of their PKs). The caller
+        should use the result as a context manager, so that its temporary
+        files are deleted.
+
+        Returns:
+            a :class:`camcops_server.cc_modules.cc_tsv.SpooledTsvCollection`
+        """
+        audit_descriptions = []  # type: List[str]
+        tsvcoll = SpooledTsvCollection()
+        try:
+            for cls in self.collection.task_classes():
+                for tasks in gen_audited_task_chunks_for_task_class(
+                        self.collection, cls, audit_descriptions):
+                    preload_stored_summaries(self.req, tasks)
+                    for task in tasks:
+                        tsvcoll.add_pages(task.get_tsv_pages(self.req))
+                    self.req.stored_task_summaries.clear()
+        except Exception:
+            tsvcoll.cleanup()
+            raise
+
+        if self.options.spreadsheet_sort_by_heading:
+            tsvcoll.sort_headings_within_all_pages()
+
+        audit(self.req, f"Basic dump: {'; '.join(audit_descriptions)}")
+
+        return tsvcoll
+
 
 class OdsExporter(TaskCollectionExporter):
     """
@@ -761,6 +1514,10 @@ class OdsExporter(TaskCollectionExporter):
     def get_file_body(self) -> bytes:
         return self.get_tsv_collection().as_ods()
 
+    def write_file(self, filename: str) -> None:
+        with self.get_spooled_tsv_collection() as tsvcoll:
+            tsvcoll.write_ods(filename)
+
     def get_data_response(self, body: bytes, filename: str) -> Response:
         return OdsResponse(body=body, filename=filename)
 
@@ -782,6 +1539,10 @@ class RExporter(TaskCollectionExporter):
     def get_r_script(self) -> str:
         return self.get_tsv_collection().as_r()
 
+    def write_file(self, filename: str) -> None:
+        with self.get_spooled_tsv_collection() as tsvcoll:
+            tsvcoll.write_r(filename, encoding=self.encoding)
+
     def get_data_response(self, body: bytes, filename: str) -> Response:
         filename = self.get_filename()
         r_script = self.get_r_script()
@@ -799,6 +1560,10 @@ class TsvZipExporter(TaskCollectionExporter):
     def get_file_body(self) -> bytes:
         return self.get_tsv_collection().as_zip()
 
+    def write_file(self, filename: str) -> None:
+        with self.get_spooled_tsv_collection() as tsvcoll:
+            tsvcoll.write_zip(filename)
+
     def get_data_response(self, body: bytes, filename: str) -> Response:
         return ZipResponse(body=body, filename=filename)
 
@@ -813,6 +1578,10 @@ class XlsxExporter(TaskCollectionExporter):
     def get_file_body(self) -> bytes:
         return self.get_tsv_collection().as_xlsx()
 
+    def write_file(self, filename: str) -> None:
+        with self.get_spooled_tsv_collection() as tsvcoll:
+            tsvcoll.write_xlsx(filename)
+
     def get_data_response(self, body: bytes, filename: str) -> Response:
         return XlsxResponse(body=body, filename=filename)
 
@@ -1268,3 +2037,354 @@ class UserDownloadFile(object):
                     req=req
                 ))
         return results
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class DatabaseExportStagingTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir_obj = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir_obj.name, "staging")
+
+    def tearDown(self) -> None:
+        self.tmpdir_obj.cleanup()
+
+    def test_manifest_round_trip(self) -> None:
+        chunks_ = [
+            {"basetable": "phq9", "task_pks": [1, 2]},
+            {"basetable": "bmi", "task_pks": [3]},
+        ]
+        staging = DatabaseExportStaging(self.directory)
+        self.assertFalse(staging.exists())
+        staging.create(chunks_)
+        self.assertTrue(staging.exists())
+
+        reloaded = DatabaseExportStaging(self.directory)
+        self.assertEqual(reloaded.chunks, chunks_)
+        self.assertEqual(reloaded.state, DatabaseExportStaging.STATE_WRITING)
+        self.assertEqual(reloaded.pending_chunk_indexes(), [0, 1])
+
+        open(reloaded.chunk_filename(1), "w").close()
+        self.assertFalse(reloaded.chunk_done(0))
+        self.assertTrue(reloaded.chunk_done(1))
+        self.assertEqual(reloaded.pending_chunk_indexes(), [0])
+
+        reloaded.set_state(DatabaseExportStaging.STATE_COMMITTING)
+        reloaded = DatabaseExportStaging(self.directory)
+        self.assertEqual(reloaded.state,
+                         DatabaseExportStaging.STATE_COMMITTING)
+        self.assertEqual(reloaded.chunks, chunks_)
+        self.assertTrue(reloaded.chunk_done(1))
+
+        reloaded.remove()
+        self.assertFalse(reloaded.exists())
+        self.assertFalse(os.path.exists(self.directory))
+
+
+class ExportTestCase(DemoDatabaseTestCase):
+    """
+    Test case with lock and staging directories of its own, and export
+    records that can be saved to SQLite.
+    """
+    def override_config_settings(self,
+                                 parser: configparser.ConfigParser) -> None:
+        parser.set(CONFIG_FILE_EXPORT_SECTION,
+                   ConfigParamExportGeneral.EXPORT_LOCKDIR,
+                   self.tmpdir_obj.name)
+        parser.set(CONFIG_FILE_EXPORT_SECTION,
+                   ConfigParamExportGeneral.EXPORT_STAGING_DIR,
+                   os.path.join(self.tmpdir_obj.name, "staging"))
+
+    def setUp(self) -> None:
+        super().setUp()
+        # auto increment doesn't work for BigInteger with SQLite, so allocate
+        # PKs for the export records ourselves
+        for cls in (ExportedTask, ExportedTaskHL7Message):
+            ids = count(1)
+
+            # noinspection PyUnusedLocal
+            def set_id(mapper: Any, connection: Any, target: Any,
+                       ids_: Iterable[int] = ids) -> None:
+                if target.id is None:
+                    target.id = next(ids_)
+
+            event.listen(cls, "before_insert", set_id)
+            self.addCleanup(event.remove, cls, "before_insert", set_id)
+
+
+class DatabaseExportViaBackendTests(ExportTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        from camcops_server.cc_modules.cc_exportrecipientinfo import (
+            ExportRecipientInfo,
+            ExportTransmissionMethod,
+        )
+        self.dst_filename = os.path.join(self.tmpdir_obj.name, "dst.sqlite")
+        self.recipient = ExportRecipient(ExportRecipientInfo())
+        # auto increment doesn't work for BigInteger with SQLite
+        self.recipient.id = 1
+        self.recipient.recipient_name = "test"
+        self.recipient.transmission_method = ExportTransmissionMethod.DATABASE
+        self.recipient.db_url = "sqlite:///" + self.dst_filename
+        self.recipient.db_echo = False
+        self.recipient.db_include_blobs = True
+        self.recipient.db_add_summaries = True
+        self.recipient.db_patient_id_per_row = True
+        self.dbsession.add(self.recipient)
+        self.dbsession.commit()
+
+    def _create_staging(self) -> DatabaseExportStaging:
+        from camcops_server.tasks.bmi import Bmi
+        from camcops_server.tasks.phq9 import Phq9
+        from camcops_server.tasks.photo import Photo
+        chunks_ = []  # type: List[Dict[str, Any]]
+        for cls in (Bmi, Phq9, Photo):
+            # noinspection PyProtectedMember
+            for pk, in self.dbsession.query(cls._pk).order_by(cls._pk):
+                chunks_.append({"basetable": cls.__tablename__,
+                                "task_pks": [pk]})
+        staging = DatabaseExportStaging(
+            self.req.config.get_export_db_staging_dir(
+                self.recipient.recipient_name))
+        staging.create(chunks_)
+        return staging
+
+    def _write_chunks(self, staging: DatabaseExportStaging) -> None:
+        with mock.patch.object(finalise_database_export_backend,
+                               "delay") as mock_finalise:
+            for chunk_index in staging.pending_chunk_indexes():
+                export_database_chunk(self.req, self.recipient, chunk_index)
+        mock_finalise.assert_called_once_with(
+            recipient_name=self.recipient.recipient_name)
+
+    def _exported_task_pks(self) -> List[Tuple[str, int]]:
+        # noinspection PyUnresolvedReferences
+        return sorted(
+            self.dbsession.query(ExportedTask.basetable,
+                                 ExportedTask.task_server_pk)
+            .filter(ExportedTask.recipient_id == self.recipient.id)
+            .filter(ExportedTask.success == True)  # noqa: E712
+        )
+
+    def _dst_task_pks(self) -> List[Tuple[str, int]]:
+        engine = create_engine(self.recipient.db_url, echo=False)
+        try:
+            return sorted(
+                (basetable, pk)
+                for basetable in ("bmi", "phq9", "photo")
+                for pk, in engine.execute(f"SELECT _pk FROM {basetable}")
+            )
+        finally:
+            engine.dispose()
+
+    @staticmethod
+    def _staged_task_pks(
+            staging: DatabaseExportStaging) -> List[Tuple[str, int]]:
+        return sorted(
+            (chunk["basetable"], pk)
+            for chunk in staging.chunks
+            for pk in chunk["task_pks"]
+        )
+
+    def test_resume_submits_missing_chunks_only(self) -> None:
+        staging = self._create_staging()
+        n_chunks = len(staging.chunks)
+        self.assertGreater(n_chunks, 2)
+        with mock.patch.object(finalise_database_export_backend, "delay"):
+            export_database_chunk(self.req, self.recipient, 1)
+        self.assertEqual(staging.pending_chunk_indexes(),
+                         [0] + list(range(2, n_chunks)))
+
+        with mock.patch.object(export_database_chunk_backend,
+                               "delay") as mock_chunk, \
+                mock.patch.object(finalise_database_export_backend,
+                                  "delay") as mock_finalise:
+            export_whole_database_via_backend(self.req, self.recipient)
+        submitted = [c[1]["chunk_index"] for c in mock_chunk.call_args_list]
+        self.assertEqual(submitted, [0] + list(range(2, n_chunks)))
+        mock_finalise.assert_not_called()
+
+    def test_finalise(self) -> None:
+        staging = self._create_staging()
+        expected = self._staged_task_pks(staging)
+        self._write_chunks(staging)
+
+        finalise_database_export(self.req, self.recipient)
+
+        self.assertFalse(staging.exists())
+        self.assertEqual(self._dst_task_pks(), expected)
+        self.assertEqual(self._exported_task_pks(), expected)
+
+    def test_finalise_resumes_after_destination_commit(self) -> None:
+        staging = self._create_staging()
+        expected = self._staged_task_pks(staging)
+        self._write_chunks(staging)
+
+        # Fail straight after the destination commit, before the manifest
+        # says so.
+        set_state = DatabaseExportStaging.set_state
+
+        def set_state_then_fail(self_: DatabaseExportStaging,
+                                state: str) -> None:
+            if state == DatabaseExportStaging.STATE_COMMITTED:
+                raise RuntimeError("Crash")
+            set_state(self_, state)
+
+        with mock.patch.object(DatabaseExportStaging, "set_state",
+                               set_state_then_fail):
+            self.assertRaises(RuntimeError,
+                              finalise_database_export,
+                              self.req, self.recipient)
+        staging = DatabaseExportStaging(staging.directory)
+        self.assertEqual(staging.state,
+                         DatabaseExportStaging.STATE_COMMITTING)
+        self.assertEqual(self._exported_task_pks(), [])
+
+        finalise_database_export(self.req, self.recipient)
+
+        self.assertFalse(staging.exists())
+        self.assertEqual(self._dst_task_pks(), expected)  # not copied twice
+        self.assertEqual(self._exported_task_pks(), expected)
+
+    def test_finalise_resumes_after_recording_exports(self) -> None:
+        staging = self._create_staging()
+        expected = self._staged_task_pks(staging)
+        self._write_chunks(staging)
+
+        with mock.patch.object(DatabaseExportStaging, "remove",
+                               side_effect=RuntimeError("Crash")):
+            self.assertRaises(RuntimeError,
+                              finalise_database_export,
+                              self.req, self.recipient)
+        self.assertTrue(staging.exists())
+
+        finalise_database_export(self.req, self.recipient)
+
+        self.assertFalse(staging.exists())
+        self.assertEqual(self._dst_task_pks(), expected)
+        self.assertEqual(self._exported_task_pks(), expected)  # not twice
+
+
+class HL7PipelinedExportTests(ExportTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        from camcops_server.cc_modules.cc_exportrecipientinfo import (
+            ExportRecipientInfo,
+        )
+        self.recipient = ExportRecipient(ExportRecipientInfo())
+        # auto increment doesn't work for BigInteger with SQLite
+        self.recipient.id = 1
+        self.recipient.recipient_name = "test_hl7"
+        self.recipient.transmission_method = ExportTransmissionMethod.HL7
+        self.recipient.task_format = FileType.XML
+        self.recipient.all_groups = True
+        self.recipient.finalized_only = False
+        self.recipient.include_anonymous = False
+        self.recipient.primary_idnum = self.nhs_iddef.which_idnum
+        self.recipient.hl7_host = "127.0.0.1"
+        self.recipient.hl7_port = 0  # set when the server starts
+        self.recipient.hl7_ping_first = False
+        self.recipient.hl7_network_timeout_ms = 5000
+        self.recipient.hl7_keep_message = True
+        self.recipient.hl7_keep_reply = True
+        self.recipient.hl7_debug_divert_to_file = False
+        self.recipient.hl7_persistent_connection = True
+        self.recipient.hl7_pipeline_window = 2
+        self.dbsession.add(self.recipient)
+        self.dbsession.commit()
+
+    def _tasks(self) -> List[Task]:
+        from camcops_server.tasks.bmi import Bmi
+        from camcops_server.tasks.phq9 import Phq9
+        # noinspection PyProtectedMember
+        return (
+            self.dbsession.query(Phq9).order_by(Phq9._pk).all() +
+            self.dbsession.query(Bmi).order_by(Bmi._pk).all()
+        )
+
+    def _lockfilename(self, task: Task) -> str:
+        return self.req.config.get_export_lockfilename_task(
+            recipient_name=self.recipient.recipient_name,
+            basetable=task.tablename,
+            pk=task.get_pk(),
+        )
+
+    def _export(self, tasks: List[Task], port: int) -> None:
+        from camcops_server.cc_modules.cc_hl7 import (
+            _mllp_connections,
+            MLLPConnection,
+        )
+        self.recipient.hl7_port = port
+        key = (self.recipient.hl7_host, port)
+        # Our own connection, so that we don't wait long for a dead server.
+        conn = MLLPConnection(self.recipient.hl7_host, port,
+                              timeout_ms=self.recipient.hl7_network_timeout_ms,
+                              max_connect_attempts=2,
+                              backoff_initial_s=0.01)
+        _mllp_connections[key] = conn
+        try:
+            export_hl7_tasks_pipelined(self.req, self.recipient, tasks)
+        finally:
+            conn.close()
+            del _mllp_connections[key]
+
+    def _results(self, task: Task) -> List[Tuple[bool, List[Tuple]]]:
+        ets = (
+            self.dbsession.query(ExportedTask)
+            .filter(ExportedTask.recipient_id == self.recipient.id)
+            .filter(ExportedTask.basetable == task.tablename)
+            .filter(ExportedTask.task_server_pk == task.get_pk())
+            .all()
+        )  # type: List[ExportedTask]
+        return [
+            (et.success,
+             [(m.success, m.reply is not None, m.failure_reason)
+              for m in et.hl7_messages])
+            for et in ets
+        ]
+
+    def _assert_unlocked(self, tasks: List[Task]) -> None:
+        # A thread can re-acquire its own lock, so look for the lock file.
+        for task in tasks:
+            self.assertFalse(
+                lockfile.FileLock(self._lockfilename(task)).is_locked())
+
+    def test_messages_acknowledged(self) -> None:
+        from camcops_server.cc_modules.cc_hl7 import DummyHL7Server
+        tasks = self._tasks()
+        self.assertGreater(len(tasks), self.recipient.hl7_pipeline_window)
+        with DummyHL7Server() as server:
+            self._export(tasks, server.port)
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(len(server.received), len(tasks))
+        for task in tasks:
+            self.assertEqual(self._results(task),
+                             [(True, [(True, True, None)])])
+        self._assert_unlocked(tasks)
+
+        # Not exported again:
+        with DummyHL7Server() as server:
+            self._export(tasks, server.port)
+            self.assertEqual(server.received, [])
+        self._assert_unlocked(tasks)
+
+    def test_messages_aborted_if_server_unavailable(self) -> None:
+        from camcops_server.cc_modules.cc_hl7 import DummyHL7Server
+        tasks = self._tasks()
+        with DummyHL7Server() as server:
+            port = server.port
+        # Server now closed.
+        self._export(tasks, port)
+        for task in tasks:
+            results = self._results(task)
+            self.assertEqual(len(results), 1)
+            et_success, messages = results[0]
+            self.assertFalse(et_success)
+            self.assertEqual(len(messages), 1)
+            msg_success, got_reply, failure_reason = messages[0]
+            self.assertFalse(msg_success)
+            self.assertFalse(got_reply)
+            self.assertIn("Failed to send message via MLLP", failure_reason)
+        self._assert_unlocked(tasks)
@@ -28,12 +28,14 @@ camcops_server/cc_modules/cc_exportmodels.py
 
 """
 
+import functools
 import logging
 import os
 import socket
 import subprocess
 import sys
-from typing import Generator, List, Optional, Tuple, TYPE_CHECKING
+from typing import (Callable, Generator, List, Optional, TextIO, Tuple,
+                    TYPE_CHECKING)
 
 from cardinal_pythonlib.datetimefunc import (
     get_now_utc_datetime,
@@ -80,6 +82,7 @@ from camcops_server.cc_modules.cc_filename import (
     change_filename_ext,
 )
 from camcops_server.cc_modules.cc_hl7 import (
+    get_mllp_connection,
     make_msh_segment,
     MLLPTimeoutClient,
     msg_is_successful_ack,
@@ -391,12 +394,9 @@ class ExportedTask(Base):
             efg.export_task(req)
 
         elif transmission_method == ExportTransmissionMethod.HL7:
-            ehl7 = ExportedTaskHL7Message(self)
-            if ehl7.valid():
-                dbsession.add(ehl7)
-                ehl7.export_task(req)
-            else:
-                self.abort("Task not valid for HL7 export")
+            ehl7 = self.prepare_hl7_message(req)
+            if ehl7:
+                ehl7.transmit_hl7()
 
         elif transmission_method == ExportTransmissionMethod.REDCAP:
             eredcap = ExportedTaskRedcap(self)
@@ -405,6 +405,32 @@ class ExportedTask(Base):
         else:
             raise AssertionError("Bug: bad transmission_method")
 
+    def prepare_hl7_message(
+            self, req: "CamcopsRequest") -> Optional["ExportedTaskHL7Message"]:
+        """
+        Creates the HL7 message for this task, but doesn't send it. (Used
+        directly when sending several messages at once; see
+        :meth:`ExportedTaskHL7Message.transmit_hl7_messages`.)
+
+        Args:
+            req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+
+        Returns:
+            the :class:`ExportedTaskHL7Message`, if it should now be
+            transmitted, or ``None`` (e.g. if the task isn't suitable for HL7,
+            or the message has been diverted to a file)
+        """
+        ehl7 = ExportedTaskHL7Message(self)
+        if not ehl7.valid():
+            self.abort("Task not valid for HL7 export")
+            return None
+        dbsession = req.dbsession
+        dbsession.add(ehl7)
+        dbsession.flush()  # so that ehl7.id, the message control ID, is set
+        if not ehl7.prepare(req):
+            return None
+        return ehl7
+
     @property
     def filegroup(self) -> "ExportedTaskFileGroup":
         """
@@ -423,15 +449,18 @@ class ExportedTask(Base):
                     filename: str,
                     text: str = None,
                     binary: bytes = None,
-                    text_encoding: str = UTF8) -> bool:
+                    text_encoding: str = UTF8,
+                    writer: Callable[[TextIO], None] = None) -> bool:
         """
         Exports a file.
 
         Args:
             filename:
-            text: text contents (specify this XOR ``binary``)
-            binary: binary contents (specify this XOR ``text``)
+            text: text contents (specify exactly one of ``text``, ``binary``,
+                and ``writer``)
+            binary: binary contents
             text_encoding: encoding to use when writing text
+            writer: function that writes text contents to a file-like object
 
         Returns: was it exported?
         """
@@ -439,7 +468,8 @@ class ExportedTask(Base):
         return filegroup.export_file(filename=filename,
                                      text=text,
                                      binary=binary,
-                                     text_encoding=text_encoding)
+                                     text_encoding=text_encoding,
+                                     writer=writer)
 
     def cancel(self) -> None:
         """
@@ -624,13 +654,27 @@ class ExportedTaskHL7Message(Base):
             self.abort(
                 "Unsuitable for HL7; should have been filtered out earlier")
             return
+        if self.prepare(req):
+            # Proper HL7 message
+            self.transmit_hl7()
+
+    def prepare(self, req: "CamcopsRequest") -> bool:
+        """
+        Makes the HL7 message, and diverts it to a file if the recipient
+        wants that.
+
+        Args:
+            req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+
+        Returns:
+            bool: should the message now be transmitted?
+        """
         self.make_hl7_message(req)
         recipient = self.exported_task.recipient
         if recipient.hl7_debug_divert_to_file:
             self.divert_to_file(req)
-        else:
-            # Proper HL7 message
-            self.transmit_hl7()
+            return False
+        return True
 
     def divert_to_file(self, req: "CamcopsRequest") -> None:
         """
@@ -703,9 +747,16 @@ class ExportedTaskHL7Message(Base):
 
         - http://python-hl7.readthedocs.org/en/latest/api.html; however,
           we've modified that
+
+        If the recipient uses a persistent connection, the message is sent via
+        :meth:`transmit_hl7_messages`.
         """  # noqa
         recipient = self.exported_task.recipient
 
+        if recipient.hl7_persistent_connection:
+            self.transmit_hl7_messages(recipient, [self])
+            return
+
         if recipient.hl7_ping_first:
             pinged = self.ping_hl7_server(recipient)
             if not pinged:
@@ -730,6 +781,17 @@ class ExportedTaskHL7Message(Base):
             self.abort("No response from server")
             return
 
+        self.process_reply(reply)
+
+    def process_reply(self, reply: str) -> None:
+        """
+        Records the HL7 server's reply to our message, and whether it was a
+        successful acknowledgement.
+
+        Args:
+            reply: the reply
+        """
+        recipient = self.exported_task.recipient
         self.reply_at_utc = get_now_utc_datetime()
         if recipient.hl7_keep_reply:
             self.reply = reply
@@ -746,6 +808,44 @@ class ExportedTaskHL7Message(Base):
         else:
             self.abort(failure_reason)
 
+    @classmethod
+    def transmit_hl7_messages(
+            cls,
+            recipient: ExportRecipient,
+            messages: List["ExportedTaskHL7Message"]) -> None:
+        """
+        Sends several prepared messages (see :meth:`prepare`) to the
+        recipient's HL7 server, over this process's persistent connection to
+        it, with up to ``recipient.hl7_pipeline_window`` awaiting
+        acknowledgement at any one time. If requested, pings the server first,
+        but only if the connection isn't already open.
+
+        Args:
+            recipient: an :class:`camcops_server.cc_modules.cc_exportrecipient.ExportRecipient`
+            messages: the :class:`ExportedTaskHL7Message` objects
+        """  # noqa
+        if not messages:
+            return
+        conn = get_mllp_connection(
+            recipient.hl7_host,
+            recipient.hl7_port,
+            timeout_ms=recipient.hl7_network_timeout_ms,
+            window=recipient.hl7_pipeline_window)
+        if recipient.hl7_ping_first and not conn.connected:
+            if not cls.ping_hl7_server(recipient):
+                for ehl7 in messages:
+                    ehl7.abort("Could not ping HL7 host")
+                return
+        log.info("Sending {} HL7 message(s) to {}:{}",
+                 len(messages), recipient.hl7_host, recipient.hl7_port)
+        results = conn.send_messages(
+            [(str(ehl7.id), ehl7._hl7_msg) for ehl7 in messages])
+        for ehl7, (reply, error) in zip(messages, results):
+            if error:
+                ehl7.abort(error)
+            else:
+                ehl7.process_reply(reply)
+
     @staticmethod
     def ping_hl7_server(recipient: ExportRecipient) -> bool:
         """
@@ -837,20 +937,26 @@ class ExportedTaskFileGroup(Base):
                     filename: str,
                     text: str = None,
                     binary: bytes = None,
-                    text_encoding: str = UTF8) -> False:
+                    text_encoding: str = UTF8,
+                    writer: Callable[[TextIO], None] = None) -> False:
         """
         Exports the file.
 
         Args:
             filename:
-            text: text contents (specify this XOR ``binary``)
-            binary: binary contents (specify this XOR ``text``)
+            text: text contents (specify exactly one of ``text``, ``binary``,
+                and ``writer``)
+            binary: binary contents
             text_encoding: encoding to use when writing text
+            writer: function that writes text contents to a file-like object;
+                use this for large outputs, which can then be written in a
+                single pass without being held in memory
 
         Returns:
             bool: was it exported?
         """
-        assert bool(text) != bool(binary), "Specify text XOR binary"
+        n_sources = [bool(text), bool(binary), writer is not None].count(True)
+        assert n_sources == 1, "Specify one of text, binary, writer"
         exported_task = self.exported_task
         filename = os.path.abspath(filename)
         directory = os.path.dirname(filename)
@@ -872,10 +978,19 @@ class ExportedTaskFileGroup(Base):
             if text:
                 with open(filename, mode="w", encoding=text_encoding) as f:
                     f.write(text)
+            elif writer is not None:
+                with open(filename, mode="w", encoding=text_encoding) as f:
+                    writer(f)
             else:
                 with open(filename, mode="wb") as f:
                     f.write(binary)
         except Exception as e:
+            if writer is not None and os.path.isfile(filename):
+                # Don't leave a partially written file behind.
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
             self.abort(f"Failed to open or write file {filename!r}: {e}")
             return False
 
@@ -924,6 +1039,7 @@ class ExportedTaskFileGroup(Base):
                     return
 
         # Export task
+        writer = None  # type: Optional[Callable[[TextIO], None]]
         if task_format == FileType.PDF:
             binary = task.get_pdf(req)
             text = None
@@ -931,12 +1047,14 @@ class ExportedTaskFileGroup(Base):
             binary = None
             text = task.get_html(req)
         elif task_format == FileType.XML:
+            # Streamed straight to the file; see Task.write_xml().
             binary = None
-            text = task.get_xml(req)
+            text = None
+            writer = functools.partial(task.write_xml, req=req)
         else:
             raise AssertionError("Unknown task_format")
         written = self.export_file(task_filename, text=text, binary=binary,
-                                   text_encoding=UTF8)
+                                   text_encoding=UTF8, writer=writer)
         if not written:
             return
 
@@ -1164,3 +1282,39 @@ class ExportedTaskRedcap(Base):
             exported_task.succeed()
         except RedcapExportException as e:
             exported_task.abort(str(e))
+
+    @classmethod
+    def export_tasks(cls,
+                     req: "CamcopsRequest",
+                     exported_task_redcaps: List["ExportedTaskRedcap"]) -> None:
+        """
+        Exports several tasks, all for the same recipient, to REDCap in one
+        batch (see
+        :meth:`camcops_server.cc_modules.cc_redcap.RedcapTaskExporter.export_tasks`).
+        Otherwise equivalent to calling :meth:`export_task` for each.
+
+        Once anything may have been imported, the exporter reports any failure
+        (including an unexpected one, such as a connection error) for the
+        tasks concerned, rather than raising, so each task's outcome is
+        recorded here and can be committed by the caller.
+
+        Args:
+            req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            exported_task_redcaps: the :class:`ExportedTaskRedcap` objects
+        """  # noqa
+        if not exported_task_redcaps:
+            return
+        exporter = RedcapTaskExporter()
+
+        try:
+            errors = exporter.export_tasks(req, exported_task_redcaps)
+        except RedcapExportException as e:
+            for eredcap in exported_task_redcaps:
+                eredcap.exported_task.abort(str(e))
+            return
+
+        for eredcap, error in zip(exported_task_redcaps, errors):
+            if error is None:
+                eredcap.exported_task.succeed()
+            else:
+                eredcap.exported_task.abort(error)
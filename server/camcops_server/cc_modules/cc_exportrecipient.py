@@ -50,6 +50,7 @@ from sqlalchemy.sql.sqltypes import (
     Text,
 )
 
+from camcops_server.cc_modules.cc_constants import ConfigDefaults
 from camcops_server.cc_modules.cc_exportrecipientinfo import (
     ExportRecipientInfo,
 )
@@ -98,6 +99,8 @@ class ExportRecipient(ExportRecipientInfo, Base):
     ]
     NEEDS_RECOPYING_EACH_TIME_FROM_CONFIG_ATTRNAMES = [
         "email_host_password",
+        "hl7_persistent_connection",
+        "hl7_pipeline_window",
         "redcap_api_key",
     ]
 
@@ -398,6 +401,9 @@ class ExportRecipient(ExportRecipientInfo, Base):
         # Python only:
         self.group_names = []  # type: List[str]
         self.email_host_password = ""
+        cd = ConfigDefaults
+        self.hl7_persistent_connection = cd.HL7_PERSISTENT_CONNECTION
+        self.hl7_pipeline_window = cd.HL7_PIPELINE_WINDOW
         self.redcap_api_key = ""
 
     def get_attrnames(self) -> List[str]:
@@ -139,6 +139,8 @@ class ExportRecipientInfo(object):
     IGNORE_FOR_EQ_ATTRNAMES = [
         # Attribute names to ignore for equality comparison
         "email_host_password",
+        "hl7_persistent_connection",
+        "hl7_pipeline_window",
         "redcap_api_key",
     ]
 
@@ -208,6 +210,9 @@ class ExportRecipientInfo(object):
         self.hl7_keep_reply = cd.HL7_KEEP_REPLY
         self.hl7_debug_divert_to_file = cd.HL7_DEBUG_DIVERT_TO_FILE
         self.hl7_debug_treat_diverted_as_sent = cd.HL7_DEBUG_TREAT_DIVERTED_AS_SENT  # noqa
+        # ... connection handling only; not in database:
+        self.hl7_persistent_connection = cd.HL7_PERSISTENT_CONNECTION
+        self.hl7_pipeline_window = cd.HL7_PIPELINE_WINDOW
 
         # File
 
@@ -487,6 +492,10 @@ class ExportRecipientInfo(object):
             r.hl7_debug_treat_diverted_as_sent = _get_bool(
                 cpr.HL7_DEBUG_TREAT_DIVERTED_AS_SENT,
                 cd.HL7_DEBUG_TREAT_DIVERTED_AS_SENT)
+            r.hl7_persistent_connection = _get_bool(
+                cpr.HL7_PERSISTENT_CONNECTION, cd.HL7_PERSISTENT_CONNECTION)
+            r.hl7_pipeline_window = _get_int(cpr.HL7_PIPELINE_WINDOW,
+                                             cd.HL7_PIPELINE_WINDOW)
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # File
@@ -667,6 +676,10 @@ class ExportRecipientInfo(object):
                 if not self.hl7_port or self.hl7_port <= 0:
                     fail_invalid(
                         f"Missing/invalid {cpr.HL7_PORT}: {self.hl7_port}")
+            if self.hl7_pipeline_window < 1:
+                fail_invalid(
+                    f"Invalid {cpr.HL7_PIPELINE_WINDOW}: "
+                    f"{self.hl7_pipeline_window}")
             if not self.primary_idnum:
                 fail_missing(cpr.PRIMARY_IDNUM)
             if self.include_anonymous:
@@ -856,6 +869,12 @@ class ExportRecipientInfo(object):
         """
         return self.transmission_method == ExportTransmissionMethod.HL7
 
+    def using_redcap(self) -> bool:
+        """
+        Is the recipient a REDCap instance?
+        """
+        return self.transmission_method == ExportTransmissionMethod.REDCAP
+
     def anonymous_ok(self) -> bool:
         """
         Does this recipient permit/want anonymous tasks?
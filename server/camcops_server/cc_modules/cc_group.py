@@ -30,7 +30,7 @@ camcops_server/cc_modules/cc_group.py
 
 import logging
 import re
-from typing import List, Optional, Set
+from typing import Dict, List, Optional, Set
 
 from cardinal_pythonlib.logs import BraceStyleAdapter
 from cardinal_pythonlib.reprfunc import simple_repr
@@ -41,6 +41,7 @@ from sqlalchemy.orm import relationship, Session as SqlASession
 from sqlalchemy.sql.schema import Column, ForeignKey, Table
 from sqlalchemy.sql.sqltypes import Integer
 
+from camcops_server.cc_modules.cc_cache import db_cache_get_or_create
 from camcops_server.cc_modules.cc_policy import TokenizedPolicy
 from camcops_server.cc_modules.cc_sqla_coltypes import (
     GROUP_NAME_MAX_LEN,
@@ -218,8 +219,7 @@ class Group(Base):
         """
         Returns all group IDs.
         """
-        query = dbsession.query(cls).order_by(cls.id)
-        return [g.id for g in query]
+        return sorted(get_group_visibility_map(dbsession).keys())
 
     @classmethod
     def all_group_names(cls, dbsession: SqlASession) -> List[str]:
@@ -247,3 +247,33 @@ class Group(Base):
         Returns the finalize policy for a group.
         """
         return TokenizedPolicy(self.finalize_policy)
+
+
+# =============================================================================
+# Group visibility, cached
+# =============================================================================
+
+CACHE_KEY_GROUP_VISIBILITY = "camcops:group_visibility"
+
+
+def get_group_visibility_map(dbsession: SqlASession) -> Dict[int, List[int]]:
+    """
+    Returns a dictionary mapping each group ID to a sorted list of the IDs of
+    groups it may see (always including itself).
+
+    This is read on almost every request and changes rarely, so it is held in
+    the shared database cache; see
+    :func:`camcops_server.cc_modules.cc_cache.db_cache_get_or_create`.
+    """
+    def creator() -> Dict[int, List[int]]:
+        visibility = {
+            group_id: {group_id}
+            for group_id, in dbsession.query(Group.id)
+        }  # type: Dict[int, Set[int]]
+        gg = group_group_table.c
+        for group_id, can_see_group_id in dbsession.query(
+                gg.group_id, gg.can_see_group_id):
+            visibility.setdefault(group_id, {group_id}).add(can_see_group_id)
+        return {k: sorted(v) for k, v in visibility.items()}
+
+    return db_cache_get_or_create(CACHE_KEY_GROUP_VISIBILITY, creator)
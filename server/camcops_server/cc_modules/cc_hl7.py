@@ -61,10 +61,14 @@ We can then add an option for structure (XML), HTML, PDF export.
 
 """
 
+import asyncio
 import base64
+from collections import deque
 import logging
 import socket
-from typing import List, Optional, Tuple, TYPE_CHECKING, Union
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING, Union
 
 from cardinal_pythonlib.datetimefunc import format_datetime
 from cardinal_pythonlib.logs import BraceStyleAdapter
@@ -73,7 +77,10 @@ from pendulum import Date, DateTime as Pendulum
 
 from camcops_server.cc_modules.cc_constants import DateFormat, FileType
 from camcops_server.cc_modules.cc_simpleobjects import HL7PatientIdentifier
-from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
+from camcops_server.cc_modules.cc_unittest import (
+    DemoDatabaseTestCase,
+    ExtendedTestCase,
+)
 
 if TYPE_CHECKING:
     from camcops_server.cc_modules.cc_request import CamcopsRequest
@@ -868,6 +875,300 @@ class MLLPTimeoutClient(object):
             return False, None
 
 
+# =============================================================================
+# Persistent, pipelined MLLP connections
+# =============================================================================
+
+MLLP_MAX_CONNECT_ATTEMPTS = 5
+MLLP_BACKOFF_INITIAL_S = 0.5
+MLLP_BACKOFF_MAX_S = 30.0
+MLLP_MAX_SEND_ATTEMPTS = 2  # i.e. resend once if the connection drops
+
+
+def wrap_mllp(message: Union[str, hl7.Message],
+              encoding: str = "utf-8") -> bytes:
+    """
+    Wraps a string or :class:`hl7.Message` in an MLLP container (as for
+    :meth:`MLLPTimeoutClient.send_message`).
+    """
+    if isinstance(message, hl7.Message):
+        message = str(message)
+    return (SB + message + CR + EB + CR).encode(encoding)
+
+
+def get_ack_control_id(reply: str) -> Optional[str]:
+    """
+    Returns the message control ID that an ACK/NAK message refers to (MSA-2),
+    or ``None`` if the reply can't be parsed.
+    """
+    try:
+        msg = hl7.parse(reply)
+        return str(msg.segment("MSA")[2])
+    except Exception:
+        return None
+
+
+class MLLPConnection(object):
+    """
+    A persistent MLLP connection to an HL7 server.
+
+    - The connection is opened when first needed and kept open between
+      messages, rather than opened for each one.
+    - If it can't be opened, it retries with exponential backoff.
+    - Up to ``window`` messages may be sent before their acknowledgements
+      arrive. Acknowledgements are matched to messages by message control ID
+      (MSA-2), or failing that in order of sending (MLLP delivers messages in
+      order).
+    - If the connection drops, it reconnects and resends the unacknowledged
+      messages (at most :data:`MLLP_MAX_SEND_ATTEMPTS` attempts per message);
+      the message control ID allows the server to recognize duplicates.
+
+    Use :func:`get_mllp_connection` to share connections within a process.
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 timeout_ms: int = None,
+                 window: int = 1,
+                 max_connect_attempts: int = MLLP_MAX_CONNECT_ATTEMPTS,
+                 backoff_initial_s: float = MLLP_BACKOFF_INITIAL_S,
+                 backoff_max_s: float = MLLP_BACKOFF_MAX_S) -> None:
+        """
+        Args:
+            host: HL7 server hostname
+            port: HL7 server port
+            timeout_ms: network timeout (for connecting and for each
+                acknowledgement), or ``None`` for no timeout
+            window: maximum number of unacknowledged messages
+            max_connect_attempts: attempts to connect before giving up
+            backoff_initial_s: delay after the first failed connection
+                attempt; doubled after each subsequent failure
+            backoff_max_s: maximum delay between connection attempts
+        """
+        self.host = host
+        self.port = port
+        self.socket = None  # type: Optional[socket.socket]
+        self.timeout_s = None  # type: Optional[float]
+        self.window = 1
+        self.configure(timeout_ms=timeout_ms, window=window)
+        self.max_connect_attempts = max_connect_attempts
+        self.backoff_initial_s = backoff_initial_s
+        self.backoff_max_s = backoff_max_s
+        self.encoding = "utf-8"
+        self._recv_buffer = b""
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}({self.host}:{self.port}, "
+            f"window={self.window}, connected={self.connected})>"
+        )
+
+    def configure(self, timeout_ms: int = None, window: int = 1) -> None:
+        """
+        Sets the network timeout and the window size.
+        """
+        self.timeout_s = float(timeout_ms) / float(1000) \
+            if timeout_ms is not None else None
+        self.window = max(1, window)
+        if self.socket is not None:
+            self.socket.settimeout(self.timeout_s)
+
+    @property
+    def connected(self) -> bool:
+        """
+        Is the connection open (as far as we know)?
+        """
+        return self.socket is not None
+
+    def connect(self) -> None:
+        """
+        Opens the connection if necessary, retrying with exponential backoff.
+
+        Raises:
+            :exc:`OSError` (including :exc:`socket.timeout`) if all attempts
+            fail
+        """
+        if self.connected:
+            return
+        delay_s = self.backoff_initial_s
+        attempt = 1
+        while True:
+            try:
+                log.info("Opening MLLP connection to {}:{}",
+                         self.host, self.port)
+                sock = socket.create_connection((self.host, self.port),
+                                                timeout=self.timeout_s)
+                sock.settimeout(self.timeout_s)
+                self.socket = sock
+                self._recv_buffer = b""
+                return
+            except OSError as e:
+                if attempt >= self.max_connect_attempts:
+                    raise
+                log.warning(
+                    "Failed to connect to HL7 server {}:{} (attempt {} of "
+                    "{}): {}; retrying in {} s", self.host, self.port,
+                    attempt, self.max_connect_attempts, e, delay_s)
+                time.sleep(delay_s)
+                delay_s = min(delay_s * 2, self.backoff_max_s)
+                attempt += 1
+
+    def close(self) -> None:
+        """
+        Closes the connection, if open.
+        """
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+        self.socket = None
+        self._recv_buffer = b""
+
+    def _read_frame(self) -> str:
+        """
+        Reads the next MLLP frame from the server, and returns its contents.
+
+        Raises:
+            :exc:`socket.timeout` if the server doesn't reply in time
+            :exc:`ConnectionError` if the server closes the connection
+        """
+        while True:
+            end = self._recv_buffer.find(EB.encode(self.encoding))
+            if end >= 0:
+                frame = self._recv_buffer[:end]
+                rest = self._recv_buffer[end + 1:]
+                if rest.startswith(CR.encode(self.encoding)):
+                    rest = rest[1:]
+                self._recv_buffer = rest
+                start = frame.find(SB.encode(self.encoding))
+                if start >= 0:
+                    frame = frame[start + 1:]
+                return frame.decode(self.encoding)
+            data = self.socket.recv(RECV_BUFFER)
+            if not data:
+                raise ConnectionError("Connection closed by HL7 server")
+            self._recv_buffer += data
+
+    def send_messages(
+            self,
+            messages: Sequence[Tuple[str, Union[str, hl7.Message]]]) \
+            -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        Sends messages, keeping up to ``window`` of them in flight, and
+        collects the server's replies.
+
+        Args:
+            messages: list of ``message_control_id, message`` tuples
+
+        Returns:
+            a list (in the same order as ``messages``) of ``reply, error``
+            tuples; ``reply`` is the server's reply (without the MLLP
+            container) and ``error`` is ``None`` if there was a reply, or
+            vice versa.
+        """
+        n = len(messages)
+        control_ids = [str(control_id) for control_id, _ in messages]
+        data = [wrap_mllp(msg, self.encoding) for _, msg in messages]
+        results = [(None, None)] * n  # type: List[Tuple[Optional[str], Optional[str]]]  # noqa
+        attempts = [0] * n
+        unsent = deque(range(n))
+        in_flight = []  # type: List[int]
+        answered_control_ids = set()
+
+        def fail(indexes: Sequence[int], error: str) -> None:
+            for i_ in indexes:
+                results[i_] = (None, error)
+
+        with self._lock:
+            while unsent or in_flight:
+                try:
+                    self.connect()
+                except OSError as e:
+                    fail(in_flight, f"Failed to send message via MLLP: {e}")
+                    fail(unsent, f"Failed to send message via MLLP: {e}")
+                    break
+                try:
+                    while unsent and len(in_flight) < self.window:
+                        i = unsent.popleft()
+                        attempts[i] += 1
+                        in_flight.append(i)
+                        self.socket.sendall(data[i])
+                    reply = self._read_frame()
+                    ack_control_id = get_ack_control_id(reply)
+                    if (ack_control_id in answered_control_ids and
+                            not any(control_ids[j] == ack_control_id
+                                    for j in in_flight)):
+                        # A second reply to a message that we resent.
+                        log.debug("Ignoring duplicate acknowledgement for "
+                                  "message {!r}", ack_control_id)
+                        continue
+                    i = next(
+                        (j for j in in_flight
+                         if control_ids[j] == ack_control_id),
+                        in_flight[0]  # unknown: assume the oldest
+                    )
+                    in_flight.remove(i)
+                    results[i] = (reply, None)
+                    answered_control_ids.add(control_ids[i])
+                except socket.timeout:
+                    # We don't know what the server will do next; start
+                    # afresh.
+                    self.close()
+                    fail(in_flight, "No response from server")
+                    in_flight = []
+                except OSError as e:
+                    # Includes ConnectionError. Reconnect and resend.
+                    log.warning("MLLP connection to {}:{} lost: {}",
+                                self.host, self.port, e)
+                    self.close()
+                    for i in reversed(in_flight):
+                        if attempts[i] < MLLP_MAX_SEND_ATTEMPTS:
+                            unsent.appendleft(i)
+                        else:
+                            fail([i], f"Failed to send message via MLLP: {e}")
+                    in_flight = []
+        return results
+
+    def send_message(self, message: Union[str, hl7.Message],
+                     control_id: str = "") -> Tuple[Optional[str],
+                                                    Optional[str]]:
+        """
+        Sends a single message; see :meth:`send_messages`.
+
+        Returns:
+            tuple: ``reply, error``
+        """
+        return self.send_messages([(control_id, message)])[0]
+
+
+_mllp_connections = {}  # type: Dict[Tuple[str, int], MLLPConnection]
+_mllp_connections_lock = threading.Lock()
+
+
+def get_mllp_connection(host: str,
+                        port: int,
+                        timeout_ms: int = None,
+                        window: int = 1) -> MLLPConnection:
+    """
+    Returns this process's persistent :class:`MLLPConnection` to the
+    specified HL7 server, creating it if necessary (and updating its timeout
+    and window otherwise).
+    """
+    key = (host, port)
+    with _mllp_connections_lock:
+        conn = _mllp_connections.get(key)
+        if conn is None:
+            conn = MLLPConnection(host, port,
+                                  timeout_ms=timeout_ms, window=window)
+            _mllp_connections[key] = conn
+        else:
+            conn.configure(timeout_ms=timeout_ms, window=window)
+        return conn
+
+
 # =============================================================================
 # Unit tests
 # =============================================================================
@@ -921,3 +1222,139 @@ class HL7CoreTests(DemoDatabaseTestCase):
                     export_options=export_options,
                 ), hl7.Segment)
         self.assertIsInstance(escape_hl7_text("blahblah"), str)
+
+
+class DummyHL7Server(object):
+    """
+    A stand-in HL7 server for testing, after ``playing/hl7_dummy_server.py``
+    but using :mod:`asyncio` and keeping connections open. It runs in a
+    background thread, and acknowledges each MLLP-wrapped message, quoting the
+    message's control ID (MSH-10).
+    """
+    def __init__(self, drop_after: int = None) -> None:
+        """
+        Args:
+            drop_after: drop each connection, without replying, on receipt
+                of this many messages (for testing reconnection)
+        """
+        self.drop_after = drop_after
+        self.received = []  # type: List[str]
+        self.connections = 0
+        self.host = "127.0.0.1"
+        self.port = None  # type: Optional[int]
+        self._loop = asyncio.new_event_loop()
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True)
+
+    def __enter__(self) -> "DummyHL7Server":
+        self._thread.start()
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, self.host, 0),
+            self._loop)
+        self._server = future.result(timeout=5)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        async def _stop() -> None:
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(_stop(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop.close()
+
+    @staticmethod
+    def make_ack(control_id: str) -> str:
+        msh = FIELD_SEPARATOR.join([
+            "MSH", "^~\\&", "hl7_dummy_server.py", "", "", "",
+            "20140619232037+0100", "", "ACK", control_id, "P", "2.3",
+        ])
+        msa = FIELD_SEPARATOR.join(["MSA", "AA", control_id, "Success"])
+        return msh + SEGMENT_SEPARATOR + msa
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        n_this_connection = 0
+        try:
+            while True:
+                data = await reader.readuntil((EB + CR).encode("utf-8"))
+                message = data.decode("utf-8").strip(SB + EB + CR)
+                n_this_connection += 1
+                if (self.drop_after is not None and
+                        n_this_connection >= self.drop_after):
+                    break
+                self.received.append(message)
+                msh_fields = message.split(SEGMENT_SEPARATOR)[0].split(
+                    FIELD_SEPARATOR)
+                control_id = msh_fields[9] if len(msh_fields) > 9 else ""
+                ack = SB + self.make_ack(control_id) + EB + CR
+                writer.write(ack.encode("utf-8"))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class MLLPConnectionTests(ExtendedTestCase):
+    """
+    Unit tests for :class:`MLLPConnection`, against :class:`DummyHL7Server`.
+    """
+    @staticmethod
+    def _messages(n: int) -> List[Tuple[str, str]]:
+        messages = []  # type: List[Tuple[str, str]]
+        for i in range(1, n + 1):
+            control_id = str(i)
+            msh = FIELD_SEPARATOR.join([
+                "MSH", "^~\\&", "CamCOPS", "", "", "",
+                "20200101000000+0000", "", "ORU^R01", control_id, "P", "2.3",
+            ])
+            messages.append((control_id, msh))
+        return messages
+
+    def test_persistent_pipelined_connection(self) -> None:
+        self.announce("test_persistent_pipelined_connection")
+        messages = self._messages(20)
+        with DummyHL7Server() as server:
+            conn = MLLPConnection(server.host, server.port,
+                                  timeout_ms=5000, window=4)
+            try:
+                results = conn.send_messages(messages[:10])
+                results += conn.send_messages(messages[10:])
+            finally:
+                conn.close()
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(len(server.received), len(messages))
+        for (control_id, _), (reply, error) in zip(messages, results):
+            self.assertIsNone(error)
+            self.assertEqual(get_ack_control_id(reply), control_id)
+
+    def test_reconnect_and_resend(self) -> None:
+        self.announce("test_reconnect_and_resend")
+        messages = self._messages(5)
+        with DummyHL7Server(drop_after=3) as server:
+            conn = MLLPConnection(server.host, server.port,
+                                  timeout_ms=5000, window=1)
+            try:
+                results = conn.send_messages(messages)
+            finally:
+                conn.close()
+            self.assertGreater(server.connections, 1)
+        for (control_id, _), (reply, error) in zip(messages, results):
+            self.assertIsNone(error)
+            self.assertEqual(get_ack_control_id(reply), control_id)
+
+    def test_connection_refused(self) -> None:
+        self.announce("test_connection_refused")
+        with DummyHL7Server() as server:
+            host, port = server.host, server.port
+        # Server now closed.
+        conn = MLLPConnection(host, port, timeout_ms=1000,
+                              max_connect_attempts=2, backoff_initial_s=0.01)
+        reply, error = conn.send_message("MSH|^~\\&", control_id="1")
+        self.assertIsNone(reply)
+        self.assertIn("Failed to send message via MLLP", error)
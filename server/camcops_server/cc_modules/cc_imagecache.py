@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+camcops_server/cc_modules/cc_imagecache.py
+
+===============================================================================
+
+    Copyright (C) 2012-2020 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CamCOPS.
+
+    CamCOPS is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CamCOPS is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CamCOPS. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**On-disk cache of derived (rotated, resized) BLOB images.**
+
+- Rotating an image, or making a thumbnail of it, needs ImageMagick (via
+  ``wand``), which is slow. Without a cache, that is repeated for every view of
+  a task (HTML, PDF, XML), by every user.
+
+- A BLOB row never changes its content or rotation (a modified re-upload
+  creates a new row), so a derived image is identified by the BLOB's server
+  PK, its rotation, the target size and the output format. See
+  :class:`DerivedImageKey`.
+
+- Renditions are stored one per file, below a root directory (see the
+  ``DERIVED_IMAGE_CACHE_DIRECTORY`` config parameter), sharded by BLOB PK.
+  Files are written to a temporary file and renamed into place, so readers
+  never see a partial file; several server processes can share the directory.
+
+- The cache is bounded (``DERIVED_IMAGE_CACHE_MAX_SIZE_MB``). Reading a file
+  refreshes its modification time; when the total size exceeds the limit, the
+  least recently used files are deleted until it is comfortably below the
+  limit again.
+
+- Hit/miss counters appear alongside those of our other caches; see
+  :func:`camcops_server.cc_modules.cc_cache.get_cache_stats`.
+
+"""
+
+import logging
+import os
+import re
+import tempfile
+from threading import Lock
+from typing import List, Optional, Tuple
+import unittest
+
+from cardinal_pythonlib.logs import BraceStyleAdapter
+from cardinal_pythonlib.reprfunc import auto_repr
+
+from camcops_server.cc_modules.cc_cache import (
+    CacheRegionStats,
+    make_cache_stats,
+)
+
+log = BraceStyleAdapter(logging.getLogger(__name__))
+
+
+# =============================================================================
+# Constants
+# =============================================================================
+
+THUMBNAIL_SIZE_PX = 200  # maximum width/height of a thumbnail
+EVICTION_TARGET_FRACTION = 0.9  # evict down to this fraction of the maximum
+_SHARDS = 256
+
+
+# =============================================================================
+# Keys
+# =============================================================================
+
+class DerivedImageKey(object):
+    """
+    Identifies a derived image.
+    """
+    def __init__(self, blob_pk: int, rotation: int,
+                 max_size_px: Optional[int], fmt: str) -> None:
+        """
+        Args:
+            blob_pk: server PK of the source BLOB
+            rotation: clockwise rotation in degrees
+            max_size_px: maximum width/height, or ``None`` for full size
+            fmt: output format (e.g. MIME type)
+        """
+        self.blob_pk = blob_pk
+        self.rotation = rotation % 360
+        self.max_size_px = max_size_px
+        self.fmt = fmt
+
+    def __repr__(self) -> str:
+        return auto_repr(self)
+
+    @property
+    def filename(self) -> str:
+        size = "full" if self.max_size_px is None else str(self.max_size_px)
+        fmt = re.sub(r"[^a-z0-9]+", "_", self.fmt.lower())
+        return f"{self.blob_pk}_{self.rotation}_{size}_{fmt}"
+
+
+# =============================================================================
+# The cache
+# =============================================================================
+
+class DerivedImageCache(object):
+    """
+    Size-bounded, least-recently-used cache of derived images, on disk.
+    """
+    def __init__(self, root: str, max_size_bytes: int,
+                 stats: CacheRegionStats = None) -> None:
+        """
+        Args:
+            root: root directory (created if necessary)
+            max_size_bytes: maximum total size of cached files
+            stats: hit/miss counters (by default, new ones not registered
+                with :func:`camcops_server.cc_modules.cc_cache.get_cache_stats`)
+        """
+        if not root:
+            raise ValueError("No directory specified for derived image cache")
+        if max_size_bytes <= 0:
+            raise ValueError(f"Bad maximum size for derived image cache: "
+                             f"{max_size_bytes!r}")
+        self.root = os.path.abspath(root)
+        self.max_size_bytes = max_size_bytes
+        self.stats = stats or CacheRegionStats("derived_images")
+        self._lock = Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._total_size = sum(size for _, _, size in self._gen_files())
+        # ... an estimate; other processes may write to the same directory,
+        # so we recount when evicting.
+
+    def __repr__(self) -> str:
+        return (f"{self.__class__.__name__}(root={self.root!r}, "
+                f"max_size_bytes={self.max_size_bytes!r})")
+
+    def _shard_dir(self, blob_pk: int) -> str:
+        return os.path.join(self.root, f"{blob_pk % _SHARDS:02x}")
+
+    def _path(self, key: DerivedImageKey) -> str:
+        return os.path.join(self._shard_dir(key.blob_pk), key.filename)
+
+    def _gen_files(self) -> List[Tuple[float, str, int]]:
+        """
+        Returns ``(mtime, path, size)`` for all cached files.
+        """
+        results = []  # type: List[Tuple[float, str, int]]
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:  # deleted by someone else
+                    continue
+                results.append((st.st_mtime, path, st.st_size))
+        return results
+
+    def get(self, key: DerivedImageKey) -> Optional[bytes]:
+        """
+        Returns the cached image, or ``None``.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:  # including eviction by another process
+            self.stats.record(misses=1)
+            return None
+        self.stats.record(hits=1)
+        return data
+
+    def put(self, key: DerivedImageKey, data: bytes) -> None:
+        """
+        Stores an image. Failure to write is logged, not raised; the cache is
+        only an optimization.
+        """
+        directory = self._shard_dir(key.blob_pk)
+        tmpname = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmpname, self._path(key))
+            tmpname = None
+        except OSError as e:
+            log.warning("Failed to write derived image {!r}: {}", key, e)
+            return
+        finally:
+            if tmpname:
+                try:
+                    os.remove(tmpname)
+                except OSError:
+                    pass
+        with self._lock:
+            self._total_size += len(data)
+            must_evict = self._total_size > self.max_size_bytes
+        if must_evict:
+            self.evict()
+
+    def discard_blob(self, blob_pk: int) -> None:
+        """
+        Removes all renditions of a BLOB (e.g. when it is erased).
+        """
+        directory = self._shard_dir(blob_pk)
+        prefix = f"{blob_pk}_"
+        try:
+            filenames = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            if filename.startswith(prefix):
+                path = os.path.join(directory, filename)
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                with self._lock:
+                    self._total_size -= size
+
+    def evict(self) -> int:
+        """
+        Deletes least recently used files until the total size is below
+        :data:`EVICTION_TARGET_FRACTION` of the maximum. Returns the number of
+        files deleted.
+        """
+        files = sorted(self._gen_files())  # oldest first
+        total = sum(size for _, _, size in files)
+        target = self.max_size_bytes * EVICTION_TARGET_FRACTION
+        n_deleted = 0
+        for _, path, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            n_deleted += 1
+        with self._lock:
+            self._total_size = total
+        log.debug("Derived image cache: evicted {} file(s); {} bytes remain",
+                  n_deleted, total)
+        return n_deleted
+
+
+# =============================================================================
+# The process-wide cache
+# =============================================================================
+
+_derived_image_cache = None  # type: Optional[DerivedImageCache]
+_derived_image_cache_configured = False
+
+
+def configure_derived_image_cache(directory: str, max_size_mb: int) -> None:
+    """
+    Sets up the process-wide derived image cache (if ``directory`` is given).
+    Only the first call has any effect (the config is not re-read within a
+    process).
+    """
+    global _derived_image_cache, _derived_image_cache_configured
+    if _derived_image_cache_configured:
+        return
+    if directory:
+        _derived_image_cache = DerivedImageCache(
+            root=directory,
+            max_size_bytes=max_size_mb * 1024 * 1024,
+            stats=make_cache_stats("derived_images")
+        )
+    _derived_image_cache_configured = True
+    log.debug("Derived image cache: {!r}", _derived_image_cache)
+
+
+def get_derived_image_cache() -> Optional[DerivedImageCache]:
+    """
+    Returns the process-wide derived image cache, or ``None``.
+    """
+    return _derived_image_cache
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class DerivedImageCacheTests(unittest.TestCase):
+    """
+    Unit tests.
+    """
+    def test_get_put_evict(self) -> None:
+        with tempfile.TemporaryDirectory() as root:
+            cache = DerivedImageCache(root, max_size_bytes=250)
+            k1 = DerivedImageKey(1, 90, None, "image/jpeg")
+            k2 = DerivedImageKey(2, 90, THUMBNAIL_SIZE_PX, "image/jpeg")
+            self.assertIsNone(cache.get(k1))
+            cache.put(k1, b"x" * 100)
+            self.assertEqual(cache.get(k1), b"x" * 100)
+            self.assertEqual((cache.stats.hits, cache.stats.misses), (1, 1))
+            # Make k1 look old, then push the total over the limit.
+            os.utime(cache._path(k1), (0, 0))
+            cache.put(k2, b"y" * 200)
+            self.assertIsNone(cache.get(k1))
+            self.assertEqual(cache.get(k2), b"y" * 200)
+            cache.discard_blob(2)
+            self.assertIsNone(cache.get(k2))
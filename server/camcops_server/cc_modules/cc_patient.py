@@ -28,9 +28,11 @@ camcops_server/cc_modules/cc_patient.py
 
 """
 
+from collections import OrderedDict
 import logging
 from typing import (
-    Any, Dict, Generator, List, Optional, Tuple, TYPE_CHECKING, Union,
+    Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple,
+    TYPE_CHECKING, TypeVar, Union,
 )
 
 from cardinal_pythonlib.classes import classproperty
@@ -102,6 +104,8 @@ if TYPE_CHECKING:
 
 log = BraceStyleAdapter(logging.getLogger(__name__))
 
+T = TypeVar("T")
+
 
 # =============================================================================
 # Patient class
@@ -400,6 +404,26 @@ class Patient(GenericTabletRecordMixin, Base):
         equal).
         """
         return 0  # all objects have the same hash; "use __eq__() instead"
+        # ... so sets of patients degrade to O(n^2) comparisons. To group
+        # many patients (or their tasks), use PatientIdentityIndex instead.
+
+    def get_identity_keys(self) -> List[Tuple]:
+        """
+        Returns the keys that identify this patient, in the sense used by
+        :meth:`__eq__`: one for the device/era/client PK combination (if all
+        are known), and one per ID number. Two patients sharing any key are
+        the same patient. See :class:`PatientIdentityIndex`.
+        """
+        keys = []  # type: List[Tuple]
+        if (self.id is not None and
+                self._device_id is not None and
+                self._era is not None):
+            keys.append(("device_era_id", self._device_id, self._era, self.id))
+        idnums = self.idnums  # type: List[PatientIdNum]
+        for idnum in idnums:
+            if idnum.which_idnum is not None and idnum.idnum_value is not None:
+                keys.append(("idnum", idnum.which_idnum, idnum.idnum_value))
+        return keys
 
     # -------------------------------------------------------------------------
     # ID numbers
@@ -888,6 +912,156 @@ class Patient(GenericTabletRecordMixin, Base):
         return req.user.may_administer_group(self._group_id)
 
 
+# =============================================================================
+# Grouping patients by identity
+# =============================================================================
+
+class PatientIdentityIndex(object):
+    """
+    Groups :class:`Patient` objects, or things belonging to them such as
+    tasks, by patient identity, in time roughly linear in the number of
+    patients.
+
+    Two patients are the same if they share a device/era/client PK
+    combination or any ID number (see :meth:`Patient.get_identity_keys`).
+    Identity is also made transitive, via a union-find (disjoint-set)
+    structure: if P1 shares an ID number with P2, and P2 shares a different
+    ID number with P3, then P1, P2 and P3 are all the same patient. (This
+    fixes a known imperfection in :meth:`Patient.__eq__`, which can't do
+    that.)
+
+    Typical use:
+
+    .. code-block:: python
+
+        index = PatientIdentityIndex()
+        for patient_tasks in index.group(tasks, lambda t: t.patient):
+            ...
+    """
+    def __init__(self, patients: Iterable[Patient] = ()) -> None:
+        """
+        Args:
+            patients: patients to add to the index straight away
+        """
+        self._parent = {}  # type: Dict[Any, Any]  # union-find forest
+        self._size = {}  # type: Dict[Any, int]  # size of each tree
+        self._patient_node = {}  # type: Dict[int, Tuple]  # id(patient) -> node  # noqa
+        self._patients = []  # type: List[Patient]  # keeps id() values valid
+        for patient in patients:
+            self.add(patient)
+
+    def __len__(self) -> int:
+        """
+        Number of patient objects added.
+        """
+        return len(self._patients)
+
+    # -------------------------------------------------------------------------
+    # Union-find
+    # -------------------------------------------------------------------------
+
+    def _make_node(self, node: Any) -> None:
+        if node not in self._parent:
+            self._parent[node] = node
+            self._size[node] = 1
+
+    def _find(self, node: Any) -> Any:
+        """
+        Returns the root (canonical) node for ``node``, with path compression.
+        """
+        parent = self._parent
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    def _union(self, a: Any, b: Any) -> None:
+        """
+        Merges the sets containing nodes ``a`` and ``b`` (union by size).
+        """
+        root_a = self._find(a)
+        root_b = self._find(b)
+        if root_a == root_b:
+            return
+        if self._size[root_a] < self._size[root_b]:
+            root_a, root_b = root_b, root_a
+        self._parent[root_b] = root_a
+        self._size[root_a] += self._size[root_b]
+
+    # -------------------------------------------------------------------------
+    # Public interface
+    # -------------------------------------------------------------------------
+
+    def add(self, patient: Patient) -> None:
+        """
+        Adds a patient to the index. Adding the same object again does
+        nothing.
+        """
+        if id(patient) in self._patient_node:
+            return
+        node = ("object", id(patient))
+        self._patient_node[id(patient)] = node
+        self._patients.append(patient)
+        self._make_node(node)
+        for key in patient.get_identity_keys():
+            self._make_node(key)
+            self._union(node, key)
+
+    def identity_key(self, patient: Patient) -> Tuple:
+        """
+        Returns a key that is the same for all patients in the index that
+        are the same person, and different for different people. (Only
+        stable until more patients are added.) The patient is added to the
+        index if necessary.
+        """
+        self.add(patient)
+        return self._find(self._patient_node[id(patient)])
+
+    def same_patient(self, a: Patient, b: Patient) -> bool:
+        """
+        Are ``a`` and ``b`` the same patient (possibly via other patients in
+        the index)?
+        """
+        return self.identity_key(a) == self.identity_key(b)
+
+    def patient_groups(self) -> List[List[Patient]]:
+        """
+        Returns the patients in the index, grouped by identity. Groups, and
+        patients within groups, are in the order the patients were added.
+        """
+        return self.group(self._patients, lambda p: p)
+
+    def group(self, items: Iterable[T],
+              patient_getter: Callable[[T], Optional[Patient]]) \
+            -> List[List[T]]:
+        """
+        Groups items (e.g. tasks) by the identity of their patients.
+
+        Args:
+            items: the things to group
+            patient_getter: function returning the :class:`Patient` for an
+                item, e.g. ``lambda task: task.patient``; items whose patient
+                is ``None`` are grouped together
+
+        Returns:
+            a list of groups, each a list of items, in the order that each
+            group was first encountered (and preserving the original order
+            within each group)
+        """
+        items = list(items)
+        patients = [patient_getter(item) for item in items]
+        for patient in patients:
+            if patient is not None:
+                self.add(patient)
+        groups = OrderedDict()  # type: Dict[Any, List[T]]
+        for item, patient in zip(items, patients):
+            key = None if patient is None else self.identity_key(patient)
+            groups.setdefault(key, []).append(item)
+        return list(groups.values())
+
+
 # =============================================================================
 # Validate candidate patient info for upload
 # =============================================================================
@@ -1102,3 +1276,60 @@ class LineageTests(DemoDatabaseTestCase):
         idnums = list(self.patient_1.gen_patient_idnums_even_noncurrent())
 
         self.assertEqual(len(idnums), 2)
+
+
+class PatientIdentityIndexTests(DemoDatabaseTestCase):
+    def create_tasks(self) -> None:
+        # No tasks; just patients whose identity is linked in a chain:
+        # P1 (RiO 3) ~ P2 (RiO 3, NHS 5) ~ P3 (NHS 5); P4 (NHS 6) is separate.
+        self.patients = []  # type: List[Patient]
+        idnum_client_pk = 1
+        for patient_id, idnums in (
+                (1, [(self.rio_iddef.which_idnum, 3)]),
+                (2, [(self.rio_iddef.which_idnum, 3),
+                     (self.nhs_iddef.which_idnum, 5)]),
+                (3, [(self.nhs_iddef.which_idnum, 5)]),
+                (4, [(self.nhs_iddef.which_idnum, 6)])):
+            patient = Patient()
+            patient.id = patient_id
+            self._apply_standard_db_fields(patient)
+            self.dbsession.add(patient)
+            for which_idnum, idnum_value in idnums:
+                pidnum = PatientIdNum()
+                pidnum.id = idnum_client_pk
+                idnum_client_pk += 1
+                self._apply_standard_db_fields(pidnum)
+                pidnum.patient_id = patient_id
+                pidnum.which_idnum = which_idnum
+                pidnum.idnum_value = idnum_value
+                self.dbsession.add(pidnum)
+            self.patients.append(patient)
+        self.dbsession.commit()
+
+    def test_transitive_identity(self) -> None:
+        self.announce("test_transitive_identity")
+        p1, p2, p3, p4 = self.patients
+        # Patient.__eq__ can't see the transitive link...
+        self.assertFalse(p1 == p3)
+        # ... but the index can.
+        index = PatientIdentityIndex(self.patients)
+        self.assertTrue(index.same_patient(p1, p3))
+        self.assertFalse(index.same_patient(p1, p4))
+        self.assertEqual(index.patient_groups(), [[p1, p2, p3], [p4]])
+
+    def test_group_items(self) -> None:
+        self.announce("test_group_items")
+        p1, p2, p3, p4 = self.patients
+        items = [("a", p3), ("b", p4), ("c", None), ("d", p1), ("e", p3),
+                 ("f", p2)]
+        groups = PatientIdentityIndex().group(items, lambda x: x[1])
+        self.assertEqual(
+            [[name for name, _ in group] for group in groups],
+            [["a", "d", "e", "f"], ["b"], ["c"]]
+        )
+        # Without P2 to link them, P1 and P3 are different people:
+        groups = PatientIdentityIndex().group(items[:5], lambda x: x[1])
+        self.assertEqual(
+            [[name for name, _ in group] for group in groups],
+            [["a", "e"], ["b"], ["c"], ["d"]]
+        )
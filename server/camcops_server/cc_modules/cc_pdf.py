@@ -26,10 +26,50 @@ camcops_server/cc_modules/cc_pdf.py
 
 **PDF functions.**
 
+PDF RENDERING POOL
+
+- Each PDF is made by a separate ``wkhtmltopdf`` process. By default, this
+  happens in the calling process, one PDF at a time.
+
+- Optionally (see the ``PDF_WORKER_PROCESSES`` config parameter), rendering is
+  done by a pool of worker processes, started on first use and kept for the
+  life of the server process. Callers submit a batch of documents
+  (:class:`PdfJob`) with :func:`submit_pdf_jobs`; batches are split into
+  chunks of up to :data:`PDF_JOBS_PER_WORKER_CALL` documents, each rendered
+  by one call to a worker, so the chunks of a batch (and the batches of
+  concurrent callers) are rendered in parallel.
+
+- In the pool, each document has a time limit (``PDF_WORKER_TIMEOUT_S``). On
+  POSIX systems, a worker is the leader of its own process group, so it can
+  kill a ``wkhtmltopdf`` process that overruns without killing itself; the
+  document then fails with :exc:`PdfRenderingError`. The caller also stops
+  waiting for a chunk after the time its documents are allowed, plus
+  :data:`PDF_WAIT_MARGIN_S` (in case a worker is stuck, or the limit can't be
+  enforced, e.g. on Windows); the chunk's documents then fail in the same
+  way. Failures are per document, so callers can fall back for just the
+  documents concerned (see :meth:`PdfBatch.get_results`). Likewise, a worker
+  limits its own address space (``PDF_WORKER_MEMORY_MB``), and that limit is
+  inherited by each ``wkhtmltopdf`` process it starts.
+
+- Workers are started with the "spawn" method, so they don't inherit the
+  server's threads, database connections or sockets.
+
 """
 
-from typing import Any, Dict, TYPE_CHECKING
+import atexit
+import logging
+import math
+import multiprocessing
+import multiprocessing.pool
+import os
+import signal
+import time
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING, Union
+import unittest
+from unittest import mock
 
+from cardinal_pythonlib.lists import chunks
+from cardinal_pythonlib.logs import BraceStyleAdapter
 from cardinal_pythonlib.pdf import get_pdf_from_html
 
 from camcops_server.cc_modules.cc_constants import (
@@ -37,9 +77,321 @@ from camcops_server.cc_modules.cc_constants import (
     WKHTMLTOPDF_OPTIONS,
 )
 
+try:
+    import resource
+except ImportError:  # e.g. Windows
+    resource = None
+
 if TYPE_CHECKING:
     from camcops_server.cc_modules.cc_request import CamcopsRequest
 
+log = BraceStyleAdapter(logging.getLogger(__name__))
+
+
+# =============================================================================
+# Constants
+# =============================================================================
+
+PDF_JOBS_PER_WORKER_CALL = 10
+PDF_WAIT_MARGIN_S = 30
+# ... how much longer than its documents' time limits we'll wait for a chunk
+
+
+# =============================================================================
+# Exceptions
+# =============================================================================
+
+class PdfRenderingError(Exception):
+    """
+    A document couldn't be rendered to PDF by a worker process (including
+    running out of time).
+    """
+    pass
+
+
+# =============================================================================
+# Jobs
+# =============================================================================
+
+class PdfJob(object):
+    """
+    Everything needed to render one PDF, independently of the request (so it
+    can be sent to a worker process).
+    """
+    def __init__(self,
+                 html: str,
+                 header_html: str = None,
+                 footer_html: str = None,
+                 wkhtmltopdf_filename: str = None,
+                 wkhtmltopdf_options: Dict[str, Any] = None) -> None:
+        self.html = html
+        self.header_html = header_html
+        self.footer_html = footer_html
+        self.wkhtmltopdf_filename = wkhtmltopdf_filename
+        self.wkhtmltopdf_options = wkhtmltopdf_options
+
+    def render(self) -> bytes:
+        """
+        Renders the PDF, in this process.
+        """
+        return get_pdf_from_html(
+            self.html,
+            header_html=self.header_html,
+            footer_html=self.footer_html,
+            processor=PDF_ENGINE,
+            wkhtmltopdf_filename=self.wkhtmltopdf_filename,
+            wkhtmltopdf_options=self.wkhtmltopdf_options)
+
+
+def make_pdf_job(req: "CamcopsRequest",
+                 html: str,
+                 header_html: str = None,
+                 footer_html: str = None,
+                 extra_wkhtmltopdf_options: Dict[str, Any] = None) -> PdfJob:
+    """
+    Creates a :class:`PdfJob` for the HTML provided, using our standard
+    ``wkhtmltopdf`` options.
+    """
+    extra_wkhtmltopdf_options = extra_wkhtmltopdf_options or {}  # type: Dict[str, Any]  # noqa
+    wkhtmltopdf_options = dict(WKHTMLTOPDF_OPTIONS,
+                               **extra_wkhtmltopdf_options)
+    return PdfJob(html=html,
+                  header_html=header_html,
+                  footer_html=footer_html,
+                  wkhtmltopdf_filename=req.config.wkhtmltopdf_filename,
+                  wkhtmltopdf_options=wkhtmltopdf_options)
+
+
+# =============================================================================
+# Worker process side
+# =============================================================================
+
+class _DocumentTimeout(Exception):
+    pass
+
+
+def _on_document_timeout(signum: int, frame: Any) -> None:
+    """
+    ``SIGALRM`` handler in a worker: kills our ``wkhtmltopdf`` child (every
+    other member of our process group), then abandons the document.
+    """
+    previous = signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        os.killpg(os.getpgrp(), signal.SIGTERM)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    raise _DocumentTimeout()
+
+
+def _init_pdf_worker(memory_mb: int) -> None:
+    """
+    Initializes a worker process.
+    """
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+        signal.signal(signal.SIGALRM, _on_document_timeout)
+    if resource is not None and memory_mb > 0:
+        limit = memory_mb * 1024 * 1024
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _render_pdf_jobs(jobs: List[PdfJob],
+                     timeout_s: int) -> List[Union[bytes, PdfRenderingError]]:
+    """
+    Renders several documents, in a worker process. Failures are returned
+    (rather than raised) so that one bad document doesn't lose the others.
+    """
+    can_time_out = hasattr(signal, "SIGALRM") and timeout_s > 0
+    results = []  # type: List[Union[bytes, PdfRenderingError]]
+    for job in jobs:
+        if can_time_out:
+            signal.alarm(timeout_s)
+        try:
+            results.append(job.render())
+        except _DocumentTimeout:
+            results.append(PdfRenderingError(
+                f"PDF rendering took longer than {timeout_s} s"))
+        except Exception as e:
+            results.append(PdfRenderingError(f"{type(e).__name__}: {e}"))
+        finally:
+            if can_time_out:
+                signal.alarm(0)
+    return results
+
+
+# =============================================================================
+# Server side
+# =============================================================================
+
+class PdfBatch(object):
+    """
+    A batch of documents submitted for rendering; see :func:`submit_pdf_jobs`.
+    """
+    def __init__(
+            self,
+            async_results: List[Tuple[multiprocessing.pool.AsyncResult,
+                                      int, Optional[float]]] = None,
+            rendered: List[Union[bytes, PdfRenderingError]] = None) -> None:
+        """
+        Args:
+            async_results: for each chunk submitted to the pool, a tuple
+                ``async_result, n_jobs, wait_timeout_s`` (the last being
+                ``None`` to wait indefinitely)
+            rendered: results, if the documents have been rendered already
+        """
+        self._async_results = async_results or []
+        self._rendered = rendered
+
+    def get_results(self) -> List[Union[bytes, PdfRenderingError]]:
+        """
+        Waits for the whole batch, and returns, in the order submitted, the
+        PDF for each document, or the :exc:`PdfRenderingError` with which it
+        failed.
+        """
+        if self._rendered is None:
+            rendered = []  # type: List[Union[bytes, PdfRenderingError]]
+            for async_result, n_jobs, wait_timeout_s in self._async_results:
+                try:
+                    rendered.extend(async_result.get(timeout=wait_timeout_s))
+                except multiprocessing.TimeoutError:
+                    rendered.extend([PdfRenderingError(
+                        f"PDF worker didn't respond in {wait_timeout_s} s"
+                    )] * n_jobs)
+                except Exception as e:  # e.g. worker died
+                    rendered.extend([PdfRenderingError(
+                        f"PDF worker failed: {type(e).__name__}: {e}"
+                    )] * n_jobs)
+            self._rendered = rendered
+        return self._rendered
+
+    def get(self) -> List[bytes]:
+        """
+        Waits for the whole batch, and returns the PDFs, in the order
+        submitted.
+
+        Raises:
+            :exc:`PdfRenderingError` if any document failed
+        """
+        results = self.get_results()
+        for result in results:
+            if isinstance(result, PdfRenderingError):
+                raise result
+        return results
+
+
+class PdfRenderPool(object):
+    """
+    A pool of worker processes for rendering PDFs.
+    """
+    def __init__(self, processes: int, timeout_s: int, memory_mb: int) -> None:
+        self.processes = processes
+        self.timeout_s = timeout_s
+        self.memory_mb = memory_mb
+        self._pool = None  # type: Optional[multiprocessing.pool.Pool]
+
+    def __repr__(self) -> str:
+        return (f"{self.__class__.__name__}(processes={self.processes!r}, "
+                f"timeout_s={self.timeout_s!r}, "
+                f"memory_mb={self.memory_mb!r})")
+
+    def wait_timeout_s(self, n_jobs: int) -> Optional[float]:
+        """
+        How long should we wait for a worker to render ``n_jobs`` documents
+        (``None`` meaning indefinitely)?
+        """
+        if self.timeout_s <= 0:
+            return None
+        return self.timeout_s * n_jobs + PDF_WAIT_MARGIN_S
+
+    def _get_pool(self) -> multiprocessing.pool.Pool:
+        if self._pool is None:
+            ctx = multiprocessing.get_context("spawn")
+            self._pool = ctx.Pool(processes=self.processes,
+                                  initializer=_init_pdf_worker,
+                                  initargs=(self.memory_mb, ))
+            log.info("Started {} PDF rendering worker(s)", self.processes)
+        return self._pool
+
+    def submit(self, jobs: List[PdfJob]) -> PdfBatch:
+        """
+        Queues documents for rendering, and returns at once.
+        """
+        pool = self._get_pool()
+        # Spread small batches across all workers.
+        per_call = max(1, min(PDF_JOBS_PER_WORKER_CALL,
+                              math.ceil(len(jobs) / self.processes)))
+        return PdfBatch(async_results=[
+            (pool.apply_async(_render_pdf_jobs, (chunk, self.timeout_s)),
+             len(chunk),
+             self.wait_timeout_s(len(chunk)))
+            for chunk in chunks(jobs, per_call)
+        ])
+
+    def close(self) -> None:
+        """
+        Stops the worker processes (abandoning any work in progress).
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+_pdf_render_pool = None  # type: Optional[PdfRenderPool]
+_pdf_render_pool_configured = False
+
+
+def configure_pdf_render_pool(processes: int,
+                              timeout_s: int,
+                              memory_mb: int) -> None:
+    """
+    Sets up the process-wide PDF rendering pool (if ``processes`` is
+    positive); its workers start on first use. Only the first call has any
+    effect (the config is not re-read within a process).
+    """
+    global _pdf_render_pool, _pdf_render_pool_configured
+    if _pdf_render_pool_configured:
+        return
+    if processes > 0:
+        _pdf_render_pool = PdfRenderPool(processes=processes,
+                                         timeout_s=timeout_s,
+                                         memory_mb=memory_mb)
+        atexit.register(_pdf_render_pool.close)
+    _pdf_render_pool_configured = True
+    log.debug("PDF rendering pool: {!r}", _pdf_render_pool)
+
+
+def get_pdf_render_pool() -> Optional[PdfRenderPool]:
+    """
+    Returns the process-wide PDF rendering pool, or ``None`` if PDFs should
+    be rendered in the calling process. (A daemonic process, such as a
+    ``multiprocessing`` worker, can't have children, so renders its own.)
+    """
+    if multiprocessing.current_process().daemon:
+        return None
+    return _pdf_render_pool
+
+
+def submit_pdf_jobs(jobs: List[PdfJob]) -> PdfBatch:
+    """
+    Submits documents for rendering to PDF, via the pool if there is one (in
+    which case this returns immediately), or in this process.
+    """
+    pool = get_pdf_render_pool()
+    if pool is None:
+        return PdfBatch(rendered=[job.render() for job in jobs])
+    return pool.submit(jobs)
+
+
+def render_pdf_jobs(jobs: List[PdfJob]) -> List[bytes]:
+    """
+    Renders documents to PDF, in parallel if we have a pool.
+    """
+    return submit_pdf_jobs(jobs).get()
+
 
 def pdf_from_html(req: "CamcopsRequest",
                   html: str,
@@ -49,13 +401,70 @@ def pdf_from_html(req: "CamcopsRequest",
     """
     Create and return a PDF from the HTML provided.
     """
-    extra_wkhtmltopdf_options = extra_wkhtmltopdf_options or {}  # type: Dict[str, Any]  # noqa
-    wkhtmltopdf_options = dict(WKHTMLTOPDF_OPTIONS,
-                               **extra_wkhtmltopdf_options)
-    cfg = req.config
-    return get_pdf_from_html(html,
-                             header_html=header_html,
-                             footer_html=footer_html,
-                             processor=PDF_ENGINE,
-                             wkhtmltopdf_filename=cfg.wkhtmltopdf_filename,
-                             wkhtmltopdf_options=wkhtmltopdf_options)
+    job = make_pdf_job(req,
+                       html=html,
+                       header_html=header_html,
+                       footer_html=footer_html,
+                       extra_wkhtmltopdf_options=extra_wkhtmltopdf_options)
+    return render_pdf_jobs([job])[0]
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class _FakePdfJob(PdfJob):
+    """
+    A "document" that is rendered without ``wkhtmltopdf``, after an optional
+    delay. (At module level, so it can be sent to a worker process.)
+    """
+    def __init__(self, html: str, delay_s: float = 0) -> None:
+        super().__init__(html=html)
+        self.delay_s = delay_s
+
+    def render(self) -> bytes:
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        return self.html.encode("utf-8")
+
+
+class PdfRenderPoolTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.pool = PdfRenderPool(processes=2, timeout_s=2, memory_mb=0)
+
+    def tearDown(self) -> None:
+        self.pool.close()
+
+    def test_round_trip(self) -> None:
+        names = [f"doc{i}" for i in range(PDF_JOBS_PER_WORKER_CALL + 3)]
+        batch = self.pool.submit([_FakePdfJob(name) for name in names])
+        self.assertEqual(batch.get(), [name.encode("utf-8")
+                                       for name in names])
+
+    @unittest.skipUnless(hasattr(signal, "SIGALRM"),
+                         "Document time limits need SIGALRM")
+    def test_document_timeout_fails_that_document_only(self) -> None:
+        batch = self.pool.submit([
+            _FakePdfJob("before"),
+            _FakePdfJob("slow", delay_s=30),
+            _FakePdfJob("after"),
+        ])
+        results = batch.get_results()
+        self.assertEqual(results[0], b"before")
+        self.assertIsInstance(results[1], PdfRenderingError)
+        self.assertEqual(results[2], b"after")
+        self.assertRaises(PdfRenderingError, batch.get)
+
+    def test_wait_timeout(self) -> None:
+        self.assertEqual(self.pool.wait_timeout_s(3), 6 + PDF_WAIT_MARGIN_S)
+        stuck = mock.Mock()
+        stuck.get.side_effect = multiprocessing.TimeoutError()
+        done = mock.Mock()
+        done.get.return_value = [b"done"]
+        batch = PdfBatch(async_results=[(stuck, 2, 1.0), (done, 1, 1.0)])
+        results = batch.get_results()
+        stuck.get.assert_called_once_with(timeout=1.0)
+        self.assertEqual(len(results), 3)
+        self.assertIsInstance(results[0], PdfRenderingError)
+        self.assertIsInstance(results[1], PdfRenderingError)
+        self.assertEqual(results[2], b"done")
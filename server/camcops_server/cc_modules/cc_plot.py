@@ -133,3 +133,123 @@ if _old_home is not None:
 log.debug("... finished importing matplotlib")
 
 # REPLACED BY OO METHOD # # THEN DO e.g. # import matplotlib.pyplot as plt
+
+
+# =============================================================================
+# Figure helpers
+# =============================================================================
+# These need no request, so that worker processes can use them too (see
+# cc_trackerplot.py); CamcopsRequest offers them to tasks.
+
+from typing import Any, Dict, List, TYPE_CHECKING  # noqa: E402
+
+from cardinal_pythonlib.plot import (  # noqa: E402
+    png_img_html_from_pyplot_figure,
+    svg_html_from_pyplot_figure,
+)
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas  # noqa: E402,E501
+from matplotlib.figure import Figure  # noqa: E402
+from matplotlib.font_manager import FontProperties  # noqa: E402
+
+from camcops_server.cc_modules.cc_constants import (  # noqa: E402
+    DEFAULT_PLOT_DPI,
+    USE_SVG_IN_HTML,
+)
+
+if TYPE_CHECKING:
+    from matplotlib.axis import Axis
+    from matplotlib.axes import Axes
+    from matplotlib.text import Text
+
+
+def create_figure(**kwargs) -> Figure:
+    """
+    Creates and returns a :class:`matplotlib.figure.Figure` with a canvas.
+    The canvas will be available as ``fig.canvas``.
+    """
+    fig = Figure(**kwargs)
+    # noinspection PyUnusedLocal
+    canvas = FigureCanvas(fig)  # noqa: F841
+    # The canvas will be now available as fig.canvas, since
+    # FigureCanvasBase.__init__ calls fig.set_canvas(self); similarly, the
+    # figure is available from the canvas as canvas.figure
+
+    # How do we set the font, so the caller doesn't have to?
+    # The "nasty global" way is:
+    #       matplotlib.rc('font', **fontdict)
+    #       matplotlib.rc('legend', **fontdict)
+    # or similar. Then matplotlib often works its way round to using its
+    # global rcParams object, which is Not OK in a multithreaded context.
+    #
+    # https://github.com/matplotlib/matplotlib/issues/6514
+    # https://github.com/matplotlib/matplotlib/issues/6518
+    #
+    # The other way is to specify a fontdict with each call, e.g.
+    #       ax.set_xlabel("some label", **fontdict)
+    # https://stackoverflow.com/questions/21321670/how-to-change-fonts-in-matplotlib-python  # noqa
+    # Relevant calls with explicit "fontdict: Dict" parameters:
+    #       ax.set_xlabel(..., fontdict=XXX, ...)
+    #       ax.set_ylabel(..., fontdict=XXX, ...)
+    #       ax.set_xticklabels(..., fontdict=XXX, ...)
+    #       ax.set_yticklabels(..., fontdict=XXX, ...)
+    #       ax.text(..., fontdict=XXX, ...)
+    #       ax.set_label_text(..., fontdict=XXX, ...)
+    #       ax.set_title(..., fontdict=XXX, ...)
+    #
+    # And with "fontproperties: FontProperties"
+    #       sig.suptitle(..., fontproperties=XXX, ...)
+    #
+    # And with "prop: FontProperties":
+    #       ax.legend(..., prop=XXX, ...)
+    #
+    # Then, some things are automatically plotted...
+
+    return fig
+
+
+def set_figure_font_sizes(ax: "Axes",  # "SubplotBase",
+                          fontdict: Dict[str, Any],
+                          x_ticklabels: bool = True,
+                          y_ticklabels: bool = True) -> None:
+    """
+    Sets font sizes for the axes of the specified Matplotlib figure.
+
+    Args:
+        ax: the figure to modify
+        fontdict: the font dictionary to use
+        x_ticklabels: if ``True``, modify the X-axis tick labels
+        y_ticklabels: if ``True``, modify the Y-axis tick labels
+    """
+    fp = FontProperties(**fontdict)
+
+    axes = []  # type: List[Axis]
+    if x_ticklabels:  # and hasattr(ax, "xaxis"):
+        axes.append(ax.xaxis)
+    if y_ticklabels:  # and hasattr(ax, "yaxis"):
+        axes.append(ax.yaxis)
+    for axis in axes:
+        for ticklabel in axis.get_ticklabels(which='both'):  # type: Text  # I think!  # noqa
+            ticklabel.set_fontproperties(fp)
+
+
+def get_html_from_pyplot_figure(fig: Figure, use_svg: bool) -> str:
+    """
+    Make HTML (as PNG or SVG) from pyplot
+    :class:`matplotlib.figure.Figure`.
+
+    Args:
+        fig: the figure
+        use_svg: produce SVG (with a PNG fallback), if the server permits,
+            rather than PNG?
+    """
+    if USE_SVG_IN_HTML and use_svg:
+        return (
+            svg_html_from_pyplot_figure(fig) +
+            png_img_html_from_pyplot_figure(fig, DEFAULT_PLOT_DPI,
+                                            "pngfallback")
+        )
+        # return both an SVG and a PNG image, for browsers that can't deal
+        # with SVG; the Javascript header will sort this out
+        # http://www.voormedia.nl/blog/2012/10/displaying-and-detecting-support-for-svg-images  # noqa
+    else:
+        return png_img_html_from_pyplot_figure(fig, DEFAULT_PLOT_DPI)
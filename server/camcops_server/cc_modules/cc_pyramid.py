@@ -154,10 +154,12 @@ class ViewParam(object):
     ADDRESS = "address"
     ADD_SPECIAL_NOTE = "add_special_note"
     ADMIN = "admin"
+    AFTER_INDEX_PK = "after_index_pk"
     AGE_MINIMUM = "age_minimum"
     AGE_MAXIMUM = "age_maximum"
     ALL_TASKS = "all_tasks"
     ANONYMISE = "anonymise"
+    BEFORE_INDEX_PK = "before_index_pk"
     CSRF_TOKEN = "csrf"
     DATABASE_TITLE = "database_title"
     DELIVERY_MODE = "delivery_mode"
@@ -226,6 +228,7 @@ class ViewParam(object):
     TABLE_NAME = "table_name"
     TASKS = "tasks"
     TEXT_CONTENTS = "text_contents"
+    THUMBNAIL = "thumbnail"
     TRUNCATE = "truncate"
     UPLOAD_GROUP_ID = "upload_group_id"
     UPLOAD_POLICY = "upload_policy"
@@ -678,6 +681,7 @@ class Routes(object):
     ADD_USER = "add_user"
     AUDIT_MENU = "audit_menu"
     BASIC_DUMP = "basic_dump"
+    BLOB = "blob"
     BUGFIX_DEFORM_MISSING_GLYPHS = "bugfix_deform_missing_glyphs"  # ... test by visiting the Task Filters page  # noqa
     CHANGE_OTHER_PASSWORD = "change_other_password"
     CHANGE_OWN_PASSWORD = "change_own_password"
@@ -797,6 +801,7 @@ class RouteCollection(object):
     ADD_USER = RoutePath(Routes.ADD_USER)
     AUDIT_MENU = RoutePath(Routes.AUDIT_MENU)
     BASIC_DUMP = RoutePath(Routes.BASIC_DUMP)
+    BLOB = RoutePath(Routes.BLOB)
     BUGFIX_DEFORM_MISSING_GLYPHS = RoutePath(Routes.BUGFIX_DEFORM_MISSING_GLYPHS, "/deform_static/fonts/glyphicons-halflings-regular.woff2")  # noqa
     CHANGE_OTHER_PASSWORD = RoutePath(Routes.CHANGE_OTHER_PASSWORD)
     CHANGE_OWN_PASSWORD = RoutePath(Routes.CHANGE_OWN_PASSWORD)
@@ -1448,6 +1453,49 @@ class PageUrl(object):
         return make_page_url(path, self.request.GET, page, partial)
 
 
+class KeysetPageUrl(PageUrl):
+    """
+    A page URL generator for collections using keyset ("seek") pagination.
+
+    As for :class:`PageUrl`, but the URL parameters that tell the collection
+    where to seek from are rebuilt for each target page, via
+    ``seek_params_fn``.
+    """
+    def __init__(self,
+                 request: "Request",
+                 seek_params_fn: Callable[[int], Dict[str, str]],
+                 seek_param_names: Sequence[str],
+                 qualified: bool = False) -> None:
+        """
+        Args:
+            request: as for :class:`PageUrl`
+            seek_params_fn: function taking the target page number and
+                returning a dictionary of seek parameters (possibly empty)
+            seek_param_names: names of all seek parameters, which are removed
+                from the current query parameters before adding new ones
+            qualified: as for :class:`PageUrl`
+        """
+        super().__init__(request, qualified=qualified)
+        self.seek_params_fn = seek_params_fn
+        self.seek_param_names = seek_param_names
+
+    def __call__(self, page: int, partial: bool = False) -> str:
+        """
+        Generate a URL for the specified page.
+        """
+        if self.qualified:
+            path = self.request.application_url
+        else:
+            path = self.request.path
+        params = self.request.GET.copy()
+        for name in self.seek_param_names:
+            if name in params:
+                del params[name]  # removes all values
+        for name, value in self.seek_params_fn(page).items():
+            params[name] = value
+        return make_page_url(path, params, page, partial)
+
+
 # =============================================================================
 # Debugging requests and responses
 # =============================================================================
@@ -46,6 +46,7 @@ record at the same time.
 
 """
 
+from collections import OrderedDict
 from enum import Enum
 import io
 import logging
@@ -53,11 +54,13 @@ import os
 import tempfile
 from typing import (
     Any,
+    Callable,
     Dict,
     Generator,
     Iterable,
     List,
     Optional,
+    Tuple,
     TYPE_CHECKING,
     Union,
 )
@@ -67,7 +70,7 @@ import xml.etree.cElementTree as ElementTree
 from asteval import Interpreter, make_symbol_table
 from cardinal_pythonlib.datetimefunc import format_datetime
 from cardinal_pythonlib.logs import BraceStyleAdapter
-from pandas import DataFrame
+from pandas import DataFrame, notna
 from pandas.errors import EmptyDataError
 import pendulum
 import redcap
@@ -234,11 +237,145 @@ class RedcapFieldmap(object):
         return list(self.instruments.values())
 
 
+class RedcapRecordIndex(object):
+    """
+    In-memory index of the existing records in a REDCap project, built from a
+    single :meth:`RedcapTaskExporter._get_existing_records` call. Lets us work
+    out record and instance IDs for a whole batch of tasks without going back
+    to REDCap for each one.
+
+    Instance IDs are handed out as they are allocated, so several tasks in the
+    same batch for the same patient and instrument get consecutive instances.
+    """
+    def __init__(self, records: "DataFrame", fieldmap: RedcapFieldmap) -> None:
+        """
+        Args:
+            records:
+                records retrieved from REDCap; Pandas data frame from
+                :meth:`RedcapTaskExporter._get_existing_records`
+            fieldmap:
+                :class:`RedcapFieldmap`
+        """
+        self.record_id_fieldname = fieldmap.record["redcap_field"]
+        self._record_ids = {}  # type: Dict[Any, str]
+        # ... {idnum_value: record_id}
+        self._max_instances = {}  # type: Dict[Tuple[str, str], int]
+        # ... {(record_id, instrument): highest existing instance ID}
+        self._next_instances = {}  # type: Dict[Tuple[Any, str], int]
+        # ... {(idnum_value, instrument): next instance ID to allocate}
+        self._has_record_id_field = True
+
+        if records.empty:
+            return
+
+        patient_id_fieldname = fieldmap.patient["redcap_field"]
+        if patient_id_fieldname not in records:
+            raise RedcapExportException(
+                (f"Field '{patient_id_fieldname}' does not exist in REDCap. "
+                 f"Is the 'patient' tag in the fieldmap correct?")
+            )
+
+        # As for RedcapTaskExporter._get_existing_record_id(), the record ID
+        # comes from the first column of the first matching row.
+        for idnum_value, record_id in zip(records[patient_id_fieldname],
+                                          records.iloc[:, 0]):
+            if notna(idnum_value) and idnum_value not in self._record_ids:
+                self._record_ids[idnum_value] = record_id
+
+        self._has_record_id_field = self.record_id_fieldname in records
+        repeat_columns = ["redcap_repeat_instrument", "redcap_repeat_instance"]
+        if (self._has_record_id_field and
+                all(c in records for c in repeat_columns)):
+            repeats = records.dropna(subset=repeat_columns)
+            maxima = repeats.groupby(
+                [self.record_id_fieldname, "redcap_repeat_instrument"]
+            )["redcap_repeat_instance"].max()
+            for (record_id, instrument), instance_id in maxima.items():
+                self._max_instances[(record_id, instrument)] = int(instance_id)
+
+    def get_record_id(self, idnum_value: int) -> Optional[str]:
+        """
+        Returns the ID of the record for a specific patient, if there is one.
+
+        Args:
+            idnum_value:
+                CamCOPS patient ID number
+        """
+        return self._record_ids.get(idnum_value)
+
+    def set_record_id(self, idnum_value: int, record_id: str) -> None:
+        """
+        Notes the ID of a record that we have just created for a patient.
+
+        Args:
+            idnum_value:
+                CamCOPS patient ID number
+            record_id:
+                REDCap record ID
+        """
+        self._record_ids[idnum_value] = record_id
+
+    def allocate_instance_id(self, idnum_value: int, instrument: str) -> int:
+        """
+        Returns the next instance ID to use for a particular patient and
+        instrument (the previous highest ID plus 1, or 1 if none can be found),
+        and reserves it.
+
+        Args:
+            idnum_value:
+                CamCOPS patient ID number
+            instrument:
+                instrument name
+        """
+        key = (idnum_value, instrument)
+        if key not in self._next_instances:
+            record_id = self.get_record_id(idnum_value)
+            if record_id is None:
+                self._next_instances[key] = 1
+            else:
+                if not self._has_record_id_field:
+                    raise RedcapExportException(
+                        (f"Field '{self.record_id_fieldname}' does not exist "
+                         f"in REDCap. Is the 'record' tag in the fieldmap "
+                         f"correct?")
+                    )
+                self._next_instances[key] = self._max_instances.get(
+                    (record_id, instrument), 0) + 1
+        instance_id = self._next_instances[key]
+        self._next_instances[key] = instance_id + 1
+        return instance_id
+
+
+class RedcapBatchItem(object):
+    """
+    A task being exported as part of a batch; see
+    :meth:`RedcapTaskExporter.export_tasks`.
+    """
+    def __init__(self, exported_task_redcap: "ExportedTaskRedcap") -> None:
+        """
+        Args:
+            exported_task_redcap:
+                a :class:`camcops_server.cc_modules.cc_exportmodels.ExportedTaskRedcap`
+        """  # noqa
+        self.exported_task_redcap = exported_task_redcap
+        self.task = exported_task_redcap.exported_task.task
+        self.idnum_value = None  # type: Optional[int]
+        self.instrument_name = None  # type: Optional[str]
+        self.instance_id = None  # type: Optional[int]
+        self.record = None  # type: Optional[Dict[str, Any]]
+        self.creates_record = False
+        self.error = None  # type: Optional[str]
+
+
 class RedcapTaskExporter(object):
     """
     Main entry point for task export to REDCap. Works out which record needs
     updating or creating. Creates the fieldmap and initiates upload.
     """
+    def __init__(self) -> None:
+        self._fieldmaps = {}  # type: Dict[str, RedcapFieldmap]
+        # ... parsed fieldmaps, by filename
+
     def export_task(self,
                     req: "CamcopsRequest",
                     exported_task_redcap: "ExportedTaskRedcap") -> None:
@@ -307,6 +444,314 @@ class RedcapTaskExporter(object):
         exported_task_redcap.redcap_instrument_name = instrument_name
         exported_task_redcap.redcap_instance_id = next_instance_id
 
+    def export_tasks(
+            self,
+            req: "CamcopsRequest",
+            exported_task_redcaps: List["ExportedTaskRedcap"]) \
+            -> List[Optional[str]]:
+        """
+        Exports several tasks, all for the same recipient. Equivalent to
+        calling :meth:`export_task` for each, but the fieldmap is parsed once,
+        the project's existing records are fetched once, and the records are
+        sent with a few bulk ``import_records`` calls (see
+        :meth:`_import_batch_items`). Files are uploaded afterwards, task by
+        task.
+
+        A problem with an individual task (e.g. an anonymous task, one whose
+        instrument is missing from the fieldmap, or one with a field value
+        that REDCap rejects) is reported for that task alone. A problem with
+        the project as a whole (e.g. fetching its details) raises
+        :exc:`RedcapExportException`, before anything is imported. Once
+        records may have been imported, any other exception (e.g. a connection
+        error from ``import_records`` or ``import_file``) is also reported for
+        the tasks concerned, rather than raised, so that the caller can still
+        record the outcome of the batch.
+
+        Args:
+            req:
+                a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            exported_task_redcaps:
+                :class:`camcops_server.cc_modules.cc_exportmodels.ExportedTaskRedcap`
+                objects
+
+        Returns:
+            a list, parallel to ``exported_task_redcaps``, of error messages
+            (``None`` for each task exported successfully)
+        """  # noqa
+        if not exported_task_redcaps:
+            return []
+        recipient = exported_task_redcaps[0].exported_task.recipient
+
+        project = self.get_project(recipient)
+        fieldmap = self.get_fieldmap(recipient)
+
+        if project.is_longitudinal():
+            if not all(fieldmap.events.values()):
+                raise RedcapExportException(MISSING_EVENT_TAG_OR_ATTRIBUTE)
+
+        index = RedcapRecordIndex(
+            self._get_existing_records(project, fieldmap), fieldmap
+        )
+        uploader = RedcapNewRecordUploader(req, project)
+        record_id_fieldname = fieldmap.record["redcap_field"]
+        # From here on, records may have been imported, so every failure must
+        # be attributed to the tasks concerned, not raised.
+
+        items = [RedcapBatchItem(etr) for etr in exported_task_redcaps]
+        try:
+            self._import_batch(items, recipient, fieldmap, index, uploader)
+        except Exception as e:
+            log.exception("Unexpected error importing a batch of {} tasks "
+                          "into REDCap", len(items))
+            for item in items:
+                if item.error is None:
+                    item.error = f"Unexpected error importing records: {e!r}"
+            return [item.error for item in items]
+
+        pending = [item for item in items if item.error is None]
+        for item in pending:
+            task = item.task
+            record_id = item.record[record_id_fieldname]
+            try:
+                file_dict = {}
+                uploader.transform_fields(file_dict, task,
+                                          fieldmap.files[task.tablename])
+                uploader.upload_files(task,
+                                      record_id,
+                                      item.instance_id,
+                                      file_dict,
+                                      event=fieldmap.events[task.tablename])
+            except RedcapExportException as e:
+                item.error = str(e)
+                continue
+            except Exception as e:
+                log.exception("Unexpected error uploading files for task {!r} "
+                              "to REDCap", task)
+                item.error = f"Unexpected error uploading files: {e!r}"
+                continue
+
+            if item.creates_record:
+                RedcapNewRecordUploader.log_success(record_id)
+            else:
+                RedcapUpdatedRecordUploader.log_success(record_id)
+
+            exported_task_redcap = item.exported_task_redcap
+            exported_task_redcap.redcap_record_id = record_id
+            exported_task_redcap.redcap_instrument_name = item.instrument_name
+            exported_task_redcap.redcap_instance_id = item.instance_id
+
+        return [item.error for item in items]
+
+    @classmethod
+    def _import_batch(cls,
+                      items: List[RedcapBatchItem],
+                      recipient: ExportRecipient,
+                      fieldmap: RedcapFieldmap,
+                      index: RedcapRecordIndex,
+                      uploader: "RedcapNewRecordUploader") -> None:
+        """
+        Prepares the records of a batch's tasks and imports them: first those
+        that create a record for a new patient, then the rest, in one go. A
+        task that can't be imported has its error set.
+        """
+        record_id_fieldname = fieldmap.record["redcap_field"]
+        for item in items:
+            try:
+                cls._prepare_batch_item(item, recipient, fieldmap, index,
+                                        uploader)
+            except RedcapExportException as e:
+                item.error = str(e)
+
+        # Create records for new patients, via the first task for each.
+        creators = {}  # type: Dict[int, RedcapBatchItem]
+        for item in items:
+            if (item.error is None and
+                    index.get_record_id(item.idnum_value) is None and
+                    item.idnum_value not in creators):
+                item.creates_record = True
+                creators[item.idnum_value] = item
+        cls._create_records(list(creators.values()), uploader, index,
+                            fieldmap)
+
+        # Everything else goes into existing records, in one go.
+        updates = []  # type: List[RedcapBatchItem]
+        for item in items:
+            if item.error is not None or item.creates_record:
+                continue
+            record_id = index.get_record_id(item.idnum_value)
+            if record_id is None:
+                item.error = (f"No REDCap record was created for patient "
+                              f"{item.idnum_value}")
+                continue
+            item.record[record_id_fieldname] = record_id
+            updates.append(item)
+        cls._import_batch_items(updates, uploader, fieldmap,
+                                return_content="count",
+                                force_auto_number=False)
+
+    @staticmethod
+    def _prepare_batch_item(item: RedcapBatchItem,
+                            recipient: ExportRecipient,
+                            fieldmap: RedcapFieldmap,
+                            index: RedcapRecordIndex,
+                            uploader: "RedcapUploader") -> None:
+        """
+        Works out the patient, instrument and instance ID for a task in a
+        batch, and builds its record (without a record ID), or raises
+        :exc:`RedcapExportException`.
+        """
+        task = item.task
+        if task.is_anonymous:
+            raise RedcapExportException(
+                f"Skipping anonymous task '{task.tablename}'"
+            )
+
+        idnum_object = task.patient.get_idnum_object(recipient.primary_idnum)
+
+        try:
+            instrument_name = fieldmap.instruments[task.tablename]
+        except KeyError:
+            raise RedcapExportException(
+                (f"Instrument for task '{task.tablename}' is missing from the "
+                 f"fieldmap")
+            )
+
+        record = uploader.get_task_record(task, None, None, fieldmap)
+
+        # Allocated last, so that a task we can't export doesn't use up an
+        # instance ID.
+        instance_id = index.allocate_instance_id(idnum_object.idnum_value,
+                                                 instrument_name)
+        record["redcap_repeat_instance"] = instance_id
+
+        item.idnum_value = idnum_object.idnum_value
+        item.instrument_name = instrument_name
+        item.instance_id = instance_id
+        item.record = record
+
+    @classmethod
+    def _create_records(cls,
+                        creators: List[RedcapBatchItem],
+                        uploader: "RedcapNewRecordUploader",
+                        index: RedcapRecordIndex,
+                        fieldmap: RedcapFieldmap) -> None:
+        """
+        Uploads the records of tasks that create a new REDCap record (one per
+        patient), and notes the new record IDs in the index. A task whose
+        record can't be created has its error set.
+
+        With record autonumbering, this is one bulk ``import_records`` call:
+        each record is sent with a temporary ID and REDCap tells us which ID it
+        assigned to each. Otherwise, record names come from
+        ``generate_next_record_name``, which only moves on once a record has
+        been imported, so the records are sent one at a time.
+        """
+        if not creators:
+            return
+        record_id_fieldname = fieldmap.record["redcap_field"]
+
+        if not uploader.autonumbering_enabled:
+            for item in creators:
+                try:
+                    record_id = uploader.get_record_id(None)
+                except redcap.RedcapError as e:
+                    item.error = str(e)
+                    continue
+                item.record[record_id_fieldname] = record_id
+                if cls._import_batch_items(
+                        [item], uploader, fieldmap,
+                        return_content=uploader.return_content,
+                        force_auto_number=False):
+                    index.set_record_id(item.idnum_value, record_id)
+            return
+
+        for temporary_id, item in enumerate(creators, start=1):
+            item.record[record_id_fieldname] = str(temporary_id)
+        imported = cls._import_batch_items(
+            creators, uploader, fieldmap,
+            return_content=uploader.return_content,
+            force_auto_number=True
+        )
+
+        # e.g. ["123,1", "124,2"]; IDs may be non-integer, e.g. "15-30,1"
+        for items, response in imported:
+            new_record_ids = {}  # type: Dict[str, str]
+            for id_pair in response:
+                new_record_id, sent_record_id = id_pair.rsplit(",", 1)
+                new_record_ids[sent_record_id] = new_record_id
+            for item in items:
+                new_record_id = new_record_ids.get(
+                    item.record[record_id_fieldname])
+                if new_record_id is None:
+                    item.error = ("REDCap did not report the ID of the new "
+                                  "record")
+                else:
+                    index.set_record_id(item.idnum_value, new_record_id)
+
+    @staticmethod
+    def _get_batch_records(items: List[RedcapBatchItem],
+                           fieldmap: RedcapFieldmap) -> List[Dict[str, Any]]:
+        """
+        Returns the task records of some batch items, plus a patient record
+        for each REDCap record they go into.
+        """
+        record_id_fieldname = fieldmap.record["redcap_field"]
+        records = [item.record for item in items]
+        # We don't mark the patient records as complete; see upload().
+        patient_records = OrderedDict()  # type: Dict[str, Dict[str, Any]]
+        for item in items:
+            record_id = item.record[record_id_fieldname]
+            patient_records.setdefault(record_id, {
+                record_id_fieldname: record_id,
+                fieldmap.patient["redcap_field"]: item.idnum_value,
+            })
+        return records + list(patient_records.values())
+
+    @classmethod
+    def _import_batch_items(
+            cls,
+            items: List[RedcapBatchItem],
+            uploader: "RedcapUploader",
+            fieldmap: RedcapFieldmap,
+            **kwargs) -> List[Tuple[List[RedcapBatchItem], Any]]:
+        """
+        Imports the task records of some batch items, along with their
+        patient records, in one ``import_records`` call.
+
+        REDCap imports all of the records in a call, or (if any is invalid)
+        none of them. So if the call fails, we import each item's records
+        separately, and set the error only for those items that still fail.
+        (An item is never left with its task record imported but its patient
+        record not, or vice versa.)
+
+        Args:
+            items: the items
+            uploader: the :class:`RedcapUploader`
+            fieldmap: the :class:`RedcapFieldmap`
+            kwargs: passed to :meth:`RedcapUploader.upload_records`
+
+        Returns:
+            a list of ``(items, response)`` tuples, one for each successful
+            ``import_records`` call
+        """
+        if not items:
+            return []
+        try:
+            response = uploader.upload_records(
+                cls._get_batch_records(items, fieldmap), **kwargs)
+            return [(items, response)]
+        except RedcapExportException as e:
+            if len(items) == 1:
+                items[0].error = str(e)
+                return []
+            log.warning("REDCap rejected a batch of {} tasks ({}); importing "
+                        "them one at a time", len(items), e)
+        imported = []  # type: List[Tuple[List[RedcapBatchItem], Any]]
+        for item in items:
+            imported.extend(cls._import_batch_items([item], uploader,
+                                                    fieldmap, **kwargs))
+        return imported
+
     @staticmethod
     def _get_existing_records(project: redcap.project.Project,
                               fieldmap: RedcapFieldmap) -> "DataFrame":
@@ -426,16 +871,19 @@ class RedcapTaskExporter(object):
 
     def get_fieldmap(self, recipient: ExportRecipient) -> RedcapFieldmap:
         """
-        Returns the relevant :class:`RedcapFieldmap`.
+        Returns the relevant :class:`RedcapFieldmap`. Each fieldmap file is
+        parsed once per exporter.
 
         Args:
             recipient:
                 an
                 :class:`camcops_server.cc_modules.cc_exportmodels.ExportRecipient`
         """  # noqa
-        fieldmap = RedcapFieldmap(self.get_fieldmap_filename(recipient))
+        filename = self.get_fieldmap_filename(recipient)
+        if filename not in self._fieldmaps:
+            self._fieldmaps[filename] = RedcapFieldmap(filename)
 
-        return fieldmap
+        return self._fieldmaps[filename]
 
     @staticmethod
     def get_fieldmap_filename(recipient: ExportRecipient) -> str:
@@ -601,27 +1049,12 @@ class RedcapUploader(object):
             str: REDCap record ID of the record that was created or updated
 
         """
-        complete_status = RedcapRecordStatus.INCOMPLETE
-
-        if task.is_complete():
-            complete_status = RedcapRecordStatus.COMPLETE
-        instrument_name = fieldmap.instruments[task.tablename]
         record_id_fieldname = fieldmap.record["redcap_field"]
 
         record_id = self.get_record_id(existing_record_id)
 
-        record = {
-            record_id_fieldname: record_id,
-            "redcap_repeat_instrument": instrument_name,
-            # https://community.projectredcap.org/questions/74561/unexpected-behaviour-with-import-records-repeat-in.html  # noqa
-            # REDCap won't create instance IDs automatically so we have to
-            # assume no one else is writing to this record
-            "redcap_repeat_instance": next_instance_id,
-            f"{instrument_name}_complete": complete_status.value,
-            "redcap_event_name": fieldmap.events[task.tablename]
-        }
-
-        self.transform_fields(record, task, fieldmap.fields[task.tablename])
+        record = self.get_task_record(task, record_id, next_instance_id,
+                                      fieldmap)
 
         import_kwargs = {
             "return_content": self.return_content,
@@ -653,6 +1086,44 @@ class RedcapUploader(object):
 
         return new_record_id
 
+    def get_task_record(self, task: "Task", record_id: Optional[str],
+                        instance_id: Optional[int],
+                        fieldmap: RedcapFieldmap) -> Dict[str, Any]:
+        """
+        Returns the REDCap record for a CamCOPS task.
+
+        Args:
+            task:
+                :class:`camcops_server.cc_modules.cc_task.Task` to be uploaded
+            record_id:
+                REDCap record ID to send
+            instance_id:
+                REDCap instance ID to be used for a repeating instrument
+            fieldmap:
+                :class:`RedcapFieldmap`
+        """
+        complete_status = RedcapRecordStatus.INCOMPLETE
+
+        if task.is_complete():
+            complete_status = RedcapRecordStatus.COMPLETE
+        instrument_name = fieldmap.instruments[task.tablename]
+        record_id_fieldname = fieldmap.record["redcap_field"]
+
+        record = {
+            record_id_fieldname: record_id,
+            "redcap_repeat_instrument": instrument_name,
+            # https://community.projectredcap.org/questions/74561/unexpected-behaviour-with-import-records-repeat-in.html  # noqa
+            # REDCap won't create instance IDs automatically so we have to
+            # assume no one else is writing to this record
+            "redcap_repeat_instance": instance_id,
+            f"{instrument_name}_complete": complete_status.value,
+            "redcap_event_name": fieldmap.events[task.tablename]
+        }
+
+        self.transform_fields(record, task, fieldmap.fields[task.tablename])
+
+        return record
+
     def upload_record(self, record: Dict[str, Any],
                       **kwargs) -> Union[Dict, List, str]:
         """
@@ -660,9 +1131,18 @@ class RedcapUploader(object):
         :func:`redcap.project.Project.import_record` function. Returns its
         response.
         """
+        return self.upload_records([record], **kwargs)
+
+    def upload_records(self, records: List[Dict[str, Any]],
+                       **kwargs) -> Union[Dict, List, str]:
+        """
+        Uploads several REDCap records in one
+        :func:`redcap.project.Project.import_record` call. Returns its
+        response.
+        """
         try:
             response = self.project.import_records(
-                [record],
+                records,
                 **kwargs
             )
         except redcap.RedcapError as e:
@@ -843,6 +1323,7 @@ class MockProject(mock.Mock):
 
 class MockRedcapTaskExporter(RedcapTaskExporter):
     def __init__(self) -> None:
+        super().__init__()
         mock_project = MockProject()
         self.get_project = mock.Mock(return_value=mock_project)
 
@@ -858,6 +1339,96 @@ class MockRedcapNewRecordUploader(RedcapNewRecordUploader):
         self.task = mock.Mock(tablename="mock_task")
 
 
+class FakeRedcapProject(object):
+    """
+    Local stand-in for :class:`redcap.project.Project`, holding its records in
+    memory and counting the API calls made.
+    """
+    def __init__(self,
+                 autonumbering: bool = True,
+                 record_id_fieldname: str = "record_id",
+                 reject: Callable[[Dict[str, Any]], bool] = None) -> None:
+        """
+        Args:
+            autonumbering: is record autonumbering enabled?
+            record_id_fieldname: name of the record ID field
+            reject: function saying whether a row is invalid; as for REDCap,
+                an import with any invalid row imports nothing
+        """
+        self.autonumbering = autonumbering
+        self.record_id_fieldname = record_id_fieldname
+        self.reject = reject
+        self.rows = []  # type: List[Dict[str, Any]]
+        self.files = {}  # type: Dict[Tuple[str, str, int], str]
+        # ... {(record_id, fieldname, repeat_instance): filename}
+        self.calls = {}  # type: Dict[str, int]
+        self.last_record_number = 0
+
+    def _count(self, method: str) -> None:
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def _store(self, row: Dict[str, Any]) -> None:
+        key_fields = (self.record_id_fieldname,
+                      "redcap_repeat_instrument",
+                      "redcap_repeat_instance")
+        key = tuple(row.get(f) for f in key_fields)
+        for existing in self.rows:
+            if tuple(existing.get(f) for f in key_fields) == key:
+                existing.update(row)
+                return
+        self.rows.append(row)
+
+    def export_project_info(self) -> Dict[str, Any]:
+        self._count("export_project_info")
+        return {"record_autonumbering_enabled": int(self.autonumbering)}
+
+    @staticmethod
+    def is_longitudinal() -> bool:
+        return False
+
+    # noinspection PyUnusedLocal
+    def export_records(self, **kwargs) -> DataFrame:
+        self._count("export_records")
+        return DataFrame([dict(row) for row in self.rows])
+
+    def generate_next_record_name(self) -> str:
+        self._count("generate_next_record_name")
+        return str(self.last_record_number + 1)
+
+    def import_records(self, to_import: List[Dict[str, Any]],
+                       return_content: str = "count",
+                       force_auto_number: bool = False) -> Union[Dict, List]:
+        self._count("import_records")
+        if self.reject and any(self.reject(row) for row in to_import):
+            raise redcap.RedcapError("Invalid value in import")
+        auto_ids = []  # type: List[str]
+        new_record_ids = {}  # type: Dict[str, str]
+        for row in to_import:
+            row = dict(row)
+            sent_record_id = row[self.record_id_fieldname]
+            if force_auto_number:
+                if sent_record_id not in new_record_ids:
+                    self.last_record_number += 1
+                    new_record_id = str(self.last_record_number)
+                    new_record_ids[sent_record_id] = new_record_id
+                    auto_ids.append(f"{new_record_id},{sent_record_id}")
+                row[self.record_id_fieldname] = new_record_ids[sent_record_id]
+            elif sent_record_id.isdigit():
+                self.last_record_number = max(self.last_record_number,
+                                              int(sent_record_id))
+            self._store(row)
+
+        if return_content == "auto_ids":
+            return auto_ids
+        return {"count": len(to_import)}
+
+    # noinspection PyUnusedLocal
+    def import_file(self, record: str, field: str, fname: str, fobj: Any,
+                    event: str = None, repeat_instance: int = None) -> None:
+        self._count("import_file")
+        self.files[(record, field, repeat_instance)] = fname
+
+
 class RedcapExporterTests(TestCase):
     def test_next_instance_id_converted_to_int(self) -> None:
         import numpy
@@ -882,6 +1453,28 @@ class RedcapExporterTests(TestCase):
         self.assertEqual(next_instance_id, 6)
         self.assertEqual(type(next_instance_id), int)
 
+    def test_record_index_allocates_consecutive_instances(self) -> None:
+        import numpy
+
+        fieldmap = mock.Mock(record={"redcap_field": "record_id"},
+                             patient={"redcap_field": "patient_id"})
+        records = DataFrame({
+            "record_id": ["7", "7", "7"],
+            "patient_id": [555, numpy.nan, numpy.nan],
+            "redcap_repeat_instrument": [numpy.nan, "bmi", "bmi"],
+            "redcap_repeat_instance": [numpy.nan, 1.0, 2.0],
+        })
+
+        index = RedcapRecordIndex(records, fieldmap)
+
+        self.assertEqual(index.get_record_id(555), "7")
+        self.assertIsNone(index.get_record_id(556))
+        self.assertEqual(index.allocate_instance_id(555, "bmi"), 3)
+        self.assertEqual(index.allocate_instance_id(555, "bmi"), 4)
+        self.assertEqual(index.allocate_instance_id(555, "phq9"), 1)
+        self.assertEqual(index.allocate_instance_id(556, "bmi"), 1)
+        self.assertEqual(type(index.allocate_instance_id(555, "bmi")), int)
+
 
 class RedcapExportErrorTests(TestCase):
     def test_raises_when_fieldmap_has_unknown_symbols(self) -> None:
@@ -1503,6 +2096,189 @@ class BmiRedcapUpdateTests(BmiRedcapValidFieldmapTestCase):
         self.assertFalse(kwargs["force_auto_number"])
 
 
+class BmiRedcapBatchExportTests(BmiRedcapValidFieldmapTestCase):
+    def create_tasks(self) -> None:
+        from camcops_server.tasks.apeq_cpft_perinatal import APEQCPFTPerinatal
+        from camcops_server.tasks.bmi import Bmi
+        patient = self.create_patient_with_idnum_1001()
+        self.bmi_tasks = []
+        for mass_kg in (67.57, 68.5):
+            task = Bmi()
+            self.apply_standard_task_fields(task)
+            task.id = next(self.id_sequence)
+            task.height_m = 1.83
+            task.mass_kg = mass_kg
+            task.patient_id = patient.id
+            self.dbsession.add(task)
+            self.bmi_tasks.append(task)
+
+        self.anonymous_task = APEQCPFTPerinatal()
+        self.apply_standard_task_fields(self.anonymous_task)
+        self.anonymous_task.id = 1
+        self.dbsession.add(self.anonymous_task)
+        self.dbsession.commit()
+
+    def export_tasks(self, project: FakeRedcapProject,
+                     tasks: List["Task"]) -> Tuple[List["ExportedTaskRedcap"],
+                                                   List[Optional[str]]]:
+        from camcops_server.cc_modules.cc_exportmodels import (
+            ExportedTask,
+            ExportedTaskRedcap,
+        )
+
+        exporter = MockRedcapTaskExporter()
+        exporter.get_project = mock.Mock(return_value=project)
+        exported_task_redcaps = [
+            ExportedTaskRedcap(ExportedTask(task=task,
+                                            recipient=self.recipient))
+            for task in tasks
+        ]
+        errors = exporter.export_tasks(self.req, exported_task_redcaps)
+
+        return exported_task_redcaps, errors
+
+    def test_new_record_created_once_per_batch(self) -> None:
+        project = FakeRedcapProject()
+
+        exported_task_redcaps, errors = self.export_tasks(project,
+                                                          self.bmi_tasks)
+
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(
+            [etr.redcap_record_id for etr in exported_task_redcaps],
+            ["1", "1"]
+        )
+        self.assertEqual(
+            [etr.redcap_instance_id for etr in exported_task_redcaps],
+            [1, 2]
+        )
+        self.assertEqual(project.calls["export_records"], 1)
+        self.assertEqual(project.calls["export_project_info"], 1)
+        # New record (with its patient record), other task
+        self.assertEqual(project.calls["import_records"], 2)
+        self.assertEqual(
+            [row["patient_id"] for row in project.rows
+             if not row.get("redcap_repeat_instrument")],
+            [555]
+        )
+
+        weights = sorted(row["pa_weight"] for row in project.rows
+                         if row.get("redcap_repeat_instrument") == "bmi")
+        self.assertEqual(weights, ["67.6", "68.5"])
+
+    def test_existing_record_used_for_batch(self) -> None:
+        project = FakeRedcapProject()
+        project.rows = [
+            {"record_id": "7", "patient_id": 555},
+            {"record_id": "7", "redcap_repeat_instrument": "bmi",
+             "redcap_repeat_instance": 3},
+        ]
+        project.last_record_number = 7
+
+        exported_task_redcaps, errors = self.export_tasks(project,
+                                                          self.bmi_tasks)
+
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(
+            [etr.redcap_record_id for etr in exported_task_redcaps],
+            ["7", "7"]
+        )
+        self.assertEqual(
+            [etr.redcap_instance_id for etr in exported_task_redcaps],
+            [4, 5]
+        )
+        # Task records, with the patient record
+        self.assertEqual(project.calls["import_records"], 1)
+
+    def test_record_id_generated_when_no_autonumbering(self) -> None:
+        project = FakeRedcapProject(autonumbering=False)
+        project.last_record_number = 28
+
+        exported_task_redcaps, errors = self.export_tasks(project,
+                                                          self.bmi_tasks)
+
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(
+            [etr.redcap_record_id for etr in exported_task_redcaps],
+            ["29", "29"]
+        )
+        self.assertEqual(project.calls["generate_next_record_name"], 1)
+
+    def test_rejected_update_fails_alone(self) -> None:
+        project = FakeRedcapProject(
+            reject=lambda row: row.get("pa_weight") == "68.5")
+        project.rows = [
+            {"record_id": "7", "patient_id": 555},
+        ]
+        project.last_record_number = 7
+
+        exported_task_redcaps, errors = self.export_tasks(project,
+                                                          self.bmi_tasks)
+
+        self.assertIsNone(errors[0])
+        self.assertIn("Invalid value", errors[1])
+        self.assertEqual(exported_task_redcaps[0].redcap_record_id, "7")
+        self.assertIsNone(exported_task_redcaps[1].redcap_record_id)
+        # Bulk import (rejected), then one for each task
+        self.assertEqual(project.calls["import_records"], 3)
+        weights = [row["pa_weight"] for row in project.rows
+                   if row.get("redcap_repeat_instrument") == "bmi"]
+        self.assertEqual(weights, ["67.6"])
+
+    def test_rejected_new_record_not_created(self) -> None:
+        project = FakeRedcapProject(
+            reject=lambda row: row.get("pa_weight") == "67.6")
+
+        exported_task_redcaps, errors = self.export_tasks(project,
+                                                          self.bmi_tasks)
+
+        self.assertIn("Invalid value", errors[0])
+        self.assertIn("No REDCap record was created for patient 555",
+                      errors[1])
+        self.assertEqual(project.rows, [])
+        self.assertEqual(project.calls["import_records"], 1)
+
+    def test_connection_error_after_import_fails_tasks(self) -> None:
+        project = FakeRedcapProject()
+        import_records = project.import_records
+
+        def flaky_import_records(*args, **kwargs) -> Union[Dict, List]:
+            if project.calls.get("import_records"):
+                raise ConnectionError("Connection reset by peer")
+            return import_records(*args, **kwargs)
+
+        project.import_records = flaky_import_records
+
+        exported_task_redcaps, errors = self.export_tasks(project,
+                                                          self.bmi_tasks)
+
+        self.assertEqual(len(errors), 2)
+        for error in errors:
+            self.assertIn("Connection reset by peer", error)
+        self.assertEqual(
+            [etr.redcap_record_id for etr in exported_task_redcaps],
+            [None, None]
+        )
+        # New record only
+        self.assertEqual(project.calls["import_records"], 1)
+
+    def test_anonymous_task_fails_alone(self) -> None:
+        project = FakeRedcapProject()
+
+        exported_task_redcaps, errors = self.export_tasks(
+            project, [self.anonymous_task] + self.bmi_tasks
+        )
+
+        self.assertIn("Skipping anonymous task 'apeq_cpft_perinatal'",
+                      errors[0])
+        self.assertEqual(errors[1:], [None, None])
+        self.assertIsNone(exported_task_redcaps[0].redcap_record_id)
+        self.assertEqual(
+            [etr.redcap_instance_id for etr in exported_task_redcaps[1:]],
+            [1, 2]
+        )
+
+
 class Phq9RedcapExportTests(RedcapExportTestCase):
     """
     These are more of a test of the fieldmap code than anything
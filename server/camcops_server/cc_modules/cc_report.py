@@ -55,7 +55,11 @@ from camcops_server.cc_modules.cc_constants import (
     DateFormat,
     DEFAULT_ROWS_PER_PAGE,
 )
-from camcops_server.cc_modules.cc_db import FN_CURRENT, TFN_WHEN_CREATED
+from camcops_server.cc_modules.cc_db import (
+    FN_CURRENT,
+    TFN_WHEN_CREATED_UTC,
+    when_created_to_utc_datetime,
+)
 from camcops_server.cc_modules.cc_pyramid import (
     CamcopsPage,
     PageUrl,
@@ -576,14 +580,18 @@ class DateTimeFilteredReportMixin(object):
         # noinspection PyUnresolvedReferences
         super().add_task_report_filters(wheres)
 
+        # Filter on the indexed UTC DATETIME column, rather than comparing the
+        # ISO-8601 text of when_created (which may carry various timezones).
         if self.start_datetime is not None:
             wheres.append(
-                column(TFN_WHEN_CREATED) >= self.start_datetime
+                column(TFN_WHEN_CREATED_UTC) >=
+                when_created_to_utc_datetime(self.start_datetime)
             )
 
         if self.end_datetime is not None:
             wheres.append(
-                column(TFN_WHEN_CREATED) < self.end_datetime
+                column(TFN_WHEN_CREATED_UTC) <
+                when_created_to_utc_datetime(self.end_datetime)
             )
 
 
@@ -596,7 +604,8 @@ class ScoreDetails(object):
                  scorefunc: Callable[["Task"], Union[None, int, float]],
                  minimum: int,
                  maximum: int,
-                 higher_score_is_better: bool = False) -> None:
+                 higher_score_is_better: bool = False,
+                 summary_name: str = None) -> None:
         """
         Args:
             name:
@@ -611,12 +620,34 @@ class ScoreDetails(object):
                 maximum possible value of this score (for display purposes)
             higher_score_is_better:
                 is a higher score a better thing?
+            summary_name:
+                name of the task's summary (see
+                :meth:`camcops_server.cc_modules.cc_task.Task.get_summaries`)
+                that holds the same score, if there is one; if so, its stored
+                value is used in preference to calling ``scorefunc`` (see
+                :mod:`camcops_server.cc_modules.cc_tasksummary`)
         """
         self.name = name
         self.scorefunc = scorefunc
         self.minimum = minimum
         self.maximum = maximum
         self.higher_score_is_better = higher_score_is_better
+        self.summary_name = summary_name
+
+    def get_score(self, task: "Task",
+                  stored_summaries: Optional[Dict[str, Any]] = None) \
+            -> Union[None, int, float]:
+        """
+        Returns the score for a task, from its stored summaries if possible.
+
+        Args:
+            task: the task
+            stored_summaries: the task's stored summary values, if any
+        """
+        if (self.summary_name and stored_summaries and
+                self.summary_name in stored_summaries):
+            return stored_summaries[self.summary_name]
+        return self.scorefunc(task)
 
     def calculate_improvement(self,
                               first_score: float,
@@ -694,7 +725,8 @@ class AverageScoreReport(DateTimeFilteredReportMixin, Report, ABC):
         We use an SQLAlchemy ORM, rather than Core, method. Why?
 
         - "Patient equality" is complex (e.g. same patient_id on same device,
-          or a shared ID number, etc.) -- simplicity via Patient.__eq__.
+          or a shared ID number, etc.) -- simplicity via
+          :class:`camcops_server.cc_modules.cc_patient.PatientIdentityIndex`.
         - Facilities "is task complete?" checks, and use of Python
           calculations.
         """
@@ -704,6 +736,8 @@ class AverageScoreReport(DateTimeFilteredReportMixin, Report, ABC):
             task_when_created_sorter,
         )  # delayed import
         from camcops_server.cc_modules.cc_taskfilter import TaskFilter  # delayed import  # noqa
+        from camcops_server.cc_modules.cc_patient import PatientIdentityIndex  # delayed import  # noqa
+        from camcops_server.cc_modules.cc_tasksummary import TaskSummaryEntry  # delayed import  # noqa
 
         # Which tasks?
         taskfilter = TaskFilter()
@@ -721,25 +755,31 @@ class AverageScoreReport(DateTimeFilteredReportMixin, Report, ABC):
         )
         all_tasks = collection.all_tasks
 
-        # Get all distinct patients
-        patients = set(t.patient for t in all_tasks)
+        # Group tasks by distinct patient
+        tasks_by_patient = PatientIdentityIndex().group(
+            all_tasks, lambda t: t.patient)
         # log.critical("all_tasks: {}", all_tasks)
-        # log.critical("patients: {}", [str(p) for p in patients])
 
         scoretypes = self.scoretypes(req)
         n_scoretypes = len(scoretypes)
 
+        # Read stored scores in bulk, rather than recalculating them
+        if any(scoretype.summary_name for scoretype in scoretypes):
+            stored_summaries = TaskSummaryEntry.fetch_summaries(
+                req.dbsession, self.task_class.__tablename__,
+                [task.get_pk() for task in all_tasks])
+        else:
+            stored_summaries = {}  # type: Dict[int, Dict[str, Any]]
+
         # Sum first/last/progress scores by patient
         sum_first_by_score = [0] * n_scoretypes
         sum_last_by_score = [0] * n_scoretypes
         sum_improvement_by_score = [0] * n_scoretypes
         n_first = 0
         n_last = 0  # also n_progress
-        for patient in patients:
-            # Find tasks for this patient
-            patient_tasks = [t for t in all_tasks if t.patient == patient]
-            assert patient_tasks, f"No tasks for patient {patient}"
-            # log.critical("For patient {}, tasks: {}", patient, patient_tasks)
+        for patient_tasks in tasks_by_patient:
+            # log.critical("For patient {}, tasks: {}",
+            #              patient_tasks[0].patient, patient_tasks)
             # Find first and last task (last may be absent)
             patient_tasks.sort(key=task_when_created_sorter)
             first = patient_tasks[0]
@@ -752,11 +792,13 @@ class AverageScoreReport(DateTimeFilteredReportMixin, Report, ABC):
 
             # Obtain first/last scores and progress
             for scoreidx, scoretype in enumerate(scoretypes):
-                firstscore = scoretype.scorefunc(first)
+                firstscore = scoretype.get_score(
+                    first, stored_summaries.get(first.get_pk()))
                 # Scores should not be None, because all tasks are complete.
                 sum_first_by_score[scoreidx] += firstscore
                 if last:
-                    lastscore = scoretype.scorefunc(last)
+                    lastscore = scoretype.get_score(
+                        last, stored_summaries.get(last.get_pk()))
                     sum_last_by_score[scoreidx] += lastscore
                     improvement = scoretype.calculate_improvement(
                         firstscore, lastscore)
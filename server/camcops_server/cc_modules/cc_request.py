@@ -37,6 +37,7 @@ import os
 from typing import (Any, Dict, Generator, List, Optional, Set,
                     Tuple, TYPE_CHECKING, Union)
 import urllib.parse
+import uuid
 
 from cardinal_pythonlib.datetimefunc import (
     coerce_to_pendulum,
@@ -48,14 +49,9 @@ from cardinal_pythonlib.datetimefunc import (
 # from cardinal_pythonlib.debugging import get_caller_stack_info
 from cardinal_pythonlib.fileops import get_directory_contents_size, mkdir_p
 from cardinal_pythonlib.logs import BraceStyleAdapter
-from cardinal_pythonlib.plot import (
-    png_img_html_from_pyplot_figure,
-    svg_html_from_pyplot_figure,
-)
 import cardinal_pythonlib.rnc_web as ws
 from cardinal_pythonlib.wsgi.constants import WsgiEnvVar
 import lockfile
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.font_manager import FontProperties
 from pendulum import Date, DateTime as Pendulum, Duration
@@ -67,6 +63,7 @@ from pyramid.interfaces import ISession
 from pyramid.request import Request
 from pyramid.response import Response
 from pyramid.testing import DummyRequest
+from sqlalchemy import inspect
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session as SqlASession
@@ -79,6 +76,10 @@ from camcops_server.cc_modules.cc_baseconstants import (
     ENVVAR_CONFIG_FILE,
     TRANSLATIONS_DIR,
 )
+from camcops_server.cc_modules.cc_cache import (
+    db_cache_get_or_create,
+    invalidate_cache_region_db,
+)
 from camcops_server.cc_modules.cc_config import (
     CamcopsConfig,
     get_config,
@@ -87,8 +88,6 @@ from camcops_server.cc_modules.cc_config import (
 from camcops_server.cc_modules.cc_constants import (
     CSS_PAGED_MEDIA,
     DateFormat,
-    DEFAULT_PLOT_DPI,
-    USE_SVG_IN_HTML,
 )
 from camcops_server.cc_modules.cc_idnumdef import (
     get_idnum_definitions,
@@ -101,6 +100,11 @@ from camcops_server.cc_modules.cc_language import (
 )
 # noinspection PyUnresolvedReferences
 import camcops_server.cc_modules.cc_plot  # import side effects (configure matplotlib)  # noqa
+from camcops_server.cc_modules.cc_plot import (
+    create_figure,
+    get_html_from_pyplot_figure,
+    set_figure_font_sizes,
+)
 from camcops_server.cc_modules.cc_pyramid import (
     camcops_add_mako_renderer,
     CamcopsAuthenticationPolicy,
@@ -126,10 +130,8 @@ from camcops_server.cc_modules.cc_text import SS, server_string
 from camcops_server.cc_modules.cc_user import User
 
 if TYPE_CHECKING:
-    from matplotlib.axis import Axis
     from matplotlib.axes import Axes
     # from matplotlib.figure import SubplotBase
-    from matplotlib.text import Text
     from camcops_server.cc_modules.cc_exportrecipient import ExportRecipient
     from camcops_server.cc_modules.cc_exportrecipientinfo import ExportRecipientInfo  # noqa
     from camcops_server.cc_modules.cc_session import CamcopsSession
@@ -158,6 +160,13 @@ if any([DEBUG_ADD_ROUTES,
         DEBUG_TABLET_SESSION]):
     log.warning("cc_request: Debugging options enabled!")
 
+# =============================================================================
+# Keys for the shared database cache
+# =============================================================================
+
+CACHE_KEY_IDNUM_DEFINITIONS = "camcops:idnum_definitions"
+CACHE_KEY_SERVER_SETTINGS = "camcops:server_settings"
+
 
 # =============================================================================
 # Modified Request interface, for type checking
@@ -208,11 +217,15 @@ class CamcopsRequest(Request):
         """  # noqa
         super().__init__(*args, **kwargs)
         self.use_svg = False
+        self.use_blob_urls = False  # see Blob.get_img_html()
+        self.prerendered_task_pdfs = {}  # type: Dict[Tuple[str, int, bool], bytes]  # see Task.get_pdf()  # noqa
+        self.stored_task_summaries = {}  # type: Dict[Tuple[str, int], Dict[str, Any]]  # see Task.get_summary_values()  # noqa
         self.add_response_callback(complete_request_add_cookies)
         self._camcops_session = None  # type: Optional[CamcopsSession]
         self._debugging_db_session = None  # type: Optional[SqlASession]  # for unit testing only  # noqa
         self._debugging_user = None  # type: Optional[User]  # for unit testing only  # noqa
         self._pending_export_push_requests = []  # type: List[Tuple[str, str, int]]  # noqa
+        self._db_cache_invalidation_pending = False
         self._cached_sstring = {}  # type: Dict[SS, str]
         # Don't make the _camcops_session yet; it will want a Registry, and
         # we may not have one yet; see command_line_request().
@@ -379,6 +392,7 @@ class CamcopsRequest(Request):
         # - https://docs.pylonsproject.org/projects/pyramid_cookbook/en/latest/pylons/exceptions.html  # noqa
         # But they are neatly subclasses of HTTPException, and isinstance()
         # deals with None, so:
+        from camcops_server.cc_modules.cc_audit import send_deferred_audit_entries  # delayed import  # noqa
         session = self.dbsession
         if (self.exception is not None and
                 not isinstance(self.exception, HTTPException)):
@@ -390,12 +404,35 @@ class CamcopsRequest(Request):
             if DEBUG_DBSESSION_MANAGEMENT:
                 log.warning("Committing to database")
             session.commit()
+            if self._db_cache_invalidation_pending:
+                invalidate_cache_region_db()
+                self._db_cache_invalidation_pending = False
             if self._pending_export_push_requests:
                 self._process_pending_export_push_requests()
+            send_deferred_audit_entries(session)
         if DEBUG_DBSESSION_MANAGEMENT:
             log.warning("Closing SQLAlchemy session")
         session.close()
 
+    def invalidate_db_cache(self) -> None:
+        """
+        Marks the shared database cache (see
+        :mod:`camcops_server.cc_modules.cc_cache`) for invalidation, which
+        happens once this request's changes have been committed. Call this
+        when altering ID number definitions, server settings, or groups.
+        """
+        self._db_cache_invalidation_pending = True
+
+    def _merge_cached_object(self, obj: Any) -> Any:
+        """
+        Reattaches a (possibly unpickled) ORM object from the database cache
+        to our database session, without querying the database.
+        """
+        dbsession = self.dbsession
+        if obj in dbsession:
+            return obj
+        return dbsession.merge(obj, load=False)
+
     def get_bare_dbsession(self) -> SqlASession:
         """
         Returns a bare SQLAlchemy session for the request.
@@ -1036,46 +1073,10 @@ class CamcopsRequest(Request):
     def create_figure(**kwargs) -> Figure:
         """
         Creates and returns a :class:`matplotlib.figure.Figure` with a canvas.
-        The canvas will be available as ``fig.canvas``.
-        """
-        fig = Figure(**kwargs)
-        # noinspection PyUnusedLocal
-        canvas = FigureCanvas(fig)  # noqa: F841
-        # The canvas will be now available as fig.canvas, since
-        # FigureCanvasBase.__init__ calls fig.set_canvas(self); similarly, the
-        # figure is available from the canvas as canvas.figure
-
-        # How do we set the font, so the caller doesn't have to?
-        # The "nasty global" way is:
-        #       matplotlib.rc('font', **fontdict)
-        #       matplotlib.rc('legend', **fontdict)
-        # or similar. Then matplotlib often works its way round to using its
-        # global rcParams object, which is Not OK in a multithreaded context.
-        #
-        # https://github.com/matplotlib/matplotlib/issues/6514
-        # https://github.com/matplotlib/matplotlib/issues/6518
-        #
-        # The other way is to specify a fontdict with each call, e.g.
-        #       ax.set_xlabel("some label", **fontdict)
-        # https://stackoverflow.com/questions/21321670/how-to-change-fonts-in-matplotlib-python  # noqa
-        # Relevant calls with explicit "fontdict: Dict" parameters:
-        #       ax.set_xlabel(..., fontdict=XXX, ...)
-        #       ax.set_ylabel(..., fontdict=XXX, ...)
-        #       ax.set_xticklabels(..., fontdict=XXX, ...)
-        #       ax.set_yticklabels(..., fontdict=XXX, ...)
-        #       ax.text(..., fontdict=XXX, ...)
-        #       ax.set_label_text(..., fontdict=XXX, ...)
-        #       ax.set_title(..., fontdict=XXX, ...)
-        #
-        # And with "fontproperties: FontProperties"
-        #       sig.suptitle(..., fontproperties=XXX, ...)
-        #
-        # And with "prop: FontProperties":
-        #       ax.legend(..., prop=XXX, ...)
-        #
-        # Then, some things are automatically plotted...
-
-        return fig
+        The canvas will be available as ``fig.canvas``. See
+        :func:`camcops_server.cc_modules.cc_plot.create_figure`.
+        """
+        return create_figure(**kwargs)
 
     @reify
     def fontdict(self) -> Dict[str, Any]:
@@ -1122,33 +1123,16 @@ class CamcopsRequest(Request):
         final_fontdict = self.fontdict.copy()
         if fontdict:
             final_fontdict.update(fontdict)
-        fp = FontProperties(**final_fontdict)
-
-        axes = []  # type: List[Axis]
-        if x_ticklabels:  # and hasattr(ax, "xaxis"):
-            axes.append(ax.xaxis)
-        if y_ticklabels:  # and hasattr(ax, "yaxis"):
-            axes.append(ax.yaxis)
-        for axis in axes:
-            for ticklabel in axis.get_ticklabels(which='both'):  # type: Text  # I think!  # noqa
-                ticklabel.set_fontproperties(fp)
+        set_figure_font_sizes(ax, final_fontdict,
+                              x_ticklabels=x_ticklabels,
+                              y_ticklabels=y_ticklabels)
 
     def get_html_from_pyplot_figure(self, fig: Figure) -> str:
         """
         Make HTML (as PNG or SVG) from pyplot
         :class:`matplotlib.figure.Figure`.
         """
-        if USE_SVG_IN_HTML and self.use_svg:
-            return (
-                svg_html_from_pyplot_figure(fig) +
-                png_img_html_from_pyplot_figure(fig, DEFAULT_PLOT_DPI,
-                                                "pngfallback")
-            )
-            # return both an SVG and a PNG image, for browsers that can't deal
-            # with SVG; the Javascript header will sort this out
-            # http://www.voormedia.nl/blog/2012/10/displaying-and-detecting-support-for-svg-images  # noqa
-        else:
-            return png_img_html_from_pyplot_figure(fig, DEFAULT_PLOT_DPI)
+        return get_html_from_pyplot_figure(fig, self.use_svg)
 
     # -------------------------------------------------------------------------
     # Convenience functions for user information
@@ -1181,7 +1165,11 @@ class CamcopsRequest(Request):
         Returns all
         :class:`camcops_server.cc_modules.cc_idnumdef.IdNumDefinition` objects.
         """
-        return get_idnum_definitions(self.dbsession)  # no longer cached
+        iddefs = db_cache_get_or_create(
+            CACHE_KEY_IDNUM_DEFINITIONS,
+            lambda: get_idnum_definitions(self.dbsession)
+        )  # type: List[IdNumDefinition]
+        return [self._merge_cached_object(iddef) for iddef in iddefs]
 
     @reify
     def valid_which_idnums(self) -> List[int]:
@@ -1269,7 +1257,13 @@ class CamcopsRequest(Request):
         :class:`camcops_server.cc_modules.cc_serversettings.ServerSettings` for
         the server.
         """
-        return get_server_settings(self)
+        ss = db_cache_get_or_create(
+            CACHE_KEY_SERVER_SETTINGS,
+            lambda: get_server_settings(self),
+            should_cache_fn=lambda x: inspect(x).persistent
+            # ... not if we have just created it
+        )  # type: ServerSettings
+        return self._merge_cached_object(ss)
 
     @reify
     def database_title(self) -> str:
@@ -1285,6 +1279,7 @@ class CamcopsRequest(Request):
         """
         ss = self.server_settings
         ss.database_title = title
+        self.invalidate_db_cache()
 
     # -------------------------------------------------------------------------
     # SNOMED-CT
@@ -1764,6 +1759,38 @@ def make_post_body_from_dict(d: Dict[str, str],
     return body
 
 
+def make_multipart_post_body(fields: Dict[str, str],
+                             files: Dict[str, bytes],
+                             encoding: str = "utf8") -> Tuple[bytes, str]:
+    """
+    Makes a ``multipart/form-data`` HTTP POST body, with text fields and raw
+    binary (file) parts.
+
+    For debugging HTTP requests.
+
+    Returns:
+        tuple: ``body, content_type``
+    """
+    boundary = uuid.uuid4().hex
+    crlf = b"\r\n"
+    parts = []  # type: List[bytes]
+    for name, value in fields.items():
+        parts.append(
+            f'Content-Disposition: form-data; name="{name}"'.encode(encoding) +
+            crlf + crlf + str(value).encode(encoding)
+        )
+    for name, data in files.items():
+        parts.append(
+            f'Content-Disposition: form-data; name="{name}"; '
+            f'filename="{name}"'.encode(encoding) + crlf +
+            b"Content-Type: application/octet-stream" + crlf + crlf + data
+        )
+    delimiter = b"--" + boundary.encode("ascii")
+    body = b"".join(delimiter + crlf + part + crlf for part in parts)
+    body += delimiter + b"--" + crlf
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
 class CamcopsDummyRequest(CamcopsRequest, DummyRequest):
     """
     Request class that allows manual manipulation of GET/POST parameters
@@ -1887,6 +1914,19 @@ class CamcopsDummyRequest(CamcopsRequest, DummyRequest):
         body = make_post_body_from_dict(d, encoding=encoding)
         self.set_post_body(body, set_method_post=set_method_post)
 
+    def fake_request_post_multipart(self,
+                                    fields: Dict[str, str],
+                                    files: Dict[str, bytes],
+                                    encoding: str = "utf8") -> None:
+        """
+        Sets the request's POST body to ``multipart/form-data``, with text
+        fields and binary (file) parts; see :func:`make_multipart_post_body`.
+        """
+        body, content_type = make_multipart_post_body(fields, files,
+                                                      encoding=encoding)
+        self.content_type = content_type
+        self.set_post_body(body)
+
 
 _ = """
 # A demonstration of the manipulation of superclass properties:
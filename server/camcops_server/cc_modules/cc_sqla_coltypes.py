@@ -346,6 +346,8 @@ SESSION_TOKEN_MAX_BYTES = 64
 SESSION_TOKEN_MAX_LEN = len(
     create_base64encoded_randomness(SESSION_TOKEN_MAX_BYTES))
 
+SHA256_HEX_MAX_LEN = 64  #: SHA-256 digest as hexadecimal text
+
 TABLENAME_MAX_LEN = 128
 """
 For
@@ -380,6 +382,9 @@ class RelationshipInfo(object):
     """  # noqa
     IS_ANCILLARY = "is_ancillary"
     IS_BLOB = "is_blob"
+    ANCILLARY_FK_TO_PARENT = "ancillary_fk_to_parent"
+    # ... for ancillary relationships: the name of the ancillary attribute
+    # referring to the parent's "id"
 
 
 # =============================================================================
@@ -454,6 +459,7 @@ PatientNameColType = Unicode(length=PATIENT_NAME_MAX_LEN)
 Rfc2822DateColType = String(length=RFC_2822_DATE_MAX_LEN)
 
 SessionTokenColType = String(length=SESSION_TOKEN_MAX_LEN)
+Sha256HexColType = String(length=SHA256_HEX_MAX_LEN)
 SexColType = String(length=1)
 SummaryCategoryColType = String(length=TASK_SUMMARY_TEXT_FIELD_DEFAULT_MAX_LEN)  # pretty generic  # noqa
 
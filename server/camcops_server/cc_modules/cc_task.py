@@ -44,10 +44,13 @@ SQL     As part of an SQL or SQLite download.
 
 from collections import OrderedDict
 import datetime
+import functools
+import io
 import logging
 import statistics
-from typing import (Any, Dict, Iterable, Generator, List, Optional,
-                    Tuple, Type, TYPE_CHECKING, Union)
+import time
+from typing import (Any, Callable, Dict, Iterable, Generator, List,
+                    Optional, TextIO, Tuple, Type, TYPE_CHECKING, Union)
 
 from cardinal_pythonlib.classes import classproperty
 from cardinal_pythonlib.datetimefunc import (
@@ -66,8 +69,9 @@ import hl7
 from pendulum import Date, DateTime as Pendulum
 from pyramid.renderers import render
 from semantic_version import Version
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import Mapper, relationship
 from sqlalchemy.orm.relationships import RelationshipProperty
 from sqlalchemy.sql.expression import not_, update
 from sqlalchemy.sql.schema import Column
@@ -90,7 +94,9 @@ from camcops_server.cc_modules.cc_db import (
     TFN_FIRSTEXIT_IS_ABORT,
     TFN_FIRSTEXIT_IS_FINISH,
     TFN_WHEN_CREATED,
+    TFN_WHEN_CREATED_UTC,
     TFN_WHEN_FIRSTEXIT,
+    when_created_to_utc_datetime,
 )
 from camcops_server.cc_modules.cc_filename import get_export_filename
 from camcops_server.cc_modules.cc_hl7 import make_obr_segment, make_obx_segment
@@ -102,7 +108,11 @@ from camcops_server.cc_modules.cc_html import (
     tr,
     tr_qa,
 )
-from camcops_server.cc_modules.cc_pdf import pdf_from_html
+from camcops_server.cc_modules.cc_pdf import (
+    make_pdf_job,
+    PdfJob,
+    render_pdf_jobs,
+)
 from camcops_server.cc_modules.cc_pyramid import ViewArg
 from camcops_server.cc_modules.cc_simpleobjects import TaskExportOptions
 from camcops_server.cc_modules.cc_specialnote import SpecialNote
@@ -128,7 +138,7 @@ from camcops_server.cc_modules.cc_version import (
 )
 from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
 from camcops_server.cc_modules.cc_xml import (
-    get_xml_document,
+    write_xml_document,
     XML_COMMENT_ANCILLARY,
     XML_COMMENT_ANONYMOUS,
     XML_COMMENT_BLOBS,
@@ -138,10 +148,12 @@ from camcops_server.cc_modules.cc_xml import (
     XML_COMMENT_SPECIAL_NOTES,
     XML_NAME_SNOMED_CODES,
     XmlElement,
+    XmlLazyBranches,
     XmlLiteral,
 )
 
 if TYPE_CHECKING:
+    from sqlalchemy.engine.default import DefaultExecutionContext
     from camcops_server.cc_modules.cc_ctvinfo import CtvInfo  # noqa: F401
     from camcops_server.cc_modules.cc_exportrecipient import ExportRecipient  # noqa: E501,F401
     from camcops_server.cc_modules.cc_patient import Patient  # noqa: F401
@@ -164,6 +176,17 @@ SNOMED_COLNAME_EXPRESSION = "snomed_expression"
 UNUSED_SNOMED_XML_NAME = "snomed_ct_expressions"
 
 
+def when_created_utc_default(context: "DefaultExecutionContext") \
+        -> Optional[datetime.datetime]:
+    """
+    SQLAlchemy column default for ``Task._when_created_utc``: derives the value
+    from the ``when_created`` value being inserted. This applies to ORM inserts
+    and to the SQLAlchemy Core inserts used by the client upload API alike.
+    """
+    return when_created_to_utc_datetime(
+        context.get_current_parameters().get(TFN_WHEN_CREATED))
+
+
 # =============================================================================
 # Patient mixin
 # =============================================================================
@@ -421,6 +444,22 @@ class Task(GenericTabletRecordMixin, Base):
             comment="(TASK) Date/time this task instance was created (ISO 8601)"
         )
 
+    # noinspection PyMethodParameters
+    @declared_attr
+    def _when_created_utc(cls) -> Column:
+        """
+        Column representing the task's creation time in UTC, as a ``DATETIME``.
+        This duplicates ``when_created``, but can be indexed and compared
+        directly, rather than via a per-row conversion of the ISO-8601 text.
+        Set by the server on insertion (see :func:`when_created_utc_default`).
+        """
+        return Column(
+            TFN_WHEN_CREATED_UTC, DateTime,
+            index=True,
+            default=when_created_utc_default,
+            comment="(SERVER) Date/time this task instance was created (UTC)"
+        )
+
     # noinspection PyMethodParameters
     @declared_attr
     def when_firstexit(cls) -> Column:
@@ -959,6 +998,19 @@ class Task(GenericTabletRecordMixin, Base):
             ),
         ]
 
+    def get_summary_values(self, req: "CamcopsRequest") -> Dict[str, Any]:
+        """
+        Returns the values of this task's summaries, from the summary store
+        if they have been preloaded into the request (see
+        :func:`camcops_server.cc_modules.cc_tasksummary.preload_stored_summaries`),
+        or else by calculating them.
+        """  # noqa
+        stored = req.stored_task_summaries.pop(
+            (self.tablename, self.get_pk()), None)
+        if stored is not None:
+            return stored
+        return super().get_summary_values(req)
+
     def get_all_summary_tables(self, req: "CamcopsRequest") \
             -> List[ExtraSummaryTable]:
         """
@@ -1449,9 +1501,35 @@ class Task(GenericTabletRecordMixin, Base):
             an XML UTF-8 document representing the task.
 
         """  # noqa
+        sink = io.StringIO()
+        self.write_xml(sink, req=req, options=options,
+                       indent_spaces=indent_spaces, eol=eol)
+        return sink.getvalue()
+
+    def write_xml(self,
+                  sink: TextIO,
+                  req: "CamcopsRequest",
+                  options: TaskExportOptions = None,
+                  indent_spaces: int = 4,
+                  eol: str = '\n') -> None:
+        """
+        Writes XML describing the task to a file-like object, in a single
+        pass. The output is identical to that of :meth:`get_xml`, but large
+        tasks (e.g. those with many ancillary records or BLOBs) don't need
+        their entire XML held in memory.
+
+        Args:
+            sink: file-like object, opened in text mode
+            req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            options: a :class:`camcops_server.cc_modules.cc_simpleobjects.TaskExportOptions`
+
+            indent_spaces: number of spaces to indent formatted XML
+            eol: end-of-line string
+        """  # noqa
         options = options or TaskExportOptions()
         tree = self.get_xml_root(req=req, options=options)
-        return get_xml_document(
+        write_xml_document(
+            sink,
             tree,
             indent_spaces=indent_spaces,
             eol=eol,
@@ -1554,27 +1632,35 @@ class Task(GenericTabletRecordMixin, Base):
                 xml_sort_by_name=True,
                 xml_with_header_comments=options.xml_with_header_comments,
             )
+
+            def gen_itembranches(attrname_: str,
+                                 uselist: bool) -> Generator[XmlElement,
+                                                             None, None]:
+                if uselist:
+                    ancillaries = getattr(self, attrname_)  # type: List[GenericTabletRecordMixin]  # noqa
+                else:
+                    ancillaries = [getattr(self, attrname_)]  # type: List[GenericTabletRecordMixin]  # noqa
+                for ancillary in ancillaries:
+                    yield ancillary._get_xml_root(req=req,
+                                                  options=ancillary_options)
+
             item_collections = []  # type: List[XmlElement]
             found_ancillary = False
             # We use a slightly more manual iteration process here so that
             # we iterate through individual ancillaries but clustered by their
             # name (e.g. if we have 50 trials and 5 groups, we do them in
-            # collections).
+            # collections). The XML for each collection is only created when
+            # it's written (see write_xml()), so we don't hold XML for all
+            # ancillary records in memory at once.
             for attrname, rel_prop, rel_cls in gen_ancillary_relationships(self):  # noqa
                 if not found_ancillary:
                     add_comment(XML_COMMENT_ANCILLARY)
                     found_ancillary = True
-                itembranches = []  # type: List[XmlElement]
-                if rel_prop.uselist:
-                    ancillaries = getattr(self, attrname)  # type: List[GenericTabletRecordMixin]  # noqa
-                else:
-                    ancillaries = [getattr(self, attrname)]  # type: List[GenericTabletRecordMixin]  # noqa
-                for ancillary in ancillaries:
-                    itembranches.append(
-                        ancillary._get_xml_root(req=req,
-                                                options=ancillary_options)
-                    )
-                itemcollection = XmlElement(name=attrname, value=itembranches)
+                itemcollection = XmlElement(
+                    name=attrname,
+                    value=XmlLazyBranches(functools.partial(
+                        gen_itembranches, attrname, rel_prop.uselist))
+                )
                 item_collections.append(itemcollection)
             item_collections.sort(key=lambda el: el.name)
             branches += item_collections
@@ -1650,12 +1736,28 @@ class Task(GenericTabletRecordMixin, Base):
         Args:
             req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
             anonymise: hide patient identifying details?
+
+        If the PDF has been rendered in advance (see
+        :func:`camcops_server.cc_modules.cc_export.export_tasks_individually`),
+        that copy is used (once).
+        """
+        prerendered = req.prerendered_task_pdfs.pop(
+            (self.tablename, self.get_pk(), anonymise), None)
+        if prerendered is not None:
+            return prerendered
+        return render_pdf_jobs([self.get_pdf_job(req, anonymise)])[0]
+
+    def get_pdf_job(self, req: "CamcopsRequest",
+                    anonymise: bool = False) -> PdfJob:
+        """
+        Returns a :class:`camcops_server.cc_modules.cc_pdf.PdfJob` to make the
+        PDF representing the task (see :meth:`get_pdf`).
         """
         html = self.get_pdf_html(req, anonymise=anonymise)  # main content
         if CSS_PAGED_MEDIA:
-            return pdf_from_html(req, html=html)
+            return make_pdf_job(req, html=html)
         else:
-            return pdf_from_html(
+            return make_pdf_job(
                 req,
                 html=html,
                 header_html=render(
@@ -2016,18 +2118,22 @@ class Task(GenericTabletRecordMixin, Base):
                                                     getattr(self, fieldname)))
 
     @staticmethod
-    def get_twocol_picture_row(blob: Optional[Blob], label: str) -> str:
+    def get_twocol_picture_row(blob: Optional[Blob], label: str,
+                               req: "CamcopsRequest" = None) -> str:
         """
         HTML table row, two columns, with PNG on right.
 
         Args:
             blob: the :class:`camcops_server.cc_modules.cc_blob.Blob` object
             label: descriptive label
+            req: the
+                :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`,
+                if the picture may be referred to by URL
 
         Returns:
             two-column HTML table row (label, picture)
         """
-        return tr(label, get_blob_img_html(blob))
+        return tr(label, get_blob_img_html(blob, req=req))
 
     # -------------------------------------------------------------------------
     # Field helper functions for subclasses
@@ -2323,6 +2429,118 @@ class Task(GenericTabletRecordMixin, Base):
         return d
 
 
+# =============================================================================
+# Memoised scores
+# =============================================================================
+# Scoring methods are called many times per task instance: by each other
+# (e.g. a total from subtotals), and by get_summaries(), get_trackers(),
+# get_clinical_text() and get_task_html(), for every view and export. We cache
+# their results in the instance, and discard that cache whenever a mapped
+# column of the instance changes (by assignment, expiry or refresh).
+
+SCORE_CACHE_ATTR = "_score_cache"
+_MEMOISED_SCORE_FLAG = "_memoised_score"
+_memoise_scores = True  # only altered for benchmarking
+
+
+def memoised_score(fn: Callable) -> Callable:
+    """
+    Decorator for a task method that derives a value (e.g. a score) from the
+    task's own columns. The result is cached per instance, and per set of
+    arguments (which must be hashable); exceptions are not cached.
+
+    Only use this for methods whose result depends on nothing but the task's
+    column values (and their arguments): not on relationships (e.g. the
+    patient or ancillary objects), the request, or the time. Callers must not
+    modify the (shared) result.
+
+    Example:
+
+    .. code-block:: python
+
+        class Phq9(TaskHasPatientMixin, Task):
+            @memoised_score
+            def total_score(self) -> int:
+                return self.sum_fields(self.QUESTION_FIELDS)
+    """
+    name = fn.__qualname__  # distinct for overrides that call super()
+
+    @functools.wraps(fn)
+    def wrapper(self: "Task", *args, **kwargs) -> Any:
+        if not _memoise_scores:
+            return fn(self, *args, **kwargs)
+        if args or kwargs:
+            key = (name, args, tuple(sorted(kwargs.items())))
+        else:
+            key = name
+        cache = self.__dict__.get(SCORE_CACHE_ATTR)
+        if cache is None:
+            cache = self.__dict__[SCORE_CACHE_ATTR] = {}
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        result = fn(self, *args, **kwargs)
+        cache[key] = result
+        return result
+
+    setattr(wrapper, _MEMOISED_SCORE_FLAG, True)
+    return wrapper
+
+
+def clear_score_cache(task: "Task") -> None:
+    """
+    Discards all memoised scores (see :func:`memoised_score`) of a task
+    instance. This happens automatically when its columns change.
+    """
+    task.__dict__.pop(SCORE_CACHE_ATTR, None)
+
+
+def has_memoised_scores(cls: Type["Task"]) -> bool:
+    """
+    Does a task class have any methods decorated with
+    :func:`memoised_score`?
+    """
+    return any(
+        getattr(v, _MEMOISED_SCORE_FLAG, False)
+        for klass in cls.__mro__
+        for v in klass.__dict__.values()
+    )
+
+
+# noinspection PyUnusedLocal
+def _on_column_set(target: "Task", value: Any, oldvalue: Any,
+                   initiator: Any) -> None:
+    clear_score_cache(target)
+
+
+# noinspection PyUnusedLocal
+def _on_expire(target: "Task", attrs: Optional[Iterable[str]]) -> None:
+    clear_score_cache(target)
+
+
+# noinspection PyUnusedLocal
+def _on_refresh(target: "Task", context: Any,
+                attrs: Optional[Iterable[str]]) -> None:
+    clear_score_cache(target)
+
+
+@event.listens_for(Task, "mapper_configured", propagate=True)
+def _install_score_cache_invalidation(mapper: Mapper,
+                                      cls: Type[Task]) -> None:
+    """
+    When a task class is mapped, and it memoises scores, arrange that
+    changing any of its columns clears the cache. (Other classes don't pay
+    for attribute events.)
+    """
+    if not has_memoised_scores(cls):
+        return
+    for prop in mapper.column_attrs:
+        event.listen(getattr(cls, prop.key), "set", _on_column_set)
+    event.listen(cls, "expire", _on_expire)
+    event.listen(cls, "refresh", _on_refresh)
+
+
 # =============================================================================
 # Collating all task tables for specific purposes
 # =============================================================================
@@ -2393,6 +2611,65 @@ def get_from_dict(d: Dict, key: Any, default: Any = INVALID_VALUE) -> Any:
     return d.get(key, default)
 
 
+# =============================================================================
+# Benchmarking
+# =============================================================================
+
+def benchmark_task_scoring(req: "CamcopsRequest",
+                           classes: Iterable[Type[Task]] = None,
+                           ntasks: int = 10000) -> None:
+    """
+    Times the scoring work of a task dump (summaries, clinical text, trackers
+    and completeness, for each task), with and without memoised scores (see
+    :func:`memoised_score`).
+
+    For each task class, up to ``ntasks`` tasks are read from the database;
+    if there are fewer, they are used repeatedly (with their caches cleared
+    each time) to make up ``ntasks``.
+
+    Use with:
+
+    .. code-block:: python
+
+        from cardinal_pythonlib.logs import main_only_quicksetup_rootlogger
+        from camcops_server.cc_modules.cc_task import benchmark_task_scoring
+        from camcops_server.tasks import Ace3, Cisr
+        main_only_quicksetup_rootlogger()
+        benchmark_task_scoring(req, [Ace3, Cisr])
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        classes: task classes to test (default: all those that memoise
+            scores)
+        ntasks: number of tasks per class
+    """  # noqa
+    global _memoise_scores
+    if classes is None:
+        classes = [cls for cls in Task.all_subclasses_by_tablename()
+                   if has_memoised_scores(cls)]
+    for cls in classes:
+        tasks = req.dbsession.query(cls).limit(ntasks).all()  # type: List[Task]  # noqa
+        if not tasks:
+            log.warning("No {} tasks to benchmark", cls.__name__)
+            continue
+        for memoise in (False, True):
+            _memoise_scores = memoise
+            try:
+                t0 = time.time()
+                for i in range(ntasks):
+                    task = tasks[i % len(tasks)]
+                    clear_score_cache(task)
+                    task.get_summaries(req)
+                    task.get_clinical_text(req)
+                    task.get_trackers(req)
+                    task.is_complete()
+                t1 = time.time()
+            finally:
+                _memoise_scores = True
+            log.info("{}: {} tasks ({} distinct), memoised={}: {:.3f} s",
+                     cls.__name__, ntasks, len(tasks), memoise, t1 - t0)
+
+
 # =============================================================================
 # Unit testing
 # =============================================================================
@@ -2408,6 +2685,22 @@ class TaskTests(DemoDatabaseTestCase):
         results = phq9_query.all()
         log.info("{}", results)
 
+    def test_memoised_score(self) -> None:
+        self.announce("test_memoised_score")
+        from camcops_server.tasks import Phq9
+        t = self.dbsession.query(Phq9).first()  # type: Phq9
+        self.assertTrue(has_memoised_scores(Phq9))
+        original_q1 = t.q1
+        t.q1 = 0
+        score = t.total_score()
+        self.assertIn(SCORE_CACHE_ATTR, t.__dict__)
+        t.q1 = 3  # changing a column clears the cache
+        self.assertNotIn(SCORE_CACHE_ATTR, t.__dict__)
+        self.assertEqual(t.total_score(), score + 3)
+        self.dbsession.expire(t)
+        self.assertNotIn(SCORE_CACHE_ATTR, t.__dict__)
+        self.assertEqual(t.q1, original_q1)
+
     def test_all_tasks(self) -> None:
         self.announce("test_all_tasks")
         from datetime import date
@@ -2468,6 +2761,9 @@ class TaskTests(DemoDatabaseTestCase):
             self.assertIsInstanceOrNone(t.get_creation_datetime(), Pendulum)
             self.assertIsInstanceOrNone(
                 t.get_creation_datetime_utc(), Pendulum)
+            # noinspection PyProtectedMember
+            self.assertEqual(t._when_created_utc,
+                             t.get_creation_datetime_utc_tz_unaware())
             self.assertIsInstanceOrNone(
                 t.get_seconds_from_creation_to_first_finish(), float)
 
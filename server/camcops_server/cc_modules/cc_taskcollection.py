@@ -29,12 +29,13 @@ camcops_server/cc_modules/cc_taskcollection.py
 """
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from enum import Enum
 import logging
-from threading import Thread
-from typing import (Dict, Generator, List, Optional, Tuple, Type,
+from typing import (Any, Dict, Generator, List, Optional, Tuple, Type,
                     TYPE_CHECKING, Union)
+from unittest import mock
 
 from cardinal_pythonlib.json.serialize import (
     register_class_for_json,
@@ -45,13 +46,18 @@ from cardinal_pythonlib.reprfunc import auto_repr, auto_str
 from cardinal_pythonlib.sort import MINTYPE_SINGLETON, MinType
 from kombu.serialization import dumps, loads
 from pendulum import DateTime as Pendulum
-from sqlalchemy.orm import Query
-from sqlalchemy.orm.session import Session as SqlASession
+from sqlalchemy.orm import Query, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import Session as SqlASession, sessionmaker
 from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.expression import and_, exists, or_
 
+from camcops_server.cc_modules.cc_cache import cache_region_counts
 from camcops_server.cc_modules.cc_constants import ERA_NOW
+from camcops_server.cc_modules.cc_db import when_created_to_utc_datetime
 from camcops_server.cc_modules.cc_exportrecipient import ExportRecipient
+from camcops_server.cc_modules.cc_patient import Patient
+from camcops_server.cc_modules.cc_pyramid import ViewParam
 from camcops_server.cc_modules.cc_task import (
     tablename_to_task_class_dict,
     Task,
@@ -146,45 +152,50 @@ def sort_tasks_in_place(tasklist: List[Task],
 #
 # HOWEVER, the query time per table drops from ~27ms to 4-8ms if we disable
 # eager loading (lazy="joined") of patients from tasks.
-
-class FetchThread(Thread):
+#
+# The current method (see TaskCollection._run_task_queries):
+# - Queries are BUILT in the request's thread, using the request's session
+#   (since building them may consult the user's permissions, which may involve
+#   lazy loading on the request's session, which is not thread-safe).
+# - They are RUN by a bounded pool of worker threads, each with its own
+#   session (and therefore database connection), with the relationships we
+#   need later (patient, patient ID numbers, special notes) loaded eagerly.
+#   The worker then detaches its results and closes its session.
+# - The results are MERGED into the request's session, in the request's
+#   thread, without further database access; the eagerly loaded relationships
+#   are attached to the merged objects as already-loaded values. Anything else
+#   that is lazy-loaded later (e.g. BLOBs) is then loaded normally, via the
+#   request's session.
+# - The number of workers is kept below the default SQLAlchemy connection
+#   pool size (5), as the request holds a connection too.
+
+PARALLEL_FETCH_MAX_WORKERS = 4
+
+
+def _run_detached_task_query(req: "CamcopsRequest",
+                             task_class: Type[Task],
+                             q: Query) -> List[Task]:
     """
-    Thread to fetch tasks in parallel.
+    Runs a task query in a new database session (for use in a worker thread),
+    eagerly loading the relationships that are needed later, and returns the
+    resulting tasks, detached from that session.
 
-    CURRENTLY UNUSED.
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        task_class: the task class being queried
+        q: an SQLAlchemy ORM query for ``task_class``, built elsewhere
     """
-    def __init__(self,
-                 req: "CamcopsRequest",
-                 task_class: Type[Task],
-                 factory: "TaskCollection",
-                 **kwargs) -> None:
-        self.req = req
-        self.task_class = task_class
-        self.factory = factory
-        self.error = False
-        name = task_class.__tablename__
-        super().__init__(name=name, target=None, **kwargs)
-
-    def run(self) -> None:
-        log.debug("Thread starting")
-        dbsession = self.req.get_bare_dbsession()
-        # noinspection PyBroadException
-        try:
-            # noinspection PyProtectedMember
-            q = self.factory._make_query(dbsession, self.task_class)
-            if q:
-                tasks = q.all()  # type: List[Task]
-                # https://stackoverflow.com/questions/6319207/are-lists-thread-safe  # noqa
-                # https://stackoverflow.com/questions/6953351/thread-safety-in-pythons-dictionary  # noqa
-                # http://effbot.org/pyfaq/what-kinds-of-global-value-mutation-are-thread-safe.htm  # noqa
-                # noinspection PyProtectedMember
-                self.factory._tasks_by_class[self.task_class] = tasks
-                log.debug("Thread finishing with results")
-            else:
-                log.debug("Thread finishing without results")
-        except Exception:
-            self.error = True
-            log.error("Thread error")
+    dbsession = req.get_bare_dbsession()
+    try:
+        options = [selectinload(task_class.special_notes)]
+        if task_class.has_patient:
+            # noinspection PyUnresolvedReferences
+            options.append(
+                selectinload(task_class.patient).subqueryload(Patient.idnums))
+        tasks = q.with_session(dbsession).options(*options).all()  # type: List[Task]  # noqa
+        dbsession.expunge_all()
+        return tasks
+    finally:
         dbsession.close()
 
 
@@ -192,6 +203,9 @@ class FetchThread(Thread):
 # Make a set of tasks, deferring work until things are needed
 # =============================================================================
 
+STREAMED_FETCH_CHUNK_SIZE = 500  # see TaskCollection.gen_task_chunks_for_task_class  # noqa
+
+
 class TaskCollection(object):
     """
     Represent a potential or instantiated call to fetch tasks from the
@@ -208,7 +222,8 @@ class TaskCollection(object):
                  sort_method_global: TaskSortMethod = TaskSortMethod.NONE,
                  current_only: bool = True,
                  via_index: bool = True,
-                 export_recipient: "ExportRecipient" = None) \
+                 export_recipient: "ExportRecipient" = None,
+                 parallel_fetch: bool = False) \
             -> None:
         """
         Args:
@@ -234,6 +249,11 @@ class TaskCollection(object):
                 use the server's index (faster)?
             export_recipient:
                 a :class:`camcops_server.cc_modules.cc_exportrecipient.ExportRecipient`
+            parallel_fetch:
+                fetch tasks for different task tables concurrently, using a
+                pool of threads, each with its own database session? (See
+                "Parallel fetch helper" above.) Worthwhile when many task
+                tables are involved, e.g. trackers, CTVs, and dumps.
         """  # noqa
         if via_index and not current_only:
             log.warning("Can't use index for non-current tasks")
@@ -246,6 +266,7 @@ class TaskCollection(object):
         self._sort_method_global = sort_method_global
         self._current_only = current_only
         self._via_index = via_index
+        self._parallel_fetch = parallel_fetch
         self.export_recipient = export_recipient
 
         if export_recipient:
@@ -312,6 +333,10 @@ class TaskCollection(object):
         """
         if self._via_index:
             self._ensure_everything_fetched_via_index()
+        elif self._parallel_fetch:
+            # Callers generally iterate through all task classes, so fetch
+            # them all at once.
+            self._fetch_task_classes(self.task_classes())
         else:
             self._fetch_task_class(task_class)
         tasklist = self._tasks_by_class.get(task_class, [])
@@ -385,6 +410,54 @@ class TaskCollection(object):
             for task in self.tasks_for_task_class(cls):
                 yield task
 
+    def gen_task_chunks_for_task_class(
+            self,
+            task_class: Type[Task],
+            chunk_size: int = STREAMED_FETCH_CHUNK_SIZE) \
+            -> Generator[List[Task], None, None]:
+        """
+        As for :meth:`tasks_for_task_class`, but without keeping the tasks.
+        We fetch (and sort) the PKs of the appropriate tasks, then fetch the
+        tasks themselves in chunks, expunging each chunk from the session once
+        the caller has asked for the next. Memory use therefore depends on the
+        chunk size, not the number of tasks. For large, read-only exports.
+
+        (If the tasks for this class have already been fetched, we use them.)
+
+        Args:
+            task_class: the task class
+            chunk_size: maximum number of tasks per chunk
+
+        Yields:
+            lists of tasks, in our per-class sort order
+        """
+        if task_class in self._tasks_by_class:
+            tasks = self._tasks_by_class[task_class]
+            for start in range(0, len(tasks), chunk_size):
+                yield tasks[start:start + chunk_size]
+            return
+        dbsession = self.dbsession
+        task_pks = self._sorted_task_pks_for_task_class(task_class)
+        for start in range(0, len(task_pks), chunk_size):
+            chunk_pks = task_pks[start:start + chunk_size]
+            # noinspection PyProtectedMember
+            q = (
+                dbsession.query(task_class)
+                .filter(task_class._pk.in_(chunk_pks))
+            )
+            if self._via_index:
+                q = self._filter_query_for_text_contents(q, task_class)
+                if q is None:
+                    return
+            # noinspection PyProtectedMember
+            fetched = {task._pk: task for task in q.all()}
+            tasks = [fetched[pk] for pk in chunk_pks if pk in fetched]
+            if not self._via_index:
+                tasks = self._filter_through_python(tasks)
+            yield tasks
+            for task in fetched.values():
+                dbsession.expunge(task)
+
     def gen_tasks_in_global_order(self) -> Generator[Task, None, None]:
         """
         Generates all tasks, in the global order.
@@ -399,35 +472,148 @@ class TaskCollection(object):
         """
         return self.req.dbsession
 
+    # =========================================================================
+    # Keyset ("seek") pagination via the index
+    # =========================================================================
+
+    @property
+    def supports_index_pagination(self) -> bool:
+        """
+        Can we fetch a single page of tasks directly from the index, via
+        :meth:`index_count` and :meth:`fetch_index_page`?
+
+        Not if we're not using the index, or if the filter has parts that
+        require the tasks themselves to be inspected (text contents), or if
+        the global sort order isn't by creation date.
+        """
+        return (
+            self._via_index and
+            not self._filter.text_contents and
+            self._sort_method_global in (TaskSortMethod.CREATION_DATE_ASC,
+                                         TaskSortMethod.CREATION_DATE_DESC)
+        )
+
+    def index_count(self) -> int:
+        """
+        Returns the number of index entries that match our criteria, via a
+        ``COUNT`` query whose result is cached briefly (see
+        :data:`camcops_server.cc_modules.cc_cache.cache_region_counts`).
+
+        The cache key is the SQL and its parameters, which include our
+        permission restrictions, so users with different permissions don't
+        share counts.
+        """
+        assert self.supports_index_pagination
+        q = self._make_index_query()
+        if q is None:
+            return 0
+        q = q.order_by(None)
+        compiled = q.statement.compile(dialect=self.dbsession.get_bind().dialect)  # noqa
+        key = "task_index_count: {} {!r}".format(
+            compiled, sorted(compiled.params.items()))
+        return cache_region_counts.get_or_create(key, q.count)
+
+    def fetch_index_page(self,
+                         limit: int,
+                         offset: int = 0,
+                         after_index_pk: int = None,
+                         before_index_pk: int = None) -> List[TaskIndexEntry]:
+        """
+        Fetches a single page of index entries, in our global sort order,
+        which (for this purpose) is by ``(when_created_utc, index_entry_pk)``.
+        The PK is a tie-breaker; ``task_pk`` won't do, as it is only unique
+        within a task table.
+
+        If we are given the PK of the index entry just before the page we want
+        (``after_index_pk``) or just after it (``before_index_pk``), we "seek"
+        from that entry, which costs the same regardless of how far through
+        the index we are. Otherwise (or if that entry has gone, e.g. after a
+        reindex), we fall back to ``LIMIT/OFFSET``.
+
+        Args:
+            limit: maximum number of entries to return
+            offset: number of entries to skip, if we can't seek
+            after_index_pk: PK of the entry preceding the page
+            before_index_pk: PK of the entry following the page
+
+        Returns:
+            a list of :class:`camcops_server.cc_modules.cc_taskindex.TaskIndexEntry`
+            objects
+        """  # noqa
+        assert self.supports_index_pagination
+        q = self._make_index_query()
+        if q is None:
+            return []
+        when = TaskIndexEntry.when_created_utc
+        pk = TaskIndexEntry.index_entry_pk
+        descending = (self._sort_method_global ==
+                      TaskSortMethod.CREATION_DATE_DESC)
+        q = q.order_by(None)
+
+        anchor_pk = after_index_pk or before_index_pk
+        anchor = None
+        if anchor_pk is not None:
+            anchor = (
+                self.dbsession.query(when, pk)
+                .filter(pk == anchor_pk)
+                .first()
+            )
+        if anchor is None:
+            if descending:
+                q = q.order_by(when.desc(), pk.desc())
+            else:
+                q = q.order_by(when.asc(), pk.asc())
+            return q.offset(offset).limit(limit).all()
+
+        # Seeking backwards (to the previous page) means walking the index in
+        # the reverse of our display order, then reversing the results.
+        backwards = after_index_pk is None
+        anchor_when, anchor_pk = anchor
+        if descending != backwards:
+            q = (
+                q.filter(or_(when < anchor_when,
+                             and_(when == anchor_when, pk < anchor_pk)))
+                .order_by(when.desc(), pk.desc())
+            )
+        else:
+            q = (
+                q.filter(or_(when > anchor_when,
+                             and_(when == anchor_when, pk > anchor_pk)))
+                .order_by(when.asc(), pk.asc())
+            )
+        indexes = q.limit(limit).all()  # type: List[TaskIndexEntry]
+        if backwards:
+            indexes.reverse()
+        return indexes
+
+    def tasks_for_index_entries(
+            self, indexes: List[TaskIndexEntry]) -> List[Task]:
+        """
+        Returns the tasks for some index entries (e.g. a page from
+        :meth:`fetch_index_page`), in the same order, using one query per task
+        table.
+        """
+        tasks = self._fetch_tasks_for_index_entries(indexes)
+        return [
+            tasks[key] for key in (
+                (index.task_table_name, index.task_pk) for index in indexes
+            )
+            if key in tasks
+        ]
+
     # =========================================================================
     # Internals: fetching Task objects
     # =========================================================================
 
-    def _fetch_all_tasks_without_index(self, parallel: bool = False) -> None:
+    def _fetch_all_tasks_without_index(self) -> None:
         """
         Fetch all tasks from the database.
         """
-
-        # AVOID parallel=True; see notes above.
         if DEBUG_QUERY_TIMING:
             start_time = Pendulum.now()
 
-        if parallel:
-            # Deprecated parallel fetch
-            threads = []  # type: List[FetchThread]
-            for task_class in self._filter.task_classes:
-                thread = FetchThread(self.req, task_class, self)
-                thread.start()
-                threads.append(thread)
-            for thread in threads:
-                thread.join()
-                if thread.error:
-                    raise ValueError("Multithreaded fetch failed")
-
-        else:
-            # Fetch all tasks, classwise.
-            for task_class in self._filter.task_classes:
-                self._fetch_task_class(task_class)
+        # Fetch all tasks, classwise.
+        self._fetch_task_classes(self._filter.task_classes)
 
         if DEBUG_QUERY_TIMING:
             end_time = Pendulum.now()
@@ -445,17 +631,148 @@ class TaskCollection(object):
         """
         Fetch tasks from the database for one task type.
         """
-        if task_class in self._tasks_by_class:
-            return  # already fetched
-        q = self._serial_query(task_class)
-        if q is None:
-            newtasks = []  # type: List[Task]
-        else:
-            newtasks = q.all()  # type: List[Task]
+        self._fetch_task_classes([task_class])
+
+    def _fetch_task_classes(self, task_classes: List[Type[Task]]) -> None:
+        """
+        Fetch tasks from the database for several task types (concurrently,
+        if we are using a parallel fetch), skipping those already fetched.
+        """
+        queries = OrderedDict()  # type: Dict[Type[Task], Tuple[Type[Task], Query]]  # noqa
+        for task_class in task_classes:
+            if task_class in self._tasks_by_class:
+                continue  # already fetched
+            q = self._serial_query(task_class)
+            if q is None:
+                self._tasks_by_class[task_class] = []
+            else:
+                queries[task_class] = (task_class, q)
+        for task_class, newtasks in self._run_task_queries(queries).items():
             # Apply Python-side filters?
             newtasks = self._filter_through_python(newtasks)
             sort_tasks_in_place(newtasks, self._sort_method_by_class)
-        self._tasks_by_class[task_class] = newtasks
+            self._tasks_by_class[task_class] = newtasks
+
+    def _run_task_queries(
+            self, queries: Dict[Any, Tuple[Type[Task], Query]]) \
+            -> Dict[Any, List[Task]]:
+        """
+        Runs some task queries (built using the request's session).
+
+        If we are using a parallel fetch, they are run concurrently, each in
+        its own session, and the results are merged into the request's
+        session; otherwise they are run one by one.
+
+        Args:
+            queries: dictionary mapping an arbitrary key to a tuple of
+                ``task_class, query``
+
+        Returns:
+            a dictionary mapping the same keys to lists of tasks
+        """
+        if not self._parallel_fetch or len(queries) <= 1:
+            return OrderedDict(
+                (key, q.all()) for key, (_, q) in queries.items()
+            )
+
+        # If the request doesn't give us a new session each time (e.g. during
+        # testing), we can't use threads.
+        probe_session = self.req.get_bare_dbsession()
+        if probe_session is self.req.dbsession:
+            log.debug("Parallel fetch unavailable; fetching serially")
+            return OrderedDict(
+                (key, q.all()) for key, (_, q) in queries.items()
+            )
+        probe_session.close()
+
+        n_workers = min(PARALLEL_FETCH_MAX_WORKERS, len(queries))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = OrderedDict(
+                (key, executor.submit(_run_detached_task_query,
+                                      self.req, task_class, q))
+                for key, (task_class, q) in queries.items()
+            )
+            # Merge results in this thread, as they arrive (in order).
+            return OrderedDict(
+                (key, [self._merge_detached_task(task)
+                       for task in future.result()])
+                for key, future in futures.items()
+            )
+
+    def _merge_detached_task(self, task: Task) -> Task:
+        """
+        Merges a detached task, fetched by :func:`_run_detached_task_query`
+        in another session, into the request's session, without going back to
+        the database. The relationships that were loaded eagerly are attached
+        to the merged object (and its patient) as already-loaded values.
+        """
+        dbsession = self.req.dbsession
+        notes = [dbsession.merge(note, load=False)
+                 for note in task.special_notes]
+        merged = dbsession.merge(task, load=False)
+        set_committed_value(merged, "special_notes", notes)
+        if task.has_patient:
+            patient = task.patient
+            if patient is None:
+                merged_patient = None
+            else:
+                idnums = [dbsession.merge(idnum, load=False)
+                          for idnum in patient.idnums]
+                merged_patient = dbsession.merge(patient, load=False)
+                set_committed_value(merged_patient, "idnums", idnums)
+            set_committed_value(merged, "patient", merged_patient)
+        return merged
+
+    def _sorted_task_pks_for_task_class(
+            self, task_class: Type[Task]) -> List[int]:
+        """
+        Returns the PKs of the appropriate tasks of one type, in our per-class
+        sort order, without fetching the tasks themselves. Used by
+        :meth:`gen_task_chunks_for_task_class`.
+
+        (Python-side and text-contents filters are not applied here; they are
+        applied as the tasks are fetched.)
+        """
+        if self._via_index:
+            q = self._make_index_query()
+            if q is None:
+                return []
+            q = (
+                q.filter(TaskIndexEntry.task_table_name ==
+                         task_class.__tablename__)
+                .with_entities(TaskIndexEntry.task_pk)
+                .order_by(None)
+            )
+            when = TaskIndexEntry.when_created_utc
+            added = TaskIndexEntry.when_added_batch_utc
+            if self._sort_method_by_class == TaskSortMethod.CREATION_DATE_ASC:
+                q = q.order_by(when.asc(), added.asc())
+            elif (self._sort_method_by_class ==
+                    TaskSortMethod.CREATION_DATE_DESC):
+                q = q.order_by(when.desc(), added.desc())
+            return [row[0] for row in q.all()]
+
+        q = self._serial_query(task_class)
+        if q is None:
+            return []
+        # noinspection PyProtectedMember
+        rows = q.with_entities(task_class._pk,
+                               task_class.when_created,
+                               task_class._when_added_batch_utc).all()
+
+        def sorter(row: Tuple[int, Optional[Pendulum],
+                              Optional[datetime.datetime]]) \
+                -> Union[Tuple[Pendulum, datetime.datetime], MinType]:
+            # As for task_when_created_sorter.
+            _, created, uploaded = row
+            return MINTYPE_SINGLETON if created is None else (created,
+                                                              uploaded)
+
+        if self._sort_method_by_class == TaskSortMethod.CREATION_DATE_ASC:
+            rows.sort(key=sorter)
+        elif self._sort_method_by_class == TaskSortMethod.CREATION_DATE_DESC:
+            rows.sort(key=sorter, reverse=True)
+        return [row[0] for row in rows]
 
     def _serial_query(self, task_class: Type[Task]) -> Optional[Query]:
         """
@@ -580,10 +897,16 @@ class TaskCollection(object):
             # noinspection PyProtectedMember
             q = q.filter(cls._group_id.in_(permitted_group_ids))
 
+        # Compare against the indexed UTC DATETIME copy of when_created, not
+        # when_created itself (which needs a per-row conversion from text).
         if tf.start_datetime is not None:
-            q = q.filter(cls.when_created >= tf.start_datetime)
+            # noinspection PyProtectedMember
+            q = q.filter(cls._when_created_utc >=
+                         when_created_to_utc_datetime(tf.start_datetime))
         if tf.end_datetime is not None:
-            q = q.filter(cls.when_created < tf.end_datetime)
+            # noinspection PyProtectedMember
+            q = q.filter(cls._when_created_utc <
+                         when_created_to_utc_datetime(tf.end_datetime))
 
         q = self._filter_query_for_text_contents(q, cls)
 
@@ -763,8 +1086,6 @@ class TaskCollection(object):
             return
         assert self._all_indexes is not None
 
-        d = tablename_to_task_class_dict()
-        dbsession = self.req.dbsession
         self._all_tasks = []  # type: List[Task]
 
         # Fetch indexes
@@ -775,32 +1096,57 @@ class TaskCollection(object):
         indexes = self._all_indexes
 
         # Fetch tasks
-        tablenames = set(index.task_table_name for index in indexes)
-        for tablename in tablenames:
-            # We do this by task class, so we can execute a single query per
-            # task type (rather than per task).
+        for task in self._fetch_tasks_for_index_entries(indexes).values():
+            self._tasks_by_class.setdefault(type(task), []).append(task)
+            self._all_tasks.append(task)
+
+        # Sort tasks
+        for tasklist in self._tasks_by_class.values():
+            sort_tasks_in_place(tasklist, self._sort_method_by_class)
+        sort_tasks_in_place(self._all_tasks, self._sort_method_global)
+
+    def _fetch_tasks_for_index_entries(
+            self, indexes: List[TaskIndexEntry]) \
+            -> Dict[Tuple[str, int], Task]:
+        """
+        Fetches the tasks referred to by some index entries, applying our
+        "text contents" filter (which the index can't do).
+
+        We do this by task class, so we execute a single ``IN`` query per task
+        type (rather than one query per task).
+
+        Returns:
+            a dictionary mapping ``(tablename, task_pk)`` to tasks, in the
+            order in which they were fetched
+        """
+        d = tablename_to_task_class_dict()
+        dbsession = self.req.dbsession
+        task_pks_by_tablename = OrderedDict()  # type: Dict[str, List[int]]
+        for index in indexes:
+            task_pks_by_tablename.setdefault(index.task_table_name, []).append(
+                index.task_pk)
+        queries = OrderedDict()  # type: Dict[str, Tuple[Type[Task], Query]]
+        for tablename, task_pks in task_pks_by_tablename.items():
             try:
                 taskclass = d[tablename]
             except KeyError:
                 log.warning("Bad tablename in index: {!r}", tablename)
                 continue
-            tasklist = self._tasks_by_class.setdefault(taskclass, [])
-            task_pks = [i.task_pk for i in indexes if i.tablename == tablename]
             # noinspection PyProtectedMember
             qtask = (
                 dbsession.query(taskclass)
                 .filter(taskclass._pk.in_(task_pks))
             )
             qtask = self._filter_query_for_text_contents(qtask, taskclass)
-            tasks = qtask.all()  # type: List[Task]
-            for task in tasks:
-                tasklist.append(task)
-                self._all_tasks.append(task)
-
-        # Sort tasks
-        for tasklist in self._tasks_by_class.values():
-            sort_tasks_in_place(tasklist, self._sort_method_by_class)
-        sort_tasks_in_place(self._all_tasks, self._sort_method_global)
+            if qtask is None:
+                continue
+            queries[tablename] = (taskclass, qtask)
+        tasks = OrderedDict()  # type: Dict[Tuple[str, int], Task]
+        for tablename, tasklist in self._run_task_queries(queries).items():
+            for task in tasklist:
+                # noinspection PyProtectedMember
+                tasks[(tablename, task._pk)] = task
+        return tasks
 
     def _make_index_query(self) -> Optional[Query]:
         """
@@ -1000,6 +1346,80 @@ class TaskCollection(object):
         return q
 
 
+# =============================================================================
+# A page of tasks, fetched via the index
+# =============================================================================
+
+class TaskIndexPageCollection(object):
+    """
+    List-like view of a :class:`TaskCollection` for pagination (e.g. by
+    :class:`camcops_server.cc_modules.cc_pyramid.CamcopsPage`), which fetches
+    only the index entries for the page requested, and then their tasks.
+
+    Its length comes from a cached ``COUNT``. Slicing uses keyset ("seek")
+    pagination when it's been told the index entry adjoining the page (which
+    :meth:`seek_params_for_page` puts in the URLs to neighbouring pages).
+    """
+    def __init__(self,
+                 collection: TaskCollection,
+                 after_index_pk: int = None,
+                 before_index_pk: int = None) -> None:
+        """
+        Args:
+            collection:
+                the :class:`TaskCollection`, which must support index
+                pagination
+            after_index_pk:
+                PK of the index entry just before the page we'll be asked for
+            before_index_pk:
+                PK of the index entry just after the page we'll be asked for
+        """
+        assert collection.supports_index_pagination
+        self.collection = collection
+        self.after_index_pk = after_index_pk
+        self.before_index_pk = before_index_pk
+        self._start = None  # type: Optional[int]
+        self._limit = None  # type: Optional[int]
+        self._indexes = []  # type: List[TaskIndexEntry]
+
+    def __len__(self) -> int:
+        return self.collection.index_count()
+
+    def __getitem__(self, cut: slice) -> List[Task]:
+        """
+        Returns the tasks for a range of the index.
+        """
+        assert isinstance(cut, slice) and cut.step is None
+        self._start = cut.start or 0
+        self._limit = cut.stop - self._start
+        self._indexes = self.collection.fetch_index_page(
+            limit=self._limit,
+            offset=self._start,
+            after_index_pk=self.after_index_pk,
+            before_index_pk=self.before_index_pk,
+        )
+        return self.collection.tasks_for_index_entries(self._indexes)
+
+    def seek_params_for_page(self, page: int) -> Dict[str, str]:
+        """
+        Returns URL parameters allowing the page numbered ``page`` (from 1) to
+        be fetched by seeking, if it adjoins the page we fetched; otherwise,
+        an empty dictionary.
+        """
+        if not self._indexes:
+            return {}
+        start = (page - 1) * self._limit
+        if start == self._start + self._limit:
+            return {
+                ViewParam.AFTER_INDEX_PK: str(self._indexes[-1].index_entry_pk)
+            }
+        if start == self._start - self._limit:
+            return {
+                ViewParam.BEFORE_INDEX_PK: str(self._indexes[0].index_entry_pk)
+            }
+        return {}
+
+
 # noinspection PyProtectedMember
 def encode_task_collection(coll: TaskCollection) -> Dict:
     """
@@ -1013,6 +1433,7 @@ def encode_task_collection(coll: TaskCollection) -> Dict:
         "as_dump": coll._as_dump,
         "sort_method_by_class": dumps(coll._sort_method_by_class,
                                       serializer="json"),
+        "parallel_fetch": coll._parallel_fetch,
     }
 
 
@@ -1029,6 +1450,7 @@ def decode_task_collection(d: Dict, cls: Type) -> TaskCollection:
         "as_dump": d["as_dump"],
         "sort_method_by_class": loads(
             *reorder_args(*d["sort_method_by_class"])),
+        "parallel_fetch": d.get("parallel_fetch", False),
     }
     return TaskCollection(req=None, **kwargs)
 
@@ -1079,3 +1501,156 @@ class TaskCollectionTests(DemoDatabaseTestCase):
                          ['task1', 'task2', 'task3'])
         self.assertEqual(new_coll._filter.group_ids,
                          [1, 2, 3])
+
+
+class TaskCollectionIndexPaginationTests(DemoDatabaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        TaskIndexEntry.rebuild_entire_task_index(
+            self.dbsession, indexed_at_utc=Pendulum.utcnow())
+        self.dbsession.commit()
+
+    def _make_collection(self) -> TaskCollection:
+        return TaskCollection(
+            self.req,
+            taskfilter=TaskFilter(),
+            sort_method_global=TaskSortMethod.CREATION_DATE_DESC,
+        )
+
+    def test_seek_matches_offset(self) -> None:
+        coll = self._make_collection()
+        self.assertTrue(coll.supports_index_pagination)
+        n = coll.index_count()
+        self.assertEqual(n, self.dbsession.query(TaskIndexEntry).count())
+        self.assertGreater(n, 6)
+        page_size = 3
+        all_pks = [i.index_entry_pk
+                   for i in coll.fetch_index_page(limit=n)]
+        self.assertEqual(len(all_pks), n)
+
+        # Forwards, seeking from the last entry of each page:
+        seek_pks = []  # type: List[int]
+        after_pk = None
+        while True:
+            page = coll.fetch_index_page(limit=page_size,
+                                         after_index_pk=after_pk)
+            if not page:
+                break
+            seek_pks += [i.index_entry_pk for i in page]
+            after_pk = page[-1].index_entry_pk
+        self.assertEqual(seek_pks, all_pks)
+
+        # Backwards from the last page:
+        page = coll.fetch_index_page(limit=page_size,
+                                     before_index_pk=all_pks[-1])
+        self.assertEqual([i.index_entry_pk for i in page],
+                         all_pks[-1 - page_size:-1])
+
+    def test_page_collection(self) -> None:
+        coll = self._make_collection()
+        pagecoll = TaskIndexPageCollection(coll)
+        tasks = pagecoll[2:4]
+        indexes = coll.fetch_index_page(limit=2, offset=2)
+        # noinspection PyProtectedMember
+        self.assertEqual(
+            [(t.tablename, t._pk) for t in tasks],
+            [(i.task_table_name, i.task_pk) for i in indexes])
+        self.assertEqual(
+            pagecoll.seek_params_for_page(3),
+            {ViewParam.AFTER_INDEX_PK: str(indexes[-1].index_entry_pk)})
+        self.assertEqual(
+            pagecoll.seek_params_for_page(1),
+            {ViewParam.BEFORE_INDEX_PK: str(indexes[0].index_entry_pk)})
+        self.assertEqual(pagecoll.seek_params_for_page(4), {})
+
+
+class TaskCollectionChunkedFetchTests(DemoDatabaseTestCase):
+    def test_chunks_match_tasks_for_task_class(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        TaskIndexEntry.rebuild_entire_task_index(
+            self.dbsession, indexed_at_utc=Pendulum.utcnow())
+        self.dbsession.commit()
+
+        def make_collection(via_index: bool) -> TaskCollection:
+            return TaskCollection(
+                self.req,
+                taskfilter=TaskFilter(),
+                sort_method_by_class=TaskSortMethod.CREATION_DATE_DESC,
+                via_index=via_index,
+            )
+
+        for via_index in (False, True):
+            expected = [
+                t.get_pk()
+                for t in make_collection(via_index).tasks_for_task_class(Phq9)
+            ]
+            self.assertGreater(len(expected), 1)
+            chunks = list(make_collection(
+                via_index).gen_task_chunks_for_task_class(Phq9, chunk_size=1))
+            self.assertEqual(len(chunks), len(expected))
+            # (The demo tasks share a creation time, so compare as sets.)
+            self.assertEqual(
+                sorted(t.get_pk() for chunk in chunks for t in chunk),
+                sorted(expected))
+            # Once the generator is exhausted, everything has been expunged:
+            self.assertTrue(all(t not in self.dbsession
+                                for chunk in chunks for t in chunk))
+
+
+class TaskCollectionParallelFetchTests(DemoDatabaseTestCase):
+    def test_parallel_fetch_matches_serial(self) -> None:
+        def get_task_keys(parallel_fetch: bool) -> List[Tuple[str, int]]:
+            coll = TaskCollection(
+                self.req,
+                taskfilter=TaskFilter(),
+                sort_method_global=TaskSortMethod.CREATION_DATE_ASC,
+                via_index=False,
+                parallel_fetch=parallel_fetch,
+            )
+            return [(t.tablename, t.get_pk()) for t in coll.all_tasks]
+
+        serial_keys = get_task_keys(False)
+        self.assertTrue(serial_keys)
+        self.dbsession.expunge_all()
+
+        # The test request always returns its own session; give the worker
+        # threads sessions of their own, on our (file-based) database.
+        def make_session() -> SqlASession:
+            return sessionmaker(bind=self.engine)()
+
+        with mock.patch.object(self.req, "get_bare_dbsession",
+                               side_effect=make_session), \
+                mock.patch(__name__ + "._run_detached_task_query",
+                           wraps=_run_detached_task_query) as mock_run, \
+                mock.patch.object(TaskCollection, "_merge_detached_task",
+                                  autospec=True,
+                                  side_effect=TaskCollection._merge_detached_task) as mock_merge:  # noqa
+            parallel_keys = get_task_keys(True)
+
+        self.assertGreater(mock_run.call_count, 1)
+        self.assertGreaterEqual(mock_merge.call_count, len(serial_keys))
+        self.assertEqual(parallel_keys, serial_keys)
+
+    def test_merge_detached_task(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        coll = TaskCollection(self.req, taskfilter=TaskFilter(),
+                              via_index=False, parallel_fetch=True)
+        # noinspection PyUnresolvedReferences
+        tasks = (
+            self.dbsession.query(Phq9)
+            .options(selectinload(Phq9.special_notes),
+                     selectinload(Phq9.patient).subqueryload(Patient.idnums))
+            .all()
+        )  # type: List[Phq9]
+        self.assertTrue(tasks)
+        self.dbsession.expunge_all()
+
+        for task in tasks:
+            merged = coll._merge_detached_task(task)
+            self.assertIn(merged, self.dbsession)
+            self.assertEqual(merged.get_pk(), task.get_pk())
+            self.assertEqual(merged.special_notes, [])
+            self.assertIn(merged.patient, self.dbsession)
+            self.assertEqual(
+                [i.idnum_value for i in merged.patient.idnums],
+                [i.idnum_value for i in task.patient.idnums])
@@ -33,7 +33,9 @@ it caches ``is_complete()`` information).
 """
 
 import logging
-from typing import List, Optional, Type, TYPE_CHECKING
+from multiprocessing import Pool
+import time
+from typing import Any, Dict, List, Optional, Tuple, Type, TYPE_CHECKING
 
 from cardinal_pythonlib.logs import BraceStyleAdapter
 from cardinal_pythonlib.reprfunc import simple_repr
@@ -60,7 +62,6 @@ from camcops_server.cc_modules.cc_patient import Patient
 from camcops_server.cc_modules.cc_patientidnum import PatientIdNum
 from camcops_server.cc_modules.cc_sqla_coltypes import (
     EraColType,
-    isotzdatetime_to_utcdatetime,
     PendulumDateTimeAsIsoTextColType,
     TableNameColType,
 )
@@ -70,6 +71,11 @@ from camcops_server.cc_modules.cc_task import (
     tablename_to_task_class_dict,
     Task,
 )
+from camcops_server.cc_modules.cc_tasksummary import (
+    ancillary_tablename_to_parents,
+    TaskSummaryEntry,
+)
+from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
 from camcops_server.cc_modules.cc_user import User
 
 if TYPE_CHECKING:
@@ -77,6 +83,8 @@ if TYPE_CHECKING:
 
 log = BraceStyleAdapter(logging.getLogger(__name__))
 
+DEFAULT_REINDEX_CHUNK_SIZE = 1000  # tasks read/inserted per statement
+
 
 # =============================================================================
 # Helper functions
@@ -229,6 +237,7 @@ class PatientIdNumIndexEntry(Base):
             indexed_at_utc: current time in UTC
         """
         log.info("Rebuilding patient ID number index")
+        start = time.monotonic()
         # noinspection PyUnresolvedReferences
         indextable = PatientIdNumIndexEntry.__table__  # type: Table
         indexcols = indextable.columns
@@ -280,6 +289,8 @@ class PatientIdNumIndexEntry(Base):
                 )
             )
         )
+        log.info("Rebuilt patient ID number index in {:.1f} s",
+                 time.monotonic() - start)
 
     # -------------------------------------------------------------------------
     # Check index
@@ -647,6 +658,38 @@ class TaskIndexEntry(Base):
     # Create
     # -------------------------------------------------------------------------
 
+    @classmethod
+    def make_index_row(cls, task: Task,
+                       indexed_at_utc: Pendulum) -> Dict[str, Any]:
+        """
+        Returns the column values of the index entry for the specified
+        :class:`camcops_server.cc_modules.cc_task.Task`, as a dictionary
+        suitable for a (multi-row) SQLAlchemy Core ``INSERT``.
+
+        Args:
+            task:
+                a :class:`camcops_server.cc_modules.cc_task.Task`
+            indexed_at_utc:
+                current time in UTC
+        """
+        assert indexed_at_utc is not None, "Missing indexed_at_utc"
+        patient = task.patient
+        # noinspection PyProtectedMember
+        return dict(
+            indexed_at_utc=indexed_at_utc,
+            task_table_name=task.tablename,
+            task_pk=task.get_pk(),
+            patient_pk=patient.get_pk() if patient else None,
+            device_id=task.get_device_id(),
+            era=task.get_era(),
+            when_created_utc=task.get_creation_datetime_utc(),
+            when_created_iso=task.when_created,
+            when_added_batch_utc=task._when_added_batch_utc,
+            adding_user_id=task.get_adding_user_id(),
+            group_id=task.get_group_id(),
+            task_is_complete=task.is_complete(),
+        )
+
     @classmethod
     def make_from_task(cls, task: Task,
                        indexed_at_utc: Pendulum) -> "TaskIndexEntry":
@@ -661,29 +704,7 @@ class TaskIndexEntry(Base):
             indexed_at_utc:
                 current time in UTC
         """
-        assert indexed_at_utc is not None, "Missing indexed_at_utc"
-
-        index = cls()
-
-        index.indexed_at_utc = indexed_at_utc
-
-        index.task_table_name = task.tablename
-        index.task_pk = task.get_pk()
-
-        patient = task.patient
-        index.patient_pk = patient.get_pk() if patient else None
-
-        index.device_id = task.get_device_id()
-        index.era = task.get_era()
-        index.when_created_utc = task.get_creation_datetime_utc()
-        index.when_created_iso = task.when_created
-        # noinspection PyProtectedMember
-        index.when_added_batch_utc = task._when_added_batch_utc
-        index.adding_user_id = task.get_adding_user_id()
-        index.group_id = task.get_group_id()
-        index.task_is_complete = task.is_complete()
-
-        return index
+        return cls(**cls.make_index_row(task, indexed_at_utc=indexed_at_utc))
 
     @classmethod
     def index_task(cls, task: Task, session: SqlASession,
@@ -731,13 +752,22 @@ class TaskIndexEntry(Base):
     # -------------------------------------------------------------------------
 
     @classmethod
-    def rebuild_index_for_task_type(cls, session: SqlASession,
-                                    taskclass: Type[Task],
-                                    indexed_at_utc: Pendulum,
-                                    delete_first: bool = True) -> None:
+    def rebuild_index_for_task_type(
+            cls, session: SqlASession,
+            taskclass: Type[Task],
+            indexed_at_utc: Pendulum,
+            delete_first: bool = True,
+            chunk_size: int = DEFAULT_REINDEX_CHUNK_SIZE) -> int:
         """
         Rebuilds the index for a particular task type.
 
+        Tasks are read in chunks of ``chunk_size`` (by server PK), and the
+        index entries for each chunk are written with a single multi-row
+        ``INSERT`` via SQLAlchemy Core, rather than via the ORM one object at
+        a time. We still need whole task objects (not just the columns that
+        are copied into the index), because ``is_complete()`` is arbitrary
+        task code.
+
         Args:
             session: an SQLAlchemy Session
             taskclass: a subclass of
@@ -746,33 +776,62 @@ class TaskIndexEntry(Base):
             delete_first: delete old index entries first? Should always be True
                 unless called as part of a master rebuild that deletes
                 everything first.
+            chunk_size: number of tasks to read and index per query
+
+        Returns:
+            the number of index entries created
         """
         # noinspection PyUnresolvedReferences
         idxtable = cls.__table__  # type: Table
         idxcols = idxtable.columns
         tasktablename = taskclass.tablename
         log.info("Rebuilding task index for {}", tasktablename)
+        start = time.monotonic()
         # Delete all entries for this task
         if delete_first:
             session.execute(
                 idxtable.delete()
-                .where(idxcols.table_name == tasktablename)
+                .where(idxcols.task_table_name == tasktablename)
             )
         # Create new entries
-        # noinspection PyPep8,PyUnresolvedReferences,PyProtectedMember
-        q = (
-            session.query(taskclass)
-            .filter(taskclass._current == True)  # noqa: E712
-            .order_by(isotzdatetime_to_utcdatetime(taskclass.when_created))
-        )
-        for task in q:
-            cls.index_task(task, session, indexed_at_utc)
+        n_indexed = 0
+        last_pk = None  # type: Optional[int]
+        while True:
+            # noinspection PyPep8,PyUnresolvedReferences,PyProtectedMember
+            q = (
+                session.query(taskclass)
+                .filter(taskclass._current == True)  # noqa: E712
+            )
+            if last_pk is not None:
+                # noinspection PyProtectedMember
+                q = q.filter(taskclass._pk > last_pk)
+            # noinspection PyProtectedMember
+            tasks = q.order_by(taskclass._pk).limit(chunk_size).all()
+            if not tasks:
+                break
+            rows = [cls.make_index_row(task, indexed_at_utc=indexed_at_utc)
+                    for task in tasks]
+            session.execute(idxtable.insert(), rows)
+            n_indexed += len(rows)
+            last_pk = tasks[-1].get_pk()
+            log.debug("... {}: {} index entries so far",
+                      tasktablename, n_indexed)
+            if len(tasks) < chunk_size:
+                break
+        elapsed = time.monotonic() - start
+        log.info("Indexed {} {} task(s) in {:.1f} s ({:.0f} per second)",
+                 n_indexed, tasktablename, elapsed,
+                 n_indexed / elapsed if elapsed > 0 else 0)
+        return n_indexed
 
     @classmethod
     def rebuild_entire_task_index(
             cls, session: SqlASession,
             indexed_at_utc: Pendulum,
-            skip_tasks_with_missing_tables: bool = False) -> None:
+            skip_tasks_with_missing_tables: bool = False,
+            nprocesses: int = 1,
+            chunk_size: int = DEFAULT_REINDEX_CHUNK_SIZE,
+            config_filename: str = None) -> None:
         """
         Rebuilds the entire index.
 
@@ -783,10 +842,22 @@ class TaskIndexEntry(Base):
                 tables are not in the database? (This is so we can rebuild an
                 index from a database upgrade, but not crash because newer
                 tasks haven't had their tables created yet.)
+            nprocesses: number of worker processes across which to split the
+                task tables. If this is more than 1, each worker uses its own
+                database connection and commits its own work, so the deletion
+                of the old index is committed via ``session`` first. Ignored
+                (treated as 1) for SQLite, whose databases may not be shared
+                across connections.
+            chunk_size: number of tasks to read and index per query
+            config_filename: CamCOPS config file from which worker processes
+                (see ``nprocesses``) set up their database connections; by
+                default, the one named by our environment
         """
         log.info("Rebuilding entire task index")
+        start = time.monotonic()
         # noinspection PyUnresolvedReferences
         idxtable = cls.__table__  # type: Table
+        engine = get_engine_from_session(session)
 
         # Delete all entries
         with if_sqlserver_disable_constraints_triggers(session,
@@ -796,15 +867,47 @@ class TaskIndexEntry(Base):
             )
 
         # Now rebuild:
+        taskclasses = []  # type: List[Type[Task]]
         for taskclass in Task.all_subclasses_by_tablename():
             if skip_tasks_with_missing_tables:
                 basetable = taskclass.tablename
-                engine = get_engine_from_session(session)
                 if not table_exists(engine, basetable):
                     continue
-            cls.rebuild_index_for_task_type(session, taskclass,
-                                            indexed_at_utc,
-                                            delete_first=False)
+            taskclasses.append(taskclass)
+
+        if nprocesses > 1 and engine.dialect.name == "sqlite":
+            log.warning("Parallel reindexing unsupported for SQLite; "
+                        "using a single process")
+            nprocesses = 1
+
+        if nprocesses <= 1:
+            n_indexed = 0
+            for taskclass in taskclasses:
+                n_indexed += cls.rebuild_index_for_task_type(
+                    session, taskclass, indexed_at_utc,
+                    delete_first=False, chunk_size=chunk_size)
+        else:
+            session.commit()  # workers can't see uncommitted deletions
+            if not config_filename:
+                from camcops_server.cc_modules.cc_config import get_config_filename_from_os_env  # delayed import  # noqa
+                config_filename = get_config_filename_from_os_env()
+            # Interleave tables across workers, for rough load balancing.
+            jobs = [
+                (config_filename,
+                 [tc.tablename for tc in taskclasses[i::nprocesses]],
+                 indexed_at_utc,
+                 chunk_size)
+                for i in range(nprocesses)
+            ]
+            with Pool(processes=nprocesses) as pool:
+                results = pool.starmap(_rebuild_task_index_worker, jobs)
+            n_indexed = sum(n for result in results for _, n in result)
+
+        elapsed = time.monotonic() - start
+        log.info("Rebuilt entire task index: {} entries from {} table(s) "
+                 "in {:.1f} s ({:.0f} per second)",
+                 n_indexed, len(taskclasses), elapsed,
+                 n_indexed / elapsed if elapsed > 0 else 0)
 
     # -------------------------------------------------------------------------
     # Update index at the point of upload from a device
@@ -936,8 +1039,50 @@ class TaskIndexEntry(Base):
 # Wide-ranging index update functions
 # =============================================================================
 
+def _rebuild_task_index_worker(
+        config_filename: str,
+        tablenames: List[str],
+        indexed_at_utc: Pendulum,
+        chunk_size: int) -> List[Tuple[str, int]]:
+    """
+    Worker process function for
+    :meth:`TaskIndexEntry.rebuild_entire_task_index`. Connects to the database
+    afresh, as configured by the specified CamCOPS config file, rebuilds the
+    index for the specified task tables (whose old entries must already have
+    been deleted), and commits.
+
+    Returns:
+        a list of ``(tablename, n_indexed)`` tuples
+    """
+    # Ensure all tasks are registered (a spawned process starts from scratch).
+    import camcops_server.cc_modules.cc_all_models  # noqa: F401
+    from camcops_server.cc_modules.cc_config import CamcopsConfig  # delayed import  # noqa
+    # A new config object (not the cached one, whose engine a forked process
+    # would share with its parent):
+    cfg = CamcopsConfig(config_filename)
+    session = cfg.get_dbsession_raw()
+    d = tablename_to_task_class_dict()
+    results = []  # type: List[Tuple[str, int]]
+    try:
+        for tablename in tablenames:
+            n = TaskIndexEntry.rebuild_index_for_task_type(
+                session, d[tablename], indexed_at_utc,
+                delete_first=False, chunk_size=chunk_size)
+            session.commit()
+            results.append((tablename, n))
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+        cfg.get_sqla_engine().dispose()
+    return results
+
+
 def reindex_everything(session: SqlASession,
-                       skip_tasks_with_missing_tables: bool = False) -> None:
+                       skip_tasks_with_missing_tables: bool = False,
+                       nprocesses: int = 1,
+                       config_filename: str = None) -> None:
     """
     Deletes from and rebuilds all server index tables.
 
@@ -947,20 +1092,26 @@ def reindex_everything(session: SqlASession,
             tables are not in the database? (This is so we can rebuild an index
             from a database upgrade, but not crash because newer tasks haven't
             had their tables created yet.)
+        nprocesses: number of processes to use for the task index; see
+            :meth:`TaskIndexEntry.rebuild_entire_task_index`
+        config_filename: CamCOPS config file for those processes; see
+            :meth:`TaskIndexEntry.rebuild_entire_task_index`
     """
     now = Pendulum.utcnow()
     log.info("Reindexing database; indexed_at_utc = {}", now)
     PatientIdNumIndexEntry.rebuild_idnum_index(session, now)
     TaskIndexEntry.rebuild_entire_task_index(
         session, now,
-        skip_tasks_with_missing_tables=skip_tasks_with_missing_tables)
+        skip_tasks_with_missing_tables=skip_tasks_with_missing_tables,
+        nprocesses=nprocesses,
+        config_filename=config_filename)
 
 
 def update_indexes_and_push_exports(req: "CamcopsRequest",
                                     batchdetails: BatchDetails,
                                     tablechanges: UploadTableChanges) -> None:
     """
-    Update server indexes, if required.
+    Update server indexes (and stored task summaries), if required.
 
     Also triggers background jobs to export "new arrivals", if required.
 
@@ -972,13 +1123,26 @@ def update_indexes_and_push_exports(req: "CamcopsRequest",
             object describing the changes to a table
     """  # noqa
     tablename = tablechanges.tablename
-    if tablename == PatientIdNum.__tablename__:
+    if tablename == Patient.__tablename__:
+        # Stored task summaries may depend on patient details
+        TaskSummaryEntry.update_summaries_for_patient_upload(
+            session=req.dbsession,
+            tablechanges=tablechanges,
+        )
+    elif tablename == PatientIdNum.__tablename__:
         # Update idnum index
         PatientIdNumIndexEntry.update_idnum_index_for_upload(
             session=req.dbsession,
             indexed_at_utc=batchdetails.batchtime,
             tablechanges=tablechanges,
         )
+    elif tablename in ancillary_tablename_to_parents():
+        # Stored task summaries may depend on ancillary records
+        TaskSummaryEntry.update_summaries_for_ancillary_upload(
+            req=req,
+            tablechanges=tablechanges,
+            summarized_at_utc=batchdetails.batchtime
+        )
     elif tablename in all_task_tablenames():
         # Update task index
         TaskIndexEntry.update_task_index_for_upload(
@@ -986,6 +1150,12 @@ def update_indexes_and_push_exports(req: "CamcopsRequest",
             tablechanges=tablechanges,
             indexed_at_utc=batchdetails.batchtime
         )
+        # Update stored summaries
+        TaskSummaryEntry.update_summaries_for_upload(
+            req=req,
+            tablechanges=tablechanges,
+            summarized_at_utc=batchdetails.batchtime
+        )
         # Push exports
         recipients = req.all_push_recipients
         uploading_group_id = req.user.upload_group_id
@@ -1024,3 +1194,39 @@ def check_indexes(session: SqlASession, show_all_bad: bool = False) -> bool:
     else:
         log.error("Task index is bad")
     return p_ok and t_ok
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class TaskIndexRebuildTests(DemoDatabaseTestCase):
+    """
+    Unit tests.
+    """
+    @staticmethod
+    def _index_key(index: TaskIndexEntry) -> Tuple:
+        return (index.task_table_name, index.task_pk, index.patient_pk,
+                index.device_id, index.era, index.when_created_utc,
+                index.group_id, index.task_is_complete)
+
+    def test_chunked_rebuild_matches_per_task_index(self) -> None:
+        now = Pendulum.utcnow()
+        expected = set()
+        for taskclass in Task.all_subclasses_by_tablename():
+            # noinspection PyProtectedMember
+            q = self.dbsession.query(taskclass).filter(
+                taskclass._current == True)  # noqa: E712
+            for task in q:
+                expected.add(self._index_key(
+                    TaskIndexEntry.make_from_task(task, now)))
+        self.assertGreater(len(expected), 0)
+
+        # A small chunk size exercises the keyset chunking.
+        TaskIndexEntry.rebuild_entire_task_index(self.dbsession, now,
+                                                 chunk_size=2)
+        self.dbsession.flush()
+        actual = [self._index_key(index)
+                  for index in self.dbsession.query(TaskIndexEntry)]
+        self.assertEqual(len(actual), len(expected))
+        self.assertEqual(set(actual), expected)
@@ -36,9 +36,6 @@ from cardinal_pythonlib.sqlalchemy.orm_query import get_rows_fieldnames_from_que
 from cardinal_pythonlib.sqlalchemy.sqlfunc import extract_month, extract_year
 from sqlalchemy.sql.expression import and_, desc, func, literal, select
 
-from camcops_server.cc_modules.cc_sqla_coltypes import (
-    isotzdatetime_to_utcdatetime,
-)
 from camcops_server.cc_modules.cc_forms import (
     ReportParamSchema,
     ViaIndexSelector,
@@ -131,10 +128,8 @@ class TaskCountReport(Report):
                         # func.year() is specific to some DBs, e.g. MySQL
                         # so is func.extract();
                         # http://modern-sql.com/feature/extract
-                        extract_year(isotzdatetime_to_utcdatetime(
-                            cls.when_created)).label("year"),
-                        extract_month(isotzdatetime_to_utcdatetime(
-                            cls.when_created)).label("month"),
+                        extract_year(cls._when_created_utc).label("year"),
+                        extract_month(cls._when_created_utc).label("month"),
                         literal(cls.__tablename__).label("task"),
                         func.count().label("num_tasks_added"),
                     ])
@@ -225,10 +220,8 @@ class TaskCountByUserReport(Report):
                         # func.year() is specific to some DBs, e.g. MySQL
                         # so is func.extract();
                         # http://modern-sql.com/feature/extract
-                        extract_year(isotzdatetime_to_utcdatetime(
-                            cls.when_created)).label("year"),
-                        extract_month(isotzdatetime_to_utcdatetime(
-                            cls.when_created)).label("month"),
+                        extract_year(cls._when_created_utc).label("year"),
+                        extract_month(cls._when_created_utc).label("month"),
                         User.username.label("adding_user_name"),
                         func.count().label("num_tasks_added"),
                     ])
@@ -0,0 +1,778 @@
+#!/usr/bin/env python
+
+"""
+camcops_server/cc_modules/cc_tasksummary.py
+
+===============================================================================
+
+    Copyright (C) 2012-2020 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CamCOPS.
+
+    CamCOPS is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CamCOPS is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CamCOPS. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Server-side store of task summary values.**
+
+- Tasks calculate summary information (e.g. total scores) in Python; see
+  :meth:`camcops_server.cc_modules.cc_task.Task.get_summaries`. Dumps and
+  reports need those values for every task, every time.
+
+- So, like the task index (:mod:`camcops_server.cc_modules.cc_taskindex`), we
+  calculate them when a task arrives, and store them, one row per current
+  task, keyed by ``(task table name, server PK)``. The values are held as a
+  JSON object, which keeps their types (integer, float, Boolean, null).
+
+- Text values are not stored. Many are built in the language of the request
+  that calculates them (e.g. severity categories), and a later reader may
+  want another language. An entry records whether any values were left out.
+
+- Summaries may also depend on the task's patient (e.g. sex, or age from date
+  of birth), so a patient's entries are deleted when the patient's details
+  change (see :meth:`TaskSummaryEntry.delete_summaries_for_patients`).
+
+- Likewise, summaries may depend on the task's ancillary records (e.g. trials,
+  for ``kirby_mcq``), so an upload changing those recalculates the parent
+  task's entry (see
+  :meth:`TaskSummaryEntry.update_summaries_for_ancillary_upload`).
+
+- Readers load stored values in bulk, with :func:`preload_stored_summaries`;
+  :meth:`camcops_server.cc_modules.cc_task.Task.get_summary_values` then uses
+  them rather than running scoring code. Tasks without a complete stored entry
+  (e.g. uploaded before the store existed, or with text summaries) are scored
+  as before. Readers wanting a single number (e.g. reports) can use an
+  incomplete entry, via :meth:`TaskSummaryEntry.fetch_summaries`.
+
+- If you, as a developer, change how a task calculates its summaries, the
+  stored values need recalculating: run ``camcops_server rebuild_summaries``.
+
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import time
+from typing import (Any, Dict, Iterable, List, Optional, Set, Tuple, Type,
+                    TYPE_CHECKING)
+from unittest import mock
+
+from cardinal_pythonlib.lists import chunks
+from cardinal_pythonlib.logs import BraceStyleAdapter
+from cardinal_pythonlib.reprfunc import simple_repr
+from cardinal_pythonlib.sqlalchemy.schema import table_exists
+from cardinal_pythonlib.sqlalchemy.session import get_engine_from_session
+from pendulum import DateTime as Pendulum
+from semantic_version import Version
+from sqlalchemy.orm import Session as SqlASession
+from sqlalchemy.sql.expression import and_, or_, select
+from sqlalchemy.sql.schema import Column, Table
+from sqlalchemy.sql.sqltypes import Boolean, DateTime, Integer, UnicodeText
+
+from camcops_server.cc_modules.cc_cache import cache_region_static, fkg
+from camcops_server.cc_modules.cc_client_api_core import (
+    fail_user_error,
+    UploadTableChanges,
+)
+from camcops_server.cc_modules.cc_patient import Patient
+from camcops_server.cc_modules.cc_sqla_coltypes import (
+    gen_ancillary_relationships,
+    RelationshipInfo,
+    SummaryCategoryColType,
+    TableNameColType,
+)
+from camcops_server.cc_modules.cc_sqlalchemy import Base
+from camcops_server.cc_modules.cc_summaryelement import SummaryElement
+from camcops_server.cc_modules.cc_task import (
+    tablename_to_task_class_dict,
+    Task,
+)
+from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
+
+if TYPE_CHECKING:
+    from camcops_server.cc_modules.cc_db import GenericTabletRecordMixin
+    from camcops_server.cc_modules.cc_request import CamcopsRequest
+
+log = BraceStyleAdapter(logging.getLogger(__name__))
+
+DEFAULT_SUMMARY_CHUNK_SIZE = 1000  # tasks read/inserted per statement
+PATIENT_CHUNK_SIZE = 100  # patients per statement, when deleting summaries
+PARENT_CHUNK_SIZE = 100  # tasks per statement, when finding ancillaries' tasks
+
+
+# =============================================================================
+# Ancillary tables
+# =============================================================================
+
+@cache_region_static.cache_on_arguments(function_key_generator=fkg)
+def ancillary_tablename_to_parents() -> Dict[
+        str, List[Tuple[Type[Task], Type["GenericTabletRecordMixin"], str]]]:
+    """
+    Returns a mapping from ancillary table names to ``taskclass,
+    ancillary_class, fk_attr_name`` tuples, where ``fk_attr_name`` is the name
+    of the ancillary attribute referring to the task's ``id``.
+    """
+    d = {}  # type: Dict[str, List[Tuple[Type[Task], Type["GenericTabletRecordMixin"], str]]]  # noqa
+    for taskclass in Task.all_subclasses_by_tablename():
+        for _, rel_prop, rel_cls in gen_ancillary_relationships(taskclass):
+            fk_attr_name = rel_prop.info[
+                RelationshipInfo.ANCILLARY_FK_TO_PARENT]
+            d.setdefault(rel_cls.__tablename__, []).append(
+                (taskclass, rel_cls, fk_attr_name))
+    return d
+
+
+# =============================================================================
+# Encoding summary values
+# =============================================================================
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, Version):
+        return str(value)
+    raise TypeError(f"Can't store summary value {value!r} of type "
+                    f"{type(value).__name__}")
+
+
+def encode_summary_values(values: Dict[str, Any]) -> str:
+    """
+    Encodes summary values (name to value) as JSON.
+
+    Raises:
+        :exc:`TypeError` for values that JSON can't represent (other than
+        semantic versions, which are stored as strings)
+    """
+    return json.dumps(values, default=_json_default)
+
+
+def decode_summary_values(json_str: str) -> Dict[str, Any]:
+    """
+    Reverses :func:`encode_summary_values`, keeping the order of values.
+    """
+    return json.loads(json_str, object_pairs_hook=OrderedDict)
+
+
+def storable_summary_values(values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns those summary values that we store: all but text, which may be
+    language-dependent.
+    """
+    return OrderedDict(
+        (name, value) for name, value in values.items()
+        if not isinstance(value, str)
+    )
+
+
+# =============================================================================
+# TaskSummaryEntry
+# =============================================================================
+
+class TaskSummaryEntry(Base):
+    """
+    Stored summary values for a current
+    :class:`camcops_server.cc_modules.cc_task.Task`.
+    """
+    __tablename__ = "_task_summaries"
+
+    task_table_name = Column(
+        "task_table_name", TableNameColType,
+        primary_key=True,
+        comment="Table name of the task's base table"
+    )
+    task_pk = Column(
+        "task_pk", Integer,
+        primary_key=True, autoincrement=False,
+        comment="Server primary key of the task"
+    )
+    summarized_at_utc = Column(
+        "summarized_at_utc", DateTime, nullable=False,
+        comment="When these summaries were calculated"
+    )
+    summaries = Column(
+        "summaries", UnicodeText, nullable=False,
+        comment="Summary values, as a JSON object mapping summary names to "
+                "values"
+    )
+    has_all_values = Column(
+        "has_all_values", Boolean, nullable=False,
+        comment="Are all the task's summary values stored? (Text values, "
+                "which may be language-dependent, are not.)"
+    )
+
+    def __repr__(self) -> str:
+        return simple_repr(self, [
+            "task_table_name", "task_pk", "summarized_at_utc", "summaries",
+            "has_all_values",
+        ])
+
+    # -------------------------------------------------------------------------
+    # Create
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def make_summary_row(cls, req: "CamcopsRequest", task: Task,
+                         summarized_at_utc: Pendulum) \
+            -> Optional[Dict[str, Any]]:
+        """
+        Returns the column values of the summary entry for a task, as a
+        dictionary suitable for a (multi-row) SQLAlchemy Core ``INSERT``, or
+        ``None`` if its summaries can't be calculated or stored (in which case
+        they will be calculated whenever needed, as before). This is called
+        during upload, so it must not raise.
+
+        Args:
+            req:
+                a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            task:
+                a :class:`camcops_server.cc_modules.cc_task.Task`
+            summarized_at_utc:
+                current time in UTC
+        """
+        try:
+            values = OrderedDict(
+                (s.name, s.value) for s in task.get_summaries(req)
+            )
+            stored = storable_summary_values(values)
+            return dict(
+                task_table_name=task.tablename,
+                task_pk=task.get_pk(),
+                summarized_at_utc=summarized_at_utc,
+                summaries=encode_summary_values(stored),
+                has_all_values=len(stored) == len(values),
+            )
+        except Exception:
+            log.exception("Not storing summaries for {}/{}",
+                          task.tablename, task.get_pk())
+            return None
+
+    @classmethod
+    def delete_summaries(cls, session: SqlASession, tablename: str,
+                         task_pks: List[int] = None) -> None:
+        """
+        Deletes stored summaries for a task table.
+
+        Args:
+            session: an SQLAlchemy Session
+            tablename: the task's base table name
+            task_pks: server PKs of the tasks (or ``None`` for all tasks of
+                this type)
+        """
+        # noinspection PyUnresolvedReferences
+        table = cls.__table__  # type: Table
+        cols = table.columns
+        query = table.delete().where(cols.task_table_name == tablename)
+        if task_pks is None:
+            session.execute(query)
+            return
+        for pks in chunks(task_pks, DEFAULT_SUMMARY_CHUNK_SIZE):
+            session.execute(query.where(cols.task_pk.in_(pks)))
+
+    @classmethod
+    def unsummarize_task(cls, task: Task, session: SqlASession) -> None:
+        """
+        Deletes the stored summaries for a task (e.g. when it is erased).
+        """
+        cls.delete_summaries(session, task.tablename, [task.get_pk()])
+
+    @classmethod
+    def delete_summaries_for_patients(
+            cls, session: SqlASession,
+            patient_keys: Iterable[Tuple[int, int, str]]) -> None:
+        """
+        Deletes the stored summaries for all tasks belonging to some patients,
+        because the patients' details have changed (and summaries may depend
+        on them). The summaries will be calculated when needed, or at the
+        next rebuild.
+
+        Args:
+            session: an SQLAlchemy Session
+            patient_keys: ``(patient_id, device_id, era)`` tuples, identifying
+                patients in the way that tasks refer to them
+        """
+        patient_keys = sorted(set(patient_keys))
+        if not patient_keys:
+            return
+        # noinspection PyUnresolvedReferences
+        table = cls.__table__  # type: Table
+        cols = table.columns
+        for taskclass in Task.all_subclasses_by_tablename():
+            if not taskclass.has_patient:
+                continue
+            # noinspection PyUnresolvedReferences
+            taskcols = taskclass.__table__.columns
+            for keys in chunks(patient_keys, PATIENT_CHUNK_SIZE):
+                task_pks = select([taskcols._pk]).where(or_(*[
+                    and_(taskcols.patient_id == patient_id,
+                         taskcols._device_id == device_id,
+                         taskcols._era == era)
+                    for patient_id, device_id, era in keys
+                ]))
+                session.execute(
+                    table.delete()
+                    .where(cols.task_table_name == taskclass.tablename)
+                    .where(cols.task_pk.in_(task_pks))
+                )
+
+    @classmethod
+    def unsummarize_patient(cls, patient: Patient,
+                            session: SqlASession) -> None:
+        """
+        Deletes the stored summaries for a patient's tasks (e.g. when the
+        patient is edited).
+        """
+        cls.delete_summaries_for_patients(
+            session, [(patient.id, patient.get_device_id(),
+                       patient.get_era())])
+
+    @classmethod
+    def summarize_tasks(cls, req: "CamcopsRequest", tasks: List[Task],
+                        summarized_at_utc: Pendulum) -> int:
+        """
+        Calculates and stores summaries for tasks, which must all be of the
+        same type and must not have stored summaries already. Returns the
+        number of entries stored.
+        """
+        rows = [cls.make_summary_row(req, task, summarized_at_utc)
+                for task in tasks]
+        rows = [row for row in rows if row is not None]
+        if rows:
+            # noinspection PyUnresolvedReferences
+            req.dbsession.execute(cls.__table__.insert(), rows)
+        return len(rows)
+
+    # -------------------------------------------------------------------------
+    # Rebuild
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def rebuild_summaries_for_task_type(
+            cls, req: "CamcopsRequest",
+            taskclass: Type[Task],
+            summarized_at_utc: Pendulum,
+            delete_first: bool = True,
+            chunk_size: int = DEFAULT_SUMMARY_CHUNK_SIZE) -> int:
+        """
+        Recalculates the stored summaries for a particular task type, reading
+        current tasks in chunks (by server PK).
+
+        Args:
+            req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            taskclass: a subclass of
+                :class:`camcops_server.cc_modules.cc_task.Task`
+            summarized_at_utc: current time in UTC
+            delete_first: delete old entries first? Should always be True
+                unless called as part of a master rebuild that deletes
+                everything first.
+            chunk_size: number of tasks to read and summarize per query
+
+        Returns:
+            the number of entries created
+        """
+        session = req.dbsession
+        tablename = taskclass.tablename
+        log.info("Rebuilding task summaries for {}", tablename)
+        start = time.monotonic()
+        if delete_first:
+            cls.delete_summaries(session, tablename)
+        n_stored = 0
+        last_pk = None  # type: Optional[int]
+        while True:
+            # noinspection PyPep8,PyUnresolvedReferences,PyProtectedMember
+            q = (
+                session.query(taskclass)
+                .filter(taskclass._current == True)  # noqa: E712
+            )
+            if last_pk is not None:
+                # noinspection PyProtectedMember
+                q = q.filter(taskclass._pk > last_pk)
+            # noinspection PyProtectedMember
+            tasks = q.order_by(taskclass._pk).limit(chunk_size).all()
+            if not tasks:
+                break
+            n_stored += cls.summarize_tasks(req, tasks, summarized_at_utc)
+            last_pk = tasks[-1].get_pk()
+            log.debug("... {}: {} summary entries so far", tablename, n_stored)
+            if len(tasks) < chunk_size:
+                break
+        elapsed = time.monotonic() - start
+        log.info("Summarized {} {} task(s) in {:.1f} s ({:.0f} per second)",
+                 n_stored, tablename, elapsed,
+                 n_stored / elapsed if elapsed > 0 else 0)
+        return n_stored
+
+    @classmethod
+    def rebuild_all_summaries(
+            cls, req: "CamcopsRequest",
+            skip_tasks_with_missing_tables: bool = False,
+            chunk_size: int = DEFAULT_SUMMARY_CHUNK_SIZE) -> None:
+        """
+        Recalculates all stored summaries.
+
+        Args:
+            req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            skip_tasks_with_missing_tables: should we skip over tasks if their
+                tables are not in the database?
+            chunk_size: number of tasks to read and summarize per query
+        """
+        log.info("Rebuilding all task summaries")
+        now = Pendulum.utcnow()
+        session = req.dbsession
+        engine = get_engine_from_session(session)
+        # noinspection PyUnresolvedReferences
+        session.execute(cls.__table__.delete())
+        n_stored = 0
+        for taskclass in Task.all_subclasses_by_tablename():
+            if (skip_tasks_with_missing_tables and
+                    not table_exists(engine, taskclass.tablename)):
+                continue
+            n_stored += cls.rebuild_summaries_for_task_type(
+                req, taskclass, now,
+                delete_first=False, chunk_size=chunk_size)
+        log.info("Rebuilt all task summaries: {} entries", n_stored)
+
+    # -------------------------------------------------------------------------
+    # Update at the point of upload from a device
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def update_summaries_for_upload(cls,
+                                    req: "CamcopsRequest",
+                                    tablechanges: UploadTableChanges,
+                                    summarized_at_utc: Pendulum) -> None:
+        """
+        Updates stored summaries for a device's upload, for the same records
+        as
+        :meth:`camcops_server.cc_modules.cc_taskindex.TaskIndexEntry.update_task_index_for_upload`.
+
+        Args:
+            req:
+                a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            tablechanges:
+                a :class:`camcops_server.cc_modules.cc_client_api_core.UploadTableChanges`
+                object describing the changes to a table
+            summarized_at_utc:
+                current time in UTC
+        """  # noqa
+        tablename = tablechanges.tablename
+        d = tablename_to_task_class_dict()
+        try:
+            taskclass = d[tablename]  # may raise KeyError
+        except KeyError:
+            fail_user_error(f"Bug: no such task table: {tablename!r}")
+
+        session = req.dbsession
+        delete_pks = tablechanges.task_delete_index_pks
+        reindex_pks = tablechanges.task_reindex_pks
+        if delete_pks or reindex_pks:
+            # A record being preserved is in both lists; make sure it is only
+            # deleted once, before it is recreated.
+            cls.delete_summaries(session, tablename,
+                                 sorted(set(delete_pks) | set(reindex_pks)))
+        for pks in chunks(reindex_pks, DEFAULT_SUMMARY_CHUNK_SIZE):
+            # noinspection PyUnboundLocalVariable,PyProtectedMember
+            tasks = (
+                session.query(taskclass)
+                .filter(taskclass._pk.in_(pks))
+                .all()
+            )
+            cls.summarize_tasks(req, tasks, summarized_at_utc)
+
+    @classmethod
+    def update_summaries_for_ancillary_upload(
+            cls,
+            req: "CamcopsRequest",
+            tablechanges: UploadTableChanges,
+            summarized_at_utc: Pendulum) -> None:
+        """
+        Recalculates stored summaries for tasks whose ancillary records have
+        been added or removed by a device's upload. (Tasks uploaded in the
+        same batch are dealt with again afterwards, since task tables are
+        committed after ancillary tables.)
+
+        Args:
+            req:
+                a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+            tablechanges:
+                a :class:`camcops_server.cc_modules.cc_client_api_core.UploadTableChanges`
+                object describing the changes to an ancillary table
+            summarized_at_utc:
+                current time in UTC
+        """  # noqa
+        parents = ancillary_tablename_to_parents().get(
+            tablechanges.tablename, [])
+        changed_pks = sorted(set(tablechanges.addition_pks) |
+                             set(tablechanges.removal_pks))
+        if not parents or not changed_pks:
+            return
+        session = req.dbsession
+        for taskclass, ancillary_class, fk_attr_name in parents:
+            # Which tasks do the ancillary records belong to?
+            task_keys = set()  # type: Set[Tuple[int, int, str]]
+            for pks in chunks(changed_pks, DEFAULT_SUMMARY_CHUNK_SIZE):
+                # noinspection PyProtectedMember
+                task_keys.update(
+                    tuple(row) for row in
+                    session.query(getattr(ancillary_class, fk_attr_name),
+                                  ancillary_class._device_id,
+                                  ancillary_class._era)
+                    .filter(ancillary_class._pk.in_(pks))
+                )
+            task_pks = []  # type: List[int]
+            for keys in chunks(sorted(task_keys), PARENT_CHUNK_SIZE):
+                # noinspection PyProtectedMember
+                task_pks.extend(
+                    row[0] for row in
+                    session.query(taskclass._pk)
+                    .filter(taskclass._current == True)  # noqa: E712
+                    .filter(or_(*[
+                        and_(taskclass.id == task_id,
+                             taskclass._device_id == device_id,
+                             taskclass._era == era)
+                        for task_id, device_id, era in keys
+                    ]))
+                )
+            if not task_pks:
+                continue
+            cls.delete_summaries(session, taskclass.tablename, task_pks)
+            for pks in chunks(task_pks, DEFAULT_SUMMARY_CHUNK_SIZE):
+                # noinspection PyProtectedMember
+                tasks = (
+                    session.query(taskclass)
+                    .filter(taskclass._pk.in_(pks))
+                    .all()
+                )
+                cls.summarize_tasks(req, tasks, summarized_at_utc)
+
+    @classmethod
+    def update_summaries_for_patient_upload(
+            cls, session: SqlASession,
+            tablechanges: UploadTableChanges) -> None:
+        """
+        Deletes stored summaries for tasks whose patient has been modified by
+        a device's upload. (Tasks uploaded in the same batch are summarized
+        afterwards, since task tables are committed after the patient table.)
+
+        Args:
+            session:
+                an SQLAlchemy Session
+            tablechanges:
+                a :class:`camcops_server.cc_modules.cc_client_api_core.UploadTableChanges`
+                object describing the changes to the patient table
+        """  # noqa
+        modified_pks = tablechanges.removal_modified_pks
+        if not modified_pks:
+            return
+        patient_keys = []  # type: List[Tuple[int, int, str]]
+        for pks in chunks(modified_pks, DEFAULT_SUMMARY_CHUNK_SIZE):
+            # noinspection PyProtectedMember
+            patient_keys.extend(
+                tuple(row) for row in
+                session.query(Patient.id, Patient._device_id, Patient._era)
+                .filter(Patient._pk.in_(pks))
+            )
+        cls.delete_summaries_for_patients(session, patient_keys)
+
+    # -------------------------------------------------------------------------
+    # Read
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def fetch_summaries(cls, session: SqlASession, tablename: str,
+                        task_pks: Iterable[int],
+                        all_values_only: bool = False) \
+            -> Dict[int, Dict[str, Any]]:
+        """
+        Reads stored summaries in bulk.
+
+        Args:
+            session: an SQLAlchemy Session
+            tablename: the tasks' base table name
+            task_pks: server PKs of the tasks
+            all_values_only: only return entries holding all of a task's
+                summary values (i.e. without text values)? Otherwise, entries
+                may lack some summaries.
+
+        Returns:
+            dict: ``{task_pk: {summary_name: value}}``, for those tasks with
+            stored summaries
+        """
+        # noinspection PyUnresolvedReferences
+        table = cls.__table__  # type: Table
+        cols = table.columns
+        result = {}  # type: Dict[int, Dict[str, Any]]
+        for pks in chunks(list(task_pks), DEFAULT_SUMMARY_CHUNK_SIZE):
+            q = (
+                select([cols.task_pk, cols.summaries])
+                .where(cols.task_table_name == tablename)
+                .where(cols.task_pk.in_(pks))
+            )
+            if all_values_only:
+                q = q.where(cols.has_all_values == True)  # noqa: E712
+            for task_pk, summaries in session.execute(q):
+                result[task_pk] = decode_summary_values(summaries)
+        return result
+
+
+# =============================================================================
+# Using stored summaries
+# =============================================================================
+
+def preload_stored_summaries(req: "CamcopsRequest",
+                             tasks: Iterable[Task]) -> None:
+    """
+    Reads the stored summaries for the tasks, in bulk, into the request, so
+    that
+    :meth:`camcops_server.cc_modules.cc_task.Task.get_summary_values` can use
+    them. Each preloaded entry is used once. Entries without all of a task's
+    values are ignored, so such tasks are scored as usual.
+    """
+    pks_by_tablename = OrderedDict()  # type: Dict[str, List[int]]
+    for task in tasks:
+        pks_by_tablename.setdefault(task.tablename, []).append(task.get_pk())
+    for tablename, pks in pks_by_tablename.items():
+        stored = TaskSummaryEntry.fetch_summaries(req.dbsession, tablename,
+                                                  pks, all_values_only=True)
+        for pk, values in stored.items():
+            req.stored_task_summaries[(tablename, pk)] = values
+
+
+def rebuild_summaries(req: "CamcopsRequest",
+                      skip_tasks_with_missing_tables: bool = False) -> None:
+    """
+    Recalculates all stored task summaries; see
+    :meth:`TaskSummaryEntry.rebuild_all_summaries`.
+    """
+    TaskSummaryEntry.rebuild_all_summaries(
+        req, skip_tasks_with_missing_tables=skip_tasks_with_missing_tables)
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class TaskSummaryEntryTests(DemoDatabaseTestCase):
+    """
+    Unit tests.
+    """
+    def test_stored_summaries_match_calculated(self) -> None:
+        req = self.req
+        TaskSummaryEntry.rebuild_all_summaries(req, chunk_size=2)
+        self.dbsession.flush()
+        for taskclass in Task.all_subclasses_by_tablename():
+            # noinspection PyProtectedMember
+            tasks = self.dbsession.query(taskclass).filter(
+                taskclass._current == True).all()  # noqa: E712
+            preload_stored_summaries(req, tasks)
+            for task in tasks:
+                calculated = OrderedDict(
+                    (s.name, s.value) for s in task.get_summaries(req))
+                stored = task.get_summary_values(req)
+                self.assertEqual(list(stored.keys()),
+                                 list(calculated.keys()))
+                for name, value in calculated.items():
+                    if isinstance(value, Version):
+                        value = str(value)
+                    self.assertEqual(stored[name], value,
+                                     f"{task.tablename}.{name}")
+        self.assertEqual(req.stored_task_summaries, {})
+
+    def _stored_pks(self, tablename: str) -> List[int]:
+        # noinspection PyUnresolvedReferences
+        cols = TaskSummaryEntry.__table__.columns
+        return sorted(
+            row[0] for row in self.dbsession.execute(
+                select([cols.task_pk])
+                .where(cols.task_table_name == tablename)
+            )
+        )
+
+    def test_scoring_failure_is_not_stored(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        task = self.dbsession.query(Phq9).first()
+        with mock.patch.object(Phq9, "get_summaries",
+                               side_effect=ZeroDivisionError):
+            row = TaskSummaryEntry.make_summary_row(self.req, task,
+                                                    Pendulum.utcnow())
+        self.assertIsNone(row)
+
+    def test_text_values_are_not_stored(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        req = self.req
+        task = self.dbsession.query(Phq9).first()
+        summaries = [
+            SummaryElement(name="total", coltype=Integer(), value=5),
+            SummaryElement(name="severity", coltype=SummaryCategoryColType,
+                           value="Mild"),
+        ]
+        with mock.patch.object(Phq9, "get_summaries",
+                               return_value=summaries):
+            TaskSummaryEntry.delete_summaries(self.dbsession, Phq9.tablename)
+            TaskSummaryEntry.summarize_tasks(req, [task], Pendulum.utcnow())
+            # A reader wanting single values can use the entry...
+            self.assertEqual(
+                TaskSummaryEntry.fetch_summaries(
+                    self.dbsession, Phq9.tablename, [task.get_pk()]),
+                {task.get_pk(): {"total": 5}}
+            )
+            # ... but for all values, the task is scored as usual.
+            preload_stored_summaries(req, [task])
+            self.assertEqual(req.stored_task_summaries, {})
+            self.assertEqual(task.get_summary_values(req),
+                             OrderedDict([("total", 5),
+                                          ("severity", "Mild")]))
+
+    def test_patient_edits_delete_summaries(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        TaskSummaryEntry.rebuild_all_summaries(self.req)
+        tasks = self.dbsession.query(Phq9).order_by(Phq9.id).all()
+        self.assertEqual(len(tasks), 2)
+        self.assertNotEqual(tasks[0].patient.get_pk(),
+                            tasks[1].patient.get_pk())
+        TaskSummaryEntry.unsummarize_patient(tasks[0].patient,
+                                             self.dbsession)
+        self.assertEqual(self._stored_pks(Phq9.tablename),
+                         [tasks[1].get_pk()])
+
+        tablechanges = UploadTableChanges(Patient.__table__)
+        tablechanges.note_removal_modified_pk(tasks[1].patient.get_pk())
+        TaskSummaryEntry.update_summaries_for_patient_upload(
+            self.dbsession, tablechanges)
+        self.assertEqual(self._stored_pks(Phq9.tablename), [])
+
+    def test_ancillary_uploads_update_summaries(self) -> None:
+        from camcops_server.tasks.kirby_mcq import Kirby, KirbyTrial
+        TaskSummaryEntry.rebuild_all_summaries(self.req)
+        tasks = self.dbsession.query(Kirby).order_by(Kirby.id).all()
+        self.assertEqual(len(tasks), 2)
+        trial = KirbyTrial()
+        trial.id = 1
+        trial.kirby_mcq_id = tasks[0].id
+        trial.trial = 1
+        self._apply_standard_db_fields(trial)
+        self.dbsession.add(trial)
+        self.dbsession.flush()
+
+        tablechanges = UploadTableChanges(KirbyTrial.__table__)
+        tablechanges.note_addition_pk(trial.get_pk())
+        summaries = [
+            SummaryElement(name="k_kirby", coltype=Integer(), value=42),
+        ]
+        with mock.patch.object(Kirby, "get_summaries",
+                               return_value=summaries):
+            TaskSummaryEntry.update_summaries_for_ancillary_upload(
+                self.req, tablechanges, Pendulum.utcnow())
+        stored = TaskSummaryEntry.fetch_summaries(
+            self.dbsession, Kirby.tablename,
+            [task.get_pk() for task in tasks])
+        self.assertEqual(stored[tasks[0].get_pk()], {"k_kirby": 42})
+        self.assertNotEqual(stored[tasks[1].get_pk()], {"k_kirby": 42})
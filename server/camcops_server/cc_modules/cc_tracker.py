@@ -37,17 +37,19 @@ from cardinal_pythonlib.logs import BraceStyleAdapter
 from pendulum import DateTime as Pendulum
 from pyramid.renderers import render
 
-from camcops_server.cc_modules.cc_audit import audit
+from camcops_server.cc_modules.cc_audit import audit_task_access
 from camcops_server.cc_modules.cc_constants import (
     CssClass,
     CSS_PAGED_MEDIA,
     DateFormat,
-    FULLWIDTH_PLOT_WIDTH,
-    WHOLE_PANEL,
 )
 from camcops_server.cc_modules.cc_filename import get_export_filename
 from camcops_server.cc_modules.cc_plot import matplotlib
-from camcops_server.cc_modules.cc_pdf import pdf_from_html
+from camcops_server.cc_modules.cc_pdf import (
+    make_pdf_job,
+    PdfJob,
+    render_pdf_jobs,
+)
 from camcops_server.cc_modules.cc_pyramid import ViewArg, ViewParam
 from camcops_server.cc_modules.cc_simpleobjects import (
     IdNumReference,
@@ -60,6 +62,10 @@ from camcops_server.cc_modules.cc_taskcollection import (
     TaskSortMethod,
 )
 from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
+from camcops_server.cc_modules.cc_trackerplot import (
+    render_tracker_plots,
+    TrackerPlotSpec,
+)
 from camcops_server.cc_modules.cc_xml import (
     get_xml_document,
     XmlDataTypes,
@@ -189,6 +195,33 @@ def consistency_idnums(req: "CamcopsRequest",
         return True, f"{_('consistent')} ({'; '.join(successes)})"
 
 
+def consistency_patient_identity(req: "CamcopsRequest",
+                                 patients: List[Optional["Patient"]]) \
+        -> Tuple[bool, str]:
+    """
+    Checks that a set of
+    :class:`camcops_server.cc_modules.cc_patient.Patient` records all refer
+    to the same person, directly or transitively (via shared ID numbers or
+    client records); see
+    :class:`camcops_server.cc_modules.cc_patient.PatientIdentityIndex`.
+
+    Args:
+        req: a :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        patients: the patients (``None`` values are ignored)
+
+    Returns:
+        the tuple ``consistent, msg``, where ``consistent`` is a bool and
+        ``msg`` is a descriptive HTML message
+    """
+    from camcops_server.cc_modules.cc_patient import PatientIdentityIndex  # delayed import  # noqa
+    _ = req.gettext
+    index = PatientIdentityIndex(p for p in patients if p is not None)
+    n_people = len(index.patient_groups())
+    if n_people <= 1:
+        return True, f"{_('consistent')} ({n_people})"
+    return False, f"<b>{_('INCONSISTENT')} ({n_people})</b>"
+
+
 def format_daterange(start: Optional[Pendulum],
                      end: Optional[Pendulum]) -> str:
     """
@@ -233,12 +266,17 @@ class ConsistencyInfo(object):
         self.consistent_idnums, self.msg_idnums = consistency_idnums(
             req,
             [task.get_patient_idnum_objects() for task in tasklist])
+        self.consistent_patients, self.msg_patients = \
+            consistency_patient_identity(
+                req,
+                [task.patient for task in tasklist])
         self.all_consistent = (
             self.consistent_forename and
             self.consistent_surname and
             self.consistent_dob and
             self.consistent_sex and
-            self.consistent_idnums
+            self.consistent_idnums and
+            self.consistent_patients
         )
 
     def are_all_consistent(self) -> bool:
@@ -259,6 +297,7 @@ class ConsistencyInfo(object):
             f"{_('DOB:')} {self.msg_dob}",
             f"{_('Sex:')} {self.msg_sex}",
             f"{_('ID numbers:')} {self.msg_idnums}",
+            f"{_('Patients:')} {self.msg_patients}",
         ]
         return cons
 
@@ -312,7 +351,8 @@ class TrackerCtvCommon(object):
             taskfilter=taskfilter,
             sort_method_by_class=TaskSortMethod.CREATION_DATE_ASC,
             sort_method_global=TaskSortMethod.CREATION_DATE_ASC,
-            via_index=via_index
+            via_index=via_index,
+            parallel_fetch=True
         )
         all_tasks = self.collection.all_tasks
         if all_tasks:
@@ -454,13 +494,7 @@ class TrackerCtvCommon(object):
                                     include_blobs=False)
         for t in self.collection.all_tasks:
             branches.append(t.get_xml_root(self.req, options))
-            audit(
-                self.req,
-                audit_string,
-                table=t.tablename,
-                server_pk=t.get_pk(),
-                patient_server_pk=t.get_patient_server_pk()
-            )
+        audit_task_access(self.req, audit_string, self.collection.all_tasks)
         tree = XmlElement(name=xml_name, value=branches)
         return get_xml_document(
             tree,
@@ -495,12 +529,19 @@ class TrackerCtvCommon(object):
         """
         Get PDF representing tracker/CTV.
         """
+        return render_pdf_jobs([self.get_pdf_job()])[0]
+
+    def get_pdf_job(self) -> PdfJob:
+        """
+        Returns a :class:`camcops_server.cc_modules.cc_pdf.PdfJob` to make the
+        PDF representing this tracker/CTV.
+        """
         req = self.req
         html = self.get_pdf_html()  # main content
         if CSS_PAGED_MEDIA:
-            return pdf_from_html(req, html)
+            return make_pdf_job(req, html)
         else:
-            return pdf_from_html(
+            return make_pdf_job(
                 req,
                 html=html,
                 header_html=render(
@@ -564,6 +605,7 @@ class Tracker(TrackerCtvCommon):
             as_ctv=False,
             via_index=via_index
         )
+        self._plot_html_by_format = {}  # type: Dict[bool, Dict[Tuple[Any, ...], str]]  # noqa
 
     def get_xml(self,
                 indent_spaces: int = 4,
@@ -597,155 +639,142 @@ class Tracker(TrackerCtvCommon):
     def get_all_plots_for_one_task_html(self, tasks: List[Task]) -> str:
         """
         HTML for all plots for a given task type.
+
+        The first call draws the figures for all task types in this tracker
+        at once (see :func:`render_tracker_plots`), so they can be drawn in
+        parallel.
         """
         html = ""
-        ntasks = len(tasks)
-        if ntasks == 0:
+        if not tasks or not tasks[0].provides_trackers:
+            # ask the first of the task instances
             return html
+        key = self._plot_group_key(tasks)
+        plot_html = self._get_all_plot_html()
+        if key in plot_html:
+            html = plot_html[key]
+        else:
+            html = "".join(render_tracker_plots(self._get_plot_specs(tasks)))
+        audit_task_access(self.req, "Tracker data accessed", tasks)
+        return html
+
+    def _plot_group_key(self, tasks: List[Task]) -> Tuple[Any, ...]:
+        """
+        Identifies a set of tasks (and the current figure format), for
+        :meth:`_get_all_plot_html`.
+        """
+        return (self.req.use_svg, tasks[0].tablename,
+                tuple(task.get_pk() for task in tasks))
+
+    def _get_all_plot_html(self) -> Dict[Tuple[Any, ...], str]:
+        """
+        Draws the figures for every task type in this tracker, in one batch
+        (for the current figure format), and returns their HTML, keyed by
+        :meth:`_plot_group_key`.
+        """
+        if self.req.use_svg in self._plot_html_by_format:
+            return self._plot_html_by_format[self.req.use_svg]
+        groups = []  # type: List[Tuple[Tuple[Any, ...], int]]
+        specs = []  # type: List[TrackerPlotSpec]
+        for cls in self.taskfilter.task_classes:
+            tasks = self.collection.tasks_for_task_class(cls)
+            if not tasks:
+                continue
+            group_specs = self._get_plot_specs(tasks)
+            groups.append((self._plot_group_key(tasks), len(group_specs)))
+            specs.extend(group_specs)
+        all_html = render_tracker_plots(specs)
+        plot_html = {}  # type: Dict[Tuple[Any, ...], str]
+        start = 0
+        for key, n in groups:
+            plot_html[key] = "".join(all_html[start:start + n])
+            start += n
+        self._plot_html_by_format[self.req.use_svg] = plot_html
+        return plot_html
+
+    def _get_plot_specs(self, tasks: List[Task]) -> List[TrackerPlotSpec]:
+        """
+        Describes the figures for a set of tasks of the same type.
+        """
         if not tasks[0].provides_trackers:
             # ask the first of the task instances
-            return html
+            return []
+        ntasks = len(tasks)
         alltrackers = [task.get_trackers(self.req) for task in tasks]
         datetimes = [task.get_creation_datetime() for task in tasks]
         ntrackers = len(alltrackers[0])
         # ... number of trackers supplied by the first task (and all tasks)
+        specs = []  # type: List[TrackerPlotSpec]
         for tracker in range(ntrackers):
             values = [
                 alltrackers[tasknum][tracker].value
                 for tasknum in range(ntasks)
             ]
-            html += self.get_single_plot_html(
+            specs.append(self.get_single_plot_spec(
                 datetimes, values,
-                specimen_tracker=alltrackers[0][tracker]
-            )
-        for task in tasks:
-            # noinspection PyProtectedMember
-            audit(self.req,
-                  "Tracker data accessed",
-                  table=task.tablename,
-                  server_pk=task._pk,
-                  patient_server_pk=task.get_patient_server_pk())
-        return html
+                specimen_tracker=alltrackers[0][tracker],
+                tablename=tasks[0].tablename,
+                tracker_index=tracker
+            ))
+        return specs
 
-    def get_single_plot_html(self,
+    def get_single_plot_spec(self,
                              datetimes: List[Pendulum],
                              values: List[Optional[float]],
-                             specimen_tracker: "TrackerInfo") -> str:
+                             specimen_tracker: "TrackerInfo",
+                             tablename: str = "",
+                             tracker_index: int = 0) -> TrackerPlotSpec:
         """
-        HTML for a single figure.
+        Describes a single figure, for
+        :func:`camcops_server.cc_modules.cc_trackerplot.render_tracker_plot`.
         """
-        nonblank_values = [x for x in values if x is not None]
-        # NB DIFFERENT to list(filter(None, values)), which implements the
-        # test "if x", not "if x is not None" -- thus eliminating zero values!
-        # We don't want that.
-        if not nonblank_values:
-            return ""
-
-        plot_label = specimen_tracker.plot_label
-        axis_label = specimen_tracker.axis_label
-        axis_min = specimen_tracker.axis_min
-        axis_max = specimen_tracker.axis_max
-        axis_ticks = specimen_tracker.axis_ticks
-        horizontal_lines = specimen_tracker.horizontal_lines
-        horizontal_labels = specimen_tracker.horizontal_labels
-        aspect_ratio = specimen_tracker.aspect_ratio
-
-        figsize = (FULLWIDTH_PLOT_WIDTH,
-                   (1.0/float(aspect_ratio)) * FULLWIDTH_PLOT_WIDTH)
-        fig = self.req.create_figure(figsize=figsize)
-        ax = fig.add_subplot(WHOLE_PANEL)
-        x = [matplotlib.dates.date2num(t) for t in datetimes]
-        datelabels = [dt.strftime(TRACKER_DATEFORMAT) for dt in datetimes]
-
-        # First plot
-        ax.plot(x, values, color="b", linestyle="-", marker="+",
-                markeredgecolor="r", markerfacecolor="r", label=None)
-        # ... NB command performed twice, see below
-
-        # x axis
-        ax.set_xlabel("Date/time", fontdict=self.req.fontdict)
-        ax.set_xticks(x)
-        ax.set_xticklabels(datelabels, fontdict=self.req.fontdict)
         if (self.earliest is not None and
                 self.latest is not None and
                 self.earliest != self.latest):
             xlim = matplotlib.dates.date2num((self.earliest, self.latest))
             margin = (2.5 / 95.0) * (xlim[1] - xlim[0])
-            xlim[0] -= margin
-            xlim[1] += margin
-            ax.set_xlim(xlim)
-        xlim = ax.get_xlim()
-        fig.autofmt_xdate(rotation=90)
-        # ... autofmt_xdate must be BEFORE twinx:
-        # http://stackoverflow.com/questions/8332395
-        if axis_ticks is not None and len(axis_ticks) > 0:
-            tick_positions = [m.y for m in axis_ticks]
-            tick_labels = [m.label for m in axis_ticks]
-            ax.set_yticks(tick_positions)
-            ax.set_yticklabels(tick_labels, fontdict=self.req.fontdict)
-
-        # y axis
-        ax.set_ylabel(axis_label, fontdict=self.req.fontdict)
-        axis_min = min(axis_min, min(nonblank_values)) if axis_min else min(nonblank_values)  # noqa
-        axis_max = max(axis_max, max(nonblank_values)) if axis_max else max(nonblank_values)  # noqa
-        # ... the supplied values are stretched if the data are outside them
-        # ... but min(something, None) is None, so beware
-        # If we get something with no sense of scale whatsoever, then what
-        # we do is arbitrary. Matplotlib does its own thing, but we could do:
-        if axis_min == axis_max:
-            if axis_min == 0:
-                axis_min, axis_min = -1.0, 1.0
-            else:
-                singlevalue = axis_min
-                axis_min = 0.9 * singlevalue
-                axis_max = 1.1 * singlevalue
-                if axis_min > axis_max:
-                    axis_min, axis_max = axis_max, axis_min
-        ax.set_ylim(axis_min, axis_max)
-
-        # title
-        ax.set_title(plot_label, fontdict=self.req.fontdict)
-
-        # Horizontal lines
-        stupid_jitter = 0.001
-        if horizontal_lines is not None:
-            for y in horizontal_lines:
-                ax.plot(xlim, [y, y + stupid_jitter], color="0.5",
-                        linestyle=":")
-                # PROBLEM: horizontal lines becoming invisible
-                # (whether from ax.axhline or plot)
-
-        # Horizontal labels
-        if horizontal_labels is not None:
-            label_left = xlim[0] + 0.01 * (xlim[1] - xlim[0])
-            for lab in horizontal_labels:
-                y = lab.y
-                l_ = lab.label
-                va = lab.vertical_alignment.value
-                ax.text(label_left, y, l_, verticalalignment=va, alpha=0.5,
-                        fontdict=self.req.fontdict)
-                # was "0.5" rather than 0.5, which led to a tricky-to-find
-                # "TypeError: a float is required" exception after switching
-                # to Python 3.
-
-        # replot so the data are on top of the rest:
-        ax.plot(x, values, color="b", linestyle="-", marker="+",
-                markeredgecolor="r", markerfacecolor="r", label=None)
-        # ... NB command performed twice, see above
-
-        self.req.set_figure_font_sizes(ax)
-
-        fig.tight_layout()
-        # ... stop the labels dropping off
-        # (only works properly for LEFT labels...)
-
-        # http://matplotlib.org/faq/howto_faq.html
-        # ... tried it - didn't work (internal numbers change fine,
-        # check the logger, but visually doesn't help)
-        # - http://stackoverflow.com/questions/9126838
-        # - http://matplotlib.org/examples/pylab_examples/finance_work2.html
-        return self.req.get_html_from_pyplot_figure(fig) + "<br>"
-        # ... extra line break for the PDF rendering
+            xlim = (float(xlim[0] - margin), float(xlim[1] + margin))
+        else:
+            xlim = None
+        axis_ticks = specimen_tracker.axis_ticks
+        horizontal_labels = specimen_tracker.horizontal_labels
+        return TrackerPlotSpec(
+            tablename=tablename,
+            tracker_index=tracker_index,
+            x=[float(matplotlib.dates.date2num(t)) for t in datetimes],
+            x_labels=[dt.strftime(TRACKER_DATEFORMAT) for dt in datetimes],
+            values=list(values),
+            xlim=xlim,
+            plot_label=specimen_tracker.plot_label,
+            axis_label=specimen_tracker.axis_label,
+            axis_min=specimen_tracker.axis_min,
+            axis_max=specimen_tracker.axis_max,
+            axis_ticks=(
+                [(m.y, m.label) for m in axis_ticks]
+                if axis_ticks else None
+            ),
+            horizontal_lines=(
+                list(specimen_tracker.horizontal_lines)
+                if specimen_tracker.horizontal_lines is not None else None
+            ),
+            horizontal_labels=(
+                [(lab.y, lab.label, lab.vertical_alignment.value)
+                 for lab in horizontal_labels]
+                if horizontal_labels is not None else None
+            ),
+            aspect_ratio=specimen_tracker.aspect_ratio,
+            fontdict=self.req.fontdict,
+            use_svg=self.req.use_svg,
+        )
+
+    def get_single_plot_html(self,
+                             datetimes: List[Pendulum],
+                             values: List[Optional[float]],
+                             specimen_tracker: "TrackerInfo") -> str:
+        """
+        HTML for a single figure.
+        """
+        spec = self.get_single_plot_spec(datetimes, values, specimen_tracker)
+        return render_tracker_plots([spec])[0]
 
 
 # =============================================================================
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+"""
+camcops_server/cc_modules/cc_trackerplot.py
+
+===============================================================================
+
+    Copyright (C) 2012-2020 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CamCOPS.
+
+    CamCOPS is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CamCOPS is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CamCOPS. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Rendering of tracker figures.**
+
+- A :class:`camcops_server.cc_modules.cc_tracker.Tracker` describes each of
+  its figures with a :class:`TrackerPlotSpec`: plain data (no request, no
+  database objects), so it can be hashed and sent to another process.
+
+- :func:`render_tracker_plots` turns specs into HTML (SVG plus PNG fallback,
+  or PNG). Results are kept in a per-process, size-bounded LRU cache, keyed by
+  a hash of the spec, so repeated views of a tracker (and the HTML/PDF pair)
+  don't use matplotlib again.
+
+- Optionally (see the ``TRACKER_PLOT_PROCESSES`` config parameter), figures
+  not in the cache are drawn by a pool of worker processes, in parallel.
+  Otherwise they are drawn in the calling thread, one at a time.
+
+- This module is deliberately light (no database models, and matplotlib is
+  only imported when first needed), as worker processes and the config
+  module import it.
+
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import multiprocessing
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import unittest
+from unittest import mock
+
+from cardinal_pythonlib.logs import BraceStyleAdapter
+
+from camcops_server.cc_modules.cc_cache import (
+    CacheRegionStats,
+    make_cache_stats,
+)
+from camcops_server.cc_modules.cc_constants import (
+    DEFAULT_PLOT_DPI,
+    FULLWIDTH_PLOT_WIDTH,
+    USE_SVG_IN_HTML,
+    WHOLE_PANEL,
+)
+
+log = BraceStyleAdapter(logging.getLogger(__name__))
+
+
+# =============================================================================
+# Specification of a figure
+# =============================================================================
+
+class TrackerPlotSpec(object):
+    """
+    Everything needed to draw one tracker figure.
+    """
+    def __init__(self,
+                 tablename: str,
+                 tracker_index: int,
+                 x: List[float],
+                 x_labels: List[str],
+                 values: List[Optional[float]],
+                 xlim: Optional[Tuple[float, float]],
+                 plot_label: str,
+                 axis_label: str,
+                 axis_min: Optional[float],
+                 axis_max: Optional[float],
+                 axis_ticks: Optional[List[Tuple[float, str]]],
+                 horizontal_lines: Optional[List[float]],
+                 horizontal_labels: Optional[List[Tuple[float, str, str]]],
+                 aspect_ratio: float,
+                 fontdict: Dict[str, Any],
+                 use_svg: bool) -> None:
+        """
+        Args:
+            tablename: base table of the task
+            tracker_index: which of the task's trackers this is
+            x: X coordinates (from ``matplotlib.dates.date2num``)
+            x_labels: labels for the X coordinates
+            values: Y values (``None`` for missing)
+            xlim: limits of the X axis, if known
+            plot_label: title
+            axis_label: Y axis label
+            axis_min: suggested Y axis minimum
+            axis_max: suggested Y axis maximum
+            axis_ticks: Y axis ticks, as ``(y, label)`` tuples
+            horizontal_lines: Y values for horizontal lines
+            horizontal_labels: labels as ``(y, label, vertical_alignment)``
+                tuples
+            aspect_ratio: width / height
+            fontdict: matplotlib font dictionary
+            use_svg: produce SVG (with PNG fallback), rather than PNG?
+        """
+        self.tablename = tablename
+        self.tracker_index = tracker_index
+        self.x = x
+        self.x_labels = x_labels
+        self.values = values
+        self.xlim = xlim
+        self.plot_label = plot_label
+        self.axis_label = axis_label
+        self.axis_min = axis_min
+        self.axis_max = axis_max
+        self.axis_ticks = axis_ticks
+        self.horizontal_lines = horizontal_lines
+        self.horizontal_labels = horizontal_labels
+        self.aspect_ratio = aspect_ratio
+        self.fontdict = fontdict
+        self.use_svg = use_svg
+
+    def cache_key(self) -> str:
+        """
+        Returns a hash of everything that affects the figure.
+        """
+        contents = (
+            self.tablename, self.tracker_index,
+            self.x, self.x_labels, self.values, self.xlim,
+            self.plot_label, self.axis_label, self.axis_min, self.axis_max,
+            self.axis_ticks, self.horizontal_lines, self.horizontal_labels,
+            self.aspect_ratio,
+            sorted(self.fontdict.items()),
+            self.use_svg and USE_SVG_IN_HTML,
+            DEFAULT_PLOT_DPI,
+        )
+        return hashlib.sha256(repr(contents).encode("utf8")).hexdigest()
+
+
+# =============================================================================
+# Drawing
+# =============================================================================
+
+def render_tracker_plot(spec: TrackerPlotSpec) -> str:
+    """
+    Draws a figure, returning HTML for it (or "" if there are no values).
+    """
+    # Delayed import; matplotlib is slow to import.
+    from camcops_server.cc_modules.cc_plot import (
+        create_figure,
+        get_html_from_pyplot_figure,
+        set_figure_font_sizes,
+    )
+
+    values = spec.values
+    nonblank_values = [v for v in values if v is not None]
+    # NB DIFFERENT to list(filter(None, values)), which implements the
+    # test "if x", not "if x is not None" -- thus eliminating zero values!
+    # We don't want that.
+    if not nonblank_values:
+        return ""
+    fontdict = spec.fontdict
+    x = spec.x
+
+    figsize = (FULLWIDTH_PLOT_WIDTH,
+               (1.0/float(spec.aspect_ratio)) * FULLWIDTH_PLOT_WIDTH)
+    fig = create_figure(figsize=figsize)
+    ax = fig.add_subplot(WHOLE_PANEL)
+
+    # First plot
+    ax.plot(x, values, color="b", linestyle="-", marker="+",
+            markeredgecolor="r", markerfacecolor="r", label=None)
+    # ... NB command performed twice, see below
+
+    # x axis
+    ax.set_xlabel("Date/time", fontdict=fontdict)
+    ax.set_xticks(x)
+    ax.set_xticklabels(spec.x_labels, fontdict=fontdict)
+    if spec.xlim is not None:
+        ax.set_xlim(spec.xlim)
+    xlim = ax.get_xlim()
+    fig.autofmt_xdate(rotation=90)
+    # ... autofmt_xdate must be BEFORE twinx:
+    # http://stackoverflow.com/questions/8332395
+    if spec.axis_ticks:
+        ax.set_yticks([y for y, _ in spec.axis_ticks])
+        ax.set_yticklabels([label for _, label in spec.axis_ticks],
+                           fontdict=fontdict)
+
+    # y axis
+    ax.set_ylabel(spec.axis_label, fontdict=fontdict)
+    axis_min = spec.axis_min
+    axis_max = spec.axis_max
+    axis_min = min(axis_min, min(nonblank_values)) if axis_min else min(nonblank_values)  # noqa
+    axis_max = max(axis_max, max(nonblank_values)) if axis_max else max(nonblank_values)  # noqa
+    # ... the supplied values are stretched if the data are outside them
+    # ... but min(something, None) is None, so beware
+    # If we get something with no sense of scale whatsoever, then what
+    # we do is arbitrary. Matplotlib does its own thing, but we could do:
+    if axis_min == axis_max:
+        if axis_min == 0:
+            axis_min, axis_min = -1.0, 1.0
+        else:
+            singlevalue = axis_min
+            axis_min = 0.9 * singlevalue
+            axis_max = 1.1 * singlevalue
+            if axis_min > axis_max:
+                axis_min, axis_max = axis_max, axis_min
+    ax.set_ylim(axis_min, axis_max)
+
+    # title
+    ax.set_title(spec.plot_label, fontdict=fontdict)
+
+    # Horizontal lines
+    stupid_jitter = 0.001
+    if spec.horizontal_lines is not None:
+        for y in spec.horizontal_lines:
+            ax.plot(xlim, [y, y + stupid_jitter], color="0.5",
+                    linestyle=":")
+            # PROBLEM: horizontal lines becoming invisible
+            # (whether from ax.axhline or plot)
+
+    # Horizontal labels
+    if spec.horizontal_labels is not None:
+        label_left = xlim[0] + 0.01 * (xlim[1] - xlim[0])
+        for y, label, va in spec.horizontal_labels:
+            ax.text(label_left, y, label, verticalalignment=va, alpha=0.5,
+                    fontdict=fontdict)
+
+    # replot so the data are on top of the rest:
+    ax.plot(x, values, color="b", linestyle="-", marker="+",
+            markeredgecolor="r", markerfacecolor="r", label=None)
+    # ... NB command performed twice, see above
+
+    set_figure_font_sizes(ax, fontdict)
+
+    fig.tight_layout()
+    # ... stop the labels dropping off
+    # (only works properly for LEFT labels...)
+
+    return get_html_from_pyplot_figure(fig, spec.use_svg) + "<br>"
+    # ... extra line break for the PDF rendering
+
+
+# =============================================================================
+# Cache
+# =============================================================================
+
+class TrackerPlotCache(object):
+    """
+    Thread-safe LRU cache of figure HTML, bounded by total size.
+    """
+    def __init__(self, max_size_bytes: int,
+                 stats: CacheRegionStats = None) -> None:
+        self.max_size_bytes = max_size_bytes
+        self.stats = stats or CacheRegionStats("tracker_figures")
+        self._items = OrderedDict()  # type: OrderedDict[str, str]
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+        if html is None:
+            self.stats.record(misses=1)
+        else:
+            self.stats.record(hits=1)
+        return html
+
+    def put(self, key: str, html: str) -> None:
+        size = len(html)
+        if size > self.max_size_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = html
+            self._size += size
+            while self._size > self.max_size_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+# =============================================================================
+# Process-wide cache and pool
+# =============================================================================
+
+_tracker_plot_cache = None  # type: Optional[TrackerPlotCache]
+_tracker_plot_pool = None  # type: Optional[ProcessPoolExecutor]
+_tracker_plot_processes = 0
+_tracker_plot_configured = False
+
+
+def configure_tracker_plots(processes: int, cache_max_size_mb: int) -> None:
+    """
+    Sets up the process-wide figure cache (if ``cache_max_size_mb`` is
+    positive) and worker pool (if ``processes`` is positive; started on first
+    use). Only the first call has any effect (the config is not re-read within
+    a process).
+    """
+    global _tracker_plot_cache, _tracker_plot_processes, \
+        _tracker_plot_configured
+    if _tracker_plot_configured:
+        return
+    if cache_max_size_mb > 0:
+        _tracker_plot_cache = TrackerPlotCache(
+            max_size_bytes=cache_max_size_mb * 1024 * 1024,
+            stats=make_cache_stats("tracker_figures")
+        )
+    _tracker_plot_processes = max(0, processes)
+    _tracker_plot_configured = True
+
+
+def _get_tracker_plot_pool() -> Optional[ProcessPoolExecutor]:
+    global _tracker_plot_pool
+    if (_tracker_plot_processes == 0 or
+            multiprocessing.current_process().daemon):
+        # ... a daemonic process can't have children
+        return None
+    if _tracker_plot_pool is None:
+        _tracker_plot_pool = ProcessPoolExecutor(
+            max_workers=_tracker_plot_processes,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        log.info("Started {} tracker figure worker(s)",
+                 _tracker_plot_processes)
+    return _tracker_plot_pool
+
+
+def render_tracker_plots(specs: Sequence[TrackerPlotSpec]) -> List[str]:
+    """
+    Returns HTML for each figure, in order, using the cache and (for figures
+    not in it) the worker pool where available.
+    """
+    cache = _tracker_plot_cache
+    keys = [spec.cache_key() for spec in specs]
+    results = [
+        cache.get(key) if cache is not None else None
+        for key in keys
+    ]  # type: List[Optional[str]]
+    todo = [i for i, html in enumerate(results) if html is None]
+    pool = _get_tracker_plot_pool() if len(todo) > 1 else None
+    if pool is not None:
+        futures = [(i, pool.submit(render_tracker_plot, specs[i]))
+                   for i in todo]
+        for i, future in futures:
+            results[i] = future.result()
+    else:
+        for i in todo:
+            results[i] = render_tracker_plot(specs[i])
+    if cache is not None:
+        for i in todo:
+            cache.put(keys[i], results[i])
+    return results
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class TrackerPlotCacheTests(unittest.TestCase):
+    """
+    Unit tests.
+    """
+    def test_lru(self) -> None:
+        cache = TrackerPlotCache(max_size_bytes=10)
+        cache.put("a", "xxxx")
+        cache.put("b", "yyyy")
+        self.assertEqual(cache.get("a"), "xxxx")  # now most recently used
+        cache.put("c", "zzzz")  # evicts "b"
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "xxxx")
+        self.assertEqual(cache.get("c"), "zzzz")
+        self.assertEqual((cache.stats.hits, cache.stats.misses), (3, 1))
+
+
+class TrackerPlotPoolTests(unittest.TestCase):
+    """
+    Unit tests.
+    """
+    @staticmethod
+    def _spec(values: List[Optional[float]]) -> TrackerPlotSpec:
+        return TrackerPlotSpec(
+            tablename="phq9",
+            tracker_index=0,
+            x=[737000.0, 737001.0, 737002.0],
+            x_labels=["2018-11-25", "2018-11-26", "2018-11-27"],
+            values=values,
+            xlim=None,
+            plot_label="PHQ-9 total score",
+            axis_label="Total score (out of 27)",
+            axis_min=-0.5,
+            axis_max=27.5,
+            axis_ticks=[(0, "0"), (10, "10"), (20, "20")],
+            horizontal_lines=[9.5, 19.5],
+            horizontal_labels=[(10, "moderate", "bottom")],
+            aspect_ratio=2.0,
+            fontdict=dict(family="sans-serif", size=10),
+            use_svg=False,  # PNG output is deterministic; SVG IDs aren't
+        )
+
+    def test_pool_round_trip(self) -> None:
+        specs = [
+            self._spec([5.0, None, 12.0]),
+            self._spec([21.0, 20.0, 18.0]),
+            self._spec([None, None, None]),
+        ]
+        expected = [render_tracker_plot(spec) for spec in specs]
+        self.assertEqual(expected[2], "")
+        with mock.patch(__name__ + "._tracker_plot_processes", 2), \
+                mock.patch(__name__ + "._tracker_plot_cache", None), \
+                mock.patch(__name__ + "._tracker_plot_pool", None):
+            try:
+                results = render_tracker_plots(specs)
+                pool = _tracker_plot_pool
+            finally:
+                if _tracker_plot_pool is not None:
+                    _tracker_plot_pool.shutdown()
+        self.assertIsInstance(pool, ProcessPoolExecutor)
+        self.assertEqual(results, expected)
@@ -33,12 +33,17 @@ from collections import OrderedDict
 import csv
 import datetime
 import io
+import itertools
 import logging
 import os
+import pickle
 import random
 import re
-from typing import (Any, BinaryIO, Callable, Dict, Iterable, List, Optional,
-                    Union)
+import tempfile
+import time
+import timeit
+from typing import (Any, BinaryIO, Callable, Dict, Generator, IO, Iterable,
+                    List, Optional, Tuple, Union)
 from unittest import TestCase
 import zipfile
 
@@ -49,6 +54,11 @@ from cardinal_pythonlib.datetimefunc import (
 from cardinal_pythonlib.excel import convert_for_openpyxl
 from cardinal_pythonlib.logs import BraceStyleAdapter
 from numpy import float64
+# openpyxl is always required: pyexcel_xlsx uses it, and we use its write-only
+# mode directly for disk-backed (spooled) XLSX exports.
+import openpyxl
+from openpyxl.workbook.workbook import Workbook as XLWorkbook
+from openpyxl.worksheet.worksheet import Worksheet as XLWorksheet
 from pendulum.datetime import DateTime
 from semantic_version import Version
 
@@ -66,11 +76,7 @@ else:
 
 if XLSX_VIA_PYEXCEL:
     import pyexcel_xlsx  # e.g. pip install pyexcel-xlsx==0.5.7
-    openpyxl = XLWorkbook = XLWorksheet = None
 else:
-    import openpyxl
-    from openpyxl.workbook.workbook import Workbook as XLWorkbook
-    from openpyxl.worksheet.worksheet import Worksheet as XLWorksheet
     pyexcel_xlsx = None
 
 log = BraceStyleAdapter(logging.getLogger(__name__))
@@ -109,6 +115,44 @@ def convert_for_pyexcel_ods3(x: Any) -> Any:
         return x
 
 
+# =============================================================================
+# R helpers
+# =============================================================================
+
+def r_script_header() -> str:
+    """
+    Returns the start of an R script containing data, up to the point at which
+    the table definitions begin.
+    """
+    now = format_datetime(get_now_localtz_pendulum(),
+                          DateFormat.ISO8601_HUMANIZED_TO_SECONDS_TZ)
+    return f"""
+#!/usr/bin/env Rscript
+
+# R script generated by CamCOPS at {now}
+
+# =============================================================================
+# Libraries
+# =============================================================================
+
+library(data.table)
+
+# =============================================================================
+# Data
+# =============================================================================
+
+"""
+
+
+def r_object_name(page_name: str) -> str:
+    """
+    Name of the R object for a page ("spreadsheet") when imported into R.
+    The main thing: no leading underscores.
+    """
+    n = page_name[1:] if page_name.startswith("_") else page_name
+    return f"camcops_{n}"  # less chance of conflict within R
+
+
 # =============================================================================
 # TSV output holding structures
 # =============================================================================
@@ -116,6 +160,10 @@ def convert_for_pyexcel_ods3(x: Any) -> Any:
 class TsvPage(object):
     """
     Represents a single TSV "spreadsheet".
+
+    Internally, data are stored by column: an ordered list of headings, and a
+    dictionary mapping each heading to a list of values (one per row). Missing
+    values are ``None``.
     """
     def __init__(self, name: str,
                  rows: List[Union[Dict[str, Any], OrderedDict]]) -> None:
@@ -127,10 +175,11 @@ class TsvPage(object):
         """
         assert name, "Missing name"
         self.name = name
-        self.rows = rows
         self.headings = []  # type: List[str]
+        self._columns = {}  # type: Dict[str, List[Any]]
+        self._n_rows = 0
         for row in rows:
-            self._add_headings_if_absent(row.keys())
+            self._append_row(row)
 
     def __str__(self) -> str:
         return f"TsvPage: name={self.name}\n{self.get_tsv()}"
@@ -140,15 +189,67 @@ class TsvPage(object):
         """
         Do we have zero rows?
         """
-        return len(self.rows) == 0
+        return self._n_rows == 0
 
-    def _add_headings_if_absent(self, headings: Iterable[str]) -> None:
+    @property
+    def n_rows(self) -> int:
         """
-        Add any headings we've not yet seen to our list of headings.
+        Number of rows.
         """
-        for h in headings:
-            if h not in self.headings:
-                self.headings.append(h)
+        return self._n_rows
+
+    @property
+    def rows(self) -> List[Dict[str, Any]]:
+        """
+        Returns a list of rows, where each row is a dictionary mapping column
+        name to value. (This is built on demand; changing it does not change
+        the page.)
+        """
+        return [dict(zip(self.headings, values))
+                for values in self._gen_value_tuples()]
+
+    def get_column(self, heading: str) -> List[Any]:
+        """
+        Returns the values for the column labelled ``heading`` (all ``None``
+        if there is no such column). Don't modify the result.
+        """
+        column = self._columns.get(heading)
+        if column is None:
+            return [None] * self._n_rows
+        return column
+
+    def _add_heading_if_absent(self, heading: str) -> List[Any]:
+        """
+        Add a heading (and column of blank values) if we've not yet seen it.
+        Returns its column.
+        """
+        column = self._columns.get(heading)
+        if column is None:
+            column = [None] * self._n_rows
+            self._columns[heading] = column
+            self.headings.append(heading)
+        return column
+
+    def _append_row(self, row: Dict[str, Any]) -> None:
+        """
+        Adds a row (a dictionary mapping column name to value).
+        """
+        for heading, value in row.items():
+            self._add_heading_if_absent(heading).append(value)
+        self._n_rows += 1
+        if len(row) != len(self._columns):
+            # Some columns weren't in this row; pad them.
+            for column in self._columns.values():
+                if len(column) < self._n_rows:
+                    column.append(None)
+
+    def _gen_value_tuples(self) -> Iterable[Tuple[Any, ...]]:
+        """
+        Generates rows, as tuples of values in the order of our headings.
+        """
+        if not self.headings:
+            return (() for _ in range(self._n_rows))
+        return zip(*(self._columns[h] for h in self.headings))
 
     def add_or_set_value(self, heading: str, value: Any) -> None:
         """
@@ -158,9 +259,8 @@ class TsvPage(object):
         Raises:
             :exc:`AssertionError` if we don't have exactly 1 row
         """
-        assert len(self.rows) == 1, "add_value can only be used if #rows == 1"
-        self._add_headings_if_absent([heading])
-        self.rows[0][heading] = value
+        assert self._n_rows == 1, "add_value can only be used if #rows == 1"
+        self._add_heading_if_absent(heading)[0] = value
 
     def add_or_set_column(self, heading: str, values: List[Any]) -> None:
         """
@@ -172,10 +272,9 @@ class TsvPage(object):
             :exc:`AssertionError` if the number of values doesn't match
             the number of existing rows
         """
-        assert len(values) == len(self.rows), "#values != #existing rows"
-        self._add_headings_if_absent([heading])
-        for i, row in enumerate(self.rows):
-            row[heading] = values[i]
+        assert len(values) == self._n_rows, "#values != #existing rows"
+        self._add_heading_if_absent(heading)
+        self._columns[heading] = list(values)
 
     def add_or_set_columns_from_page(self, other: "TsvPage") -> None:
         """
@@ -190,18 +289,20 @@ class TsvPage(object):
             :exc:`AssertionError` if the two pages (sheets) don't have
             the same number of rows.
         """
-        assert len(self.rows) == len(other.rows), "Mismatched #rows"
-        self._add_headings_if_absent(other.headings)
-        for i, row in enumerate(self.rows):
-            for k, v in other.rows[i].items():
-                row[k] = v
+        assert self._n_rows == other._n_rows, "Mismatched #rows"
+        for heading in other.headings:
+            self._add_heading_if_absent(heading)
+            self._columns[heading] = other._columns[heading].copy()
 
     def add_rows_from_page(self, other: "TsvPage") -> None:
         """
         Add all rows from ``other`` to ``self``.
         """
-        self._add_headings_if_absent(other.headings)
-        self.rows.extend(other.rows)
+        for heading in other.headings:
+            self._add_heading_if_absent(heading)
+        for heading, column in self._columns.items():
+            column.extend(other.get_column(heading))
+        self._n_rows += other._n_rows
 
     def sort_headings(self) -> None:
         """
@@ -217,10 +318,7 @@ class TsvPage(object):
 
         Compare :attr:`rows`, which is a list of dictionaries.
         """
-        rows = []
-        for row in self.rows:
-            rows.append([row.get(h) for h in self.headings])
-        return rows
+        return [list(values) for values in self._gen_value_tuples()]
 
     def spreadsheetrows(self, converter: Callable[[Any], Any]) \
             -> List[List[Any]]:
@@ -230,9 +328,8 @@ class TsvPage(object):
         (b) includes a header row.
         """
         rows = [self.headings.copy()]
-        for row in self.rows:
-            rows.append([converter(row.get(h))
-                         for h in self.headings])
+        for values in self._gen_value_tuples():
+            rows.append([converter(v) for v in values])
         return rows
 
     def get_tsv(self, dialect: str = "excel-tab") -> str:
@@ -271,8 +368,7 @@ class TsvPage(object):
         f = io.StringIO()
         writer = csv.writer(f, dialect=dialect)
         writer.writerow(self.headings)
-        for row in self.rows:
-            writer.writerow([row.get(h) for h in self.headings])
+        writer.writerows(self._gen_value_tuples())
         return f.getvalue()
 
     def write_to_openpyxl_xlsx_worksheet(self, ws: "XLWorksheet") -> None:
@@ -280,26 +376,23 @@ class TsvPage(object):
         Writes data from this page to an existing ``openpyxl`` XLSX worksheet.
         """
         ws.append(self.headings)
-        for row in self.rows:
-            ws.append([convert_for_openpyxl(row.get(h))
-                       for h in self.headings])
+        for values in self._gen_value_tuples():
+            ws.append([convert_for_openpyxl(v) for v in values])
 
     def write_to_odswriter_ods_worksheet(self, ws: "ODSSheet") -> None:
         """
         Writes data from this page to an existing ``odswriter`` ODS sheet.
         """
         ws.writerow(self.headings)
-        for row in self.rows:
-            ws.writerow([row.get(h) for h in self.headings])
+        for values in self._gen_value_tuples():
+            ws.writerow(list(values))
 
     def r_object_name(self) -> str:
         """
         Name of the object when imported into R.
         The main thing: no leading underscores.
         """
-        n = self.name
-        n = n[1:] if n.startswith("_") else n
-        return f"camcops_{n}"  # less chance of conflict within R
+        return r_object_name(self.name)
 
     def r_data_table_definition(self) -> str:
         """
@@ -605,42 +698,317 @@ class TsvCollection(object):
         This could be more sophisticated, e.g. creating factors with
         appropriate levels (etc.).
         """
-        now = format_datetime(get_now_localtz_pendulum(),
-                              DateFormat.ISO8601_HUMANIZED_TO_SECONDS_TZ)
         table_definition_str = "\n\n".join(
             page.r_data_table_definition()
             for page in self.pages
         )
-        script = f"""
-#!/usr/bin/env Rscript
+        return f"{r_script_header()}{table_definition_str}\n\n"
 
-# R script generated by CamCOPS at {now}
+    def write_r(self, filename: str, encoding: str = "utf-8") -> None:
+        """
+        Write the contents in R format to a file.
 
-# =============================================================================
-# Libraries
-# =============================================================================
+        Args:
+            filename: filename or file-like object
+            encoding: encoding to use
+        """
+        with open(filename, "wt", encoding=encoding) as f:
+            f.write(self.as_r())
 
-library(data.table)
 
 # =============================================================================
-# Data
+# Disk-backed TSV collection, for large exports
 # =============================================================================
 
-{table_definition_str}
+class SpooledTsvPage(object):
+    """
+    A single TSV "spreadsheet" whose rows are spooled to a disk file as they
+    arrive, rather than kept in memory. Only the headings are held in memory.
 
-"""
-        return script
+    Rows are stored as pickled lists of values, in the order of the headings
+    as they were when the row was written (headings are only ever appended,
+    so earlier rows are simply shorter).
+    """
+    def __init__(self, name: str, filename: str) -> None:
+        """
+        Args:
+            name: name for the whole sheet
+            filename: filename of the spool file (which we create)
+        """
+        assert name, "Missing name"
+        self.name = name
+        self.filename = filename
+        self.headings = []  # type: List[str]
+        self.n_rows = 0
+        self._spooled_headings = []  # type: List[str]  # insertion order
+        self._file = None  # type: Optional[IO[bytes]]
 
-    def write_r(self, filename: str, encoding: str = "utf-8") -> None:
+    @property
+    def empty(self) -> bool:
         """
-        Write the contents in R format to a file.
+        Do we have zero rows?
+        """
+        return self.n_rows == 0
+
+    def add_rows_from_page(self, other: TsvPage) -> None:
+        """
+        Spool all rows from ``other`` (an in-memory page) to disk.
+        """
+        for h in other.headings:
+            if h not in self._spooled_headings:
+                self._spooled_headings.append(h)
+                self.headings.append(h)
+        if self._file is None:
+            self._file = open(self.filename, "ab")
+        columns = [other.get_column(h) for h in self._spooled_headings]
+        if columns:
+            rows = zip(*columns)
+        else:
+            rows = ([] for _ in range(other.n_rows))
+        for values in rows:
+            pickle.dump(list(values), self._file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        self.n_rows += other.n_rows
+
+    def close(self) -> None:
+        """
+        Close our spool file (it's reopened for appending if need be).
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def sort_headings(self) -> None:
+        """
+        Sort our headings (for output; the spooled data are unaffected).
+        """
+        self.headings.sort()
+
+    def gen_plainrows(self, converter: Callable[[Any], Any] = None) \
+            -> Generator[List[Any], None, None]:
+        """
+        Generates rows from the spool file, each a list of values in the order
+        of :attr:`headings`. Does not include a "header" row.
 
         Args:
-            filename: filename or file-like object
-            encoding: encoding to use
+            converter: optional function to apply to each value
+        """
+        self.close()
+        if self.empty:
+            return
+        positions = [self._spooled_headings.index(h) for h in self.headings]
+        with open(self.filename, "rb") as f:
+            for _ in range(self.n_rows):
+                values = pickle.load(f)
+                n = len(values)
+                row = [values[p] if p < n else None for p in positions]
+                if converter:
+                    row = [converter(x) for x in row]
+                yield row
+
+    def write_tsv(self, textfile: IO[str], dialect: str = "excel-tab") -> None:
+        """
+        Writes the page as TSV (one header row, then data rows) to a text
+        file. See :meth:`TsvPage.get_tsv`.
+        """
+        writer = csv.writer(textfile, dialect=dialect)
+        writer.writerow(self.headings)
+        for row in self.gen_plainrows():
+            writer.writerow(row)
+
+    def write_r_data_table_definition(self, textfile: IO[str]) -> None:
+        """
+        Writes this page to a text file as a ``data.table`` definition in R.
+        See :meth:`TsvPage.r_data_table_definition`.
+        """
+        textfile.write(
+            f'{r_object_name(self.name)} <- '
+            f'data.table::fread(sep=",", header=TRUE, text="'
+        )
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, dialect="excel")
+        for row in itertools.chain([self.headings], self.gen_plainrows()):
+            writer.writerow(row)
+            textfile.write(buffer.getvalue().replace('"', r'\"'))
+            buffer.seek(0)
+            buffer.truncate()
+        textfile.write('"\n)')
+
+
+class SpooledTsvCollection(object):
+    """
+    A disk-backed equivalent of :class:`TsvCollection`, for exports too large
+    to hold in memory. Pages are added (e.g. task by task) and their rows are
+    spooled to per-page files in a temporary directory; the output file (ZIP of
+    TSVs, XLSX, ODS, R) is then assembled from those, page by page.
+
+    Use as a context manager, so the temporary files are deleted afterwards:
+
+    .. code-block:: python
+
+        with SpooledTsvCollection() as coll:
+            for task in tasks:
+                coll.add_pages(task.get_tsv_pages(req))
+            coll.write_xlsx("/some/file.xlsx")
+    """
+    MAX_OPEN_SPOOL_FILES = 100  # stay well under OS file handle limits
+
+    def __init__(self, tmpdir: str = None) -> None:
+        """
+        Args:
+            tmpdir: parent directory for temporary spool files (default: the
+                system temporary directory)
+        """
+        self._tempdir = tempfile.TemporaryDirectory(dir=tmpdir)
+        self._pages = OrderedDict()  # type: Dict[str, SpooledTsvPage]
+        self._open_pages = []  # type: List[SpooledTsvPage]
+
+    def __enter__(self) -> "SpooledTsvCollection":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.cleanup()
+
+    def cleanup(self) -> None:
+        """
+        Closes and deletes all spool files.
+        """
+        for page in self._pages.values():
+            page.close()
+        self._open_pages = []
+        self._tempdir.cleanup()
+
+    # -------------------------------------------------------------------------
+    # Pages
+    # -------------------------------------------------------------------------
+
+    @property
+    def pages(self) -> List[SpooledTsvPage]:
+        """
+        Our pages, sorted by page name.
+        """
+        return sorted(self._pages.values(), key=lambda p: p.name)
+
+    def add_page(self, page: TsvPage) -> None:
+        """
+        Spools the rows of an in-memory page to disk, creating a new spooled
+        page or appending to an existing one with the same name (as for
+        :meth:`TsvCollection.add_page`). Does nothing if the page is empty.
+        """
+        if page.empty:
+            return
+        spooled = self._pages.get(page.name)
+        if spooled is None:
+            filename = os.path.join(self._tempdir.name,
+                                    f"{len(self._pages)}.pickle")
+            spooled = SpooledTsvPage(name=page.name, filename=filename)
+            self._pages[page.name] = spooled
+        if spooled not in self._open_pages:
+            if len(self._open_pages) >= self.MAX_OPEN_SPOOL_FILES:
+                for p in self._open_pages:
+                    p.close()
+                self._open_pages = []
+            self._open_pages.append(spooled)
+        spooled.add_rows_from_page(page)
+
+    def add_pages(self, pages: List[TsvPage]) -> None:
+        """
+        Adds all ``pages`` to our collection, via :func:`add_page`.
+        """
+        for page in pages:
+            self.add_page(page)
+
+    def sort_headings_within_all_pages(self) -> None:
+        """
+        Sort headings within each of our pages.
+        """
+        for page in self._pages.values():
+            page.sort_headings()
+
+    # -------------------------------------------------------------------------
+    # Output
+    # -------------------------------------------------------------------------
+
+    def write_zip(self,
+                  file: Union[str, BinaryIO],
+                  encoding: str = "utf-8",
+                  compression: int = zipfile.ZIP_DEFLATED) -> None:
+        """
+        Writes data to a file, as a ZIP file of TSV files, streaming each TSV
+        into the ZIP. See :meth:`TsvCollection.write_zip`.
+        """
+        with zipfile.ZipFile(file, mode="w", compression=compression) as z:
+            for page in self.pages:
+                # force_zip64: we don't know in advance how big each TSV is
+                with z.open(page.name + ".tsv", mode="w",
+                            force_zip64=True) as binaryfile:
+                    with io.TextIOWrapper(binaryfile, encoding=encoding,
+                                          newline="") as textfile:
+                        page.write_tsv(textfile)
+
+    def write_xlsx(self, file: Union[str, BinaryIO]) -> None:
+        """
+        Writes the contents in XLSX (Excel) format to a file, using
+        ``openpyxl`` in write-only mode, which streams rows to disk.
+        """
+        wb = XLWorkbook(write_only=True)
+        valid_name_dict = self.get_pages_with_valid_sheet_names()
+        for page, title in valid_name_dict.items():
+            ws = wb.create_sheet(title=title)
+            ws.append(page.headings)
+            for row in page.gen_plainrows(convert_for_openpyxl):
+                ws.append(row)
+        wb.save(file)
+
+    def write_ods(self, file: Union[str, BinaryIO]) -> None:
+        """
+        Writes an ODS (OpenOffice spreadsheet document) to a file.
+
+        Rows are generated from disk, but note that ``pyexcel-ods3`` builds
+        the whole document in memory before saving it.
+        """
+        valid_name_dict = self.get_pages_with_valid_sheet_names()
+        if ODS_VIA_PYEXCEL:  # use pyexcel_ods3
+            data = OrderedDict()
+            for page, title in valid_name_dict.items():
+                data[title] = itertools.chain(
+                    [page.headings],
+                    page.gen_plainrows(convert_for_pyexcel_ods3)
+                )
+            pyexcel_ods3.save_data(file, data)
+        else:  # use odswriter
+            if isinstance(file, str):  # it's a filename
+                with open(file, "wb") as binaryfile:
+                    return self.write_ods(binaryfile)  # recurse once
+            with ODSWriter(file) as odsfile:
+                for page, title in valid_name_dict.items():
+                    sheet = odsfile.new_sheet(name=title)
+                    sheet.writerow(page.headings)
+                    for row in page.gen_plainrows():
+                        sheet.writerow(row)
+
+    def get_pages_with_valid_sheet_names(self) -> Dict[SpooledTsvPage, str]:
+        """
+        Returns an ordered mapping from our pages to their (unique) sheet
+        names. See :meth:`TsvCollection.get_pages_with_valid_sheet_names`.
+        """
+        name_dict = OrderedDict()
+        for page in self.pages:
+            name_dict[page] = TsvCollection.get_sheet_title(page)
+        TsvCollection.make_sheet_names_unique(name_dict)
+        return name_dict
+
+    def write_r(self, filename: str, encoding: str = "utf-8") -> None:
+        """
+        Writes the contents as an R script. See :meth:`TsvCollection.as_r`.
         """
         with open(filename, "wt", encoding=encoding) as f:
-            f.write(self.as_r())
+            f.write(r_script_header())
+            for i, page in enumerate(self.pages):
+                if i > 0:
+                    f.write("\n\n")
+                page.write_r_data_table_definition(f)
+            f.write("\n\n")
 
 
 # =============================================================================
@@ -749,6 +1117,101 @@ class TsvCollectionTests(TestCase):
         self.assertIn("abcdefghijklmnopqrstuvwxyz78..2", names)
 
 
+class TsvPageTests(TestCase):
+    def test_rows_with_different_headings(self) -> None:
+        page = TsvPage(name="test", rows=[{"a": 1, "b": 2}, {"b": 3, "c": 4}])
+        self.assertEqual(page.headings, ["a", "b", "c"])
+        self.assertEqual(page.plainrows, [[1, 2, None], [None, 3, 4]])
+        self.assertEqual(page.rows, [{"a": 1, "b": 2, "c": None},
+                                     {"a": None, "b": 3, "c": 4}])
+
+    def test_add_columns_and_rows(self) -> None:
+        page = TsvPage(name="test", rows=[{"a": 1}, {"a": 2}])
+        page.add_or_set_columns_from_page(
+            TsvPage(name="other", rows=[{"b": 3}, {"b": 4}]))
+        page.add_or_set_column("c", [5, 6])
+        page.add_rows_from_page(TsvPage(name="test", rows=[{"d": 7}]))
+        self.assertEqual(page.headings, ["a", "b", "c", "d"])
+        self.assertEqual(page.plainrows, [[1, 3, 5, None],
+                                          [2, 4, 6, None],
+                                          [None, None, None, 7]])
+
+    def test_add_or_set_value(self) -> None:
+        page = TsvPage(name="test", rows=[{"a": 1}])
+        page.add_or_set_value("a", 2)
+        page.add_or_set_value("b", 3)
+        self.assertEqual(page.get_tsv(), "a\tb\r\n2\t3\r\n")
+
+
+class SpooledTsvCollectionTests(TestCase):
+    @staticmethod
+    def _make_pages() -> List[TsvPage]:
+        return [
+            TsvPage(name="b", rows=[{"x": 1, "y": "tab\there"}]),
+            TsvPage(name="a", rows=[{"q": 2}]),
+            TsvPage(name="b", rows=[{"z": 3, "x": 4}]),
+            TsvPage(name="_c", rows=[{"w": 'say "hi"'}]),
+        ]
+
+    def _make_memory_collection(self) -> TsvCollection:
+        coll = TsvCollection()
+        coll.add_pages(self._make_pages())
+        coll.sort_pages()
+        coll.sort_headings_within_all_pages()
+        return coll
+
+    def test_zip_matches_in_memory_version(self) -> None:
+        expected = zipfile.ZipFile(
+            io.BytesIO(self._make_memory_collection().as_zip()))
+        with SpooledTsvCollection() as coll:
+            coll.add_pages(self._make_pages())
+            coll.sort_headings_within_all_pages()
+            with io.BytesIO() as memfile:
+                coll.write_zip(memfile)
+                actual = zipfile.ZipFile(io.BytesIO(memfile.getvalue()))
+        self.assertEqual(actual.namelist(), expected.namelist())
+        for name in expected.namelist():
+            self.assertEqual(actual.read(name), expected.read(name))
+
+    def test_r_matches_in_memory_version(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            expected_filename = os.path.join(tmpdir, "expected.R")
+            actual_filename = os.path.join(tmpdir, "actual.R")
+            self._make_memory_collection().write_r(expected_filename)
+            with SpooledTsvCollection() as coll:
+                coll.add_pages(self._make_pages())
+                coll.sort_headings_within_all_pages()
+                coll.write_r(actual_filename)
+            with open(expected_filename) as f:
+                expected = f.read()
+            with open(actual_filename) as f:
+                actual = f.read()
+        self.assertEqual(actual, expected)
+
+    def test_xlsx_worksheet_names_and_rows(self) -> None:
+        with SpooledTsvCollection() as coll:
+            coll.add_pages(self._make_pages())
+            with io.BytesIO() as memfile:
+                coll.write_xlsx(memfile)
+                wb = openpyxl.load_workbook(io.BytesIO(memfile.getvalue()))
+        self.assertEqual(wb.sheetnames, ["_c", "a", "b"])
+        self.assertEqual(
+            [[cell.value for cell in row] for row in wb["b"].iter_rows()],
+            [["x", "y", "z"], [1, "tab\there", None], [4, None, 3]]
+        )
+
+    def test_many_pages(self) -> None:
+        n = SpooledTsvCollection.MAX_OPEN_SPOOL_FILES + 10
+        with SpooledTsvCollection() as coll:
+            for _ in range(2):
+                coll.add_pages([TsvPage(name=f"page{i}", rows=[{"x": i}])
+                                for i in range(n)])
+            pages = coll.pages
+            self.assertEqual(len(pages), n)
+            for page in pages:
+                self.assertEqual(len(list(page.gen_plainrows())), 2)
+
+
 def _make_benchmarking_collection(nsheets: int = 100,
                                   nrows: int = 200,
                                   ncols: int = 30,
@@ -777,10 +1240,71 @@ def file_size(filename: str) -> int:
     return os.stat(filename).st_size
 
 
+def _dict_rows_tsv(rows: List[Dict[str, Any]]) -> str:
+    """
+    Produces TSV from a list of row dictionaries in the way that
+    :class:`TsvPage` used to (a heading list searched for every heading of
+    every row, then one ``dict.get`` per cell). For benchmarking only.
+    """
+    headings = []  # type: List[str]
+    for row in rows:
+        for h in row.keys():
+            if h not in headings:
+                headings.append(h)
+    f = io.StringIO()
+    writer = csv.writer(f, dialect="excel-tab")
+    writer.writerow(headings)
+    for row in rows:
+        writer.writerow([row.get(h) for h in headings])
+    return f.getvalue()
+
+
+def benchmark_tsv_page(nrows: int = 2000,
+                       ncols: int = 300,
+                       repeats: int = 3) -> None:
+    """
+    Compares :class:`TsvPage` (columnar) with the older row-dictionary
+    approach, for a single wide page (like those from CIS-R or CECA), timing
+    page creation plus TSV output. Logs the best time from ``repeats`` runs.
+
+    Use with:
+
+    .. code-block:: python
+
+        from cardinal_pythonlib.logs import main_only_quicksetup_rootlogger
+        from camcops_server.cc_modules.cc_tsv import benchmark_tsv_page
+        main_only_quicksetup_rootlogger()
+        benchmark_tsv_page()
+    """
+    rows = [
+        {f"c{colnum}": random.randint(0, 1000000)
+         for colnum in range(1, ncols + 1)}
+        for _ in range(nrows)
+    ]
+
+    def _columnar() -> str:
+        return TsvPage(name="benchmark", rows=rows).get_tsv()
+
+    def _dict_rows() -> str:
+        return _dict_rows_tsv(rows)
+
+    assert _columnar() == _dict_rows(), "Implementations differ!"
+    t_columnar = min(timeit.repeat(_columnar, number=1, repeat=repeats))
+    t_dict_rows = min(timeit.repeat(_dict_rows, number=1, repeat=repeats))
+    log.info(f"TsvPage with nrows={nrows}, ncols={ncols}: "
+             f"row dictionaries {t_dict_rows:.3f} s; "
+             f"columnar {t_columnar:.3f} s; "
+             f"speedup {t_dict_rows / t_columnar:.1f}x")
+
+
 def benchmark_save(xlsx_filename: str = "test.xlsx",
                    ods_filename: str = "test.ods",
                    tsv_zip_filename: str = "test.zip",
-                   r_filename: str = "test.R") -> None:
+                   r_filename: str = "test.R",
+                   nsheets: int = 100,
+                   nrows: int = 200,
+                   ncols: int = 30,
+                   compare_page_implementations: bool = True) -> None:
     """
     Use with:
 
@@ -796,6 +1320,12 @@ def benchmark_save(xlsx_filename: str = "test.xlsx",
         ods_filename: ODS file to create
         tsv_zip_filename: TSV ZIP file to create
         r_filename: R script to create
+        nsheets: number of pages (sheets)
+        nrows: number of rows per page
+        ncols: number of columns per page
+        compare_page_implementations: also run :func:`benchmark_tsv_page`,
+            with the same number of rows and columns, to compare
+            :class:`TsvPage` with the older row-dictionary approach?
 
     Problem in Nov 2019 is that ODS is extremely slow. Rough timings:
 
@@ -805,20 +1335,21 @@ def benchmark_save(xlsx_filename: str = "test.xlsx",
     - ODS (via odswriter): about 53 Mb, 56 seconds.
     - ODS (via pyexcel_ods3): about 2.8 Mb, 29 seconds.
     """
-    coll = _make_benchmarking_collection()
-
-    log.info("Writing TSV ZIP...")
-    coll.write_zip(tsv_zip_filename)
-    log.info(f"... done. File size {file_size(tsv_zip_filename)}")
-
-    log.info("Writing XLSX...")
-    coll.write_xlsx(xlsx_filename)
-    log.info(f"... done. File size {file_size(xlsx_filename)}")
-
-    log.info("Writing ODS...")
-    coll.write_ods(ods_filename)
-    log.info(f"... done. File size {file_size(ods_filename)}")
-
-    log.info("Writing R...")
-    coll.write_r(r_filename)
-    log.info(f"... done. File size {file_size(r_filename)}")
+    if compare_page_implementations:
+        benchmark_tsv_page(nrows=nrows, ncols=ncols)
+
+    start = time.perf_counter()
+    coll = _make_benchmarking_collection(nsheets=nsheets, nrows=nrows,
+                                         ncols=ncols)
+    log.info(f"... collection built in {time.perf_counter() - start:.3f} s")
+
+    for description, writer, filename in (
+            ("TSV ZIP", coll.write_zip, tsv_zip_filename),
+            ("XLSX", coll.write_xlsx, xlsx_filename),
+            ("ODS", coll.write_ods, ods_filename),
+            ("R", coll.write_r, r_filename)):
+        log.info(f"Writing {description}...")
+        start = time.perf_counter()
+        writer(filename)
+        log.info(f"... done in {time.perf_counter() - start:.3f} s. "
+                 f"File size {file_size(filename)}")
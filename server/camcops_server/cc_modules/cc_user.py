@@ -52,7 +52,10 @@ from sqlalchemy.sql.sqltypes import Boolean, DateTime, Integer
 
 from camcops_server.cc_modules.cc_audit import audit
 from camcops_server.cc_modules.cc_constants import USER_NAME_FOR_SYSTEM
-from camcops_server.cc_modules.cc_group import Group
+from camcops_server.cc_modules.cc_group import (
+    get_group_visibility_map,
+    Group,
+)
 from camcops_server.cc_modules.cc_membership import UserGroupMembership
 from camcops_server.cc_modules.cc_sqla_coltypes import (
     EmailAddressColType,
@@ -353,6 +356,7 @@ class SecurityLoginFailure(Base):
         cls.clear_login_failures_for_nonexistent_users(req)
         log.debug("Dummy login failures cleared.")
         ss.last_dummy_login_failure_clearance_at_utc = now
+        req.invalidate_db_cache()  # server settings changed
 
 
 # =============================================================================
@@ -754,10 +758,14 @@ class User(Base):
         # And relevant set operations:
         # https://stackoverflow.com/questions/4045403/python-how-to-add-the-contents-of-an-iterable-to-a-set  # noqa
         #
-        # Process as a set rather than a list, to eliminate duplicates:
+        # Process as a set rather than a list, to eliminate duplicates.
+        # Group-to-group visibility comes from the (shared) cache, saving one
+        # query per group.
+        visibility = get_group_visibility_map(
+            SqlASession.object_session(self))
         group_ids = set()  # type: Set[int]
-        for my_group in self.groups:  # type: Group
-            group_ids.update(my_group.ids_of_groups_group_may_see())
+        for m in self.user_group_memberships:
+            group_ids.update(visibility.get(m.group_id, [m.group_id]))
         return list(group_ids)
         # Return as a list rather than a set, because SQLAlchemy's in_()
         # operator only likes lists and ?tuples.
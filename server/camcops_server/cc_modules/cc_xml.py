@@ -30,8 +30,11 @@ camcops_server/cc_modules/cc_xml.py
 
 import base64
 import datetime
+import io
 import logging
-from typing import Any, List, Optional, TYPE_CHECKING, Union
+from typing import (Any, Callable, Iterable, Iterator, List, Optional,
+                    TextIO, TYPE_CHECKING, Union)
+import unittest
 import xml.sax.saxutils
 
 from cardinal_pythonlib.logs import BraceStyleAdapter
@@ -100,9 +103,9 @@ class XmlElement(object):
         """
         Args:
             name: name of this XML element
-            value: value of this element: may be a raw value or a list of
-                :class:`camcops_server.cc_modules.cc_xml.XmlElement` objects
-                (default: ``None``)
+            value: value of this element: may be a raw value, a list of
+                :class:`camcops_server.cc_modules.cc_xml.XmlElement` objects,
+                or an :class:`XmlLazyBranches` object (default: ``None``)
             datatype: data type of this element (default: ``None``)
             comment: description of this element (default: ``None``)
             literal: literal XML; overrides all other options
@@ -131,6 +134,30 @@ class XmlLiteral(XmlElement):
         super().__init__(name="", literal=literal)
 
 
+class XmlLazyBranches(object):
+    """
+    Represents a list of XML branches (each an :class:`XmlElement`) that is
+    only created when it's needed, i.e. when it's being written (see
+    :func:`write_xml_tree`). That way, large parts of a tree (such as the
+    records ancillary to a task, or BLOBs) can be converted to XML one at a
+    time, rather than all held in memory at once.
+
+    The branches are created afresh each time the object is iterated through.
+    """
+    def __init__(self, factory: Callable[[], Iterable[XmlElement]]) -> None:
+        """
+        Args:
+            factory: function returning (or generating) the branches
+        """
+        self.factory = factory
+
+    def __iter__(self) -> Iterator[XmlElement]:
+        return iter(self.factory())
+
+    def __repr__(self) -> str:
+        return auto_repr(self, with_addr=True)
+
+
 # =============================================================================
 # Some literals
 # =============================================================================
@@ -239,7 +266,9 @@ def make_xml_branches_from_blobs(
         blob = getattr(obj, relationship_attr)
         branches.append(XmlElement(
             name=relationship_attr,
-            value=None if blob is None else blob.get_xml_element(req),
+            value=None if blob is None else XmlLazyBranches(
+                lambda b=blob: [b.get_xml_element(req)]
+            ),  # encoded only when written
             comment=column.comment,
         ))
     return branches
@@ -337,16 +366,22 @@ def xml_quote_attribute(attr: str) -> str:
     return xml.sax.saxutils.quoteattr(attr)
 
 
-def get_xml_tree(element: Union[XmlElement, XmlSimpleValue,
-                                List[Union[XmlElement, XmlSimpleValue]]],
-                 level: int = 0,
-                 indent_spaces: int = 4,
-                 eol: str = '\n',
-                 include_comments: bool = False) -> str:
+def write_xml_tree(sink: TextIO,
+                   element: Union[XmlElement, XmlSimpleValue,
+                                  List[Union[XmlElement, XmlSimpleValue]],
+                                  XmlLazyBranches],
+                   level: int = 0,
+                   indent_spaces: int = 4,
+                   eol: str = '\n',
+                   include_comments: bool = False) -> None:
     """
-    Returns an :class:`camcops_server.cc_modules.cc_xml.XmlElement` as text.
+    Writes an :class:`camcops_server.cc_modules.cc_xml.XmlElement` as text to
+    a file-like object, in a single pass. (Compare :func:`get_xml_tree`, which
+    returns the text.)
 
     Args:
+        sink: file-like object, opened in text mode (or anything else with a
+            ``write(str)`` method)
         element: root :class:`camcops_server.cc_modules.cc_xml.XmlElement`
         level: starting level/depth (used for recursion)
         indent_spaces: number of spaces to indent formatted XML
@@ -375,14 +410,14 @@ def get_xml_tree(element: Union[XmlElement, XmlSimpleValue,
       too).
 
     """  # noqa
-    xmltext = ""
+    write = sink.write
     prefix = ' ' * level * indent_spaces
 
     if isinstance(element, XmlElement):
 
         if element.literal:
             # A user-inserted piece of XML. Insert, but indent.
-            xmltext += prefix + element.literal + eol
+            write(prefix + element.literal + eol)
 
         else:
 
@@ -407,13 +442,13 @@ def get_xml_tree(element: Union[XmlElement, XmlSimpleValue,
             # Assemble
             if element.value is None:
                 # NULL handling
-                xmltext += (
+                write(
                     f'{prefix}<{element.name}{attributes} '
                     f'xsi:nil="true"/>{eol}'
                 )
             else:
-                complex_value = isinstance(element.value, XmlElement) \
-                    or isinstance(element.value, list)
+                complex_value = isinstance(
+                    element.value, (XmlElement, list, XmlLazyBranches))
                 value_to_recurse = element.value if complex_value else \
                     XmlSimpleValue(element.value)
                 # ... XmlSimpleValue is a marker that subsequently
@@ -421,34 +456,87 @@ def get_xml_tree(element: Union[XmlElement, XmlSimpleValue,
                 # user-inserted raw XML.
                 nl = eol if complex_value else ""
                 pr2 = prefix if complex_value else ""
-                v = get_xml_tree(
+                write(f'{prefix}<{element.name}{attributes}>{nl}')
+                write_xml_tree(
+                    sink,
                     value_to_recurse,
                     level=level + 1,
                     indent_spaces=indent_spaces,
                     eol=eol,
                     include_comments=include_comments
                 )
-                xmltext += (
-                    f'{prefix}<{element.name}{attributes}>{nl}'
-                    f'{v}{pr2}</{element.name}>{eol}'
-                )
+                write(f'{pr2}</{element.name}>{eol}')
 
-    elif isinstance(element, list):
+    elif isinstance(element, (list, XmlLazyBranches)):
         for subelement in element:
-            xmltext += get_xml_tree(subelement, level,
-                                    indent_spaces=indent_spaces,
-                                    eol=eol,
-                                    include_comments=include_comments)
+            write_xml_tree(sink, subelement, level,
+                           indent_spaces=indent_spaces,
+                           eol=eol,
+                           include_comments=include_comments)
         # recursive
 
     elif isinstance(element, XmlSimpleValue):
         # The lowest-level thing a value. No extra indent.
-        xmltext += xml_escape_value(str(element.value))
+        write(xml_escape_value(str(element.value)))
 
     else:
-        raise ValueError(f"Bad value to get_xml_tree: {element!r}")
+        raise ValueError(f"Bad value to write_xml_tree: {element!r}")
+
+
+def get_xml_tree(element: Union[XmlElement, XmlSimpleValue,
+                                List[Union[XmlElement, XmlSimpleValue]],
+                                XmlLazyBranches],
+                 level: int = 0,
+                 indent_spaces: int = 4,
+                 eol: str = '\n',
+                 include_comments: bool = False) -> str:
+    """
+    Returns an :class:`camcops_server.cc_modules.cc_xml.XmlElement` as text.
+    See :func:`write_xml_tree`.
+
+    Args:
+        element: root :class:`camcops_server.cc_modules.cc_xml.XmlElement`
+        level: starting level/depth (used for recursion)
+        indent_spaces: number of spaces to indent formatted XML
+        eol: end-of-line string
+        include_comments: include comments describing each field?
+    """
+    sink = io.StringIO()
+    write_xml_tree(sink, element,
+                   level=level,
+                   indent_spaces=indent_spaces,
+                   eol=eol,
+                   include_comments=include_comments)
+    return sink.getvalue()
+
+
+def write_xml_document(sink: TextIO,
+                       root: XmlElement,
+                       indent_spaces: int = 4,
+                       eol: str = '\n',
+                       include_comments: bool = False) -> None:
+    """
+    Writes an entire XML document as text to a file-like object, given the
+    root :class:`camcops_server.cc_modules.cc_xml.XmlElement`.
 
-    return xmltext
+    Args:
+        sink: file-like object, opened in text mode
+        root: root :class:`camcops_server.cc_modules.cc_xml.XmlElement`
+        indent_spaces: number of spaces to indent formatted XML
+        eol: end-of-line string
+        include_comments: include comments describing each field?
+    """
+    if not isinstance(root, XmlElement):
+        raise AssertionError("write_xml_document: root not an XmlElement; "
+                             "XML requires a single root")
+    sink.write(xml_header(eol))
+    write_xml_tree(
+        sink,
+        root,
+        indent_spaces=indent_spaces,
+        eol=eol,
+        include_comments=include_comments
+    )
 
 
 def get_xml_document(root: XmlElement,
@@ -457,7 +545,8 @@ def get_xml_document(root: XmlElement,
                      include_comments: bool = False) -> str:
     """
     Returns an entire XML document as text, given the root
-    :class:`camcops_server.cc_modules.cc_xml.XmlElement`.
+    :class:`camcops_server.cc_modules.cc_xml.XmlElement`. See
+    :func:`write_xml_document`.
 
     Args:
         root: root :class:`camcops_server.cc_modules.cc_xml.XmlElement`
@@ -468,9 +557,74 @@ def get_xml_document(root: XmlElement,
     if not isinstance(root, XmlElement):
         raise AssertionError("get_xml_document: root not an XmlElement; "
                              "XML requires a single root")
-    return xml_header(eol) + get_xml_tree(
-        root,
-        indent_spaces=indent_spaces,
-        eol=eol,
-        include_comments=include_comments
-    )
+    sink = io.StringIO()
+    write_xml_document(sink, root,
+                       indent_spaces=indent_spaces,
+                       eol=eol,
+                       include_comments=include_comments)
+    return sink.getvalue()
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class XmlWriterTests(unittest.TestCase):
+    """
+    Tests for :func:`write_xml_tree` and friends.
+    """
+    @staticmethod
+    def _make_tree(lazy: bool) -> XmlElement:
+        def make_items() -> List[XmlElement]:
+            return [
+                XmlElement(name="item", value=[
+                    XmlElement(name="n", value=i, datatype="integer"),
+                    XmlElement(name="s", value=None, comment="absent"),
+                ])
+                for i in range(2)
+            ]
+
+        return XmlElement(name="root", value=[
+            XmlLiteral("<!-- comment -->"),
+            XmlElement(name="text", value="a < b & 'c'",
+                       datatype="string", comment="some text"),
+            XmlElement(name="items",
+                       value=XmlLazyBranches(make_items) if lazy
+                       else make_items()),
+            XmlElement(name="empty",
+                       value=XmlLazyBranches(list) if lazy else []),
+        ])
+
+    def test_lazy_branches_match_lists(self) -> None:
+        for include_comments in (False, True):
+            eager = get_xml_document(self._make_tree(lazy=False),
+                                     include_comments=include_comments)
+            lazy = get_xml_document(self._make_tree(lazy=True),
+                                    include_comments=include_comments)
+            self.assertEqual(lazy, eager)
+
+    def test_write_matches_get(self) -> None:
+        root = self._make_tree(lazy=True)
+        sink = io.StringIO()
+        write_xml_document(sink, root, indent_spaces=2, eol="\r\n")
+        self.assertEqual(
+            sink.getvalue(),
+            get_xml_document(root, indent_spaces=2, eol="\r\n")
+        )
+
+    def test_tree_output(self) -> None:
+        root = self._make_tree(lazy=True)
+        self.assertEqual(
+            get_xml_tree(root.value[1:3], level=1, indent_spaces=1),
+            ' <text xsi:type="string">a &lt; b &amp; \'c\'</text>\n'
+            ' <items>\n'
+            '  <item>\n'
+            '   <n xsi:type="integer">0</n>\n'
+            '   <s xsi:nil="true"/>\n'
+            '  </item>\n'
+            '  <item>\n'
+            '   <n xsi:type="integer">1</n>\n'
+            '   <s xsi:nil="true"/>\n'
+            '  </item>\n'
+            ' </items>\n'
+        )
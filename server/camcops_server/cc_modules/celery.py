@@ -111,7 +111,7 @@ Task decorator options:
 
 import logging
 import os
-from typing import Any, Dict, TYPE_CHECKING
+from typing import Any, Dict, List, TYPE_CHECKING
 
 from cardinal_pythonlib.json.serialize import json_encode, json_decode
 from cardinal_pythonlib.logs import BraceStyleAdapter
@@ -391,6 +391,61 @@ def export_to_recipient_backend(self: "CeleryTask",
         self.retry(countdown=backoff(self.request.retries), exc=exc)
 
 
+@celery_app.task(bind=True,
+                 ignore_result=True,
+                 max_retries=MAX_RETRIES,
+                 soft_time_limit=CELERY_SOFT_TIME_LIMIT_SEC)
+def export_database_chunk_backend(self: "CeleryTask",
+                                  recipient_name: str,
+                                  chunk_index: int) -> None:
+    """
+    Writes one chunk of a whole-database export that is running via the back
+    end; see
+    :func:`camcops_server.cc_modules.cc_export.export_whole_database_via_backend`.
+
+    Args:
+        self: the Celery task, :class:`celery.app.task.Task`
+        recipient_name: export recipient name (as per the config file)
+        chunk_index: index of the chunk in the export's manifest
+    """  # noqa
+    from camcops_server.cc_modules.cc_export import export_database_chunk  # delayed import  # noqa
+    from camcops_server.cc_modules.cc_request import command_line_request_context  # delayed import  # noqa
+
+    try:
+        with command_line_request_context() as req:
+            recipient = req.get_export_recipient(recipient_name)
+            export_database_chunk(req, recipient, chunk_index)
+    except Exception as exc:
+        self.retry(countdown=backoff(self.request.retries), exc=exc)
+
+
+@celery_app.task(bind=True,
+                 ignore_result=True,
+                 max_retries=MAX_RETRIES)
+def finalise_database_export_backend(self: "CeleryTask",
+                                     recipient_name: str) -> None:
+    """
+    Finishes a whole-database export that is running via the back end,
+    copying all its chunks to the destination database; see
+    :func:`camcops_server.cc_modules.cc_export.export_whole_database_via_backend`.
+
+    No time limit, since this copies the whole export.
+
+    Args:
+        self: the Celery task, :class:`celery.app.task.Task`
+        recipient_name: export recipient name (as per the config file)
+    """  # noqa
+    from camcops_server.cc_modules.cc_export import finalise_database_export  # delayed import  # noqa
+    from camcops_server.cc_modules.cc_request import command_line_request_context  # delayed import  # noqa
+
+    try:
+        with command_line_request_context() as req:
+            recipient = req.get_export_recipient(recipient_name)
+            finalise_database_export(req, recipient)
+    except Exception as exc:
+        self.retry(countdown=backoff(self.request.retries), exc=exc)
+
+
 @celery_app.task(bind=True,
                  ignore_result=True,
                  max_retries=MAX_RETRIES,
@@ -468,6 +523,36 @@ def create_user_download(self: "CeleryTask",
         self.retry(countdown=backoff(self.request.retries), exc=exc)
 
 
+# =============================================================================
+# Auditing
+# =============================================================================
+
+@celery_app.task(bind=True,
+                 ignore_result=True,
+                 max_retries=MAX_RETRIES,
+                 soft_time_limit=CELERY_SOFT_TIME_LIMIT_SEC)
+def write_audit_entries(self: "CeleryTask",
+                        rows: List[Dict[str, Any]]) -> None:
+    """
+    Writes audit entries that were deferred by the client API (see
+    :class:`camcops_server.cc_modules.cc_audit.AuditBuffer`).
+
+    Args:
+        self: the Celery task, :class:`celery.app.task.Task`
+        rows: list of dictionaries mapping
+            :class:`camcops_server.cc_modules.cc_audit.AuditEntry` column
+            names to values
+    """
+    from camcops_server.cc_modules.cc_audit import write_audit_rows  # delayed import  # noqa
+    from camcops_server.cc_modules.cc_request import command_line_request_context  # delayed import  # noqa
+
+    try:
+        with command_line_request_context() as req:
+            write_audit_rows(req.dbsession, rows)
+    except Exception as exc:
+        self.retry(countdown=backoff(self.request.retries), exc=exc)
+
+
 # =============================================================================
 # Housekeeping
 # =============================================================================
@@ -504,6 +589,8 @@ def housekeeping() -> None:
     Celery task. We don't need it here. See
     http://docs.celeryproject.org/en/latest/userguide/tasks.html#bound-tasks.)
     """
+    from camcops_server.cc_modules.cc_blob import purge_blob_store  # delayed import  # noqa
+    from camcops_server.cc_modules.cc_blobstore import get_blob_store  # delayed import  # noqa
     from camcops_server.cc_modules.cc_request import command_line_request_context  # delayed import  # noqa
     from camcops_server.cc_modules.cc_session import CamcopsSession  # delayed import  # noqa
     from camcops_server.cc_modules.cc_user import (
@@ -523,3 +610,6 @@ def housekeeping() -> None:
         SecurityAccountLockout.delete_old_account_lockouts(req)
         SecurityLoginFailure.clear_dummy_login_failures_if_necessary(req)
         delete_old_user_downloads(req)
+        blob_store = get_blob_store()
+        if blob_store is not None:
+            purge_blob_store(req.dbsession, blob_store)
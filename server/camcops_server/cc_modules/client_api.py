@@ -113,6 +113,9 @@ As of v2.3.0, the function :func:`op_upload_entire_database` does this in one
 step (faster; for use if the network packets are not excessively large).
 
 - Code relating to this uses ``batchdetails.onestep``.
+- Each table is processed by :func:`process_table_for_onestep_upload_bulk`,
+  a set-based version of :func:`process_table_for_onestep_upload` that uses a
+  fixed number of queries per table (see :func:`benchmark_onestep_upload`).
 
 **Setup for the upload code**
 
@@ -336,8 +339,11 @@ import logging
 import json
 # from pprint import pformat
 import time
-from typing import Any, Dict, Iterable, List, Optional, Sequence, TYPE_CHECKING
+from typing import (
+    Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, TYPE_CHECKING,
+)
 import unittest
+from unittest import mock
 
 from cardinal_pythonlib.convert import (
     base64_64format_encode,
@@ -364,19 +370,25 @@ from pyramid.security import NO_PERMISSION_REQUIRED
 from semantic_version import Version
 from sqlalchemy.engine.result import ResultProxy
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.expression import exists, select, update
-from sqlalchemy.sql.schema import Table
+from sqlalchemy.sql.expression import bindparam, exists, select, update
+from sqlalchemy.sql.schema import Column, Table
+from sqlalchemy.sql.sqltypes import LargeBinary
+from sqlalchemy.sql.type_api import TypeDecorator
 
 from camcops_server.cc_modules import cc_audit  # avoids "audit" name clash
 from camcops_server.cc_modules.cc_all_models import (
     CLIENT_TABLE_MAP,
     RESERVED_FIELDS,
 )
-from camcops_server.cc_modules.cc_blob import Blob
+from camcops_server.cc_modules.cc_blob import (
+    Blob,
+    move_uploaded_blob_to_store,
+)
 from camcops_server.cc_modules.cc_cache import cache_region_static, fkg
 from camcops_server.cc_modules.cc_client_api_core import (
     AllowedTablesFieldNames,
     BatchDetails,
+    DbDataJsonStreamer,
     exception_description,
     ExtraStringFieldNames,
     fail_server_error,
@@ -411,6 +423,7 @@ from camcops_server.cc_modules.cc_constants import (
     TABLET_ID_FIELD,
 )
 from camcops_server.cc_modules.cc_convert import (
+    decode_rows,
     decode_single_value,
     decode_values,
     encode_single_value,
@@ -501,6 +514,10 @@ FAILURE_CODE = "0"
 
 DEBUG_UPLOAD = False
 
+USE_BULK_ONESTEP_UPLOAD = True
+# ... use process_table_for_onestep_upload_bulk() rather than the row-by-row
+# process_table_for_onestep_upload() for op_upload_entire_database().
+
 
 # =============================================================================
 # Cached information
@@ -794,6 +811,53 @@ def get_values_from_post_var(req: "CamcopsRequest",
     return decode_values(csvalues)
 
 
+def binary_part_name(recordnum: int, fieldname: str) -> str:
+    """
+    Returns the name of the multipart part that carries the raw binary value
+    of field ``fieldname`` in record ``recordnum``, for
+    :func:`op_upload_records`; e.g. ``binary3_theblob``.
+    """
+    return f"{TabletParam.BINARY_PREFIX}{recordnum}_{fieldname}"
+
+
+def is_binary_column(column: Column) -> bool:
+    """
+    Is this a BLOB column (including e.g. our ``LongBlob``, which is a
+    variant of :class:`LargeBinary`)?
+    """
+    coltype = column.type
+    if isinstance(coltype, TypeDecorator):
+        coltype = coltype.impl
+    return isinstance(coltype, LargeBinary)
+
+
+def get_binary_part(req: "CamcopsRequest", var: str) -> Optional[bytes]:
+    """
+    Retrieves raw bytes from a binary (file) part of a ``multipart/form-data``
+    request, without any text decoding.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        var: name of the part
+
+    Returns:
+        the bytes, or ``None`` if there is no such part
+
+    Raises:
+        :exc:`UserErrorException` if the part was sent as text (i.e. without
+        a filename), since its bytes may then have been altered
+    """
+    value = req.POST.get(var)
+    if value is None:
+        return None
+    file = getattr(value, "file", None)
+    if file is None:
+        fail_user_error(
+            f"{var} must be sent as a binary part (with a filename) of a "
+            f"multipart/form-data request")
+    return file.read()
+
+
 def get_fields_and_values(req: "CamcopsRequest",
                           table: Table,
                           fields_var: str,
@@ -1365,7 +1429,8 @@ def upload_record_core(
     """
     Uploads a record. Deals with IDENTICAL, NEW, and MODIFIED records.
 
-    Used by :func:`upload_table` and :func:`upload_record`.
+    Used by :func:`upload_table`, :func:`upload_record`, and
+    :func:`upload_records`.
 
     Args:
         req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
@@ -1374,7 +1439,8 @@ def upload_record_core(
         clientpk_name: the column name of the client's PK
         valuedict: a dictionary of {colname: value} pairs from the client
         server_live_current_records: list of :class:`ServerRecord` objects for
-            the active records on the server for this client, in this table
+            the active records on the server for this client, in this table;
+            if ``None``, the record is looked up individually
 
     Returns:
         a :class:`UploadRecordResult` object
@@ -1383,8 +1449,9 @@ def upload_record_core(
                              MOVE_OFF_TABLET_FIELD])
     clientpk_value = valuedict[clientpk_name]
 
-    if server_live_current_records:
-        # All server records for this table/device/era have been prefetched.
+    if server_live_current_records is not None:
+        # All server records for this table/device/era have been prefetched
+        # (possibly none).
         serverrec = next((r for r in server_live_current_records
                           if r.client_pk == clientpk_value), None)
         if serverrec is None:
@@ -1441,6 +1508,9 @@ def insert_record(req: "CamcopsRequest",
     """
     Inserts a record, or raises an exception if that fails.
 
+    The content of BLOBs goes to the BLOB store, if one is configured; see
+    :mod:`camcops_server.cc_modules.cc_blobstore`.
+
     Args:
         req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
         batchdetails: the :class:`BatchDetails`
@@ -1451,6 +1521,32 @@ def insert_record(req: "CamcopsRequest",
     Returns:
         the server PK of the new record
     """
+    add_server_fields_for_insert(req, batchdetails, valuedict, predecessor_pk)
+    if table.name == Blob.__tablename__:
+        move_uploaded_blob_to_store(req.dbsession, valuedict)
+    rp = req.dbsession.execute(
+        table.insert().values(valuedict)
+    )  # type: ResultProxy
+    inserted_pks = rp.inserted_primary_key
+    assert(isinstance(inserted_pks, list) and len(inserted_pks) == 1)
+    return inserted_pks[0]
+
+
+def add_server_fields_for_insert(req: "CamcopsRequest",
+                                 batchdetails: BatchDetails,
+                                 valuedict: Dict[str, Any],
+                                 predecessor_pk: Optional[int]) -> None:
+    """
+    Adds the server's own fields (device, era, group, addition flags, etc.)
+    to a dictionary of client values, ready for insertion.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        batchdetails: the :class:`BatchDetails`
+        valuedict: a dictionary of {colname: value} pairs from the client;
+            modified in place
+        predecessor_pk: an optional server PK of the record's predecessor
+    """
     ts = req.tabletsession
     valuedict.update({
         FN_DEVICE_ID: ts.device_id,
@@ -1473,12 +1569,6 @@ def insert_record(req: "CamcopsRequest",
             FN_CURRENT: 0,
             FN_ADDITION_PENDING: 1,
         })
-    rp = req.dbsession.execute(
-        table.insert().values(valuedict)
-    )  # type: ResultProxy
-    inserted_pks = rp.inserted_primary_key
-    assert(isinstance(inserted_pks, list) and len(inserted_pks) == 1)
-    return inserted_pks[0]
 
 
 def audit_upload(req: "CamcopsRequest",
@@ -2322,6 +2412,75 @@ def op_upload_record(req: "CamcopsRequest") -> str:
     # Auditing occurs at commit_all.
 
 
+def op_upload_records(req: "CamcopsRequest") -> str:
+    """
+    Upload multiple records to one table in a single request, with BLOB values
+    sent as raw binary. Intended for BLOB-heavy tables, replacing one
+    :func:`op_upload_record` call per record.
+
+    The request should be ``multipart/form-data``. As for
+    :func:`op_upload_table`, it includes the table name, the client PK name, a
+    CSV list of fields, a count of records, and variables ``record0`` ...
+    ``record{nrecords - 1}``, each a CSV list of SQL-encoded values. For any
+    BLOB field, the value may instead be sent as a binary (file) part named
+    per :func:`binary_part_name` (e.g. ``binary0_theblob``), which overrides
+    the value in the CSV list (conventionally ``NULL``). This avoids the
+    hex/base64 encoding and decoding of large values.
+
+    As for :func:`op_upload_record`, records that are not sent are not
+    flagged as deleted.
+    """
+    table = get_table_from_req(req, TabletParam.TABLE)
+    clientpk_name = get_single_field_from_post_var(req, table,
+                                                   TabletParam.PKNAME)
+    fields = get_fields_from_post_var(req, table, TabletParam.FIELDS)
+    nrecords = get_int_var(req, TabletParam.NRECORDS)
+    nfields = len(fields)
+    if nrecords < 0:
+        fail_user_error(
+            f"{TabletParam.NRECORDS}={nrecords}: can't be less than 0")
+    binary_fields = [f for f in fields if is_binary_column(table.columns[f])]
+
+    batchdetails = get_batch_details(req)
+    serverrecs = get_server_live_records(req, req.tabletsession.device_id,
+                                         table, clientpk_name=clientpk_name,
+                                         current_only=True)
+    n_new = 0
+    n_modified = 0
+    n_identical = 0
+    dirty = False
+    for r in range(nrecords):
+        values = get_values_from_post_var(req, TabletParam.RECORD_PREFIX + str(r))  # noqa
+        if len(values) != nfields:
+            fail_user_error(
+                f"Number of fields in field list ({nfields}) doesn't match "
+                f"number of values in record {r} ({len(values)})")
+        valuedict = dict(zip(fields, values))
+        for fieldname in binary_fields:
+            data = get_binary_part(req, binary_part_name(r, fieldname))
+            if data is not None:
+                valuedict[fieldname] = data
+        urr = upload_record_core(
+            req, batchdetails, table, clientpk_name, valuedict,
+            server_live_current_records=serverrecs)
+        if urr.oldserverpk is None:
+            n_new += 1
+        elif urr.newserverpk is None:
+            n_identical += 1
+        else:
+            n_modified += 1
+        if urr.dirty:
+            dirty = True
+    if dirty:
+        mark_table_dirty(req, table)
+    # Auditing occurs at commit_all.
+    log.info("Upload successful; {n} records uploaded to table {t} "
+             "({new} new, {mod} modified, {i} identical)",
+             n=nrecords, t=table.name, new=n_new, mod=n_modified,
+             i=n_identical)
+    return f"Table {table.name} upload successful"
+
+
 def op_upload_empty_tables(req: "CamcopsRequest") -> str:
     """
     The tablet supplies a list of tables that are empty at its end, and we
@@ -2627,13 +2786,14 @@ def op_upload_entire_database(req: "CamcopsRequest") -> str:
         req, TabletParam.PKNAMEINFO, decoder=DB_JSON_DECODER, mandatory=True)
     if not isinstance(pknameinfo, dict):
         fail_user_error("PK name info JSON is not a dict")
-    dbdata = get_json_from_post_var(
-        req, TabletParam.DBDATA, decoder=DB_JSON_DECODER, mandatory=True)
-    if not isinstance(dbdata, dict):
-        fail_user_error("Database data JSON is not a dict")
+    # The database itself may be large, so we decode it incrementally, one
+    # table at a time.
+    dbdata = DbDataJsonStreamer(
+        get_str_var(req, TabletParam.DBDATA, mandatory=True),
+        decoder=DB_JSON_DECODER)
 
     # Sanity checks
-    dbdata_tablenames = sorted(dbdata.keys())
+    dbdata_tablenames = sorted(dbdata.tablenames)
     pkinfo_tablenames = sorted(pknameinfo.keys())
     if pkinfo_tablenames != dbdata_tablenames:
         fail_user_error("Table names don't match from (1) DB data (2) PK info")
@@ -2649,11 +2809,15 @@ def op_upload_entire_database(req: "CamcopsRequest") -> str:
     # Process the tables in a certain order:
     tables = sorted(CLIENT_TABLE_MAP.values(),
                     key=upload_commit_order_sorter)
+    if USE_BULK_ONESTEP_UPLOAD:
+        process_table = process_table_for_onestep_upload_bulk
+    else:
+        process_table = process_table_for_onestep_upload
     changelist = []  # type: List[UploadTableChanges]
     for table in tables:
         clientpk_name = pknameinfo.get(table.name, "")
-        rows = dbdata.get(table.name, [])
-        tablechanges = process_table_for_onestep_upload(
+        rows = dbdata.gen_rows(table.name)
+        tablechanges = process_table(
             req, batchdetails, table, clientpk_name, rows)
         changelist.append(tablechanges)
 
@@ -2669,7 +2833,7 @@ def process_table_for_onestep_upload(
         batchdetails: BatchDetails,
         table: Table,
         clientpk_name: str,
-        rows: List[Dict[str, Any]]) -> UploadTableChanges:
+        rows: Iterable[Dict[str, Any]]) -> UploadTableChanges:
     """
     Performs all upload steps for a table.
     
@@ -2681,24 +2845,49 @@ def process_table_for_onestep_upload(
         batchdetails: the :class:`BatchDetails`
         table: an SQLAlchemy :class:`Table`
         clientpk_name: the name of the PK field on the client
-        rows: a list of rows, where each row is a dictionary mapping field
-            (column) names to values (those values being encoded as SQL-style
-            literals in our extended syntax)
+        rows: an iterable of rows, where each row is a dictionary mapping
+            field (column) names to values (those values being encoded as
+            SQL-style literals in our extended syntax)
 
     Returns:
         an :class:`UploadTableChanges` object
     """  # noqa
+    valuedicts = decode_rows(rows)
+    return process_decoded_table_for_onestep_upload(
+        req, batchdetails, table, clientpk_name, valuedicts)
+
+
+def process_decoded_table_for_onestep_upload(
+        req: "CamcopsRequest",
+        batchdetails: BatchDetails,
+        table: Table,
+        clientpk_name: str,
+        valuedicts: List[Dict[str, Any]]) -> UploadTableChanges:
+    """
+    Performs all upload steps for a table, row by row, once the client's
+    values have been decoded. See :func:`process_table_for_onestep_upload`.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        batchdetails: the :class:`BatchDetails`
+        table: an SQLAlchemy :class:`Table`
+        clientpk_name: the name of the PK field on the client
+        valuedicts: a list of rows, where each row is a dictionary mapping
+            field (column) names to decoded values
+
+    Returns:
+        an :class:`UploadTableChanges` object
+    """
     serverrecs = get_server_live_records(
         req, req.tabletsession.device_id, table, clientpk_name,
         current_only=False)
     servercurrentrecs = [r for r in serverrecs if r.current]
-    if rows and not clientpk_name:
+    if valuedicts and not clientpk_name:
         fail_user_error(f"Client-side PK name not specified by client for "
                         f"non-empty table {table.name!r}")
     tablechanges = UploadTableChanges(table)
     server_pks_uploaded = []  # type: List[int]
-    for row in rows:
-        valuedict = {k: decode_single_value(v) for k, v in row.items()}
+    for valuedict in valuedicts:
         urr = upload_record_core(req, batchdetails, table,
                                  clientpk_name, valuedict,
                                  server_live_current_records=servercurrentrecs)
@@ -2732,6 +2921,351 @@ def process_table_for_onestep_upload(
     return tablechanges
 
 
+# =============================================================================
+# Bulk (set-based) one-step upload
+# =============================================================================
+
+class OneStepUploadRowSets(object):
+    """
+    The rows uploaded for one table in a one-step upload, sorted into new,
+    modified, and identical sets by comparison with the server's current
+    records. Used by :func:`process_table_for_onestep_upload_bulk`.
+
+    Each entry is a tuple of ``(row_index, valuedict, serverrec)``, where
+    ``row_index`` is the row's position in the upload (so that we can
+    reconstruct the results in the client's order), and ``serverrec`` is the
+    corresponding :class:`ServerRecord` (or ``None`` for new records).
+    """
+    def __init__(self) -> None:
+        self.new = []  # type: List[Tuple[int, Dict[str, Any], None]]
+        self.modified = []  # type: List[Tuple[int, Dict[str, Any], ServerRecord]]  # noqa
+        self.identical = []  # type: List[Tuple[int, Dict[str, Any], ServerRecord]]  # noqa
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}: "
+            f"{len(self.new)} new, "
+            f"{len(self.modified)} modified, "
+            f"{len(self.identical)} identical>"
+        )
+
+    @property
+    def n_rows(self) -> int:
+        """
+        Total number of rows.
+        """
+        return len(self.new) + len(self.modified) + len(self.identical)
+
+
+def classify_onestep_upload_rows(
+        clientpk_name: str,
+        valuedicts: List[Dict[str, Any]],
+        server_index: Dict[Any, ServerRecord]) -> OneStepUploadRowSets:
+    """
+    Sorts decoded client rows into new, modified, and identical sets. The
+    logic mirrors that of :func:`upload_record_core`.
+
+    Args:
+        clientpk_name: the column name of the client's PK
+        valuedicts: decoded rows, each a dictionary of {colname: value} pairs
+            from the client
+        server_index: dictionary mapping client PK to the :class:`ServerRecord`
+            for the current server record for this device/table/era
+
+    Returns:
+        a :class:`OneStepUploadRowSets`
+    """
+    rowsets = OneStepUploadRowSets()
+    for row_index, valuedict in enumerate(valuedicts):
+        require_keys(valuedict, [clientpk_name, CLIENT_DATE_FIELD,
+                                 MOVE_OFF_TABLET_FIELD])
+        serverrec = server_index.get(valuedict[clientpk_name])
+        if serverrec is None:
+            rowsets.new.append((row_index, valuedict, None))
+            continue
+        client_date_value = coerce_to_pendulum(valuedict[CLIENT_DATE_FIELD])
+        if serverrec.server_when == client_date_value:
+            rowsets.identical.append((row_index, valuedict, serverrec))
+        else:
+            rowsets.modified.append((row_index, valuedict, serverrec))
+    return rowsets
+
+
+def insert_records_bulk(req: "CamcopsRequest",
+                        table: Table,
+                        valuedicts: List[Dict[str, Any]]) -> None:
+    """
+    Inserts many records with as few statements as possible. Rows are grouped
+    by the set of columns they supply (since a single multi-row INSERT needs
+    the same columns for every row), and each group is sent as one
+    "executemany" operation (which the MySQL drivers turn into a multi-row
+    ``INSERT ... VALUES (...), (...), ...``).
+
+    The new server PKs are not returned; see
+    :func:`get_new_server_pks_by_client_pk`.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        table: an SQLAlchemy :class:`Table`
+        valuedicts: complete dictionaries of {colname: value} pairs, as
+            prepared by :func:`add_server_fields_for_insert`
+    """
+    if table.name == Blob.__tablename__:
+        for valuedict in valuedicts:
+            move_uploaded_blob_to_store(req.dbsession, valuedict)
+    groups = {}  # type: Dict[Tuple[str, ...], List[Dict[str, Any]]]
+    for valuedict in valuedicts:
+        groups.setdefault(tuple(sorted(valuedict.keys())), []).append(
+            valuedict)
+    for group_valuedicts in groups.values():
+        req.dbsession.execute(table.insert(), group_valuedicts)
+
+
+def get_new_server_pks_by_client_pk(
+        req: "CamcopsRequest",
+        table: Table,
+        clientpk_name: str,
+        clientpk_values: Iterable[Any],
+        known_server_pks: Set[int]) -> Dict[Any, int]:
+    """
+    After :func:`insert_records_bulk`, in a one-step upload, finds the server
+    PKs of the records we inserted, in a single query. New records are the
+    current, current-era records for this device whose server PKs we didn't
+    know about beforehand.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        table: an SQLAlchemy :class:`Table`
+        clientpk_name: the column name of the client's PK
+        clientpk_values: client PK values of the records we inserted
+        known_server_pks: server PKs of all this device's records in this
+            table that existed before the insertion
+
+    Returns:
+        dict: mapping client PK to new server PK
+
+    Raises:
+        :exc:`ServerErrorException` if any record can't be found
+    """
+    wanted = set(clientpk_values)
+    query = (
+        select([
+            table.c[clientpk_name],  # client PK
+            table.c[FN_PK],  # server PK
+        ])
+        .where(table.c[FN_DEVICE_ID] == req.tabletsession.device_id)
+        .where(table.c[FN_CURRENT])
+        .where(table.c[FN_ERA] == ERA_NOW)
+    )
+    new_pks = {}  # type: Dict[Any, int]
+    for client_pk, server_pk in req.dbsession.execute(query):
+        if server_pk in known_server_pks or client_pk not in wanted:
+            continue
+        if client_pk in new_pks:
+            fail_server_error(f"{INSERT_FAILED}: duplicate new records for "
+                              f"{table.name}.{clientpk_name}={client_pk!r}")
+        new_pks[client_pk] = server_pk
+    if len(new_pks) != len(wanted):
+        fail_server_error(f"{INSERT_FAILED}: table {table.name}")
+    return new_pks
+
+
+def flag_modified_bulk(req: "CamcopsRequest",
+                       batchdetails: BatchDetails,
+                       table: Table,
+                       pk_successor_pairs: List[Tuple[int, int]]) -> None:
+    """
+    Bulk equivalent of :func:`flag_modified`: marks many records as old,
+    storing their successors' details, via a single "executemany" UPDATE.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        batchdetails: the :class:`BatchDetails`
+        table: SQLAlchemy :class:`Table`
+        pk_successor_pairs: list of ``(pk, successor_pk)`` tuples, giving the
+            server PK of each record to mark as old, and that of its successor
+    """
+    if not pk_successor_pairs:
+        return
+    if batchdetails.onestep:
+        values = {
+            FN_CURRENT: 0,
+            FN_REMOVAL_PENDING: 0,
+            FN_SUCCESSOR_PK: bindparam("b_successor_pk"),
+            FN_REMOVING_USER_ID: req.user_id,
+            FN_WHEN_REMOVED_EXACT: req.now,
+            FN_WHEN_REMOVED_BATCH_UTC: batchdetails.batchtime,
+        }
+    else:
+        values = {
+            FN_REMOVAL_PENDING: 1,
+            FN_SUCCESSOR_PK: bindparam("b_successor_pk"),
+        }
+    req.dbsession.execute(
+        update(table)
+        .where(table.c[FN_PK] == bindparam("b_pk"))
+        .values(values),
+        [{"b_pk": pk, "b_successor_pk": successor_pk}
+         for pk, successor_pk in pk_successor_pairs]
+    )
+
+
+def process_table_for_onestep_upload_bulk(
+        req: "CamcopsRequest",
+        batchdetails: BatchDetails,
+        table: Table,
+        clientpk_name: str,
+        rows: Iterable[Dict[str, Any]]) -> UploadTableChanges:
+    """
+    Set-based equivalent of :func:`process_table_for_onestep_upload`, which
+    produces an identical :class:`UploadTableChanges` object and identical
+    database changes, but with a fixed number of queries per table rather
+    than several per row.
+
+    - We build a hash index (by client PK) of the server's current records,
+      rather than scanning a list for each row.
+    - We sort the uploaded rows into new, modified, and identical sets.
+    - New and modified rows are written with multi-row INSERTs; the old
+      versions of modified rows are then flagged with a single UPDATE.
+    - Predecessor chains for records specifically marked for preservation
+      are followed in memory, and all are preserved with a single UPDATE.
+
+    If the client has sent the same client PK twice (which shouldn't happen),
+    we fall back to the row-by-row method, which defines the behaviour in that
+    situation.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        batchdetails: the :class:`BatchDetails`
+        table: an SQLAlchemy :class:`Table`
+        clientpk_name: the name of the PK field on the client
+        rows: an iterable of rows, where each row is a dictionary mapping
+            field (column) names to values (those values being encoded as
+            SQL-style literals in our extended syntax); this may be a
+            generator (e.g. from :class:`DbDataJsonStreamer`), in which case
+            each row is decoded as it arrives
+
+    Returns:
+        an :class:`UploadTableChanges` object
+    """
+    # Decode, and check for duplicates
+    valuedicts = decode_rows(rows)
+    if valuedicts and not clientpk_name:
+        fail_user_error(f"Client-side PK name not specified by client for "
+                        f"non-empty table {table.name!r}")
+    clientpk_values = [vd.get(clientpk_name) for vd in valuedicts]
+    if len(set(clientpk_values)) != len(clientpk_values):
+        log.warning("Duplicate client PKs uploaded for table {!r}; using "
+                    "row-by-row upload", table.name)
+        return process_decoded_table_for_onestep_upload(
+            req, batchdetails, table, clientpk_name, valuedicts)
+
+    serverrecs = get_server_live_records(
+        req, req.tabletsession.device_id, table, clientpk_name,
+        current_only=False)
+    servercurrentrecs = [r for r in serverrecs if r.current]
+
+    # Hash index of current server records. As with upload_record_core(),
+    # the first matching record wins.
+    server_index = {}  # type: Dict[Any, ServerRecord]
+    for sr in servercurrentrecs:
+        server_index.setdefault(sr.client_pk, sr)
+    predecessors = {sr.server_pk: sr.predecessor_pk
+                    for sr in serverrecs}  # type: Dict[int, Optional[int]]
+    known_server_pks = set(predecessors.keys())
+
+    # Sort into new/modified/identical
+    rowsets = classify_onestep_upload_rows(clientpk_name, valuedicts,
+                                           server_index)
+    if DEBUG_UPLOAD:
+        log.debug("process_table_for_onestep_upload_bulk: {}, {!r}",
+                  table.name, rowsets)
+
+    # Write new and modified records
+    to_insert = rowsets.new + rowsets.modified
+    for _, valuedict, serverrec in to_insert:
+        process_upload_record_special(req, batchdetails, table, valuedict)
+        add_server_fields_for_insert(
+            req, batchdetails, valuedict,
+            serverrec.server_pk if serverrec else None)
+    new_pks = {}  # type: Dict[Any, int]
+    if to_insert:
+        insert_records_bulk(req, table, [vd for _, vd, _ in to_insert])
+        new_pks = get_new_server_pks_by_client_pk(
+            req, table, clientpk_name,
+            (vd[clientpk_name] for _, vd, _ in to_insert),
+            known_server_pks)
+        for new_pk in new_pks.values():
+            predecessors[new_pk] = None
+    flag_modified_bulk(
+        req, batchdetails, table,
+        [(sr.server_pk, new_pks[vd[clientpk_name]])
+         for _, vd, sr in rowsets.modified])
+    for _, vd, sr in rowsets.modified:
+        predecessors[new_pks[vd[clientpk_name]]] = sr.server_pk
+
+    # Results, in the client's order
+    urrs = [None] * rowsets.n_rows  # type: List[Optional[UploadRecordResult]]
+    for rowset, identical in ((to_insert, False), (rowsets.identical, True)):
+        for row_index, valuedict, serverrec in rowset:
+            preserve = bool(valuedict[MOVE_OFF_TABLET_FIELD])
+            urrs[row_index] = UploadRecordResult(
+                oldserverpk=serverrec.server_pk if serverrec else None,
+                newserverpk=(None if identical
+                             else new_pks[valuedict[clientpk_name]]),
+                specifically_marked_for_preservation=preserve,
+                dirty=preserve or not identical
+            )
+
+    # Specific preservation, following predecessor chains in memory
+    all_preservation_pks = set()  # type: Set[int]
+    for urr in urrs:
+        if urr.specifically_marked_for_preservation:
+            chain = []  # type: List[int]
+            pk = urr.latest_pk
+            while pk is not None:
+                if pk not in predecessors:
+                    # Not one of ours; ask the database.
+                    chain.extend(get_all_predecessor_pks(req, table, pk))
+                    break
+                chain.append(pk)
+                pk = predecessors[pk]
+            chain.sort()
+            all_preservation_pks.update(chain)
+            urr.note_specifically_marked_preservation_pks(chain)
+    if all_preservation_pks:
+        flag_multiple_records_for_preservation(
+            req, batchdetails, table, sorted(all_preservation_pks))
+
+    tablechanges = UploadTableChanges(table)
+    server_pks_uploaded = set()  # type: Set[int]
+    for urr in urrs:
+        if urr.oldserverpk is not None:
+            server_pks_uploaded.add(urr.oldserverpk)
+        tablechanges.note_urr(urr,
+                              preserving_new_records=batchdetails.preserving)
+
+    # Deletion (where no record was uploaded at all)
+    server_pks_for_deletion = [r.server_pk for r in servercurrentrecs
+                               if r.server_pk not in server_pks_uploaded]
+    if server_pks_for_deletion:
+        flag_deleted(req, batchdetails, table, server_pks_for_deletion)
+        tablechanges.note_removal_deleted_pks(server_pks_for_deletion)
+
+    # Preserving all records not specifically processed above, too
+    if batchdetails.preserving:
+        preserve_all(req, batchdetails, table)
+        tablechanges.note_preservation_pks(r.server_pk for r in serverrecs)
+
+    # Indexing (and push exports)
+    update_indexes_and_push_exports(req, batchdetails, tablechanges)
+
+    if DEBUG_UPLOAD:
+        log.debug("process_table_for_onestep_upload_bulk: {}", tablechanges)
+
+    return tablechanges
+
+
 # =============================================================================
 # Action maps
 # =============================================================================
@@ -2753,6 +3287,7 @@ class Operations:
     UPLOAD_EMPTY_TABLES = "upload_empty_tables"
     UPLOAD_ENTIRE_DATABASE = "upload_entire_database"  # v2.3.0
     UPLOAD_RECORD = "upload_record"
+    UPLOAD_RECORDS = "upload_records"  # v2.3.8
     UPLOAD_TABLE = "upload_table"
     VALIDATE_PATIENTS = "validate_patients"  # v2.3.0
     WHICH_KEYS_TO_SEND = "which_keys_to_send"
@@ -2776,6 +3311,7 @@ OPERATIONS_UPLOAD = {
     Operations.UPLOAD_EMPTY_TABLES: op_upload_empty_tables,
     Operations.UPLOAD_ENTIRE_DATABASE: op_upload_entire_database,
     Operations.UPLOAD_RECORD: op_upload_record,
+    Operations.UPLOAD_RECORDS: op_upload_records,  # v2.3.8
     Operations.UPLOAD_TABLE: op_upload_table,
     Operations.VALIDATE_PATIENTS: op_validate_patients,  # v2.3.0
     Operations.WHICH_KEYS_TO_SEND: op_which_keys_to_send,
@@ -2896,6 +3432,193 @@ def client_api(req: "CamcopsRequest") -> Response:
     return TextResponse(txt, status=status)
 
 
+# =============================================================================
+# Benchmarking
+# =============================================================================
+
+def make_onestep_benchmark_rows(
+        nrows: int,
+        when_last_modified: str = "2020-01-01T00:00:00.000+00:00",
+        move_off_tablet_every: int = 0) -> List[Dict[str, str]]:
+    """
+    Makes encoded rows for the ``blobs`` table, as a client would send them to
+    :func:`op_upload_entire_database`. For benchmarking and testing.
+
+    Args:
+        nrows: number of rows (with client PKs 1 to ``nrows``)
+        when_last_modified: the ISO-8601 modification time for every row
+        move_off_tablet_every: if non-zero, mark every n-th row for
+            preservation
+
+    Returns:
+        list of rows, each a dictionary of {colname: encoded_value}
+    """
+    rows = []  # type: List[Dict[str, str]]
+    for client_pk in range(1, nrows + 1):
+        move_off = (move_off_tablet_every and
+                    client_pk % move_off_tablet_every == 0)
+        rows.append({
+            "id": encode_single_value(client_pk),
+            "tablename": encode_single_value("photo"),
+            "tablepk": encode_single_value(client_pk),
+            "fieldname": encode_single_value("photo_blobid"),
+            CLIENT_DATE_FIELD: encode_single_value(when_last_modified),
+            MOVE_OFF_TABLET_FIELD: encode_single_value(1 if move_off else 0),
+        })
+    return rows
+
+
+def benchmark_onestep_upload(
+        req: "CamcopsRequest",
+        nrows_list: Sequence[int] = (1000, 10000, 100000)) -> None:
+    """
+    Compares :func:`process_table_for_onestep_upload` (row by row) with
+    :func:`process_table_for_onestep_upload_bulk` (set-based), for uploads to
+    the ``blobs`` table.
+
+    For each size, we time (1) an upload of entirely new records, then (2) a
+    re-upload in which every second record has been modified and every tenth
+    is marked for preservation. Each path runs within a transaction that is
+    rolled back afterwards, so both start from the same database state.
+
+    ``req`` must have a ``tabletsession`` for a registered device and a user
+    with an upload group; see ``ClientApiTests``.
+
+    Use with:
+
+    .. code-block:: python
+
+        from cardinal_pythonlib.logs import main_only_quicksetup_rootlogger
+        from camcops_server.cc_modules.client_api import benchmark_onestep_upload
+        main_only_quicksetup_rootlogger()
+        benchmark_onestep_upload(req)
+
+    The row-by-row method is quadratic in the number of rows (a linear scan
+    of server records per row) and makes several queries per row, so expect
+    the 100,000-row run of that method to be very slow.
+
+    Args:
+        req: the :class:`camcops_server.cc_modules.cc_request.CamcopsRequest`
+        nrows_list: numbers of rows to test
+    """  # noqa
+    # noinspection PyUnresolvedReferences
+    table = Blob.__table__
+    clientpk_name = "id"
+    for nrows in nrows_list:
+        first_rows = make_onestep_benchmark_rows(nrows)
+        second_rows = make_onestep_benchmark_rows(
+            nrows, move_off_tablet_every=10)
+        for row in second_rows[::2]:
+            row[CLIENT_DATE_FIELD] = encode_single_value(
+                "2020-02-02T00:00:00.000+00:00")
+        for description, fn in (
+                ("row by row", process_table_for_onestep_upload),
+                ("bulk", process_table_for_onestep_upload_bulk)):
+            changes = []  # type: List[UploadTableChanges]
+            t0 = time.time()
+            for rows in (first_rows, second_rows):
+                batchdetails = BatchDetails(req.now_utc, onestep=True)
+                changes.append(fn(req, batchdetails, table, clientpk_name,
+                                  [dict(r) for r in rows]))
+            t1 = time.time()
+            req.dbsession.rollback()
+            log.info("{} rows, {}: {:.3f} s; {}",
+                     nrows, description, t1 - t0,
+                     " // ".join(c.description(always_show_current_pks=False)
+                                 for c in changes))
+
+
+def make_synthetic_dbdata_json(target_mb: float = 200,
+                               ntables: int = 20,
+                               ncols: int = 30) -> str:
+    """
+    Makes JSON of the form sent as :attr:`TabletParam.DBDATA` by
+    :func:`op_upload_entire_database`, of approximately the requested size,
+    with rows split evenly across ``ntables`` tables.
+
+    Args:
+        target_mb: approximate size in megabytes (10^6 bytes)
+        ntables: number of tables
+        ncols: number of columns per row (other than the PK and the standard
+            columns)
+    """
+    row_template = {
+        "id": "{pk}",
+        CLIENT_DATE_FIELD: encode_single_value(
+            "2020-01-01T00:00:00.000+00:00"),
+        MOVE_OFF_TABLET_FIELD: "0",
+    }
+    for c in range(ncols):
+        if c % 3 == 0:
+            row_template[f"q{c}"] = str(c)
+        elif c % 3 == 1:
+            row_template[f"q{c}"] = str(c + 0.5)
+        else:
+            row_template[f"q{c}"] = encode_single_value(f"some text {c}")
+    row_json_template = json.dumps(row_template)
+    bytes_per_row = len(row_json_template) + 2
+    nrows_per_table = max(1, int(target_mb * 1e6 / bytes_per_row / ntables))
+    tables = []  # type: List[str]
+    for t in range(ntables):
+        rows = ",".join(row_json_template.replace("{pk}", str(pk))
+                        for pk in range(1, nrows_per_table + 1))
+        tables.append(f'"table{t}":[{rows}]')
+    return "{" + ",".join(tables) + "}"
+
+
+def benchmark_onestep_upload_decoding_memory(target_mb: float = 200) -> None:
+    """
+    Uses :mod:`tracemalloc` to compare the peak memory used to decode a
+    one-step upload (a) in the old way, decoding the whole of the
+    :attr:`TabletParam.DBDATA` JSON and then each table's values, and (b)
+    incrementally, via :class:`DbDataJsonStreamer`, one table at a time.
+
+    The memory used by the raw JSON text itself (which both methods need) is
+    reported separately.
+
+    Use with:
+
+    .. code-block:: python
+
+        from cardinal_pythonlib.logs import main_only_quicksetup_rootlogger
+        from camcops_server.cc_modules.client_api import benchmark_onestep_upload_decoding_memory
+        main_only_quicksetup_rootlogger()
+        benchmark_onestep_upload_decoding_memory()
+
+    Args:
+        target_mb: approximate size of the synthetic upload, in megabytes
+    """  # noqa
+    import tracemalloc  # delayed import; benchmarking only
+
+    text = make_synthetic_dbdata_json(target_mb)
+    log.info("Synthetic upload: {:.1f} MB of JSON", len(text) / 1e6)
+
+    def decode_all_at_once() -> None:
+        dbdata = DB_JSON_DECODER.decode(text)
+        for rows in dbdata.values():
+            valuedicts = [{k: decode_single_value(v) for k, v in row.items()}
+                          for row in rows]
+            del valuedicts
+
+    def decode_incrementally() -> None:
+        dbdata = DbDataJsonStreamer(text, decoder=DB_JSON_DECODER)
+        for tablename in dbdata.tablenames:
+            valuedicts = [{k: decode_single_value(v) for k, v in row.items()}
+                          for row in dbdata.gen_rows(tablename)]
+            del valuedicts
+
+    for description, fn in (("all at once", decode_all_at_once),
+                            ("incremental", decode_incrementally)):
+        tracemalloc.start()
+        t0 = time.time()
+        fn()
+        t1 = time.time()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        log.info("Decoding {}: peak {:.1f} MB beyond the raw text; {:.1f} s",
+                 description, peak / 1e6, t1 - t0)
+
+
 # =============================================================================
 # Unit tests
 # =============================================================================
@@ -2988,6 +3711,166 @@ class ClientApiTests(DemoDatabaseTestCase):
 
         # TODO: client_api.ClientApiTests: more tests here... ?
 
+    def _set_up_tablet_session(self) -> None:
+        """
+        Creates a tablet session for our test device, without going through
+        the login process.
+        """
+        from camcops_server.cc_modules.cc_tabletsession import TabletSession
+        self.req.fake_request_post_from_dict({
+            TabletParam.CAMCOPS_VERSION: MINIMUM_TABLET_VERSION,
+            TabletParam.DEVICE: self.other_device.name,
+            TabletParam.OPERATION: Operations.UPLOAD_ENTIRE_DATABASE,
+        })
+        self.req.tabletsession = TabletSession(self.req)
+
+    def test_onestep_upload_bulk_matches_row_by_row(self) -> None:
+        self.announce("test_onestep_upload_bulk_matches_row_by_row")
+        self._set_up_tablet_session()
+        # noinspection PyUnresolvedReferences
+        table = Blob.__table__
+        first_rows = make_onestep_benchmark_rows(20)
+        second_rows = make_onestep_benchmark_rows(15, move_off_tablet_every=4)
+        for row in second_rows[::3]:
+            row[CLIENT_DATE_FIELD] = encode_single_value(
+                "2020-02-02T00:00:00.000+00:00")
+
+        pk_sets = ("addition_pks", "removal_modified_pks",
+                   "removal_deleted_pks", "preservation_pks", "current_pks")
+
+        def run(fn) -> List[Dict[str, Set[Any]]]:
+            changes = []  # type: List[UploadTableChanges]
+            # New server PKs may differ across a rollback, depending on the
+            # database engine, so identify each server record by the upload
+            # that created it and its client PK.
+            record_ids = {}  # type: Dict[int, Tuple[int, int]]
+            for upload, rows in enumerate((first_rows, second_rows)):
+                batchdetails = BatchDetails(self.req.now_utc, onestep=True)
+                tablechanges = fn(self.req, batchdetails, table, "id",
+                                  [dict(r) for r in rows])
+                # noinspection PyProtectedMember
+                for server_pk, client_pk in (
+                        self.dbsession.query(Blob._pk, Blob.id)
+                        .filter(Blob._pk.in_(tablechanges.addition_pks))):
+                    record_ids[server_pk] = (upload, client_pk)
+                changes.append(tablechanges)
+            self.dbsession.rollback()
+            return [
+                {
+                    attr: {record_ids.get(pk, pk)
+                           for pk in getattr(tablechanges, attr)}
+                    for attr in pk_sets
+                }
+                for tablechanges in changes
+            ]
+
+        rowwise = run(process_table_for_onestep_upload)
+        bulk = run(process_table_for_onestep_upload_bulk)
+        self.assertEqual(rowwise, bulk)
+        self.assertEqual(len(bulk[1]["addition_pks"]), 5)
+        self.assertEqual(len(bulk[1]["removal_modified_pks"]), 5)
+        self.assertEqual(len(bulk[1]["removal_deleted_pks"]), 5)
+
+    def test_upload_records_binary(self) -> None:
+        self.announce("test_upload_records_binary")
+        self._set_up_tablet_session()
+        # noinspection PyUnresolvedReferences
+        table = Blob.__table__
+        rows = make_onestep_benchmark_rows(3)
+        fields = list(rows[0].keys()) + ["theblob"]
+        post = {
+            TabletParam.CAMCOPS_VERSION: MINIMUM_TABLET_VERSION,
+            TabletParam.DEVICE: self.other_device.name,
+            TabletParam.OPERATION: Operations.UPLOAD_RECORDS,
+            TabletParam.TABLE: table.name,
+            TabletParam.PKNAME: "id",
+            TabletParam.FIELDS: ",".join(fields),
+            TabletParam.NRECORDS: str(len(rows)),
+        }
+        blobs = {}  # type: Dict[str, bytes]
+        for r, row in enumerate(rows):
+            post[TabletParam.RECORD_PREFIX + str(r)] = ",".join(
+                list(row.values()) + ["NULL"])
+            if r > 0:  # record 0 has a NULL BLOB
+                # All byte values, including CR/LF and "--":
+                blobs[binary_part_name(r, "theblob")] = bytes(range(256)) * r
+        self.req.fake_request_post_multipart(post, blobs)
+        op_upload_records(self.req)
+        # noinspection PyProtectedMember
+        uploaded = {
+            b.id: b.theblob
+            for b in self.dbsession.query(Blob)
+            .filter(Blob._device_id == self.other_device.id)
+            .filter(Blob._addition_pending == True)  # noqa: E712
+        }
+        self.assertEqual(uploaded, {1: None,
+                                    2: bytes(range(256)),
+                                    3: bytes(range(256)) * 2})
+        self.assertTrue(is_binary_column(table.columns["theblob"]))
+        self.assertFalse(is_binary_column(table.columns["tablename"]))
+
+    def test_dbdata_json_streamer(self) -> None:
+        self.announce("test_dbdata_json_streamer")
+        dbdata = {
+            "patient": [{"id": "1", "forename": "'Alice'"}, {"id": "2"}],
+            "blobs": [],
+            "phq9": [{"id": "3", "q1": "NULL"}],
+        }
+        streamer = DbDataJsonStreamer(json.dumps(dbdata, indent=4))
+        self.assertEqual(streamer.tablenames, ["patient", "blobs", "phq9"])
+        # Tables can be read in any order, and more than once:
+        for tablename in ("phq9", "patient", "blobs", "patient"):
+            self.assertEqual(list(streamer.gen_rows(tablename)),
+                             dbdata[tablename])
+            self.assertEqual(streamer.n_rows(tablename),
+                             len(dbdata[tablename]))
+        self.assertEqual(list(streamer.gen_rows("nonexistent")), [])
+        self.assertEqual(DbDataJsonStreamer(" {} ").tablenames, [])
+        # Output should match the all-at-once decoder:
+        text = make_synthetic_dbdata_json(target_mb=0.1, ntables=3)
+        decoded = DB_JSON_DECODER.decode(text)
+        streamer = DbDataJsonStreamer(text)
+        self.assertEqual(
+            {t: list(streamer.gen_rows(t)) for t in streamer.tablenames},
+            decoded)
+        # Rows are decoded once, when read, not when indexed:
+        decoder = json.JSONDecoder()
+        with mock.patch.object(decoder, "raw_decode",
+                               wraps=decoder.raw_decode) as mock_raw_decode:
+            streamer = DbDataJsonStreamer(text, decoder=decoder)
+            n_tables = len(streamer.tablenames)
+            self.assertEqual(mock_raw_decode.call_count, n_tables)
+            n_rows = sum(len(list(streamer.gen_rows(t)))
+                         for t in streamer.tablenames)
+            self.assertEqual(mock_raw_decode.call_count, n_tables + n_rows)
+        for bad in ("", "[]", '{"t": 1}', '{"t": [1]}', '{"t": []} junk',
+                    '{"t": [{}', '{"t": [{},]}', '{1: []}'):
+            with self.assertRaises(UserErrorException):
+                DbDataJsonStreamer(bad)
+
+    def test_classify_onestep_upload_rows(self) -> None:
+        self.announce("test_classify_onestep_upload_rows")
+        when = coerce_to_pendulum("2020-01-01T00:00:00.000+00:00")
+        server_index = {
+            1: ServerRecord(1, True, 101, when),
+            2: ServerRecord(2, True, 102, when),
+        }
+        valuedicts = [
+            {"id": 1, CLIENT_DATE_FIELD: "2020-01-01T00:00:00.000+00:00",
+             MOVE_OFF_TABLET_FIELD: 0},
+            {"id": 2, CLIENT_DATE_FIELD: "2020-03-03T00:00:00.000+00:00",
+             MOVE_OFF_TABLET_FIELD: 0},
+            {"id": 3, CLIENT_DATE_FIELD: "2020-01-01T00:00:00.000+00:00",
+             MOVE_OFF_TABLET_FIELD: 1},
+        ]
+        rowsets = classify_onestep_upload_rows("id", valuedicts, server_index)
+        self.assertEqual([r[0] for r in rowsets.identical], [0])
+        self.assertEqual([r[0] for r in rowsets.modified], [1])
+        self.assertEqual([r[0] for r in rowsets.new], [2])
+        self.assertEqual(rowsets.n_rows, 3)
+        with self.assertRaises(UserErrorException):
+            classify_onestep_upload_rows("id", [{"id": 4}], server_index)
+
     def test_client_api_antique_support_1(self):
         self.announce("test_client_api_antique_support_1")
         self.req.fake_request_post_from_dict({
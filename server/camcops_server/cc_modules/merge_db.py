@@ -31,19 +31,36 @@ Has special code to deal with old databases.
 """
 
 import logging
+import os
 from pprint import pformat
-from typing import Any, Dict, List, Optional, Type, TYPE_CHECKING
+import time
+from unittest import mock
+from typing import (Any, Dict, Generator, List, Optional, Set, Tuple, Type,
+                    TYPE_CHECKING)
 
+from cardinal_pythonlib.lists import chunks
 from cardinal_pythonlib.logs import BraceStyleAdapter
 from cardinal_pythonlib.sqlalchemy.merge_db import merge_db, TranslationContext
-from cardinal_pythonlib.sqlalchemy.schema import get_table_names
-from cardinal_pythonlib.sqlalchemy.session import get_safe_url_from_engine
+from cardinal_pythonlib.sqlalchemy.orm_inspect import (
+    get_orm_classes_by_table_name_from_base,
+)
+from cardinal_pythonlib.sqlalchemy.schema import (
+    get_column_names,
+    get_table_names,
+)
+from cardinal_pythonlib.sqlalchemy.session import (
+    get_engine_from_session,
+    get_safe_url_from_engine,
+)
 from cardinal_pythonlib.sqlalchemy.table_identity import TableIdentity
 from sqlalchemy.engine import create_engine
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
-from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.session import Session, sessionmaker
+from sqlalchemy.schema import sort_tables
 from sqlalchemy.sql.expression import column, func, select, table, text
+from sqlalchemy.sql.schema import Column, Table
+from sqlalchemy.sql.sqltypes import Integer
 
 from camcops_server.cc_modules.cc_audit import AuditEntry
 from camcops_server.cc_modules.cc_constants import (
@@ -78,6 +95,7 @@ from camcops_server.cc_modules.cc_serversettings import (
 )
 from camcops_server.cc_modules.cc_sqlalchemy import Base
 from camcops_server.cc_modules.cc_taskindex import reindex_everything
+from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
 from camcops_server.cc_modules.cc_user import (
     SecurityAccountLockout,
     SecurityLoginFailure,
@@ -508,9 +526,12 @@ def log_warning_srcobj(srcobj: Any) -> None:
     Prints a source (old) object to the log.
 
     Args:
-        srcobj: the source object
+        srcobj: the source object, or (from a batched merge) a dictionary
+            representing a source row
     """
-    log.warning("Source was:\n\n{}\n\n", pformat(srcobj.__dict__))
+    log.warning("Source was:\n\n{}\n\n",
+                pformat(srcobj if isinstance(srcobj, dict)
+                        else srcobj.__dict__))
 
 
 def get_dest_groupnum(src_groupnum: int,
@@ -988,6 +1009,655 @@ def postprocess(src_engine: Engine, dst_session: Session) -> None:
                 "from table {!r}; do this by hand.", group_group_table.name)
 
 
+# =============================================================================
+# Batched merge
+# =============================================================================
+
+DEFAULT_MERGE_CHUNK_SIZE = 1000
+MAX_VALUES_PER_IN_CLAUSE = 500  # well below e.g. SQL Server's parameter limit
+
+
+class BatchMerger(object):
+    """
+    Merges a source CamCOPS database into the destination database in batches,
+    using SQLAlchemy Core rather than the ORM. This is a much faster
+    alternative to
+    :func:`cardinal_pythonlib.sqlalchemy.merge_db.merge_db` plus
+    :func:`translate_fn`, and applies the same translation rules:
+
+    - Tables are processed in order of dependency, skipping those in
+      ``skip_tables`` and those absent from the source.
+
+    - Source rows are read ``chunk_size`` at a time, in primary key order.
+
+    - New primary keys are allocated in memory, counting up from the current
+      maximum in the destination, and the old-to-new map for each table is
+      used to rewrite foreign keys in subsequent tables. (Foreign keys to
+      skipped tables become NULL, as they would via the ORM.)
+
+    - Groups and ID number definitions are not copied, but mapped via
+      ``groupnum_map`` and ``whichidnum_map``; users and devices are merged
+      with any destination users/devices of the same name; ``_group_id`` is
+      set or remapped for tablet records; old-style patient ID numbers are
+      converted to :class:`PatientIdNum` records; and duplicate tablet records
+      are refused.
+
+    - Rows are written with one "executemany" ``INSERT`` per chunk.
+
+    Because primary keys are allocated here, rather than by the database,
+    nothing else should write to the destination database during the merge.
+    """
+
+    def __init__(self,
+                 src_engine: Engine,
+                 dst_session: Session,
+                 skip_tables: List[TableIdentity],
+                 trcon_info: Dict[str, Any],
+                 dummy_run: bool = False,
+                 info_only: bool = False,
+                 report_every: int = 10000,
+                 chunk_size: int = DEFAULT_MERGE_CHUNK_SIZE) -> None:
+        """
+        Args:
+            src_engine: source SQLAlchemy :class:`Engine`
+            dst_session: destination SQLAlchemy :class:`Session`
+            skip_tables: tables to skip
+            trcon_info: information for translation, as for
+                :func:`translate_fn`
+            dummy_run: don't alter the destination database
+            info_only: show info, then stop
+            report_every: provide a progress report every *n* records
+            chunk_size: number of source records to read and write at once
+        """
+        assert chunk_size > 0, "chunk_size must be positive"
+        self.src_engine = src_engine
+        self.dst_session = dst_session
+        self.dst_engine = get_engine_from_session(dst_session)
+        self.info = trcon_info
+        self.dummy_run = dummy_run
+        self.info_only = info_only
+        self.report_every = report_every
+        self.chunk_size = chunk_size
+
+        metadata = Base.metadata
+        for ti in skip_tables:
+            ti.set_metadata_if_none(metadata)
+        self.skip_table_names = set(ti.tablename for ti in skip_tables)
+        self.src_table_names = get_table_names(src_engine)
+        self.tablename_to_ormclass = get_orm_classes_by_table_name_from_base(
+            Base)
+
+        # Per table: map from source PK to destination PK
+        self.pk_maps = {}  # type: Dict[str, Dict[Any, Any]]
+        # Per table: next PK to allocate, and the maximum PK that existed
+        # before we started
+        self.next_pk = {}  # type: Dict[str, int]
+        self.max_preexisting_pk = {}  # type: Dict[str, int]
+
+        self.start = 0.0
+        self.n_rows_read = 0
+        self.n_rows_written = 0
+
+    # -------------------------------------------------------------------------
+    # Helpers
+    # -------------------------------------------------------------------------
+
+    @staticmethod
+    def get_single_pk_column(table: Table) -> Optional[Column]:
+        """
+        Returns the table's primary key column, if it has a single-column PK,
+        or ``None``.
+        """
+        pkcols = list(table.primary_key.columns)
+        return pkcols[0] if len(pkcols) == 1 else None
+
+    @classmethod
+    def get_allocatable_pk_column(cls, table: Table) -> Optional[Column]:
+        """
+        Returns the table's primary key column, if it's an autoincrementing
+        integer, so that we should allocate new values for it; otherwise,
+        ``None`` (and source PK values are kept).
+        """
+        pkcol = cls.get_single_pk_column(table)
+        if (pkcol is not None and
+                isinstance(pkcol.type, Integer) and
+                pkcol.autoincrement in (True, "auto") and
+                not pkcol.foreign_keys):
+            return pkcol
+        return None
+
+    def allocate_pk(self, table: Table, pkcol: Column) -> int:
+        """
+        Allocates a new destination primary key for a table.
+        """
+        tablename = table.name
+        if tablename not in self.next_pk:
+            # noinspection PyTypeChecker
+            max_pk = self.dst_session.execute(
+                select([func.max(pkcol)])
+            ).scalar() or 0
+            self.max_preexisting_pk[tablename] = max_pk
+            self.next_pk[tablename] = max_pk + 1
+        pk = self.next_pk[tablename]
+        self.next_pk[tablename] += 1
+        return pk
+
+    def rate(self) -> float:
+        """
+        Returns the overall throughput so far, in source rows per second.
+        """
+        elapsed = time.monotonic() - self.start
+        return self.n_rows_read / elapsed if elapsed > 0 else 0
+
+    def gen_src_chunks(
+            self,
+            table: Table,
+            colnames: List[str],
+            extra_colnames: List[str] = None) \
+            -> Generator[List[Dict[str, Any]], None, None]:
+        """
+        Generates chunks of rows (as dictionaries) from a source table, in
+        primary key order.
+
+        Args:
+            table: the (destination) table definition
+            colnames: names of columns to fetch; these must be present in the
+                source and in ``table``
+            extra_colnames: names of columns to fetch that are present in the
+                source but not in ``table`` (e.g. defunct columns)
+        """
+        extra_colnames = extra_colnames or []  # type: List[str]
+        pkcols = list(table.primary_key.columns)
+        # noinspection PyTypeChecker
+        query = (
+            select([table.columns[c] for c in colnames] +
+                   [column(c) for c in extra_colnames])
+            .select_from(table)
+            .order_by(*pkcols)
+        )
+        pkcol = self.get_single_pk_column(table)
+        if pkcol is not None and pkcol.name in colnames:
+            # Keyset pagination: cheap for large tables.
+            last_pk = None
+            while True:
+                q = query if last_pk is None else query.where(pkcol > last_pk)
+                rows = [
+                    dict(row) for row in
+                    self.src_engine.execute(q.limit(self.chunk_size))
+                ]
+                if not rows:
+                    return
+                yield rows
+                last_pk = rows[-1][pkcol.name]
+        else:
+            offset = 0
+            while True:
+                rows = [
+                    dict(row) for row in
+                    self.src_engine.execute(
+                        query.limit(self.chunk_size).offset(offset))
+                ]
+                if not rows:
+                    return
+                yield rows
+                offset += len(rows)
+
+    def find_existing(self,
+                      table: Table,
+                      keycolname: str,
+                      rows: List[Dict[str, Any]]) -> Dict[Any, Any]:
+        """
+        For source rows identified by ``keycolname`` (e.g. a username), find
+        destination rows with the same key.
+
+        Returns:
+            dict: ``{source_pk: existing_destination_pk}``
+        """
+        pkcol = self.get_single_pk_column(table)
+        keycol = table.columns[keycolname]
+        keys = list(set(row[keycolname] for row in rows
+                        if row[keycolname] is not None))
+        dst_pk_by_key = {}  # type: Dict[Any, Any]
+        for some_keys in chunks(keys, MAX_VALUES_PER_IN_CLAUSE):
+            # noinspection PyTypeChecker
+            q = select([keycol, pkcol]).where(keycol.in_(some_keys))
+            for key, pk in self.dst_session.execute(q):
+                dst_pk_by_key[key] = pk
+        return {
+            row[pkcol.name]: dst_pk_by_key[row[keycolname]]
+            for row in rows
+            if row[keycolname] in dst_pk_by_key
+        }
+
+    def insert(self, table: Table, rows: List[Dict[str, Any]]) -> None:
+        """
+        Writes rows to the destination, using one "executemany" ``INSERT``
+        per set of columns.
+        """
+        if not rows:
+            return
+        self.n_rows_written += len(rows)
+        if self.dummy_run:
+            return
+        rows_by_columns = {}  # type: Dict[Tuple[str, ...], List[Dict[str, Any]]]  # noqa
+        for row in rows:
+            rows_by_columns.setdefault(tuple(sorted(row.keys())),
+                                       []).append(row)
+        for some_rows in rows_by_columns.values():
+            self.dst_session.execute(table.insert(), some_rows)
+
+    # -------------------------------------------------------------------------
+    # Main
+    # -------------------------------------------------------------------------
+
+    def merge(self) -> None:
+        """
+        Performs the merge, and commits.
+        """
+        log.info("Batched merge: starting")
+        if self.dummy_run:
+            log.warning("Dummy run only; destination will not be changed")
+        self.start = time.monotonic()
+        self.dst_session.flush()  # e.g. system user, server device
+
+        ordered_tables = sort_tables(Base.metadata.tables.values())
+        log.info("Processing tables in the order: {!r}",
+                 [t.name for t in ordered_tables])
+        for tbl in ordered_tables:
+            tablename = tbl.name
+            if tablename in self.skip_table_names:
+                log.info("... skipping table {!r} (as per skip_tables)",
+                         tablename)
+                continue
+            if tablename not in self.src_table_names:
+                log.info("... ignoring table {!r} (not in source database)",
+                         tablename)
+                continue
+            if tablename not in self.tablename_to_ormclass:
+                log.warning("... ignoring table {!r} (no ORM class)",
+                            tablename)
+                continue
+            self.merge_table(tbl)
+
+        self.dst_session.commit()
+        log.info("Batched merge: finished{}; {} rows read, {} rows written, "
+                 "in {:.1f} s ({:.0f} rows/s)",
+                 " (DUMMY RUN)" if self.dummy_run else "",
+                 self.n_rows_read, self.n_rows_written,
+                 time.monotonic() - self.start, self.rate())
+
+    def merge_table(self, table: Table) -> None:
+        """
+        Merges a single table.
+        """
+        tablename = table.name
+        orm_class = self.tablename_to_ormclass[tablename]
+        src_colnames = set(get_column_names(self.src_engine, tablename))
+        colnames = [c.name for c in table.columns if c.name in src_colnames]
+        missing_columns = sorted(c.name for c in table.columns
+                                 if c.name not in src_colnames)
+        log.info("Processing table {!r} via ORM class {!r}",
+                 tablename, orm_class)
+        if missing_columns:
+            log.info("Table {} is missing columns {} in the source",
+                     tablename, missing_columns)
+        if self.info_only:
+            log.debug("info_only; skipping table contents")
+            return
+
+        extra_colnames = []  # type: List[str]
+        if tablename == Patient.__tablename__:
+            # Defunct ID number columns, for conversion to PatientIdNum
+            extra_colnames = [
+                FP_ID_NUM + str(n)
+                for n in range(1, NUMBER_OF_IDNUMS_DEFUNCT + 1)
+                if FP_ID_NUM + str(n) in src_colnames
+            ]
+        trcon = TranslationContext(
+            oldobj=None,
+            newobj=None,
+            objmap={},
+            table=table,
+            tablename=tablename,
+            src_session=None,
+            dst_session=self.dst_session,
+            src_engine=self.src_engine,
+            dst_engine=self.dst_engine,
+            missing_src_columns=missing_columns,
+            src_table_names=self.src_table_names,
+            info=self.info
+        )
+
+        table_start = time.monotonic()
+        n_table_rows = 0
+        for rows in self.gen_src_chunks(table, colnames, extra_colnames):
+            self.merge_chunk(trcon, orm_class, colnames, rows)
+            previous_n = n_table_rows
+            n_table_rows += len(rows)
+            self.n_rows_read += len(rows)
+            if n_table_rows // self.report_every > \
+                    previous_n // self.report_every:
+                log.info("... progress{}: table {!r}: {} rows this table; "
+                         "{} rows overall ({:.0f} rows/s)",
+                         " (DUMMY RUN)" if self.dummy_run else "",
+                         tablename, n_table_rows, self.n_rows_read,
+                         self.rate())
+        elapsed = time.monotonic() - table_start
+        log.info("... table {!r}: {} rows in {:.1f} s ({:.0f} rows/s)",
+                 tablename, n_table_rows, elapsed,
+                 n_table_rows / elapsed if elapsed > 0 else 0)
+
+    # noinspection PyProtectedMember
+    def merge_chunk(self,
+                    trcon: TranslationContext,
+                    orm_class: Type,
+                    colnames: List[str],
+                    rows: List[Dict[str, Any]]) -> None:
+        """
+        Translates and writes a chunk of source rows. See
+        :func:`translate_fn` for the rules.
+
+        Args:
+            trcon: a :class:`TranslationContext` for the table; its
+                ``oldobj`` and ``newobj`` are set to the source and
+                destination row dictionaries as we go
+            orm_class: the ORM class for the table
+            colnames: names of columns to copy
+            rows: source rows
+        """
+        table = trcon.table
+        tablename = trcon.tablename
+        pkcol = self.get_single_pk_column(table)
+        pk_map = self.pk_maps.setdefault(tablename, {})
+
+        # ---------------------------------------------------------------------
+        # Groups and ID number definitions: map, don't copy
+        # ---------------------------------------------------------------------
+        if tablename == Group.__tablename__:
+            for row in rows:
+                src_group_id = row[Group.id.name]
+                pk_map[src_group_id] = get_dst_group(
+                    dest_groupnum=get_dest_groupnum(src_group_id, trcon, row),
+                    dst_session=self.dst_session
+                ).id
+            return
+        if tablename == IdNumDefinition.__tablename__:
+            for row in rows:
+                src_which_idnum = row[IdNumDefinition.which_idnum.name]
+                pk_map[src_which_idnum] = get_dest_which_idnum(
+                    src_which_idnum, trcon, row)
+            return
+
+        # ---------------------------------------------------------------------
+        # Users and devices: merge on matching name
+        # ---------------------------------------------------------------------
+        matches = {}  # type: Dict[Any, Any]
+        if tablename == User.__tablename__:
+            matches = self.find_existing(table, User.username.name, rows)
+        elif tablename == Device.__tablename__:
+            matches = self.find_existing(table, Device.name.name, rows)
+
+        # ---------------------------------------------------------------------
+        # Copy, with new PKs (first, so references within the chunk work)
+        # ---------------------------------------------------------------------
+        alloc_pkcol = self.get_allocatable_pk_column(table)
+        pairs = []  # type: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+        for row in rows:
+            src_pk = row[pkcol.name] if pkcol is not None else None
+            if src_pk in matches:
+                log.debug("Matching record in table {!r} found; merging",
+                          tablename)
+                pk_map[src_pk] = matches[src_pk]
+                continue
+            newrow = {c: row[c] for c in colnames}
+            if alloc_pkcol is not None:
+                new_pk = self.allocate_pk(table, alloc_pkcol)
+                newrow[alloc_pkcol.name] = new_pk
+                pk_map[src_pk] = new_pk
+            pairs.append((row, newrow))
+
+        # ---------------------------------------------------------------------
+        # Rewrite foreign keys
+        # ---------------------------------------------------------------------
+        for col in table.columns:
+            if not col.foreign_keys or col.name not in colnames:
+                continue
+            target = next(iter(col.foreign_keys)).column
+            target_tablename = target.table.name
+            target_pkcol = self.get_single_pk_column(target.table)
+            if target_pkcol is None or target.name != target_pkcol.name:
+                continue  # not a reference to a PK; copy as is
+            target_map = self.pk_maps.get(target_tablename, {})
+            # ... empty (so we write NULL) if the target was skipped
+            for row, newrow in pairs:
+                newrow[col.name] = target_map.get(row[col.name])
+        if pkcol is not None and alloc_pkcol is None:
+            # PKs kept (or rewritten as foreign keys, above)
+            for row, newrow in pairs:
+                pk_map[row[pkcol.name]] = newrow.get(pkcol.name)
+
+        # ---------------------------------------------------------------------
+        # Per-record translation
+        # ---------------------------------------------------------------------
+        is_tablet_record = issubclass(orm_class, GenericTabletRecordMixin)
+        for row, newrow in pairs:
+            trcon.oldobj = row
+            trcon.newobj = newrow
+            if is_tablet_record:
+                if ("_group_id" in trcon.missing_src_columns or
+                        row["_group_id"] is None):
+                    ensure_default_group_id(trcon)
+                    newrow["_group_id"] = self.info["default_group_id"]
+                else:
+                    newrow["_group_id"] = get_dest_groupnum(
+                        row["_group_id"], trcon, row)
+            if tablename == PatientIdNum.__tablename__:
+                src_which_idnum = row[PatientIdNum.which_idnum.name]
+                if src_which_idnum is None:
+                    raise ValueError(f"Bad PatientIdNum: {row!r}")
+                newrow[PatientIdNum.which_idnum.name] = get_dest_which_idnum(
+                    src_which_idnum, trcon, row)
+
+        if is_tablet_record:
+            self.check_no_duplicates(trcon, pairs)
+
+        self.insert(table, [newrow for _, newrow in pairs])
+
+        if tablename == Patient.__tablename__:
+            self.insert(PatientIdNum.__table__,
+                        self.make_idnums_from_old_patients(trcon, pairs))
+
+    # noinspection PyProtectedMember
+    def check_no_duplicates(
+            self,
+            trcon: TranslationContext,
+            pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> None:
+        """
+        Checks that we're not creating duplicate tablet records; see
+        :func:`translate_fn`. Raises :exc:`ValueError` if we are.
+        """
+        table = trcon.table
+        tablename = trcon.tablename
+        if not pairs:
+            return
+
+        def key(r: Dict[str, Any]) -> Tuple[Any, Any, Any, Any]:
+            return (r["id"], r["_device_id"], r["_era"],
+                    r["_when_removed_exact"])
+
+        src_by_key = {key(newrow): row for row, newrow in pairs}
+        ids = list(set(newrow["id"] for _, newrow in pairs))
+        device_ids = list(set(newrow["_device_id"] for _, newrow in pairs))
+        pkcol = self.get_allocatable_pk_column(table)
+        for some_ids in chunks(ids, MAX_VALUES_PER_IN_CLAUSE):
+            # noinspection PyTypeChecker
+            q = (
+                select([table])
+                .where(table.columns["id"].in_(some_ids))
+                .where(table.columns["_device_id"].in_(device_ids))
+            )
+            if pkcol is not None and tablename in self.max_preexisting_pk:
+                # Ignore records from this merge, as the ORM method would.
+                q = q.where(pkcol <= self.max_preexisting_pk[tablename])
+            existing = [dict(r) for r in self.dst_session.execute(q)]
+            clashes = [r for r in existing if key(r) in src_by_key]
+            if not clashes:
+                continue
+            row = src_by_key[key(clashes[0])]
+            log.critical(
+                "Source record, inheriting from GenericTabletRecordMixin and "
+                "shown below, already exists in destination database... "
+                "in table {t!r}, clashing on: "
+                "id={i!r}, device_id={d!r}, era={e!r}, "
+                "_when_removed_exact={w!r}.\n"
+                "ARE YOU TRYING TO MERGE THE SAME DATABASE IN TWICE? "
+                "DON'T.",
+                t=tablename,
+                i=row["id"],
+                d=row["_device_id"],
+                e=row["_era"],
+                w=row["_when_removed_exact"],
+            )
+            log_warning_srcobj(row)
+            log.critical(
+                "Existing record(s) in destination DB was/were:\n\n{}\n\n",
+                pformat([r for r in clashes if key(r) == key(clashes[0])]))
+            raise ValueError("Attempt to insert duplicate record; see log "
+                             "message above.")
+
+    # noinspection PyProtectedMember
+    def make_idnums_from_old_patients(
+            self,
+            trcon: TranslationContext,
+            pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) \
+            -> List[Dict[str, Any]]:
+        """
+        Creates :class:`PatientIdNum` records for ID numbers that are stored
+        in the old format (as columns in the Patient table) but have no
+        corresponding :class:`PatientIdNum` record in the source; see
+        :func:`translate_fn`.
+
+        Returns:
+            rows for the destination :class:`PatientIdNum` table
+        """
+        if not pairs:
+            return []
+        tablename = trcon.tablename
+        src_colnames = set(get_column_names(self.src_engine, tablename))
+        idnum_fields = {
+            which_idnum: FP_ID_NUM + str(which_idnum)
+            for which_idnum in range(1, NUMBER_OF_IDNUMS_DEFUNCT + 1)
+            if FP_ID_NUM + str(which_idnum) in src_colnames
+        }
+        if not idnum_fields:
+            return []
+        patient_ids = list(set(row[Patient.id.name] for row, _ in pairs))
+
+        # (a) Old ID numbers, from the current versions of these patients
+        current_idnums = {}  # type: Dict[Tuple[Any, Any, Any], List[Dict[str, Any]]]  # noqa
+        for some_ids in chunks(patient_ids, MAX_VALUES_PER_IN_CLAUSE):
+            # noinspection PyUnresolvedReferences
+            q = (
+                select([column(Patient.id.name),
+                        column(Patient._device_id.name),
+                        column(Patient._era.name)] +
+                       [column(f) for f in idnum_fields.values()])
+                .select_from(table(tablename))
+                .where(column(Patient._current.name) == True)  # noqa: E712
+                .where(column(Patient.id.name).in_(some_ids))
+            )
+            for r in self.src_engine.execute(q):
+                d = dict(r)
+                k = (d[Patient.id.name], d[Patient._device_id.name],
+                     d[Patient._era.name])
+                current_idnums.setdefault(k, []).append(d)
+
+        # (b) Which of those already have PatientIdNum records in the source?
+        src_pidnums = set()  # type: Set[Tuple[Any, ...]]
+        if PatientIdNum.__tablename__ in self.src_table_names:
+            for some_ids in chunks(patient_ids, MAX_VALUES_PER_IN_CLAUSE):
+                # noinspection PyUnresolvedReferences
+                q = (
+                    select([column(PatientIdNum.patient_id.name),
+                            column(PatientIdNum._current.name),
+                            column(PatientIdNum._device_id.name),
+                            column(PatientIdNum._era.name),
+                            column(PatientIdNum.which_idnum.name)])
+                    .select_from(table(PatientIdNum.__tablename__))
+                    .where(column(PatientIdNum.patient_id.name).in_(some_ids))
+                )
+                for r in self.src_engine.execute(q):
+                    src_pidnums.add((r[0], bool(r[1]), r[2], r[3], r[4]))
+
+        # (c) Create the missing ones.
+        user_map = self.pk_maps.get(User.__tablename__, {})
+        idnum_table = PatientIdNum.__table__
+        idnum_pkcol = self.get_allocatable_pk_column(idnum_table)
+        new_pidnums = []  # type: List[Dict[str, Any]]
+        for row, newrow in pairs:
+            trcon.oldobj = row
+            patient_id = row[Patient.id.name]
+            k = (patient_id, row[Patient._device_id.name],
+                 row[Patient._era.name])
+            matching = current_idnums.get(k, [])
+            assert len(matching) == 1, (
+                "Failed to fetch old patient IDs correctly; bug?"
+            )
+            old_patient_dict = matching[0]
+            for src_which_idnum, old_fieldname in idnum_fields.items():
+                idnum_value = old_patient_dict[old_fieldname]
+                if idnum_value is None:
+                    # Old Patient record didn't contain this ID number
+                    continue
+                if (patient_id, bool(row[Patient._current.name]),
+                        row[Patient._device_id.name],
+                        row[Patient._era.name],
+                        src_which_idnum) in src_pidnums:
+                    # There was already a PatientIdNum for this which_idnum
+                    continue
+                pidnum = {
+                    # PatientIdNum fields:
+                    "id": fake_tablet_id_for_patientidnum(
+                        patient_id=patient_id, which_idnum=src_which_idnum),
+                    "patient_id": patient_id,
+                    "which_idnum": get_dest_which_idnum(src_which_idnum,
+                                                        trcon, row),
+                    "idnum_value": idnum_value,
+                    # GenericTabletRecordMixin fields:
+                    "_device_id": newrow["_device_id"],
+                    "_era": row["_era"],
+                    "_current": row["_current"],
+                    "_when_added_exact": row.get("_when_added_exact"),
+                    "_when_added_batch_utc": row.get("_when_added_batch_utc"),
+                    "_adding_user_id": user_map.get(
+                        row.get("_adding_user_id")),
+                    "_when_removed_exact": row.get("_when_removed_exact"),
+                    "_when_removed_batch_utc": row.get(
+                        "_when_removed_batch_utc"),
+                    "_removing_user_id": user_map.get(
+                        row.get("_removing_user_id")),
+                    "_preserving_user_id": user_map.get(
+                        row.get("_preserving_user_id")),
+                    "_forcibly_preserved": row.get("_forcibly_preserved"),
+                    "_predecessor_pk": None,  # Impossible to calculate
+                    "_successor_pk": None,  # Impossible to calculate
+                    "_manually_erased": row.get("_manually_erased"),
+                    "_manually_erased_at": row.get("_manually_erased_at"),
+                    "_manually_erasing_user_id": user_map.get(
+                        row.get("_manually_erasing_user_id")),
+                    "_camcops_version": row.get("_camcops_version"),
+                    "_addition_pending": row.get("_addition_pending"),
+                    "_removal_pending": row.get("_removal_pending"),
+                    "_group_id": newrow["_group_id"],
+                }
+                if idnum_pkcol is not None:
+                    pidnum[idnum_pkcol.name] = self.allocate_pk(idnum_table,
+                                                                idnum_pkcol)
+                log.debug("Inserting new PatientIdNum: {!r}", pidnum)
+                new_pidnums.append(pidnum)
+        return new_pidnums
+
+
 # =============================================================================
 # Main
 # =============================================================================
@@ -1002,7 +1672,9 @@ def merge_camcops_db(src: str,
                      groupnum_map: Dict[int, int],
                      whichidnum_map: Dict[int, int],
                      skip_export_logs: bool = True,
-                     skip_audit_logs: bool = True) -> None:
+                     skip_audit_logs: bool = True,
+                     batched: bool = False,
+                     chunk_size: int = DEFAULT_MERGE_CHUNK_SIZE) -> None:
     """
     Merge an existing database (with a pre-v2 or later structure) into a
     comtemporary CamCOPS database.
@@ -1047,6 +1719,14 @@ def merge_camcops_db(src: str,
         skip_audit_logs:
             skip audit log table
 
+        batched:
+            merge in batches via SQLAlchemy Core (see :class:`BatchMerger`),
+            rather than record by record via the ORM? Much faster for large
+            databases.
+
+        chunk_size:
+            for batched merges: number of records to read and write at once
+
     """
     req = get_command_line_request()  # requires manual COMMIT; see below
     src_engine = create_engine(src, echo=echo, pool_pre_ping=True)
@@ -1158,28 +1838,40 @@ def merge_camcops_db(src: str,
                       src_iddefs=src_iddefs,
                       whichidnum_map=whichidnum_map,
                       groupnum_map=groupnum_map)
-    merge_db(
-        base_class=Base,
-        src_engine=src_engine,
-        dst_session=dst_session,
-        allow_missing_src_tables=True,
-        allow_missing_src_columns=True,
-        translate_fn=translate_fn,
-        skip_tables=skip_tables,
-        only_tables=None,
-        tables_to_keep_pks_for=None,
-        # extra_table_dependencies=test_dependencies,
-        extra_table_dependencies=None,
-        dummy_run=dummy_run,
-        info_only=info_only,
-        report_every=report_every,
-        flush_per_table=True,
-        flush_per_record=False,
-        commit_with_flush=False,
-        commit_at_end=True,
-        prevent_eager_load=True,
-        trcon_info=trcon_info
-    )
+    if batched:
+        BatchMerger(
+            src_engine=src_engine,
+            dst_session=dst_session,
+            skip_tables=skip_tables,
+            trcon_info=trcon_info,
+            dummy_run=dummy_run,
+            info_only=info_only,
+            report_every=report_every,
+            chunk_size=chunk_size,
+        ).merge()
+    else:
+        merge_db(
+            base_class=Base,
+            src_engine=src_engine,
+            dst_session=dst_session,
+            allow_missing_src_tables=True,
+            allow_missing_src_columns=True,
+            translate_fn=translate_fn,
+            skip_tables=skip_tables,
+            only_tables=None,
+            tables_to_keep_pks_for=None,
+            # extra_table_dependencies=test_dependencies,
+            extra_table_dependencies=None,
+            dummy_run=dummy_run,
+            info_only=info_only,
+            report_every=report_every,
+            flush_per_table=True,
+            flush_per_record=False,
+            commit_with_flush=False,
+            commit_at_end=True,
+            prevent_eager_load=True,
+            trcon_info=trcon_info
+        )
 
     # -------------------------------------------------------------------------
     # Postprocess
@@ -1192,3 +1884,119 @@ def merge_camcops_db(src: str,
     # -------------------------------------------------------------------------
 
     dst_session.commit()
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class MergeDbTests(DemoDatabaseTestCase):
+    """
+    Merges the demonstration database into fresh destination databases.
+    """
+    def _make_dst(self, name: str) -> Tuple[Engine, Session]:
+        filename = os.path.join(self.tmpdir_obj.name, name + ".sqlite")
+        engine = create_engine("sqlite:///" + filename, echo=False)
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()  # type: Session
+        group = Group()
+        group.id = self.group.id
+        group.name = "destgroup"
+        session.add(group)
+        for src_iddef in (self.nhs_iddef, self.rio_iddef):
+            session.add(IdNumDefinition(
+                which_idnum=src_iddef.which_idnum,
+                description=src_iddef.description,
+                short_description=src_iddef.short_description))
+        session.commit()
+        return engine, session
+
+    def _merge(self, dst_engine: Engine, dst_session: Session,
+               batched: bool, dummy_run: bool = False) -> None:
+        req = mock.Mock(engine=dst_engine, dbsession=dst_session)
+        with mock.patch(__name__ + ".get_command_line_request",
+                        return_value=req), \
+                mock.patch(__name__ + ".reindex_everything"):
+            merge_camcops_db(
+                src="sqlite:///" + self.db_filename,
+                echo=False,
+                report_every=1000,
+                dummy_run=dummy_run,
+                info_only=False,
+                default_group_id=None,
+                default_group_name=None,
+                groupnum_map={self.group.id: self.group.id},
+                whichidnum_map={
+                    self.nhs_iddef.which_idnum: self.nhs_iddef.which_idnum,
+                    self.rio_iddef.which_idnum: self.rio_iddef.which_idnum,
+                },
+                batched=batched,
+                chunk_size=3,  # so that tables need several chunks
+            )
+
+    @staticmethod
+    def _contents(engine: Engine) -> Dict[str, List[str]]:
+        """
+        Returns the rows of every table of tablet records (and the names of
+        users and devices), ignoring primary keys that the merge allocates
+        (the two methods may allocate them in a different order).
+        """
+        contents = {
+            User.__tablename__: sorted(
+                r[0] for r in engine.execute(select([User.username]))),
+            Device.__tablename__: sorted(
+                r[0] for r in engine.execute(select([Device.name]))),
+        }  # type: Dict[str, List[str]]
+        ormclasses = get_orm_classes_by_table_name_from_base(Base)
+        for tbl in Base.metadata.sorted_tables:
+            if not issubclass(ormclasses.get(tbl.name, object),
+                              GenericTabletRecordMixin):
+                continue
+            pkcol = BatchMerger.get_allocatable_pk_column(tbl)
+            colnames = [c.name for c in tbl.columns
+                        if pkcol is None or c.name != pkcol.name]
+            # noinspection PyTypeChecker
+            contents[tbl.name] = sorted(
+                repr(tuple(row))
+                for row in engine.execute(
+                    select([tbl.columns[c] for c in colnames]))
+            )
+        return contents
+
+    def _n_rows(self, engine: Engine, tbl: Table) -> int:
+        # noinspection PyTypeChecker
+        return engine.execute(select([func.count()]).select_from(tbl)).scalar()
+
+    def test_batched_matches_orm(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        orm_engine, orm_session = self._make_dst("orm")
+        self._merge(orm_engine, orm_session, batched=False)
+        batch_engine, batch_session = self._make_dst("batched")
+        self._merge(batch_engine, batch_session, batched=True)
+
+        orm_contents = self._contents(orm_engine)
+        self.assertEqual(len(orm_contents[Phq9.__tablename__]), 2)
+        self.assertEqual(len(orm_contents[PatientIdNum.__tablename__]), 3)
+        self.assertEqual(self._contents(batch_engine), orm_contents)
+
+    def test_dummy_run(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        dst_engine, dst_session = self._make_dst("dummy")
+        before = self._contents(dst_engine)
+        self._merge(dst_engine, dst_session, batched=True, dummy_run=True)
+        after = self._contents(dst_engine)
+        self.assertEqual(self._n_rows(dst_engine, Phq9.__table__), 0)
+        self.assertEqual(after[Patient.__tablename__],
+                         before[Patient.__tablename__])
+        self.assertEqual(after[Phq9.__tablename__],
+                         before[Phq9.__tablename__])
+
+    def test_duplicate_records_refused(self) -> None:
+        from camcops_server.tasks.phq9 import Phq9
+        dst_engine, dst_session = self._make_dst("twice")
+        self._merge(dst_engine, dst_session, batched=True)
+        self.assertEqual(self._n_rows(dst_engine, Phq9.__table__), 2)
+        with self.assertRaises(ValueError):
+            self._merge(dst_engine, dst_session, batched=True)
+        dst_session.rollback()
+        self.assertEqual(self._n_rows(dst_engine, Phq9.__table__), 2)
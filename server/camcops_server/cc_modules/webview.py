@@ -122,10 +122,11 @@ Quick tutorial on Pyramid views:
 """
 
 from collections import OrderedDict
+import io
 import logging
 import os
 # from pprint import pformat
-from typing import Any, Dict, List, Tuple, Type, TYPE_CHECKING
+from typing import Any, Dict, List, Optional, Tuple, Type, TYPE_CHECKING
 # import unittest
 
 from cardinal_pythonlib.datetimefunc import format_datetime
@@ -147,7 +148,12 @@ from cardinal_pythonlib.sqlalchemy.orm_query import CountStarSpecializedQuery
 from cardinal_pythonlib.sqlalchemy.session import get_engine_from_session
 from deform.exception import ValidationFailure
 from pendulum import DateTime as Pendulum
-from pyramid.httpexceptions import HTTPBadRequest, HTTPFound, HTTPNotFound
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPFound,
+    HTTPNotFound,
+    HTTPNotModified,
+)
 from pyramid.view import (
     forbidden_view_config,
     notfound_view_config,
@@ -168,6 +174,9 @@ from sqlalchemy.sql.expression import desc, or_, select, update
 from camcops_server.cc_modules.cc_audit import audit, AuditEntry
 from camcops_server.cc_modules.cc_all_models import CLIENT_TABLE_MAP
 from camcops_server.cc_modules.cc_baseconstants import STATIC_ROOT_DIR
+from camcops_server.cc_modules.cc_blob import Blob
+from camcops_server.cc_modules.cc_blobstore import gen_chunks
+from camcops_server.cc_modules.cc_cache import get_cache_stats
 from camcops_server.cc_modules.cc_client_api_core import (
     BatchDetails,
     get_server_live_records,
@@ -257,6 +266,7 @@ from camcops_server.cc_modules.cc_pyramid import (
     CamcopsPage,
     FormAction,
     HTTPFoundDebugVersion,
+    KeysetPageUrl,
     PageUrl,
     Permission,
     Routes,
@@ -276,6 +286,7 @@ from camcops_server.cc_modules.cc_task import Task
 from camcops_server.cc_modules.cc_taskcollection import (
     TaskFilter,
     TaskCollection,
+    TaskIndexPageCollection,
     TaskSortMethod,
 )
 from camcops_server.cc_modules.cc_taskfactory import task_factory
@@ -288,6 +299,7 @@ from camcops_server.cc_modules.cc_taskindex import (
     TaskIndexEntry,
     update_indexes_and_push_exports
 )
+from camcops_server.cc_modules.cc_tasksummary import TaskSummaryEntry
 from camcops_server.cc_modules.cc_text import SS
 from camcops_server.cc_modules.cc_tracker import ClinicalTextView, Tracker
 from camcops_server.cc_modules.cc_unittest import DemoDatabaseTestCase
@@ -1011,26 +1023,48 @@ def view_tasks(req: "CamcopsRequest") -> Dict[str, Any]:
     rendered_refresh_form = refresh_form.render()
 
     # Get tasks, unless there have been form errors.
-    # In principle, for some filter settings (single task, no "complete"
-    # preference...) we could produce an ORM query and use SqlalchemyOrmPage,
-    # which would apply LIMIT/OFFSET (or equivalent) to the query, and be
-    # very nippy. In practice, this is probably an unusual setting, so we'll
-    # simplify things here with a Python list regardless of the settings.
+    # Where possible, we use the task index to fetch just one page of index
+    # entries (seeking from the neighbouring page's last/first entry, if we
+    # know it), and then just those tasks; the total comes from a cached
+    # COUNT. Otherwise (e.g. text filtering, which requires the tasks
+    # themselves), we paginate a query or a Python list.
     if errors:
         collection = []
     else:
-        collection = TaskCollection(
+        taskcollection = TaskCollection(
             req=req,
             taskfilter=taskfilter,
             sort_method_global=TaskSortMethod.CREATION_DATE_DESC,
             via_index=via_index
-        ).all_tasks_or_indexes_or_query or []
-    paginator = SqlalchemyOrmPage if isinstance(collection, Query) else CamcopsPage  # noqa
-    page = paginator(collection,
-                     page=page_num,
-                     items_per_page=rows_per_page,
-                     url_maker=PageUrl(req),
-                     request=req)
+        )
+        if taskcollection.supports_index_pagination:
+            collection = TaskIndexPageCollection(
+                taskcollection,
+                after_index_pk=req.get_int_param(ViewParam.AFTER_INDEX_PK),
+                before_index_pk=req.get_int_param(ViewParam.BEFORE_INDEX_PK),
+            )
+        else:
+            collection = taskcollection.all_tasks_or_indexes_or_query or []
+    if isinstance(collection, TaskIndexPageCollection):
+        page = CamcopsPage(
+            collection,
+            page=page_num,
+            items_per_page=rows_per_page,
+            url_maker=KeysetPageUrl(
+                req,
+                seek_params_fn=collection.seek_params_for_page,
+                seek_param_names=[ViewParam.AFTER_INDEX_PK,
+                                  ViewParam.BEFORE_INDEX_PK]
+            ),
+            request=req
+        )
+    else:
+        paginator = SqlalchemyOrmPage if isinstance(collection, Query) else CamcopsPage  # noqa
+        page = paginator(collection,
+                         page=page_num,
+                         items_per_page=rows_per_page,
+                         url_maker=PageUrl(req),
+                         request=req)
     return dict(
         page=page,
         head_form_html=get_head_form_html(req, [tpp_form,
@@ -1067,6 +1101,7 @@ def serve_task(req: "CamcopsRequest") -> Response:
     task.audit(req, "Viewed " + viewtype.upper())
 
     if viewtype == ViewArg.HTML:
+        req.use_blob_urls = True  # images are fetched via serve_blob()
         return Response(
             task.get_html(req=req, anonymise=anonymise)
         )
@@ -1094,7 +1129,16 @@ def serve_task(req: "CamcopsRequest") -> Response:
                 ViewParam.INCLUDE_SNOMED, True),
             xml_with_header_comments=True,
         )
-        return XmlResponse(task.get_xml(req=req, options=options))
+        # Write the XML in a single pass, straight into (encoded) bytes,
+        # rather than building it up as a string first.
+        body = io.BytesIO()
+        sink = io.TextIOWrapper(body, encoding="utf-8", newline="")
+        task.write_xml(sink, req=req, options=options)
+        sink.flush()
+        sink.detach()
+        return Response(body=body.getvalue(),
+                        content_type=MimeType.XML,
+                        charset="utf-8")
     else:
         permissible = [ViewArg.HTML, ViewArg.PDF, ViewArg.PDFHTML, ViewArg.XML]
         raise HTTPBadRequest(
@@ -1102,6 +1146,79 @@ def serve_task(req: "CamcopsRequest") -> Response:
             f"({_('permissible:')} {permissible!r})")
 
 
+@view_config(route_name=Routes.BLOB)
+def serve_blob(req: "CamcopsRequest") -> Response:
+    """
+    View that serves a single BLOB (e.g. a photo within a task), as referred
+    to by the HTML view of a task; see
+    :meth:`camcops_server.cc_modules.cc_blob.Blob.get_img_html`.
+
+    The content is streamed (unless it needs rotating), and the response
+    supports conditional requests (``ETag``, ``Last-Modified``), so browsers
+    revalidate rather than fetching the image again.
+
+    With ``thumbnail=1``, serves a thumbnail instead; see
+    :meth:`camcops_server.cc_modules.cc_blob.Blob.get_thumbnail`.
+    """
+    _ = req.gettext
+    server_pk = req.get_int_param(ViewParam.SERVER_PK)
+    thumbnail = req.get_bool_param(ViewParam.THUMBNAIL, False)
+    user = req.user
+    # noinspection PyProtectedMember
+    q = req.dbsession.query(Blob).filter(Blob._pk == server_pk)
+    if not user.superuser:
+        # Same group security as for tasks; see
+        # task_query_restricted_to_permitted_users().
+        # noinspection PyProtectedMember
+        q = q.filter(Blob._group_id.in_(user.ids_of_groups_user_may_see))
+    blob = q.first()  # type: Optional[Blob]
+    if blob is None or blob._manually_erased:
+        raise HTTPNotFound(f"{_('BLOB not found or not permitted:')} "
+                           f"server_pk={server_pk!r}")
+
+    etag = blob.get_etag(thumbnail=thumbnail)
+    last_modified = blob.get_last_modified()
+    # "private, no-cache": browsers may keep a copy (only for this user), but
+    # must check with us before using it; the check is cheap (see below).
+    cache_headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": "private, no-cache",
+    }
+    if req.if_none_match:
+        not_modified = etag in req.if_none_match
+    else:
+        not_modified = (last_modified is not None and
+                        req.if_modified_since is not None and
+                        last_modified.replace(microsecond=0) <=
+                        req.if_modified_since)
+    if not_modified:
+        return HTTPNotModified(headers=cache_headers)
+
+    content_type = blob.mimetype or MimeType.PNG
+    rotation = blob.image_rotation_deg_cw
+    if not thumbnail and (rotation is None or rotation % 360 == 0):
+        f = blob.open_blob()
+        if f is None:
+            raise HTTPNotFound(_("BLOB has no content"))
+        response = Response(app_iter=gen_chunks(f),
+                            content_type=content_type)
+        if blob.is_in_blob_store:
+            # noinspection PyProtectedMember
+            response.content_length = blob._blob_size
+    else:
+        if thumbnail:
+            image = blob.get_thumbnail()
+        else:
+            image = blob.get_rotated_image()
+        if image is None:
+            raise HTTPNotFound(_("BLOB has no content"))
+        response = Response(body=image, content_type=content_type)
+    response.headers.update(cache_headers)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
 # =============================================================================
 # Trackers, CTVs
 # =============================================================================
@@ -1424,7 +1541,8 @@ def get_dump_collection(req: "CamcopsRequest") -> TaskCollection:
         req=req,
         taskfilter=taskfilter,
         as_dump=True,
-        sort_method_by_class=TaskSortMethod.CREATION_DATE_ASC
+        sort_method_by_class=TaskSortMethod.CREATION_DATE_ASC,
+        parallel_fetch=True
     )
 
 
@@ -2042,6 +2160,7 @@ def view_server_info(req: "CamcopsRequest") -> Dict[str, Any]:
         recent_activity=recent_activity,
         session_timeout_minutes=req.config.session_timeout_minutes,
         restricted_tasks=req.config.restricted_tasks,
+        cache_stats=get_cache_stats(),
     )
 
 
@@ -2592,6 +2711,7 @@ def edit_group(req: "CamcopsRequest") -> Dict[str, Any]:
             # ... don't bother saying "you can see yourself"
             other_groups = Group.get_groups_from_id_list(dbsession, group_ids)
             group.can_see_other_groups = other_groups
+            req.invalidate_db_cache()
             raise HTTPFound(req.route_url(route_back))
         except ValidationFailure as e:
             rendered_form = e.render()
@@ -2635,6 +2755,7 @@ def add_group(req: "CamcopsRequest") -> Dict[str, Any]:
             group = Group()
             group.name = appstruct.get(ViewParam.NAME)
             dbsession.add(group)
+            req.invalidate_db_cache()
             raise HTTPFound(req.route_url(route_back))
         except ValidationFailure as e:
             rendered_form = e.render()
@@ -2697,6 +2818,7 @@ def delete_group(req: "CamcopsRequest") -> Dict[str, Any]:
                     # Delete the group
                     # ---------------------------------------------------------
                     req.dbsession.delete(group)
+                    req.invalidate_db_cache()
                     raise HTTPFound(req.route_url(route_back))
                 except ValidationFailure as e:
                     rendered_form = e.render()
@@ -2797,7 +2919,7 @@ def edit_id_definition(req: "CamcopsRequest") -> Dict[str, Any]:
             iddef.validation_method = appstruct.get(ViewParam.VALIDATION_METHOD)  # noqa
             iddef.hl7_id_type = appstruct.get(ViewParam.HL7_ID_TYPE)
             iddef.hl7_assigning_authority = appstruct.get(ViewParam.HL7_ASSIGNING_AUTHORITY)  # noqa
-            # REMOVED # clear_idnum_definition_cache()  # SPECIAL
+            req.invalidate_db_cache()
             raise HTTPFound(req.route_url(route_back))
         except ValidationFailure as e:
             rendered_form = e.render()
@@ -2844,7 +2966,7 @@ def add_id_definition(req: "CamcopsRequest") -> Dict[str, Any]:
             # Add ID definition
             # -----------------------------------------------------------------
             dbsession.add(iddef)
-            # REMOVED # clear_idnum_definition_cache()  # SPECIAL
+            req.invalidate_db_cache()
             raise HTTPFound(req.route_url(route_back))
         except ValidationFailure as e:
             rendered_form = e.render()
@@ -2899,7 +3021,7 @@ def delete_id_definition(req: "CamcopsRequest") -> Dict[str, Any]:
                 # Delete ID definition
                 # -------------------------------------------------------------
                 req.dbsession.delete(iddef)
-                # REMOVED # clear_idnum_definition_cache()  # SPECIAL
+                req.invalidate_db_cache()
                 raise HTTPFound(req.route_url(route_back))
             except ValidationFailure as e:
                 rendered_form = e.render()
@@ -3124,6 +3246,7 @@ class EraseTaskLeavingPlaceholderView(EraseTaskBaseView):
         return task
 
     def erase_task(self, task: Task) -> None:
+        TaskSummaryEntry.unsummarize_task(task, self.request.dbsession)
         task.manually_erase(self.request)
 
     def get_success_extra_html(self) -> str:
@@ -3139,6 +3262,7 @@ class EraseTaskEntirelyView(EraseTaskBaseView):
 
     def erase_task(self, task: Task) -> None:
         TaskIndexEntry.unindex_task(task, self.request.dbsession)
+        TaskSummaryEntry.unsummarize_task(task, self.request.dbsession)
         task.delete_entirely(self.request)
 
 
@@ -3249,6 +3373,7 @@ def delete_patient(req: "CamcopsRequest") -> Response:
             # -----------------------------------------------------------------
             for task in tasks:
                 TaskIndexEntry.unindex_task(task, req.dbsession)
+                TaskSummaryEntry.unsummarize_task(task, req.dbsession)
                 task.delete_entirely(req)
             # Then patients:
             for p in patient_lineage_instances:
@@ -3419,6 +3544,9 @@ def edit_patient(req: "CamcopsRequest") -> Response:
             # Apply special note to patient
             patient.apply_special_note(req, change_msg, "Patient edited")
 
+            # Stored task summaries may depend on patient details
+            TaskSummaryEntry.unsummarize_patient(patient, dbsession)
+
             # Patient details changed, so resend any tasks via HL7
             for task in affected_tasks:
                 task.cancel_from_export_log(req)
@@ -3627,3 +3755,29 @@ class WebviewTests(DemoDatabaseTestCase):
         self.dbsession.flush()
 
         self.assertFalse(any_records_use_group(self.req, group))
+
+    def test_serve_blob(self) -> None:
+        self.announce("test_serve_blob")
+        blob = self.dbsession.query(Blob).first()  # type: Blob
+        assert blob, "Missing BLOB in demo database!"
+        self.req.set_get_params({ViewParam.SERVER_PK: str(blob.get_pk())})
+        response = serve_blob(self.req)
+        self.assertEqual(response.body, blob.get_rotated_image())
+        self.assertEqual(response.etag, blob.get_etag())
+        # A conditional request for the same thing gets "304 Not Modified".
+        self.req.environ["HTTP_IF_NONE_MATCH"] = f'"{blob.get_etag()}"'
+        try:
+            response = serve_blob(self.req)
+        finally:
+            del self.req.environ["HTTP_IF_NONE_MATCH"]
+        self.assertEqual(response.status_int, 304)
+
+    def test_serve_blob_thumbnail(self) -> None:
+        self.announce("test_serve_blob_thumbnail")
+        blob = self.dbsession.query(Blob).first()  # type: Blob
+        assert blob, "Missing BLOB in demo database!"
+        self.req.set_get_params({ViewParam.SERVER_PK: str(blob.get_pk()),
+                                 ViewParam.THUMBNAIL: "1"})
+        response = serve_blob(self.req)
+        self.assertEqual(response.body, blob.get_thumbnail())
+        self.assertEqual(response.etag, blob.get_etag(thumbnail=True))
@@ -63,6 +63,7 @@ from camcops_server.cc_modules.cc_sqla_coltypes import (
 )
 from camcops_server.cc_modules.cc_summaryelement import SummaryElement
 from camcops_server.cc_modules.cc_task import (
+    memoised_score,
     Task,
     TaskHasClinicianMixin,
     TaskHasPatientMixin,
@@ -416,6 +417,7 @@ class Ace3(TaskHasPatientMixin, TaskHasClinicianMixin, Task,
                            comment=f"Visuospatial (/{VSP_MAX})"),
         ]
 
+    @memoised_score
     def attn_score(self) -> int:
         return self.sum_fields(self.ATTN_SCORE_FIELDS)
 
@@ -434,6 +436,7 @@ class Ace3(TaskHasPatientMixin, TaskHasClinicianMixin, Task,
         return answer(recognized)
 
     # noinspection PyUnresolvedReferences
+    @memoised_score
     def get_mem_recognition_score(self) -> int:
         score = 0
         score += self.get_recog_score(
@@ -453,39 +456,46 @@ class Ace3(TaskHasPatientMixin, TaskHasClinicianMixin, Task,
             self.mem_recognize_address5)
         return score
 
+    @memoised_score
     def mem_score(self) -> int:
         return (
             self.sum_fields(self.MEM_NON_RECOG_SCORE_FIELDS) +
             self.get_mem_recognition_score()
         )
 
+    @memoised_score
     def fluency_score(self) -> int:
         return (
             score_zero_for_absent(self.fluency_letters_score) +
             score_zero_for_absent(self.fluency_animals_score)
         )
 
+    @memoised_score
     def get_follow_command_score(self) -> int:
         if self.lang_follow_command_practice != 1:
             return 0
         return self.sum_fields(self.LANG_FOLLOW_CMD_FIELDS)
 
+    @memoised_score
     def get_repeat_word_score(self) -> int:
         n = self.sum_fields(self.LANG_REPEAT_WORD_FIELDS)
         return 2 if n >= 4 else (1 if n == 3 else 0)
 
+    @memoised_score
     def lang_score(self) -> int:
         return (self.sum_fields(self.LANG_SIMPLE_SCORE_FIELDS) +
                 self.get_follow_command_score() +
                 self.get_repeat_word_score() +
                 score_zero_for_absent(self.lang_read_words_aloud))
 
+    @memoised_score
     def vsp_score(self) -> int:
         return (self.sum_fields(self.VSP_SIMPLE_SCORE_FIELDS) +
                 score_zero_for_absent(self.vsp_copy_infinity) +
                 score_zero_for_absent(self.vsp_copy_cube) +
                 score_zero_for_absent(self.vsp_draw_clock))
 
+    @memoised_score
     def total_score(self) -> int:
         return (self.attn_score() +
                 self.mem_score() +
@@ -764,9 +774,9 @@ class Ace3(TaskHasPatientMixin, TaskHasClinicianMixin, Task,
                                    self.mem_recognize_address5)) +
 
             subheading_spanning_two_columns("Photos of test sheet") +
-            tr_span_col(get_blob_img_html(self.picture1),
+            tr_span_col(get_blob_img_html(self.picture1, req=req),
                         td_class=CssClass.PHOTO) +
-            tr_span_col(get_blob_img_html(self.picture2),
+            tr_span_col(get_blob_img_html(self.picture2, req=req),
                         td_class=CssClass.PHOTO) +
             f"""
                 </table>
@@ -57,6 +57,7 @@ from camcops_server.cc_modules.cc_sqla_coltypes import (
 from camcops_server.cc_modules.cc_summaryelement import SummaryElement
 from camcops_server.cc_modules.cc_task import (
     get_from_dict,
+    memoised_score,
     Task,
     TaskHasPatientMixin,
 )
@@ -1652,6 +1653,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
                 total += 1
         return total
 
+    @memoised_score
     def parental_loss_risk(self) -> bool:
         return bool(
             self.s1c_mother_died or
@@ -1660,6 +1662,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             self.s1c_separated_from_father
         )
 
+    @memoised_score
     def parental_loss_high_risk(self) -> bool:
         return bool(
             self.s1c_separated_from_mother and (
@@ -1672,6 +1675,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             )
         )
 
+    @memoised_score
     def mother_antipathy(self) -> Optional[int]:
         if self.s2a_which_mother_figure == 0:
             return None
@@ -1688,6 +1692,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             total += score
         return total
 
+    @memoised_score
     def father_antipathy(self) -> Optional[int]:
         if self.s3a_which_father_figure == 0:
             return None
@@ -1704,6 +1709,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             total += score
         return total
 
+    @memoised_score
     def mother_neglect(self) -> Optional[int]:
         if self.s2a_which_mother_figure == 0:
             return None
@@ -1717,6 +1723,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             total += score
         return total
 
+    @memoised_score
     def father_neglect(self) -> Optional[int]:
         if self.s3a_which_father_figure == 0:
             return None
@@ -1730,6 +1737,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             total += score
         return total
 
+    @memoised_score
     def mother_psychological_abuse(self) -> Optional[int]:
         if self.s2a_which_mother_figure == 0:
             return None
@@ -1746,6 +1754,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
                 total += freqscore
         return total
 
+    @memoised_score
     def father_psychological_abuse(self) -> Optional[int]:
         if self.s3a_which_father_figure == 0:
             return None
@@ -1762,6 +1771,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
                 total += freqscore
         return total
 
+    @memoised_score
     def role_reversal(self) -> Optional[int]:
         total = 0
         for i in range(1, 18):
@@ -1771,12 +1781,14 @@ class CecaQ3(TaskHasPatientMixin, Task):
             total += score
         return total
 
+    @memoised_score
     def physical_abuse_screen(self) -> Optional[int]:
         fields = [
             "s5c_physicalabuse"
         ]
         return self.total_nonzero_scores_1_abort_if_none(fields)
 
+    @memoised_score
     def physical_abuse_severity_mother(self) -> Optional[int]:
         if self.physical_abuse_screen() == 0:
             return 0
@@ -1796,6 +1808,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             total += 1
         return total
 
+    @memoised_score
     def physical_abuse_severity_father(self) -> Optional[int]:
         if self.physical_abuse_screen() == 0:
             return 0
@@ -1815,6 +1828,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
             total += 1
         return total
 
+    @memoised_score
     def sexual_abuse_screen(self) -> Optional[int]:
         fields = [
             "s6_any_unwanted_sexual_experience",
@@ -1823,6 +1837,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
         ]
         return self.total_nonzero_scores_1_abort_if_none(fields)
 
+    @memoised_score
     def sexual_abuse_score_first(self) -> Optional[int]:
         if self.sexual_abuse_screen() == 0:
             return 0
@@ -1837,6 +1852,7 @@ class CecaQ3(TaskHasPatientMixin, Task):
         ]
         return self.total_nonzero_scores_1_abort_if_none(fields)
 
+    @memoised_score
     def sexual_abuse_score_other(self) -> Optional[int]:
         if self.sexual_abuse_screen() == 0:
             return 0
@@ -63,6 +63,7 @@ from camcops_server.cc_modules.cc_sqla_coltypes import (
 )
 from camcops_server.cc_modules.cc_summaryelement import SummaryElement
 from camcops_server.cc_modules.cc_task import (
+    memoised_score,
     Task,
     TaskHasPatientMixin,
 )
@@ -4027,6 +4028,7 @@ class Cisr(TaskHasPatientMixin, Task):
 
         return int_to_enum(next_q)
 
+    @memoised_score
     def get_result(self, record_decisions: bool = False) -> CisrResult:
         # internal_q = CQ.START_MARKER
         internal_q = CQ.APPETITE1_LOSS_PAST_MONTH  # skip the preamble etc.
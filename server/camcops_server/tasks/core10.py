@@ -299,7 +299,8 @@ class Core10Report(AverageScoreReport):
                 scorefunc=Core10.clinical_score,
                 minimum=0,
                 maximum=Core10.MAX_SCORE,
-                higher_score_is_better=False
+                higher_score_is_better=False,
+                summary_name="clinical_score"
             )
         ]
 
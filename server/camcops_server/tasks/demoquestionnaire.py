@@ -195,11 +195,12 @@ class DemoQuestionnaire(Task,
         h += self.get_twocol_string_row("diagnosticcode2_code")
         h += self.get_twocol_string_row("diagnosticcode2_description")
         # noinspection PyTypeChecker
-        h += self.get_twocol_picture_row(self.photo, "photo")
+        h += self.get_twocol_picture_row(self.photo, "photo", req=req)
         # noinspection PyTypeChecker
-        h += self.get_twocol_picture_row(self.canvas, "canvas")
+        h += self.get_twocol_picture_row(self.canvas, "canvas", req=req)
         # noinspection PyTypeChecker
-        h += self.get_twocol_picture_row(self.canvas2, "canvas2")
+        h += self.get_twocol_picture_row(self.canvas2, "canvas2",
+                                         req=req)
         h += """
             </table>
 
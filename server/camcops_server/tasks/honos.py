@@ -52,6 +52,7 @@ from camcops_server.cc_modules.cc_sqla_coltypes import (
 from camcops_server.cc_modules.cc_summaryelement import SummaryElement
 from camcops_server.cc_modules.cc_task import (
     get_from_dict,
+    memoised_score,
     Task,
     TaskHasClinicianMixin,
     TaskHasPatientMixin,
@@ -132,6 +133,7 @@ class HonosBase(TaskHasPatientMixin, TaskHasClinicianMixin, Task):
                 total += value
         return total
 
+    @memoised_score
     def total_score(self) -> int:
         return self._total_score_for_fields(self.QFIELDS)
 
@@ -547,9 +549,11 @@ class Honosca(HonosBase,
             self.field_contents_valid()
         )
 
+    @memoised_score
     def section_a_score(self) -> int:
         return self._total_score_for_fields(self.SECTION_A_QFIELDS)
 
+    @memoised_score
     def section_b_score(self) -> int:
         return self._total_score_for_fields(self.SECTION_B_QFIELDS)
 
@@ -304,21 +304,24 @@ class MaasReport(AverageScoreReport):
                 scorefunc=Maas.get_global_score,
                 minimum=Maas.MIN_GLOBAL,
                 maximum=Maas.MAX_GLOBAL,
-                higher_score_is_better=True
+                higher_score_is_better=True,
+                summary_name="global_attachment_score"
             ),
             ScoreDetails(
                 name=_("Quality of attachment score"),
                 scorefunc=Maas.get_quality_score,
                 minimum=Maas.MIN_QUALITY,
                 maximum=Maas.MAX_QUALITY,
-                higher_score_is_better=True
+                higher_score_is_better=True,
+                summary_name="quality_of_attachment_score"
             ),
             ScoreDetails(
                 name=_("Time spent in attachment mode"),
                 scorefunc=Maas.get_time_score,
                 minimum=Maas.MIN_TIME,
                 maximum=Maas.MAX_TIME,
-                higher_score_is_better=True
+                higher_score_is_better=True,
+                summary_name="time_in_attachment_mode_score"
             )
         ]
 
@@ -458,14 +458,14 @@ class Moca(TaskHasPatientMixin, TaskHasClinicianMixin, Task,
                 "Images of tests: trail, cube, clock",
                 th_not_td=True),
             tr_images_1=tr(
-                td(get_blob_img_html(self.trailpicture),
+                td(get_blob_img_html(self.trailpicture, req=req),
                    td_class=CssClass.PHOTO, td_width="50%"),
-                td(get_blob_img_html(self.cubepicture),
+                td(get_blob_img_html(self.cubepicture, req=req),
                    td_class=CssClass.PHOTO, td_width="50%"),
                 literal=True,
             ),
             tr_images_2=tr(
-                td(get_blob_img_html(self.clockpicture),
+                td(get_blob_img_html(self.clockpicture, req=req),
                    td_class=CssClass.PHOTO, td_width="50%"),
                 td("", td_class=CssClass.SUBHEADING),
                 literal=True,
@@ -44,6 +44,7 @@ from camcops_server.cc_modules.cc_snomed import SnomedExpression, SnomedLookup
 from camcops_server.cc_modules.cc_summaryelement import SummaryElement
 from camcops_server.cc_modules.cc_task import (
     get_from_dict,
+    memoised_score,
     Task,
     TaskHasClinicianMixin,
     TaskHasPatientMixin,
@@ -235,18 +236,23 @@ class Panss(TaskHasPatientMixin, TaskHasClinicianMixin, Task,
             self.field_contents_valid()
         )
 
+    @memoised_score
     def total_score(self) -> int:
         return self.sum_fields(self.TASK_FIELDS)
 
+    @memoised_score
     def score_p(self) -> int:
         return self.sum_fields(self.P_FIELDS)
 
+    @memoised_score
     def score_n(self) -> int:
         return self.sum_fields(self.N_FIELDS)
 
+    @memoised_score
     def score_g(self) -> int:
         return self.sum_fields(self.G_FIELDS)
 
+    @memoised_score
     def composite(self) -> int:
         return self.score_p() - self.score_n()
 
@@ -326,34 +326,39 @@ class PBQReport(AverageScoreReport):
                 scorefunc=Pbq.total_score,
                 minimum=0,
                 maximum=Pbq.MAX_TOTAL,
-                higher_score_is_better=False
+                higher_score_is_better=False,
+                summary_name="total_score"
             ),
             ScoreDetails(
                 name=_("Factor 1 score"),
                 scorefunc=Pbq.factor_1_score,
                 minimum=0,
                 maximum=Pbq.FACTOR_1_MAX,
-                higher_score_is_better=False
+                higher_score_is_better=False,
+                summary_name="factor_1_score"
             ),
             ScoreDetails(
                 name=_("Factor 2 score"),
                 scorefunc=Pbq.factor_2_score,
                 minimum=0,
                 maximum=Pbq.FACTOR_2_MAX,
-                higher_score_is_better=False
+                higher_score_is_better=False,
+                summary_name="factor_2_score"
             ),
             ScoreDetails(
                 name=_("Factor 3 score"),
                 scorefunc=Pbq.factor_3_score,
                 minimum=0,
                 maximum=Pbq.FACTOR_3_MAX,
-                higher_score_is_better=False
+                higher_score_is_better=False,
+                summary_name="factor_3_score"
             ),
             ScoreDetails(
                 name=_("Factor 4 score"),
                 scorefunc=Pbq.factor_4_score,
                 minimum=0,
                 maximum=Pbq.FACTOR_4_MAX,
-                higher_score_is_better=False
+                higher_score_is_better=False,
+                summary_name="factor_4_score"
             ),
         ]
@@ -116,7 +116,7 @@ class Photo(TaskHasClinicianMixin, TaskHasPatientMixin, Task):
                 default_for_blank_strings=True
             ),
             # ... xhtml2pdf crashes if the contents are empty...
-            photo=get_blob_img_html(self.photo)
+            photo=get_blob_img_html(self.photo, req=req)
         )
 
     def get_snomed_codes(self, req: CamcopsRequest) -> List[SnomedExpression]:
@@ -163,7 +163,7 @@ class PhotoSequenceSinglePhoto(GenericTabletRecordMixin, TaskDescendant, Base):
 
     photo = blob_relationship("PhotoSequenceSinglePhoto", "photo_blobid")
 
-    def get_html_table_rows(self) -> str:
+    def get_html_table_rows(self, req: CamcopsRequest) -> str:
         # noinspection PyTypeChecker
         return """
             <tr class="{CssClass.SUBHEADING}">
@@ -174,7 +174,7 @@ class PhotoSequenceSinglePhoto(GenericTabletRecordMixin, TaskDescendant, Base):
             CssClass=CssClass,
             num=self.seqnum,
             description=ws.webify(self.description),
-            photo=get_blob_img_html(self.photo)
+            photo=get_blob_img_html(self.photo, req=req)
         )
 
     # -------------------------------------------------------------------------
@@ -240,7 +240,7 @@ class PhotoSequence(TaskHasClinicianMixin, TaskHasPatientMixin, Task):
             <table class="{CssClass.TASKDETAIL}">
         """
         for p in self.photos:
-            html += p.get_html_table_rows()
+            html += p.get_html_table_rows(req)
         html += """
             </table>
         """
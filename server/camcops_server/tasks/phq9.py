@@ -46,6 +46,7 @@ from camcops_server.cc_modules.cc_sqla_coltypes import (
 from camcops_server.cc_modules.cc_summaryelement import SummaryElement
 from camcops_server.cc_modules.cc_task import (
     get_from_dict,
+    memoised_score,
     Task,
     TaskHasPatientMixin,
 )
@@ -191,6 +192,7 @@ class Phq9(TaskHasPatientMixin, Task,
                 comment="PHQ9 depression severity"),
         ]
 
+    @memoised_score
     def total_score(self) -> int:
         return self.sum_fields(self.MAIN_QUESTIONS)
 
@@ -198,10 +200,12 @@ class Phq9(TaskHasPatientMixin, Task,
         value = getattr(self, "q" + str(qnum))
         return 1 if value is not None and value >= threshold else 0
 
+    @memoised_score
     def n_core(self) -> int:
         return (self.one_if_q_ge(1, 2) +
                 self.one_if_q_ge(2, 2))
 
+    @memoised_score
     def n_other(self) -> int:
         return (self.one_if_q_ge(3, 2) +
                 self.one_if_q_ge(4, 2) +
@@ -212,12 +216,15 @@ class Phq9(TaskHasPatientMixin, Task,
                 self.one_if_q_ge(9, 1))  # suicidality
         # suicidality counted whenever present
 
+    @memoised_score
     def n_total(self) -> int:
         return self.n_core() + self.n_other()
 
+    @memoised_score
     def is_mds(self) -> bool:
         return self.n_core() >= 1 and self.n_total() >= 5
 
+    @memoised_score
     def is_ods(self) -> bool:
         return self.n_core() >= 1 and 2 <= self.n_total() <= 4
 
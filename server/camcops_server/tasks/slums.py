@@ -369,9 +369,9 @@ class Slums(TaskHasClinicianMixin, TaskHasPatientMixin, Task):
         h += subheading_spanning_two_columns("Images of tests: clock, shapes")
         # noinspection PyTypeChecker
         h += tr(
-            td(get_blob_img_html(self.clockpicture),
+            td(get_blob_img_html(self.clockpicture, req=req),
                td_width="50%", td_class=CssClass.PHOTO),
-            td(get_blob_img_html(self.shapespicture),
+            td(get_blob_img_html(self.shapespicture, req=req),
                td_width="50%", td_class=CssClass.PHOTO),
             literal=True
         )
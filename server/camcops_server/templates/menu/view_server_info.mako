@@ -65,6 +65,32 @@ camcops_server/templates/menu/view_server_info.mako
     ${_("Sessions time out after")} ${session_timeout_minutes} ${_("minutes; sessions older than this are periodically deleted.")}
 </p>
 
+%if request.user.superuser:
+    <h2>${_("Cache statistics (this server process)")}</h2>
+    <table>
+        <tr>
+            <th>${_("Cache")}</th>
+            <th>${_("Hits")}</th>
+            <th>${_("Misses")}</th>
+            <th>${_("Hit ratio")}</th>
+        </tr>
+        %for cs in cache_stats:
+            <tr>
+                <td>${ cs["name"] | h }</td>
+                <td>${ cs["hits"] }</td>
+                <td>${ cs["misses"] }</td>
+                <td>
+                    %if cs["hit_ratio"] is None:
+                        —
+                    %else:
+                        ${ "{:.1%}".format(cs["hit_ratio"]) }
+                    %endif
+                </td>
+            </tr>
+        %endfor
+    </table>
+%endif
+
 <h2>${_("Extra string families present")}</h2>
 %for sf in string_families:
     ${ sf | h }
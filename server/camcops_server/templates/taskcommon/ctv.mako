@@ -31,7 +31,7 @@ camcops_server/templates/taskcommon/ctv.mako
 <%!
 
 from cardinal_pythonlib.datetimefunc import format_datetime
-from camcops_server.cc_modules.cc_audit import audit
+from camcops_server.cc_modules.cc_audit import audit_task_access
 from camcops_server.cc_modules.cc_constants import DateFormat
 from camcops_server.cc_modules.cc_pyramid import Routes, ViewArg, ViewParam
 
@@ -57,6 +57,7 @@ from camcops_server.cc_modules.cc_pyramid import Routes, ViewArg, ViewParam
                            DateFormat.ISO8601_HUMANIZED_TO_MINUTES, default="−∞") }
     </div>
 
+    <% accessed_tasks = [] %>
     %for task in tracker.collection.all_tasks:
         <% ctvinfo_list = task.get_clinical_text(request) %>
 
@@ -131,18 +132,14 @@ from camcops_server.cc_modules.cc_pyramid import Routes, ViewArg, ViewParam
                 %endif
             %endfor
 
-            <%
-                audit(
-                    request,
-                    "Clinical text view accessed",
-                    table=task.tablename,
-                    server_pk=task.get_pk(),
-                    patient_server_pk=task.get_patient_server_pk()
-                )
-            %>
+            <% accessed_tasks.append(task) %>
         %endif
 
     %endfor
+    <%
+        audit_task_access(request, "Clinical text view accessed",
+                          accessed_tasks)
+    %>
 
     <div class="ctv_datelimit_end">
         ${_("End date/time for search:")}